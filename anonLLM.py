@@ -3,17 +3,25 @@ import dataclasses
 import os
 
 import yaml
-from pygit2 import Repository, GitError
 
-from src.data.main import data_main
-from src.evaluate.main import eval_main
-from src.model.main import model_main
-from src.utils import seed_everything, init_wandb, IndentedDumper
+from src import PROCESSED_DATA_DIR
 
-from src.yml_parse import parse_yml_config
+# heavy modules (torch, transformers, datasets, wandb...) are imported only after parsing args, and modules of
+# each phase only if that phase is performed, so that e.g. `--help` or `--validate-config` don't wait for them
+
+
+def get_git_branch() -> str | None:
+    from pygit2 import Repository, GitError
+
+    try:
+        return Repository('.').head.shorthand
+    except GitError:
+        return None
 
 
 def pretty_print_configuration(config: dict):
+    from src.utils import IndentedDumper
+
     print(" Experiment configuration ".center(80, "*"))
 
     print("\n" + "-" * 80)
@@ -48,13 +56,98 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Main script to reproduce perform the experiments')
 
     parser.add_argument('-c', '--config', default="params.yml", required=True, help='')
+    parser.add_argument('--validate-config', action='store_true',
+                        help='Only parse and validate the config, printing it, without performing any phase')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume the training phase from the last checkpoint saved in the model directory')
+    parser.add_argument('--from-predictions', action='store_true',
+                        help='Perform only the eval phase, computing metrics from the predictions saved by a '
+                             'previous evaluation rather than generating them again')
+
+    # modes which skip the usual phases to perform a single operation, only one of them can be requested
+    mode_group = parser.add_mutually_exclusive_group()
+
+    mode_group.add_argument('--compare-with', default=None, metavar='OTHER_EXP_NAME',
+                            help='Perform only a paired randomization test between the predictions saved by the '
+                                 'evaluation of this experiment and the ones of OTHER_EXP_NAME')
+    mode_group.add_argument('--serve', action='store_true',
+                            help='Skip all phases and serve recommendations online with the model trained by this '
+                                 'experiment, through an HTTP server')
+    parser.add_argument('--host', default='127.0.0.1', help='Host on which the server listens (with --serve)')
+    parser.add_argument('--port', type=int, default=8000, help='Port on which the server listens (with --serve)')
+    parser.add_argument('--max-batch-size', type=int, default=32,
+                        help='Max n° of concurrent requests generated together (with --serve)')
+    parser.add_argument('--max-wait-ms', type=float, default=10.,
+                        help='Max time in milliseconds that a request waits for other requests to be batched '
+                             'with (with --serve)')
+    parser.add_argument('--cache-size', type=int, default=10000,
+                        help='Max n° of prompts whose predictions are cached by the server, 0 disables the cache '
+                             '(with --serve)')
+    parser.add_argument('--cache-max-mb', type=float, default=100.,
+                        help='Max memory in MB occupied by the cache of the server (with --serve)')
+    parser.add_argument('--cache-ttl-s', type=float, default=600.,
+                        help='Seconds after which predictions cached by the server expire (with --serve)')
+    parser.add_argument('--max-body-mb', type=float, default=1.,
+                        help='Max size in MB of the body of a request, bigger requests are rejected (with --serve)')
+    mode_group.add_argument('--predict', action='store_true',
+                            help='Skip all phases and generate recommendations for all users with the model trained by '
+                                 'this experiment, saving them into a Parquet or JSONL file')
+    parser.add_argument('--predict-task', default=None,
+                        help='Task used to generate recommendations, by default the first eval task (with --predict)')
+    parser.add_argument('--predict-template', default=None,
+                        help='Template of the task used to generate recommendations, by default a random '
+                             'inference template for each user (with --predict)')
+    parser.add_argument('--predict-input', default=None,
+                        help='JSONL file where each line contains the fields required by the task for a user. By '
+                             'default, users of a split of the processed dataset are used (with --predict)')
+    parser.add_argument('--predict-split', default='test',
+                        help='Split of the processed dataset whose users are used, if no input file is '
+                             'specified (with --predict)')
+    parser.add_argument('--predict-output', default=None,
+                        help='Output file, .parquet or .jsonl. By default recommendations are saved into '
+                             'reports/recommendations/{exp_name}/{task}.parquet (with --predict)')
+    parser.add_argument('--top-k', type=int, default=None,
+                        help='N° of distinct items recommended to each user, by default all the items generated '
+                             '(with --predict)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='N° of worker processes, each one loading its own copy of the model (with --predict)')
+    mode_group.add_argument('--export', action='store_true',
+                            help='Skip all phases and export the model trained by this experiment into ONNX graphs, '
+                                 'which can be used for inference with onnxruntime only')
+    parser.add_argument('--export-dir', default=None,
+                        help='Output directory, by default models/{exp_name}/onnx (with --export)')
+    parser.add_argument('--opset', type=int, default=14,
+                        help='ONNX opset version of the exported graphs (with --export)')
+    mode_group.add_argument('--quantize', default=None, metavar='MODE',
+                            help='Skip all phases, quantize the model trained by this experiment for inference on cpu '
+                                 '(MODE is int8, int8_weight_only or int4_weight_only) and report how metrics on the '
+                                 'validation split change with respect to the original model')
+    parser.add_argument('--quantize-output', default=None,
+                        help='Output directory of the quantized model, by default '
+                             'models/{exp_name}/quantized_{quantize} (with --quantize)')
 
     # will first parse args from yml file, and if same are passed via cmd,
     # those passed via cmd will prevail
     args = parser.parse_args()
 
+    import torch.distributed
+
+    from src.utils import seed_everything, init_wandb, init_distributed, is_main_process, barrier
+    from src.yml_parse import parse_yml_config
+
+    if args.quantize is not None:
+        from src.model.quantization import QUANTIZATION_MODES
+
+        if args.quantize not in QUANTIZATION_MODES:
+            parser.error(f"argument --quantize: invalid choice: '{args.quantize}' (choose from {QUANTIZATION_MODES})")
+
     general_params, data_params, model_params, eval_params = parse_yml_config(args.config)
 
+    # when launched via torchrun with more than one process, training and evaluation are distributed.
+    # Only the main process prepares the data and logs to wandb
+    general_params.device = init_distributed(general_params.device)
+    general_params.log_wandb = general_params.log_wandb and is_main_process()
+
     if general_params.log_wandb:
 
         if 'WANDB_API_KEY' not in os.environ:
@@ -68,12 +161,6 @@ if __name__ == '__main__':
     # this is the config dict that will be logged to wandb
     # apart from the params read from yml file, log env variables needed for reproducibility and
     # also the current active branch in which experiment is being performed (if the project is in a git directory)
-
-    try:
-        git_branch = Repository('.').head.shorthand
-    except GitError:
-        git_branch = None
-
     config_args = {
         "general_params": dataclasses.asdict(general_params),
         "data_params": dataclasses.asdict(data_params),
@@ -81,34 +168,123 @@ if __name__ == '__main__':
         "eval_params": dataclasses.asdict(eval_params),
         "PYTHONHASHSEED": os.environ.get("PYTHONHASHSEED"),
         "CUBLAS_WORKSPACE_CONFIG": os.environ.get("CUBLAS_WORKSPACE_CONFIG"),
-        "git_branch": git_branch
+        "git_branch": get_git_branch()
     }
 
-    pretty_print_configuration(config_args)
+    if is_main_process():
+        pretty_print_configuration(config_args)
+
+    if args.validate_config:
+        print(f"# Config {args.config} is valid!")
+        raise SystemExit(0)
+
+    if general_params.instrument:
+        from src.instrumentation import INSTRUMENTATION
+
+        INSTRUMENTATION.enable()
 
     with init_wandb(project=general_params.wandb_project, name=general_params.exp_name, config=config_args,
                     should_log=general_params.log_wandb):
 
-        if not general_params.eval_only:
+        if (not general_params.eval_only and not args.from_predictions and args.compare_with is None
+                and not args.serve and not args.predict and not args.export and args.quantize is None):
 
-            print(" DATA ".center(80, "*"))
+            # when resuming, the data phase is skipped if the processed dataset was already saved
+            processed_data_dir = os.path.join(PROCESSED_DATA_DIR, general_params.exp_name)
+            if args.resume and os.path.isdir(processed_data_dir) and len(os.listdir(processed_data_dir)) != 0:
+                print(f"# Resuming experiment, processed dataset found in {processed_data_dir}")
 
-            # at start of each main phase, we re-initialize the state
-            seed_everything(general_params.random_seed)
-            data_main(general_params, data_params)
+            elif is_main_process():
+                from src.data.main import data_main
+
+                print(" DATA ".center(80, "*"))
+
+                # at start of each main phase, we re-initialize the state
+                seed_everything(general_params.random_seed)
+                data_main(general_params, data_params)
+
+            # other processes wait for the processed dataset to be saved
+            barrier()
 
             print()  # simple newline
 
+            from src.model.main import model_main
+
             print(" MODEL ".center(80, "*"))
 
             # at start of each main phase, we re-initialize the state
             seed_everything(general_params.random_seed)
-            model_main(general_params, data_params, model_params)
+            model_main(general_params, data_params, model_params, resume=args.resume)
 
             print()  # simple newline
 
-        print(" EVAL ".center(80, "*"))
+        if args.compare_with is not None:
+            from src.evaluate.main import compare_main
+
+            print(" COMPARISON ".center(80, "*"))
+
+            compare_main(general_params, eval_params, other_exp_name=args.compare_with)
+
+        elif args.serve:
+            from src.serve.main import serve_main
+
+            print(" SERVE ".center(80, "*"))
+
+            seed_everything(general_params.random_seed)
+            serve_main(general_params, model_params, host=args.host, port=args.port,
+                       max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                       cache_size=args.cache_size, cache_max_mb=args.cache_max_mb, cache_ttl_seconds=args.cache_ttl_s,
+                       max_body_mb=args.max_body_mb)
+
+        elif args.predict:
+            from src.serve.main import predict_main
+
+            print(" PREDICT ".center(80, "*"))
+
+            # template ids are integers for most tasks, but they can also be strings (e.g. "2-1")
+            predict_template = args.predict_template
+            if predict_template is not None and predict_template.isdigit():
+                predict_template = int(predict_template)
+
+            seed_everything(general_params.random_seed)
+            predict_main(general_params, data_params, model_params, eval_params,
+                         task_str=args.predict_task, template_id=predict_template, input_path=args.predict_input,
+                         split=args.predict_split, output_path=args.predict_output, top_k=args.top_k,
+                         n_workers=args.workers)
+
+        elif args.export:
+            from src.serve.main import export_main
+
+            print(" EXPORT ".center(80, "*"))
+
+            export_main(general_params, model_params, output_dir=args.export_dir, opset_version=args.opset)
+
+        elif args.quantize is not None:
+            from src.evaluate.main import quantize_main
+
+            print(" QUANTIZE ".center(80, "*"))
+
+            quantize_main(general_params, data_params, model_params, eval_params, quantize=args.quantize,
+                          output_dir=args.quantize_output)
+
+        else:
+            from src.evaluate.main import eval_main
+
+            print(" EVAL ".center(80, "*"))
+
+            # at start of each main phase, we re-initialize the state
+            seed_everything(general_params.random_seed)
+            eval_main(general_params, data_params, model_params, eval_params,
+                      from_predictions=args.from_predictions)
+
+        # stats of each process are different in distributed mode, only the ones of the main process are reported
+        if general_params.instrument and is_main_process():
+            from src import INSTRUMENTATION_DIR
+
+            print(" INSTRUMENTATION ".center(80, "*"))
+
+            INSTRUMENTATION.report(os.path.join(INSTRUMENTATION_DIR, f"{general_params.exp_name}.json"),
+                                   should_log=general_params.log_wandb)
 
-        # at start of each main phase, we re-initialize the state
-        seed_everything(general_params.random_seed)
-        eval_main(general_params, data_params, model_params, eval_params)
+    if torch.distributed.is_initialized():
+        torch.distributed.destroy_process_group()
@@ -0,0 +1,438 @@
+from __future__ import annotations
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Callable
+from unittest.mock import patch
+
+import numpy as np
+
+from src import REPORTS_DIR, ROOT_PATH
+from benchmarks.synthetic_amazon import write_raw_amazon_dataset, build_tiny_model, tokenizer_corpus
+
+BENCHMARKS_DIR = os.path.join(REPORTS_DIR, "benchmarks")
+
+
+def current_rss_mb() -> float:
+    # /proc is available only on linux, elsewhere the max rss reached so far is the best estimate available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss / 2 ** 20 if platform.system() == "Darwin" else max_rss / 2 ** 10
+
+
+class PeakRssSampler:
+    """
+    Samples the resident memory of the process every `interval_s` seconds on a background thread, keeping the max
+    value observed between `__enter__` and `__exit__` (memory allocated by torch is not seen by tracemalloc)
+    """
+
+    def __init__(self, interval_s: float = 0.005):
+        self.interval_s = interval_s
+        self.start_mb = None
+        self.peak_mb = None
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+    def __enter__(self):
+        self.start_mb = self.peak_mb = current_rss_mb()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+        self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+
+def measure_stage(stage_fn: Callable[[], tuple[object, int, int | None]], repeats: int = 3,
+                  trace_python_memory: bool = True) -> tuple[object, dict]:
+    """
+    Runs `stage_fn` `repeats` times measuring its wall time and the peak resident memory of the process, plus one
+    additional time with tracemalloc enabled to measure the peak of memory allocated by python objects
+
+    Args:
+        stage_fn: function which performs the stage and returns its output, the n° of samples processed and the
+            n° of tokens processed (None if the stage doesn't process tokens)
+        repeats: n° of timed runs
+        trace_python_memory: if False, the additional run with tracemalloc is not performed
+
+    Returns:
+        output of the last run of `stage_fn` and stats of the stage
+    """
+
+    wall_times = []
+    with PeakRssSampler() as rss_sampler:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            output, n_samples, n_tokens = stage_fn()
+            wall_times.append(time.perf_counter() - start)
+
+    best_wall_time = min(wall_times)
+    stats = {
+        "n_samples": n_samples,
+        "wall_s_mean": float(np.mean(wall_times)),
+        "wall_s_min": best_wall_time,
+        "wall_s_std": float(np.std(wall_times)),
+        "samples_per_s": n_samples / best_wall_time if best_wall_time > 0 else None,
+        "rss_start_mb": rss_sampler.start_mb,
+        "rss_peak_mb": rss_sampler.peak_mb,
+        "rss_peak_increase_mb": rss_sampler.peak_mb - rss_sampler.start_mb
+    }
+
+    if n_tokens is not None:
+        stats["n_tokens"] = n_tokens
+        stats["tokens_per_s"] = n_tokens / best_wall_time if best_wall_time > 0 else None
+
+    if trace_python_memory:
+        tracemalloc.start()
+        output, _, _ = stage_fn()
+        _, python_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stats["python_peak_mb"] = python_peak / 2 ** 20
+
+    return output, stats
+
+
+def n_tokens_of(batch: dict) -> int:
+    # n° of tokens which are not padding, models name their attention masks differently (e.g. GPT2Rec
+    # tokenizes prompt and prompt + target separately during training)
+    for mask_name in ("total_attention_mask", "attention_mask", "input_prompt_attention_mask"):
+        if mask_name in batch:
+            attention_mask = batch[mask_name]
+            return int(attention_mask.sum()) if hasattr(attention_mask, "sum") else sum(map(sum, attention_mask))
+
+    raise KeyError("No attention mask found in the batch!")
+
+
+def benchmark_pipeline(raw_data_dir: str, dataset_name: str, model_cls_name: str, model_path: str,
+                       batch_size: int = 32, max_train_batches: int = 20, max_eval_batches: int = 5,
+                       repeats: int = 3, trace_python_memory: bool = True, model_kwargs: dict = None) -> dict:
+    """
+    Performs each stage of the pipeline on the raw Amazon-shaped dataset in `raw_data_dir`, with the same calls
+    performed by the data phase, `RecTrainer` and `RecEvaluator`, and returns the stats of each stage
+
+    Args:
+        raw_data_dir: directory which plays the role of `RAW_DATA_DIR` (see `write_raw_amazon_dataset()`)
+        dataset_name: name of the dataset in `raw_data_dir`
+        model_cls_name: name of the model benchmarked (e.g. "T5Rec")
+        model_path: `name_or_path` of the model
+        batch_size: batch size used for training and generation
+        max_train_batches: n° of batches on which `train_step` is benchmarked
+        max_eval_batches: n° of batches on which `generate_step` is benchmarked
+        repeats: n° of timed runs of each stage
+        trace_python_memory: if True, each stage is performed once more to measure python memory with tracemalloc
+        model_kwargs: additional parameters of the model (e.g. `num_beams`)
+
+    Returns:
+        dict with the stats of each stage
+    """
+
+    from src.data.datasets import amazon_dataset
+    from src.data.datasets.amazon_dataset import AmazonDataset, parse
+    from src.evaluate.evaluator import RecEvaluator
+    from src.evaluate.metrics.ranking_metrics import Hit, NDCG, MRR
+    from src.model import AnonModel
+    from src.utils import dict_list2list_dict
+
+    def stage(name: str, stage_fn: Callable[[], tuple[object, int, int | None]]):
+        print(f"# Benchmarking {name}")
+        output, stats[name] = measure_stage(stage_fn, repeats=repeats, trace_python_memory=trace_python_memory)
+        return output
+
+    stats = {}
+
+    meta_path = os.path.join(raw_data_dir, "AmazonDataset", dataset_name, "meta.json.gz")
+
+    def meta_parsing():
+        meta_dict = {meta_content["asin"]: meta_content for meta_content in parse(meta_path)}
+        return meta_dict, len(meta_dict), None
+
+    stage("meta_parsing", meta_parsing)
+
+    def dataset_init():
+        with patch.object(amazon_dataset, "RAW_DATA_DIR", raw_data_dir):
+            ds = AmazonDataset(dataset_name=dataset_name)
+        return ds, len(ds.original_df), None
+
+    ds = stage("dataset_init", dataset_init)
+    n_users = len(ds.all_users)
+
+    stage("split_data", lambda: (ds.split_data(ds.original_df), n_users, None))
+
+    hf_datasets = stage("get_hf_datasets", lambda: (ds.get_hf_datasets(), n_users, None))
+    train_ds, val_ds = hf_datasets["train"], hf_datasets["validation"]
+
+    def sample_train_sequence():
+        sampled_train = train_ds.map(ds.sample_train_sequence, remove_columns=train_ds.column_names,
+                                     keep_in_memory=True, load_from_cache_file=False, batched=True)
+        return sampled_train, sampled_train.num_rows, None
+
+    sampled_train = stage("sample_train_sequence", sample_train_sequence)
+
+    rec_model = AnonModel.from_string(model_cls_name, dataset_obj=ds, name_or_path=model_path,
+                                      training_tasks_str=["SequentialSideInfoTask"],
+                                      eval_task_str="SequentialSideInfoTask", **(model_kwargs or {}))
+    rec_model.to("cpu")
+    rec_model.train()
+
+    train_samples = dict_list2list_dict(sampled_train[:])
+
+    def task_templating():
+        n_prompts = 0
+        for sample in train_samples:
+            for task in rec_model.training_tasks:
+                n_prompts += len(task(items_meta_dict=rec_model.items_meta_dict,
+                                      catalog_items=rec_model.all_unique_labels, **sample))
+        return None, n_prompts, None
+
+    stage("task_templating", task_templating)
+
+    def tokenize():
+        preprocessed_train = sampled_train.map(rec_model.tokenize, remove_columns=sampled_train.column_names,
+                                               keep_in_memory=True, load_from_cache_file=False, batched=True)
+        preprocessed_train.set_format("torch")
+
+        return preprocessed_train, preprocessed_train.num_rows, None
+
+    preprocessed_train = stage("tokenize", tokenize)
+
+    # tokens are counted outside of the timed function, since counting them requires reading the whole set
+    stats["tokenize"]["n_tokens"] = n_tokens_of(preprocessed_train.with_format(None)[:])
+    stats["tokenize"]["tokens_per_s"] = stats["tokenize"]["n_tokens"] / stats["tokenize"]["wall_s_min"]
+
+    train_batches = list(itertools.islice(preprocessed_train.iter(batch_size=batch_size), max_train_batches))
+    n_train_samples = sum(len(next(iter(batch.values()))) for batch in train_batches)
+
+    def prepare_input():
+        prepared_batches = [rec_model.prepare_input(batch) for batch in train_batches]
+        n_tokens = sum(n_tokens_of(prepared_batch) for prepared_batch in prepared_batches)
+        return prepared_batches, n_train_samples, n_tokens
+
+    prepared_train_batches = stage("prepare_input", prepare_input)
+
+    optimizer = rec_model.get_suggested_optimizer
+
+    def train_step():
+        for prepared_batch in prepared_train_batches:
+            optimizer.zero_grad()
+
+            loss = rec_model.train_step(prepared_batch)
+
+            loss.backward()
+            optimizer.step()
+
+        n_tokens = sum(n_tokens_of(prepared_batch) for prepared_batch in prepared_train_batches)
+        return None, n_train_samples, n_tokens
+
+    stage("train_step", train_step)
+
+    rec_model.eval()
+
+    preprocessed_val = val_ds.map(rec_model.tokenize, remove_columns=val_ds.column_names, keep_in_memory=True,
+                                  load_from_cache_file=False, batched=True)
+    preprocessed_val.set_format("torch")
+
+    val_batches = list(itertools.islice(preprocessed_val.iter(batch_size=batch_size), max_eval_batches))
+
+    def generate_step():
+        predictions = []
+        n_tokens = 0
+        for batch in val_batches:
+            # generate_step pops fields from the batch, so each run receives a new one
+            prepared_batch = rec_model.prepare_input(dict(batch))
+            n_tokens += n_tokens_of(prepared_batch)
+
+            batch_predictions, _, _ = rec_model.generate_step(prepared_batch)
+            predictions.extend(batch_predictions)
+
+        return predictions, len(predictions), n_tokens
+
+    predictions = stage("generate_step", generate_step)
+
+    # metrics are computed on all the users of the validation set, with random predictions with the same
+    # shape of the ones generated by the model
+    n_predictions = len(predictions[0])
+    truths = val_ds["gt_item"]
+    random_predictions = np.random.default_rng(42).choice(np.array(rec_model.all_unique_labels, dtype=str),
+                                                          size=(len(truths), n_predictions))
+    metric_list = [Hit(k=n_predictions), NDCG(k=n_predictions), MRR(k=n_predictions)]
+
+    stage("compute_metrics", lambda: (RecEvaluator._compute_metrics(random_predictions, truths, metric_list),
+                                      len(truths), None))
+
+    return stats
+
+
+def get_git_revision() -> str | None:
+    from pygit2 import Repository, GitError
+
+    try:
+        return str(Repository(ROOT_PATH).head.target)
+    except GitError:
+        return None
+
+
+def print_comparison(results: dict, baseline: dict):
+    """
+    Prints, for each run of `results` whose params are also in `baseline`, the ratio between the best wall time of
+    each stage and the one of the baseline (< 1 means faster than the baseline)
+    """
+
+    baseline_runs = {json.dumps(run["params"], sort_keys=True): run for run in baseline["runs"]}
+
+    print(f" COMPARISON WITH {baseline['git_revision']} ".center(80, "*"))
+    for run in results["runs"]:
+        baseline_run = baseline_runs.get(json.dumps(run["params"], sort_keys=True))
+        if baseline_run is None:
+            print(f"# No baseline run with params {run['params']}")
+            continue
+
+        print(f"# Params: {run['params']}")
+        for stage_name, stage_stats in run["stages"].items():
+            baseline_stats = baseline_run["stages"].get(stage_name)
+            if baseline_stats is None:
+                continue
+
+            ratio = stage_stats["wall_s_min"] / baseline_stats["wall_s_min"]
+            print(f"{stage_name:>25}: {baseline_stats['wall_s_min']:.4f}s -> {stage_stats['wall_s_min']:.4f}s "
+                  f"({ratio:.2f}x)")
+
+
+def print_results(run: dict):
+
+    print(f" RESULTS {run['params']} ".center(80, "*"))
+    print(f"{'stage':>25} {'wall s (min)':>14} {'samples/s':>12} {'tokens/s':>12} {'rss peak MB':>12} "
+          f"{'py peak MB':>11}")
+
+    for stage_name, stage_stats in run["stages"].items():
+        samples_per_s = stage_stats["samples_per_s"] or float("nan")
+        tokens_per_s = stage_stats.get("tokens_per_s") or float("nan")
+        python_peak_mb = stage_stats.get("python_peak_mb", float("nan"))
+
+        print(f"{stage_name:>25} {stage_stats['wall_s_min']:>14.4f} {samples_per_s:>12.1f} {tokens_per_s:>12.1f} "
+              f"{stage_stats['rss_peak_mb']:>12.1f} {python_peak_mb:>11.1f}")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Times and memory-profiles each stage of the pipeline on synthetic '
+                                                 'Amazon-shaped datasets, without downloading anything')
+
+    parser.add_argument('--n-users', type=int, nargs='+', default=[1000],
+                        help='N° of users of the synthetic dataset, more values to benchmark each of them')
+    parser.add_argument('--n-items', type=int, nargs='+', default=[500],
+                        help='N° of items of the catalog of the synthetic dataset, more values to benchmark each '
+                             'of them')
+    parser.add_argument('--history-length', type=int, nargs='+', default=[8],
+                        help='Mean n° of interactions of each user, more values to benchmark each of them')
+    parser.add_argument('--model', default='T5Rec', choices=['T5Rec', 'GPT2Rec'], help='Model benchmarked')
+    parser.add_argument('--name-or-path', default=None,
+                        help='Pretrained model to benchmark. By default a tiny randomly initialized model is built')
+    parser.add_argument('--batch-size', type=int, default=32, help='Batch size of training and generation')
+    parser.add_argument('--max-train-batches', type=int, default=20,
+                        help='N° of batches on which train_step is benchmarked')
+    parser.add_argument('--max-eval-batches', type=int, default=5,
+                        help='N° of batches on which generate_step is benchmarked')
+    parser.add_argument('--num-beams', type=int, default=5, help='N° of beams used by generate_step')
+    parser.add_argument('--max-new-tokens', type=int, default=10,
+                        help='Max n° of tokens generated by generate_step: randomly initialized models rarely '
+                             'generate the eos token, so each prediction is usually this long')
+    parser.add_argument('--repeats', type=int, default=3, help='N° of timed runs of each stage')
+    parser.add_argument('--no-tracemalloc', action='store_true',
+                        help='Don\'t run each stage once more with tracemalloc to measure python memory')
+    parser.add_argument('--seed', type=int, default=42, help='Seed used to generate data and to run stages')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Output JSON file, by default reports/benchmarks/{git revision}_{timestamp}.json')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON file of a previous benchmark (e.g. of another commit) to compare results with')
+
+    args = parser.parse_args()
+
+    from src.utils import seed_everything
+
+    git_revision = get_git_revision()
+    results = {
+        "git_revision": git_revision,
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "runs": []
+    }
+
+    for n_users, n_items, history_length in itertools.product(args.n_users, args.n_items, args.history_length):
+        params = {"model": args.model, "name_or_path": args.name_or_path, "n_users": n_users, "n_items": n_items,
+                  "history_length": history_length, "batch_size": args.batch_size,
+                  "max_train_batches": args.max_train_batches, "max_eval_batches": args.max_eval_batches,
+                  "num_beams": args.num_beams, "max_new_tokens": args.max_new_tokens}
+
+        print(f" BENCHMARK {params} ".center(80, "*"))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            seed_everything(args.seed)
+
+            dataset_dir = write_raw_amazon_dataset(tmp_dir, n_users=n_users, n_items=n_items,
+                                                   history_length=history_length, seed=args.seed)
+
+            model_path = args.name_or_path
+            if model_path is None:
+                model_path = build_tiny_model(os.path.join(tmp_dir, "model"), args.model,
+                                              corpus=tokenizer_corpus(dataset_dir))
+
+            num_return_sequences = min(args.num_beams, 10)
+            stages = benchmark_pipeline(tmp_dir, "synthetic", args.model, model_path,
+                                        batch_size=args.batch_size, max_train_batches=args.max_train_batches,
+                                        max_eval_batches=args.max_eval_batches, repeats=args.repeats,
+                                        trace_python_memory=not args.no_tracemalloc,
+                                        model_kwargs={"num_beams": args.num_beams,
+                                                      "num_return_sequences": num_return_sequences,
+                                                      "max_new_tokens": args.max_new_tokens})
+
+        run = {"params": params, "stages": stages}
+        results["runs"].append(run)
+
+        print_results(run)
+
+    output_path = args.output
+    if output_path is None:
+        revision_prefix = git_revision[:8] if git_revision is not None else "nogit"
+        output_path = os.path.join(BENCHMARKS_DIR,
+                                   f"{revision_prefix}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"# Benchmark results saved into {output_path}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        print_comparison(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import gzip
+import json
+import os
+import pickle
+
+import numpy as np
+
+from src.data.datasets.synthetic_dataset import ITEM_WORDS, ITEM_BRANDS
+
+# categories of synthetic items, titles, descriptions and brands share the vocabulary of SyntheticDataset
+_CATEGORIES = ("Toys & Games", "Games", "Puzzles", "Dolls & Accessories", "Vehicles", "Arts & Crafts", "Learning",
+               "Outdoor Play", "Baby & Toddler", "Building Toys", "Novelty", "Electronics for Kids")
+
+
+def write_raw_amazon_dataset(output_dir: str,
+                             dataset_name: str = "synthetic",
+                             n_users: int = 1000,
+                             n_items: int = 500,
+                             history_length: int = 8,
+                             zipf_exponent: float = 1.,
+                             seed: int = 42) -> str:
+    """
+    Writes raw files with the same format of the ones of the Amazon dataset (`datamaps.json`, `user_id2name.pkl`,
+    `sequential_data.txt`, `rating_splits_augmented.pkl` and `meta.json.gz`) into
+    `{output_dir}/AmazonDataset/{dataset_name}`, so that `AmazonDataset` can parse them as it parses the real ones
+
+    Args:
+        output_dir: directory which plays the role of `RAW_DATA_DIR`
+        dataset_name: name of the dataset, to pass as `dataset_name` to `AmazonDataset`
+        n_users: n° of users
+        n_items: n° of items of the catalog
+        history_length: mean n° of interactions of each user. Each user has at least 4 interactions, so that
+            train, validation and test sets are never empty
+        zipf_exponent: items are drawn with probability proportional to 1 / rank^zipf_exponent
+        seed: seed of the random generator
+
+    Returns:
+        the directory where raw files have been written
+    """
+
+    rng = np.random.default_rng(seed)
+    dataset_dir = os.path.join(output_dir, "AmazonDataset", dataset_name)
+    os.makedirs(dataset_dir, exist_ok=True)
+
+    # string ids (ASIN) and integer ids as in the original datamaps, integer ids start from 1
+    user_asins = [f"A{user_idx:013d}" for user_idx in range(1, n_users + 1)]
+    item_asins = [f"B{item_idx:09d}" for item_idx in range(1, n_items + 1)]
+
+    datamaps = {
+        "user2id": {asin: str(user_idx) for user_idx, asin in enumerate(user_asins, start=1)},
+        "item2id": {asin: str(item_idx) for item_idx, asin in enumerate(item_asins, start=1)},
+        "id2user": {str(user_idx): asin for user_idx, asin in enumerate(user_asins, start=1)},
+        "id2item": {str(item_idx): asin for item_idx, asin in enumerate(item_asins, start=1)},
+    }
+    with open(os.path.join(dataset_dir, "datamaps.json"), "w") as f:
+        json.dump(datamaps, f)
+
+    user_id2name = {str(user_idx): f"User {user_idx}" for user_idx in range(1, n_users + 1)}
+    with open(os.path.join(dataset_dir, "user_id2name.pkl"), "wb") as f:
+        pickle.dump(user_id2name, f)
+
+    item_popularity = 1 / np.arange(1, n_items + 1) ** zipf_exponent
+    item_popularity /= item_popularity.sum()
+
+    history_lengths = np.maximum(rng.poisson(history_length, size=n_users), 4)
+
+    ratings = []
+    with open(os.path.join(dataset_dir, "sequential_data.txt"), "w") as f:
+        for user_idx, user_history_length in enumerate(history_lengths, start=1):
+            item_ids = rng.choice(n_items, size=user_history_length, p=item_popularity) + 1
+
+            f.write(" ".join([str(user_idx), *map(str, item_ids)]) + "\n")
+
+            ratings.extend({"reviewerID": user_asins[user_idx - 1], "asin": item_asins[item_id - 1],
+                            "overall": float(rating)}
+                           for item_id, rating in zip(item_ids, rng.integers(1, 6, size=user_history_length)))
+
+    # original ratings are split in train/val/test, but AmazonDataset considers all of them
+    with open(os.path.join(dataset_dir, "rating_splits_augmented.pkl"), "wb") as f:
+        pickle.dump({"train": ratings, "val": [], "test": []}, f)
+
+    # each line of the original meta file is the repr of a python dict
+    with gzip.open(os.path.join(dataset_dir, "meta.json.gz"), "wt") as f:
+        for item_idx, asin in enumerate(item_asins):
+            title_words = rng.choice(ITEM_WORDS, size=rng.integers(2, 6))
+            meta_content = {
+                "asin": asin,
+                "title": " ".join(title_words).title(),
+                "description": " ".join(rng.choice(ITEM_WORDS, size=rng.integers(10, 40))).capitalize() + ".",
+                "price": round(float(rng.uniform(1, 100)), 2),
+                "imUrl": f"http://ecx.images-amazon.com/images/I/{asin}.jpg",
+                "brand": str(rng.choice(ITEM_BRANDS)),
+                "categories": [["Toys & Games", *rng.choice(_CATEGORIES, size=rng.integers(1, 4), replace=False)]]
+            }
+            f.write(repr(meta_content) + "\n")
+
+    return dataset_dir
+
+
+def tokenizer_corpus(dataset_dir: str) -> list[str]:
+    """
+    Texts on which the tokenizer of a tiny model is trained: prompts of the tasks contain item ids (with the
+    "item_" prefix added by `AmazonDataset`), metadata of items and the text of the templates
+    """
+
+    from src.data.abstract_task import AnonTask
+
+    with open(os.path.join(dataset_dir, "sequential_data.txt")) as f:
+        corpus = [" ".join(f"item_{item_id}" for item_id in line.split()[1:]) for line in f]
+
+    corpus.append(" ".join(ITEM_WORDS + _CATEGORIES + ITEM_BRANDS))
+    corpus.extend(f"{input_text} {target_text}"
+                  for task_cls in AnonTask.all_tasks_available()
+                  for input_text, target_text in task_cls.templates_dict.values())
+
+    return corpus
+
+
+def build_tiny_model(output_dir: str, model_cls_name: str, corpus: list[str], d_model: int = 64, n_layers: int = 2,
+                     vocab_size: int = 2000) -> str:
+    """
+    Saves into `output_dir` a randomly initialized model (with its tokenizer trained on `corpus`) which can be used
+    as `name_or_path` of `model_cls_name`, so that benchmarks run offline without downloading any checkpoint
+
+    Args:
+        output_dir: directory where the model and the tokenizer are saved
+        model_cls_name: "T5Rec" or "GPT2Rec"
+        corpus: texts on which the tokenizer is trained (e.g. prompts of the tasks used)
+        d_model: hidden size of the model
+        n_layers: n° of layers of the model (of both encoder and decoder for T5)
+        vocab_size: size of the vocabulary of the tokenizer
+
+    Returns:
+        `output_dir`
+    """
+
+    from tokenizers import Tokenizer, models, pre_tokenizers, trainers, decoders, processors
+    from transformers import (T5Config, T5ForConditionalGeneration, T5TokenizerFast,
+                              GPT2Config, GPT2LMHeadModel, GPT2TokenizerFast)
+
+    if model_cls_name.lower() == "t5rec":
+        raw_tokenizer = Tokenizer(models.Unigram())
+        raw_tokenizer.pre_tokenizer = pre_tokenizers.Metaspace()
+        raw_tokenizer.decoder = decoders.Metaspace()
+        raw_tokenizer.train_from_iterator(corpus, trainers.UnigramTrainer(vocab_size=vocab_size,
+                                                                          special_tokens=["<pad>", "</s>", "<unk>"],
+                                                                          unk_token="<unk>"))
+        raw_tokenizer.post_processor = processors.TemplateProcessing(
+            single="$A </s>", pair="$A </s> $B </s>", special_tokens=[("</s>", raw_tokenizer.token_to_id("</s>"))]
+        )
+
+        tokenizer = T5TokenizerFast(tokenizer_object=raw_tokenizer, pad_token="<pad>", eos_token="</s>",
+                                    unk_token="<unk>", extra_ids=0, model_max_length=512)
+        config = T5Config(vocab_size=len(tokenizer), d_model=d_model, d_kv=d_model // 4, d_ff=d_model * 4,
+                          num_layers=n_layers, num_heads=4, decoder_start_token_id=tokenizer.pad_token_id,
+                          pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id)
+        model = T5ForConditionalGeneration(config)
+
+    elif model_cls_name.lower() == "gpt2rec":
+        raw_tokenizer = Tokenizer(models.BPE())
+        raw_tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+        raw_tokenizer.decoder = decoders.ByteLevel()
+        bpe_trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=["<|endoftext|>"],
+                                          initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+        raw_tokenizer.train_from_iterator(corpus, bpe_trainer)
+
+        tokenizer = GPT2TokenizerFast(tokenizer_object=raw_tokenizer, bos_token="<|endoftext|>",
+                                      eos_token="<|endoftext|>", unk_token="<|endoftext|>", model_max_length=1024)
+        config = GPT2Config(vocab_size=len(tokenizer), n_embd=d_model, n_layer=n_layers, n_head=4, n_positions=1024,
+                            bos_token_id=tokenizer.eos_token_id, eos_token_id=tokenizer.eos_token_id)
+        model = GPT2LMHeadModel(config)
+
+    else:
+        raise ValueError(f"Tiny models can be built only for T5Rec and GPT2Rec, not for {model_cls_name}!")
+
+    model.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+
+    return output_dir
@@ -18,6 +18,9 @@ PROCESSED_DATA_DIR = os.path.join(DATA_DIR, "processed")
 MODELS_DIR = os.path.join(ROOT_PATH, "models")
 REPORTS_DIR = os.path.join(ROOT_PATH, "reports")
 METRICS_DIR = os.path.join(REPORTS_DIR, "metrics")
+PREDICTIONS_DIR = os.path.join(REPORTS_DIR, "predictions")
+RECOMMENDATIONS_DIR = os.path.join(REPORTS_DIR, "recommendations")
+INSTRUMENTATION_DIR = os.path.join(REPORTS_DIR, "instrumentation")
 
 
 @dataclass
@@ -28,6 +31,7 @@ class GeneralParams:
     log_wandb: bool = False
     wandb_project: str = None
     eval_only: bool = False
+    instrument: bool = False
 
     @classmethod
     def from_parse(cls, general_section):
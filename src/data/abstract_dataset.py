@@ -2,13 +2,15 @@ from __future__ import annotations
 
 import inspect
 from abc import ABC, abstractmethod
-from typing import Dict, Tuple
+from typing import Dict, Tuple, TYPE_CHECKING
 
-import datasets
 import numpy as np
 import pandas as pd
 from requests.structures import CaseInsensitiveDict
 
+if TYPE_CHECKING:
+    import datasets
+
 
 class AnonDataset(ABC):
 
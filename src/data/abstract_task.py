@@ -22,6 +22,10 @@ class AnonTask(ABC):
     # class attribute since if the model is in training mode, all tasks should be in training mode
     training: bool = False
 
+    # ground truth fields which also appear in the inference prompt (e.g. the item whose rating should be predicted,
+    # or the target item listed among the candidates), thus they must be known at inference time
+    prompt_gt_fields: tuple[str, ...] = ()
+
     # automatically called on subclass definition, will populate the str_alias_cls dict
     def __init_subclass__(cls, **kwargs):
 
@@ -120,6 +124,10 @@ class TaskOutput:
     target_text: str
     ground_truth_for_eval: list[str] = None
 
+    # items listed in the input text among which the target should be chosen (e.g. for Direct tasks), so that
+    # models can rank them rather than generating freely. None if the input text does not list any candidate
+    candidates: list[str] = None
+
     # iter just so that this class can be unpacked,
     # e.g. input_prompt, target_text, gt = TaskOutput(...)
     def __iter__(self):
@@ -8,18 +8,17 @@ import random
 import zipfile
 from collections import Counter
 from functools import cached_property
-from typing import Literal, Dict
+from typing import Literal, Dict, TYPE_CHECKING
 
-import datasets
-import gdown
 import pandas as pd
-from datasets import Dataset
-from gdown.exceptions import FileURLRetrievalError
 
 from src import RAW_DATA_DIR
 from src.data.abstract_dataset import AnonDataset
 from src.utils import dict_list2list_dict, list_dict2dict_list, PrintWithSpin
 
+if TYPE_CHECKING:
+    import datasets
+
 
 def parse(path):
     with gzip.open(path, 'r') as g:
@@ -155,6 +154,10 @@ class AmazonDataset(AnonDataset):
         if not os.path.isdir(raw_data_folder_out):
 
             if not os.path.isfile(raw_data_zip_path):
+                # imported only when the dataset must be downloaded
+                import gdown
+                from gdown.exceptions import FileURLRetrievalError
+
                 print("# Downloading raw Amazon Dataset:")
 
                 try:
@@ -377,6 +380,9 @@ class AmazonDataset(AnonDataset):
         return user_items
 
     def get_hf_datasets(self, merge_train_val: bool = False) -> Dict[str, datasets.Dataset]:
+        # imported here since importing it takes a long time, and it's not needed e.g. to validate a config
+        import datasets
+        from datasets import Dataset
 
         train_df = self.train_df
         val_df = self.val_df
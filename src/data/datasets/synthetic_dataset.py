@@ -0,0 +1,313 @@
+from __future__ import annotations
+
+import os
+import pickle
+import random
+from functools import cached_property
+from typing import Dict, TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from src.data.abstract_dataset import AnonDataset
+from src.utils import dict_list2list_dict, list_dict2dict_list, PrintWithSpin
+
+if TYPE_CHECKING:
+    import datasets
+
+# words and brands used to build metadata of synthetic items, shared with the raw files written by benchmarks
+ITEM_WORDS = ("toy", "game", "puzzle", "doll", "car", "robot", "block", "ball", "card", "kit", "set", "board", "plush",
+              "train", "lego", "art", "craft", "book", "music", "science", "outdoor", "water", "baby", "classic",
+              "mini", "deluxe", "wooden", "magnetic", "electronic", "creative", "adventure", "family", "junior", "pro")
+ITEM_BRANDS = ("Hasbro", "Mattel", "LEGO", "Melissa & Doug", "Fisher-Price", "Ravensburger", "VTech", "Playmobil")
+
+# each rating from 1 to 5 has the probability of the same rating in the Amazon dataset, where high ratings prevail
+_RATING_PROBABILITIES = (0.05, 0.05, 0.1, 0.2, 0.6)
+
+# columns containing a value for each interaction of the user, in the same order of the interactions
+_SEQUENCE_COLUMNS = ("item_sequence", "rating_sequence", "title_sequence", "categories_sequence")
+
+# every user must have at least 2 interactions in the train set, one for validation and one for test
+MIN_HISTORY_LENGTH = 4
+
+
+class SyntheticDataset(AnonDataset):
+    """
+    Dataset with the same structure of the Amazon dataset (users with their sequence of rated items, items with
+    title, categories and other metadata), whose data is randomly generated rather than downloaded, so that the
+    whole pipeline can be run offline at any scale.
+
+    Popularity of items follows a Zipf distribution, as well as the activity of users is long tailed: each user
+    has at least `MIN_HISTORY_LENGTH` interactions, the remaining ones are distributed with log-normal weights.
+    Sequences of users are kept as arrow lists, so that millions of interactions don't become millions of python
+    objects
+
+    Args:
+        n_users: n° of users
+        n_items: n° of items of the catalog
+        n_interactions: total n° of interactions, it must be at least `MIN_HISTORY_LENGTH` times `n_users`
+        zipf_exponent: item at popularity rank r is interacted with probability proportional to 1 / r^zipf_exponent
+        n_categories: n° of top level categories of items, each with `n_categories` subcategories
+        seed: seed of the random generator, so that the same parameters always generate the same dataset
+        add_prefix_items_users: if True, users and items ids have "user_" and "item_" prefix as in AmazonDataset
+    """
+
+    def __init__(self,
+                 n_users: int = 1000,
+                 n_items: int = 1000,
+                 n_interactions: int = 10000,
+                 zipf_exponent: float = 1.,
+                 n_categories: int = 10,
+                 seed: int = 42,
+                 add_prefix_items_users: bool = True):
+
+        if n_interactions < MIN_HISTORY_LENGTH * n_users:
+            raise ValueError(f"Each user must have at least {MIN_HISTORY_LENGTH} interactions, thus n_interactions "
+                             f"must be at least {MIN_HISTORY_LENGTH * n_users} for {n_users} users!")
+
+        super().__init__()
+
+        self.n_users = n_users
+        self.n_items = n_items
+        self.n_interactions = n_interactions
+        self.zipf_exponent = zipf_exponent
+        self.n_categories = n_categories
+        self.seed = seed
+        self.add_prefix = add_prefix_items_users
+
+        rng = np.random.default_rng(seed)
+
+        user_prefix = "user_" if add_prefix_items_users else ""
+        item_prefix = "item_" if add_prefix_items_users else ""
+
+        # ids start from 1 as in AmazonDataset
+        self.user_ids = np.array([f"{user_prefix}{user_idx}" for user_idx in range(1, n_users + 1)], dtype=object)
+        self.item_ids = np.array([f"{item_prefix}{item_idx}" for item_idx in range(1, n_items + 1)], dtype=object)
+
+        with PrintWithSpin("Generating items metadata"):
+            self.meta_dict = self._generate_meta(rng)
+
+        with PrintWithSpin("Generating interactions"):
+            self.original_df = self._generate_interactions(rng)
+
+        with PrintWithSpin("Splitting data with Leave One Out protocol"):
+            self.train_df, self.val_df, self.test_df = self.split_data(self.original_df)
+
+    def _generate_meta(self, rng: np.random.Generator) -> dict:
+
+        title_words = rng.choice(ITEM_WORDS, size=(self.n_items, 3))
+        description_words = rng.choice(ITEM_WORDS, size=(self.n_items, 12))
+        categories = rng.integers(self.n_categories, size=self.n_items)
+        subcategories = rng.integers(self.n_categories, size=self.n_items)
+        prices = rng.uniform(1, 100, size=self.n_items).round(2)
+        brands = rng.choice(ITEM_BRANDS, size=self.n_items)
+
+        meta_dict = {}
+        for i, item_id in enumerate(self.item_ids):
+            meta_dict[item_id] = {
+                "title": " ".join(title_words[i]).title(),
+                "description": " ".join(description_words[i]).capitalize() + ".",
+                "categories": ["Synthetic", f"Category {categories[i]}",
+                               f"Category {categories[i]} - {subcategories[i]}"],
+                "price": float(prices[i]),
+                "brand": str(brands[i])
+            }
+
+        return meta_dict
+
+    def _generate_interactions(self, rng: np.random.Generator) -> pd.DataFrame:
+
+        # n° of interactions of each user: the minimum plus a long tailed share of the remaining ones
+        user_activity = rng.lognormal(mean=0, sigma=1, size=self.n_users)
+        history_lengths = MIN_HISTORY_LENGTH + rng.multinomial(self.n_interactions - MIN_HISTORY_LENGTH * self.n_users,
+                                                               user_activity / user_activity.sum())
+        offsets = np.concatenate([[0], np.cumsum(history_lengths)])
+
+        # popularity ranks are assigned to items randomly, so that popularity doesn't depend on the item id
+        item_popularity = 1 / np.arange(1, self.n_items + 1) ** self.zipf_exponent
+        item_popularity = item_popularity[rng.permutation(self.n_items)]
+        item_popularity /= item_popularity.sum()
+
+        interacted_items = rng.choice(self.n_items, size=self.n_interactions, p=item_popularity)
+        ratings = rng.choice(5, size=self.n_interactions, p=_RATING_PROBABILITIES)
+
+        # values of each interaction are taken from arrays with a value for each item (or rating)
+        item_titles = pa.array([self.meta_dict[item_id]["title"] for item_id in self.item_ids])
+        item_categories = pa.array([self.meta_dict[item_id]["categories"] for item_id in self.item_ids])
+        interacted_items = pa.array(interacted_items)
+
+        flat_sequences = {
+            "item_sequence": pa.array(self.item_ids.tolist()).take(interacted_items),
+            "rating_sequence": pa.array(["1", "2", "3", "4", "5"]).take(pa.array(ratings)),
+            "title_sequence": item_titles.take(interacted_items),
+            "categories_sequence": item_categories.take(interacted_items)
+        }
+
+        user_numbers = np.arange(1, self.n_users + 1)
+        table = pa.table({
+            "user_id": pa.array(self.user_ids.tolist()),
+            "user_name": pa.array([f"User {user_number}" for user_number in user_numbers]),
+            "user_asin": pa.array([f"A{user_number:013d}" for user_number in user_numbers]),
+            **{column: pa.ListArray.from_arrays(pa.array(offsets, type=pa.int32()), values)
+               for column, values in flat_sequences.items()}
+        })
+
+        # one row for each user, with arrow backed list columns
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+    @cached_property
+    def all_users(self):
+        return self.user_ids
+
+    @cached_property
+    def all_items(self):
+        # as in AmazonDataset, only items with at least one interaction are considered
+        item_sequences = pa.array(self.original_df["item_sequence"].array)
+        return np.array(item_sequences.flatten().unique().to_pylist(), dtype=object)
+
+    @property
+    def items_meta_dict(self):
+        return self.meta_dict
+
+    def download_extract_raw_dataset(self):
+        # data is generated, nothing to download
+        pass
+
+    def split_data(self, original_data: pd.DataFrame):
+
+        # Leave One Out is performed as in AmazonDataset: the last item of each user is the test item, the
+        # second last one is the validation item. Since each row already contains the whole sequence of the user,
+        # sequences are sliced directly
+
+        sequences = _sequences_of(original_data)
+
+        # if sequence is -> [1 2 3 4 5 6 7 8], TRAIN SET will have [1 2 3 4 5 6], input and target are sampled
+        # at each epoch with `sample_train_sequence()`
+        train_set = _with_user_columns(original_data, {column: _drop_last(sequence, 2)
+                                                       for column, sequence in sequences.items()})
+
+        # VAL SET will have input_sequence: [1 2 3 4 5 6] and gt_item: [7]
+        val_set = _with_user_columns(original_data, {
+            **{_input_column(column): _drop_last(sequence, 2) for column, sequence in sequences.items()},
+            **{_gt_column(column): _nth_from_last(sequence, 2) for column, sequence in sequences.items()}
+        })
+
+        # TEST SET will have input_sequence: [1 2 3 4 5 6 7] and gt_item: [8]
+        test_set = _with_user_columns(original_data, {
+            **{_input_column(column): _drop_last(sequence, 1) for column, sequence in sequences.items()},
+            **{_gt_column(column): _nth_from_last(sequence, 1) for column, sequence in sequences.items()}
+        })
+
+        return train_set, val_set, test_set
+
+    @staticmethod
+    def sample_train_sequence(batch: Dict[str, list]) -> Dict[str, list]:
+
+        batch = dict_list2list_dict(batch)
+
+        out_dict_list = []
+        for sample in batch:
+
+            n_items = len(sample["item_sequence"])
+            if n_items < 2:
+                raise ValueError(f"{sample['user_id']} has less than 2 items in its order history, can't divide "
+                                 "in input and ground truth!")
+
+            # as in AmazonDataset, the input sequence has at least 2 items if the sequence has at least 3 items,
+            # and at least one item is left to be used as ground truth
+            minimum_sliding_size = 1 if n_items == 2 else 2
+            sliding_size = random.randint(minimum_sliding_size, n_items - 1)
+
+            start_index = random.randint(0, n_items - sliding_size - 1)
+            end_index = start_index + sliding_size
+
+            single_out_dict = {
+                "user_id": sample["user_id"],
+                "user_name": sample["user_name"],
+                "user_asin": sample["user_asin"]
+            }
+            for column in _SEQUENCE_COLUMNS:
+                single_out_dict[_input_column(column)] = sample[column][start_index:end_index]
+                single_out_dict[_gt_column(column)] = [sample[column][end_index]]
+
+            out_dict_list.append(single_out_dict)
+
+        return list_dict2dict_list(out_dict_list)
+
+    def get_hf_datasets(self, merge_train_val: bool = False) -> Dict[str, datasets.Dataset]:
+        # imported here since importing it takes a long time, and it's not needed e.g. to validate a config
+        import datasets
+        from datasets import Dataset
+
+        train_df = self.train_df
+
+        if merge_train_val is True:
+            # if we don't use val, only the last item of each sequence should be unknown
+            train_df = _with_user_columns(self.original_df, {column: _drop_last(sequence, 1)
+                                                             for column, sequence in
+                                                             _sequences_of(self.original_df).items()})
+
+        dataset_dict = {"train": Dataset.from_pandas(train_df, split=datasets.Split.TRAIN, preserve_index=False)}
+
+        if merge_train_val is False:
+            dataset_dict["validation"] = Dataset.from_pandas(self.val_df, split=datasets.Split.VALIDATION,
+                                                             preserve_index=False)
+
+        dataset_dict["test"] = Dataset.from_pandas(self.test_df, split=datasets.Split.TEST, preserve_index=False)
+
+        return dataset_dict
+
+    def save(self, output_dir: str):
+
+        output_path = os.path.join(output_dir, "synthetic_dat.pkl")
+        with open(output_path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, dir_path: str) -> SyntheticDataset:
+
+        dat_path = os.path.join(dir_path, "synthetic_dat.pkl")
+        with open(dat_path, "rb") as f:
+            obj = pickle.load(f)
+
+        return obj
+
+
+def _sequences_of(data: pd.DataFrame) -> dict[str, pa.ListArray]:
+    return {column: pa.array(data[column].array) for column in _SEQUENCE_COLUMNS}
+
+
+def _with_user_columns(data: pd.DataFrame, sequences: dict[str, pa.ListArray]) -> pd.DataFrame:
+    # user columns of `data` followed by `sequences`, one row for each user
+    return pd.concat([data[["user_id", "user_name", "user_asin"]].reset_index(drop=True),
+                      pa.table(sequences).to_pandas(types_mapper=pd.ArrowDtype)], axis=1)
+
+
+def _input_column(sequence_column: str) -> str:
+    # e.g. item_sequence -> input_item_seq
+    return f"input_{sequence_column.removesuffix('_sequence')}_seq"
+
+
+def _gt_column(sequence_column: str) -> str:
+    # e.g. item_sequence -> gt_item
+    return f"gt_{sequence_column.removesuffix('_sequence')}"
+
+
+def _drop_last(sequences: pa.ListArray, n: int) -> pa.ListArray:
+    # each sequence without its last n values
+    offsets = sequences.offsets.to_numpy()
+    lengths = np.diff(offsets) - n
+
+    new_offsets = np.concatenate([[0], np.cumsum(lengths)])
+    value_indices = np.repeat(offsets[:-1] - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+
+    return pa.ListArray.from_arrays(pa.array(new_offsets, type=pa.int32()), sequences.values.take(value_indices))
+
+
+def _nth_from_last(sequences: pa.ListArray, n: int) -> pa.ListArray:
+    # list containing only the n-th last value of each sequence
+    value_indices = sequences.offsets.to_numpy()[1:] - n
+
+    return pa.ListArray.from_arrays(pa.array(np.arange(len(sequences) + 1), type=pa.int32()),
+                                    sequences.values.take(value_indices))
@@ -3,6 +3,7 @@ import os.path
 from src import GeneralParams, PROCESSED_DATA_DIR
 from src.data import DataParams
 from src.data.abstract_dataset import AnonDataset
+from src.instrumentation import INSTRUMENTATION
 
 
 def data_main(general_params: GeneralParams, data_section_config: DataParams):
@@ -11,11 +12,15 @@ def data_main(general_params: GeneralParams, data_section_config: DataParams):
     dataset_cls_name = data_section_config.dataset_cls_name
     dataset_params = data_section_config.dataset_params
 
-    ds = AnonDataset.from_string(dataset_cls_name, **dataset_params)
+    # samples of the data phase are the users of the dataset
+    with INSTRUMENTATION.stage("data/init_dataset") as record:
+        ds = AnonDataset.from_string(dataset_cls_name, **dataset_params)
+        record.count(n_samples=len(ds.all_users))
 
     output_dir = os.path.join(PROCESSED_DATA_DIR, general_params.exp_name)
     os.makedirs(output_dir, exist_ok=True)
 
-    ds.save(output_dir)
+    with INSTRUMENTATION.stage("data/save_dataset"):
+        ds.save(output_dir)
 
     return ds
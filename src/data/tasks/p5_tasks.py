@@ -9,6 +9,8 @@ from src.evaluate.metrics.ranking_metrics import RankingMetric
 
 
 class P5RatingTask(AnonTask):
+    prompt_gt_fields = ("gt_item", "gt_title")
+
     templates_dict = {
         "1-1": Template(
             input_text_placeholder="Which star rating will user_{user_id} give item_{item_id} ? "
@@ -190,6 +192,8 @@ class P5RatingTask(AnonTask):
 
 
 class P5EvalRatingTask(AnonTask):
+    prompt_gt_fields = ("gt_item", "gt_title")
+
     templates_dict = {
         # prompt seen during training
         "1-6": P5RatingTask.templates_dict["1-6"],
@@ -497,6 +501,8 @@ class P5EvalSequentialTask(AnonTask):
 
 
 class P5DirectTask(AnonTask):
+    prompt_gt_fields = ("gt_item",)
+
     templates_dict = {
         "5-1": Template(
             input_text_placeholder="Will user_{user_id} likely to interact with item_{item_id} ?",
@@ -580,7 +586,8 @@ class P5DirectTask(AnonTask):
 
         target_text_inference = target_text_placeholder_inference.format(target_item=target_item)
 
-        out_list.append(TaskOutput(input_text_inference, target_text_inference, ground_truth_for_eval=[target_item]))
+        out_list.append(TaskOutput(input_text_inference, target_text_inference, ground_truth_for_eval=[target_item],
+                                   candidates=candidates.tolist()))
 
         if self.training:
 
@@ -635,6 +642,8 @@ class P5DirectTask(AnonTask):
 
 
 class P5EvalDirectTask(AnonTask):
+    prompt_gt_fields = ("gt_item",)
+
     templates_dict = {
         "5-5": P5DirectTask.templates_dict["5-5"],
 
@@ -682,4 +691,5 @@ class P5EvalDirectTask(AnonTask):
 
         target_text = target_text_placeholder.format(target_item=target_item)
 
-        return [TaskOutput(input_text, target_text, ground_truth_for_eval=[target_item])]
+        return [TaskOutput(input_text, target_text, ground_truth_for_eval=[target_item],
+                           candidates=candidates.tolist())]
@@ -9,6 +9,8 @@ from src.evaluate.metrics.ranking_metrics import RankingMetric
 
 
 class RatingPredictionTask(AnonTask):
+    prompt_gt_fields = ("gt_item",)
+
     templates_dict = {
         0: Template(
             input_text_placeholder="rating prediction - {user_id}: \n\n"
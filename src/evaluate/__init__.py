@@ -14,6 +14,12 @@ class EvalParams:
     eval_tasks: dict[str, list[str]]
     eval_batch_size: int = None
     create_latex_table: bool = True
+    save_predictions: bool = True
+    predictions_shard_batches: int = 100
+    cross_template_batching: bool = False
+    bootstrap_resamples: int = 0
+    confidence_level: float = 0.95
+    randomization_permutations: int = 10000
 
     @classmethod
     def from_parse(cls, eval_section: dict):
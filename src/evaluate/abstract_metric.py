@@ -1,8 +1,11 @@
 from __future__ import annotations
 
 import inspect
+import itertools
+import math
 from abc import abstractmethod, ABC
 import operator
+from collections import defaultdict
 
 from requests.structures import CaseInsensitiveDict
 from typing import Collection, Callable
@@ -12,22 +15,69 @@ import numpy as np
 
 class PaddedArr(np.ndarray):
     def __new__(cls, iterable: Collection[Collection[str]], *args, **kwargs):
-        # Find the maximum length of the sublists
-        max_len = max((len(sublist) for sublist in iterable), default=0)
+        # dense array where each row is padded with <PAD> tokens up to the length of the longest row.
+        # Metrics work on a RaggedArr, this is kept for when a dense representation is needed
+        return RaggedArr(iterable).to_padded()
 
-        # Create a new NumPy array filled with <PAD> token
-        # object dtype here since using `str` will use the numpy str type based on <PAD> string
-        # cutting strings significantly longer than <PAD>
-        padded_array = np.full((len(iterable), max_len), fill_value="<PAD>", dtype=object)
 
-        # Copy the data from the original list into the new padded array
-        for i, sublist in enumerate(iterable):
-            padded_array[i, :len(sublist)] = sublist
+class RaggedArr:
+    """
+    Collection of rows having different lengths (e.g. the ground truth of each user), stored as a single flat
+    array containing the elements of all rows plus the offsets where each row starts. Unlike PaddedArr, no dense
+    copy padded to the longest row is built, so memory is proportional to the n° of elements even when few users
+    have many more truths than the others
 
-            assert not (padded_array[i, :len(sublist)] == "<PAD>").any(), \
-                "<PAD> is the pad token and can't be used as element of array!"
+    Args:
+        iterable: collection of rows, or a 2d array (in which case <PAD> elements, if any, are not considered)
+    """
 
-        return padded_array.astype(str)
+    def __init__(self, iterable: Collection[Collection[str]]):
+
+        if isinstance(iterable, np.ndarray) and iterable.ndim == 2:
+            # e.g. a PaddedArr: rows are padded at the end, so non-pad elements in row-major order are the values
+            not_pad_mask = iterable != "<PAD>"
+
+            self.values = iterable[not_pad_mask].astype(str)
+            lengths = not_pad_mask.sum(axis=1)
+        else:
+            lengths = np.fromiter((len(row) for row in iterable), dtype=np.int64, count=len(iterable))
+            self.values = np.array(list(itertools.chain.from_iterable(iterable)), dtype=str)
+
+            assert not (self.values == "<PAD>").any(), "<PAD> is the pad token and can't be used as element of array!"
+
+        self.offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+
+    @classmethod
+    def wrap(cls, truths: RaggedArr | Collection[Collection[str]]) -> RaggedArr:
+        # metrics accept truths in any form, but they work on a RaggedArr
+        return truths if isinstance(truths, RaggedArr) else cls(truths)
+
+    @property
+    def lengths(self) -> np.ndarray[int]:
+        return np.diff(self.offsets)
+
+    @property
+    def row_ids(self) -> np.ndarray[int]:
+        # index of the row of each element of `values`
+        return np.repeat(np.arange(len(self), dtype=np.int64), self.lengths)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> np.ndarray[str]:
+        return self.values[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def to_padded(self) -> np.ndarray[str]:
+
+        # dense representation, equal to the one of PaddedArr
+        lengths = self.lengths
+        max_len = lengths.max(initial=0)
+
+        dtype = np.result_type(self.values.dtype, np.array("<PAD>").dtype)
+        padded_array = np.full((len(self), max_len), fill_value="<PAD>", dtype=dtype)
+        padded_array[np.arange(max_len) < lengths[:, np.newaxis]] = self.values
+
+        return padded_array
 
 
 class AnonMetric(ABC):
@@ -42,6 +92,11 @@ class AnonMetric(ABC):
 
         super().__init_subclass__(**kwargs)
 
+    # if False, per user values of a batch can't be computed without knowing the other batches
+    # (e.g. error metrics bound predictions to the range of ALL truths), so the MetricAccumulator keeps
+    # the state of each batch and computes the precomputed matrix only when results are requested
+    streamable: bool = True
+
     def __init__(self, k: int = None):
         self.k = k
 
@@ -55,9 +110,44 @@ class AnonMetric(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def per_user_precomputed_matrix(self, predictions: np.ndarray[str], truths: PaddedArr) -> np.ndarray:
+    def per_user_precomputed_matrix(self, predictions: np.ndarray[str], truths: RaggedArr) -> np.ndarray:
+        raise NotImplementedError
+
+    def batch_state(self, predictions: np.ndarray[str], truths: RaggedArr):
+        # only used by non streamable metrics: what should be kept of a batch in order to build
+        # the precomputed matrix of all batches with `merge_batch_states()`
+        raise NotImplementedError
+
+    def merge_batch_states(self, batch_states: list) -> np.ndarray:
+        raise NotImplementedError
+
+    def defined_mask(self, predictions: np.ndarray[str], truths: RaggedArr) -> np.ndarray[bool]:
+        # for each per user value that the metric would compute, whether it is actually computed
+        # (e.g. error metrics ignore predictions which are not numbers). Used to align per user values
+        return np.ones(len(predictions), dtype=bool)
+
+    @abstractmethod
+    def per_user_values(self, per_user_precomputed_matrix: np.ndarray) -> np.ndarray:
+        # value of the metric for each user (or for each prediction, e.g. error metrics), which
+        # are then aggregated into the system-wise result by `aggregate()`
         raise NotImplementedError
 
+    def per_user_values_multi(self, metrics: list[AnonMetric],
+                              per_user_precomputed_matrix: np.ndarray) -> dict[str, np.ndarray]:
+
+        # per user values of several metrics of the same type from a single precomputed matrix (computed by the metric
+        # with the max k). By default each metric considers the matrix cut to its k value, metric types could
+        # override this to compute all of them at once
+        return {
+            str(metric): metric.per_user_values(per_user_precomputed_matrix[:, :metric.k] if metric.k is not None
+                                                else per_user_precomputed_matrix)
+            for metric in metrics
+        }
+
+    def aggregate(self, total: float, count: int) -> float:
+        # by default, the system-wise result is the mean of the per user values
+        return total / count if count != 0 else float("nan")
+
     @staticmethod
     def safe_div(num: np.ndarray, den: np.ndarray) -> np.ndarray[float]:
 
@@ -111,9 +201,10 @@ class AnonMetric(ABC):
         # if we arrive at the return clause, metric_cls exists that's why we return True directly
         return metric_cls if not return_bool else True
 
-    @abstractmethod
-    def __call__(self, precomputed_matrix: np.ndarray) -> float:
-        raise NotImplementedError
+    def __call__(self, per_user_precomputed_matrix: np.ndarray) -> float:
+        per_user_values = self.per_user_values(per_user_precomputed_matrix)
+
+        return self.aggregate(per_user_values.sum().item(), len(per_user_values))
 
     def __eq__(self, other):
         if type(self) is type(other) and self.k == other.k:
@@ -139,8 +230,180 @@ class Loss(AnonMetric):
         # loss metric should be minimized, hence "<"
         return operator.lt
 
-    def per_user_precomputed_matrix(self, predictions: np.ndarray[np.ndarray[str]], truths: PaddedArr):
+    def per_user_precomputed_matrix(self, predictions: np.ndarray[np.ndarray[str]], truths: RaggedArr):
+        raise NotImplementedError("This should not be called, it is simply defined to make use of polymorphism")
+
+    def per_user_values(self, per_user_precomputed_matrix: np.ndarray):
         raise NotImplementedError("This should not be called, it is simply defined to make use of polymorphism")
 
     def __call__(self, *args, **kwargs):
         raise NotImplementedError("This should not be called, it is simply defined to make use of polymorphism")
+
+
+class MetricAccumulator:
+    """
+    Accumulates results of the metrics in `metric_list` one batch at a time, so that the precomputed matrix of each
+    metric type (e.g. the relevance matrix for ranking metrics) is computed only once for each batch.
+    `compute()` can be called at any moment to get the results considering all the batches seen so far
+    """
+
+    def __init__(self, metric_list: list[AnonMetric], keep_per_user_values: bool = False):
+
+        self.metric_list = list(metric_list)
+        self.keep_per_user_values = keep_per_user_values
+
+        # this works regardless of metric type, k is always None for error metrics. This works
+        # on the assumption that a metric type is the immediate parent of the specific metric,
+        # e.g. class Hit(RankingMetric) -> RankingMetric is the metric type
+        self.type2metric_dict: dict[type[AnonMetric], list[AnonMetric]] = defaultdict(list)
+        for metric in self.metric_list:
+            [metric_type] = metric.__class__.__bases__
+            self.type2metric_dict[metric_type].append(metric)
+
+        # for streamable metrics, we keep the sum of the per user values of each batch and the n° of users.
+        # Sums of each batch are kept separately so that results do not depend on how batches are grouped
+        # (e.g. when merging accumulators of different processes)
+        self.batch_totals: dict[str, list[float]] = {str(metric): [] for metric in self.metric_list}
+        self.counts: dict[str, int] = {str(metric): 0 for metric in self.metric_list}
+
+        # for non-streamable metrics, we keep the state of each batch for each metric type
+        self.batch_states: dict[type[AnonMetric], list] = defaultdict(list)
+
+        # per user values of each batch are kept only if requested (e.g. for confidence intervals). For
+        # non-streamable metrics they are computed at the end, so we keep which of them are defined
+        self.per_user_batches: dict[str, list[np.ndarray]] = {str(metric): [] for metric in self.metric_list}
+        self.defined_masks: dict[type[AnonMetric], list[np.ndarray[bool]]] = defaultdict(list)
+
+    def _max_k_metric(self, metric_type: type[AnonMetric]) -> AnonMetric:
+
+        # find the metric with the max k: we will compute the precomputed matrix
+        # using that metric.
+        # Used to save some computational resources, since we will compute metrics
+        # by first cutting predictions to max k. If there is at least one None,
+        # sadly it means that we can't save any resource
+        return max(self.type2metric_dict[metric_type], key=lambda x: x.k if x.k is not None else np.inf)
+
+    def update(self, predictions: Collection[Collection[str]], truths: Collection[Collection[str]]):
+
+        if len(self.metric_list) == 0:
+            return
+
+        # truths can be in different number for each user, they are kept as flat values plus offsets
+        # (predictions can't be ragged otherwise metric computation will be wrong, thus
+        # they should be in constant number for each user)
+        ragged_truths = RaggedArr(truths)
+
+        # convert preds to array and check that there is no <PAD> token
+        predictions: np.ndarray = np.array(predictions)
+        assert not (predictions == "<PAD>").any(), "<PAD> is the pad token and can't be used as element of array!"
+
+        for metric_type, metrics in self.type2metric_dict.items():
+
+            max_k_metric = self._max_k_metric(metric_type)
+
+            if not max_k_metric.streamable:
+                self.batch_states[metric_type].append(max_k_metric.batch_state(predictions, ragged_truths))
+
+                if self.keep_per_user_values:
+                    self.defined_masks[metric_type].append(max_k_metric.defined_mask(predictions, ragged_truths))
+
+                continue
+
+            precomputed_matrix = max_k_metric.per_user_precomputed_matrix(predictions, ragged_truths)
+
+            # each metric considers its k value which will surely be <= max_k
+            all_per_user_values = max_k_metric.per_user_values_multi(metrics, precomputed_matrix)
+
+            for metric_name, per_user_values in all_per_user_values.items():
+                self.batch_totals[metric_name].append(per_user_values.sum().item())
+                self.counts[metric_name] += len(per_user_values)
+
+                if self.keep_per_user_values:
+                    self.per_user_batches[metric_name].append(per_user_values)
+
+    def merge(self, other: MetricAccumulator):
+
+        # batches of `other` are considered as coming after the batches of this accumulator
+        for metric_name in self.batch_totals:
+            self.batch_totals[metric_name].extend(other.batch_totals[metric_name])
+            self.counts[metric_name] += other.counts[metric_name]
+
+        for metric_type, batch_states in other.batch_states.items():
+            self.batch_states[metric_type].extend(batch_states)
+
+        for metric_name in self.per_user_batches:
+            self.per_user_batches[metric_name].extend(other.per_user_batches[metric_name])
+
+        for metric_type, defined_masks in other.defined_masks.items():
+            self.defined_masks[metric_type].extend(defined_masks)
+
+    def compute(self, streamable_only: bool = False) -> dict[str, float]:
+        """
+        Returns the results of the metrics considering all the batches seen so far. The cost of non-streamable
+        metrics grows with the n° of batches, since their precomputed matrix is built from the state of every batch:
+        if `streamable_only` is True they are not computed (e.g. for showing partial results during the evaluation)
+        """
+
+        merged_matrices = {}
+        all_metric_results = {}
+        for metric in self.metric_list:
+
+            if metric.streamable:
+                # fsum is exact, so the result does not depend on the order of the batches
+                total = math.fsum(self.batch_totals[str(metric)])
+                all_metric_results[str(metric)] = metric.aggregate(total, self.counts[str(metric)])
+                continue
+
+            if streamable_only:
+                continue
+
+            all_metric_results[str(metric)] = metric(self._merged_matrix(metric, merged_matrices))
+
+        return all_metric_results
+
+    def per_user_values(self) -> dict[str, np.ndarray[float]]:
+        """
+        Returns the per user values of each metric for all the batches seen so far, in the order of the users.
+        Values which are not defined (e.g. predictions which are not numbers for error metrics) are NaN, so that
+        values of different evaluations on the same users are always aligned
+        """
+
+        if not self.keep_per_user_values:
+            raise ValueError("Per user values are not kept! Set `keep_per_user_values=True` when initializing the "
+                             "MetricAccumulator")
+
+        merged_matrices = {}
+        all_per_user_values = {}
+        for metric in self.metric_list:
+
+            if metric.streamable:
+                batches = self.per_user_batches[str(metric)]
+                all_per_user_values[str(metric)] = np.concatenate(batches) if len(batches) != 0 else np.empty(0)
+                continue
+
+            [metric_type] = metric.__class__.__bases__
+            defined_mask = (np.concatenate(self.defined_masks[metric_type])
+                            if len(self.defined_masks[metric_type]) != 0 else np.empty(0, dtype=bool))
+
+            per_user_values = np.full(len(defined_mask), np.nan)
+            per_user_values[defined_mask] = metric.per_user_values(self._merged_matrix(metric, merged_matrices))
+
+            all_per_user_values[str(metric)] = per_user_values
+
+        return all_per_user_values
+
+    def _merged_matrix(self, metric: AnonMetric, merged_matrices: dict[type[AnonMetric], np.ndarray]) -> np.ndarray:
+
+        # the precomputed matrix of all the batches of a non-streamable metric type is built only once
+        # and cached in `merged_matrices`, each metric then considers its k value
+        [metric_type] = metric.__class__.__bases__
+        if metric_type not in merged_matrices:
+            merged_matrices[metric_type] = self._max_k_metric(metric_type).merge_batch_states(
+                self.batch_states[metric_type]
+            )
+
+        precomputed_matrix = merged_matrices[metric_type]
+        if metric.k is not None:
+            precomputed_matrix = precomputed_matrix[:, :metric.k]
+
+        return precomputed_matrix
@@ -1,37 +1,73 @@
 import operator
 import os
+import time
 from collections import defaultdict
 from math import ceil
 
 import datasets
 import numpy as np
 import pandas as pd
-import wandb
+import torch
 from tqdm import tqdm
 from loguru import logger
 
 from src.data.abstract_task import AnonTask
-from src.evaluate.abstract_metric import AnonMetric, PaddedArr
+from src.evaluate.abstract_metric import AnonMetric, MetricAccumulator
 from src.evaluate.abstract_metric import Loss
+from src.evaluate.predictions import (get_predictions_path, get_shard_path, save_predictions, save_predictions_shard,
+                                      merge_predictions_shards, load_predictions, build_manifest, sync_manifest)
+from src.evaluate.significance import per_user_values_from_predictions, bootstrap_confidence_intervals
+from src.instrumentation import INSTRUMENTATION, instrumented
 from src.model import AnonModel
-from src.utils import log_wandb
+from src.utils import (log_wandb, RunningMean, get_world_size, get_rank, is_main_process, broadcast_object,
+                       gather_objects, get_rng_state, set_rng_state, barrier)
 
 
 class RecEvaluator:
 
-    def __init__(self, rec_model: AnonModel, eval_batch_size: int, should_log: bool = False):
+    # rec_model can be None only if metrics are computed from predictions previously saved
+    def __init__(self, rec_model: AnonModel | None, eval_batch_size: int, should_log: bool = False,
+                 predictions_shard_batches: int = 100, cross_template_batching: bool = False,
+                 bootstrap_resamples: int = 0, confidence_level: float = 0.95, random_seed: int = None):
         self.rec_model = rec_model
         self.eval_batch_size = eval_batch_size
         self.should_log = should_log
 
+        # when predictions are saved, they are checkpointed every `predictions_shard_batches` batches
+        self.predictions_shard_batches = predictions_shard_batches
+
+        # if True, prompts of all the inference templates of a task are generated in the same batches
+        self.cross_template_batching = cross_template_batching
+
+        # if greater than 0, confidence intervals of results are computed by bootstrapping users
+        self.bootstrap_resamples = bootstrap_resamples
+        self.confidence_level = confidence_level
+        self.random_seed = random_seed
+
     def evaluate_suite(self,
                        eval_dataset: datasets.Dataset,
                        tasks_to_evaluate: dict[AnonTask, list[AnonMetric]],
                        output_dir: str,
-                       create_latex_table: bool = True):
+                       create_latex_table: bool = True,
+                       predictions_dir: str = None,
+                       from_predictions: bool = False):
+
+        if from_predictions and predictions_dir is None:
+            raise ValueError("predictions_dir must be specified in order to compute metrics from saved predictions!")
 
         print(f"# Starting evaluation on {', '.join(str(task) for task in tasks_to_evaluate)}\n")
 
+        # predictions saved by an interrupted evaluation are reused only if they were generated
+        # by the same model, with the same generation config, on the same eval set
+        if predictions_dir is not None and not from_predictions:
+            self._sync_predictions_dir(predictions_dir, eval_dataset)
+
+        # per user values needed for confidence intervals are computed from saved predictions
+        compute_ci = self.bootstrap_resamples > 0
+        if compute_ci and predictions_dir is None:
+            logger.warning("Confidence intervals can't be computed since predictions are not saved!")
+            compute_ci = False
+
         split_name = eval_dataset.split if eval_dataset.split is not None else "eval"
 
         # Log all eval templates used
@@ -48,8 +84,11 @@ class RecEvaluator:
                 dataframe_dict["input_text_placeholder"].append(input_text_placeholder)
                 dataframe_dict["target_text_placeholder"].append(target_text_placeholder)
 
-        log_wandb({f"{split_name}/task_templates": wandb.Table(dataframe=pd.DataFrame(dataframe_dict))},
-                  self.should_log)
+        if self.should_log:
+            import wandb
+
+            log_wandb({f"{split_name}/task_templates": wandb.Table(dataframe=pd.DataFrame(dataframe_dict))},
+                      self.should_log)
 
         all_result = {}
         for i, (task, metric_list) in enumerate(tasks_to_evaluate.items(), start=1):
@@ -57,14 +96,55 @@ class RecEvaluator:
             # metrics names are keys, values are lists containing results for each template
             task_result = defaultdict(list)
 
+            # template ids are keys, values are dataframes with confidence intervals of each metric
+            task_ci = {}
+
             template_ids_to_evaluate = task.inference_templates(return_id=True)
+
+            # predictions of each template are saved (or loaded) in the predictions dir, if specified
+            templates_predictions_path = {template_id: None for template_id in template_ids_to_evaluate}
+            if predictions_dir is not None:
+                templates_predictions_path = {template_id: get_predictions_path(predictions_dir, task, template_id)
+                                              for template_id in template_ids_to_evaluate}
+
+            # the loss is computed on batches, thus it can't be demultiplexed if templates are mixed in batches
+            cross_template = (self.cross_template_batching and not from_predictions
+                              and len(template_ids_to_evaluate) > 1)
+            if cross_template and Loss() in metric_list:
+                logger.warning(f"Loss can't be computed for each template if they are batched together, "
+                               f"templates of {task} will be evaluated one at a time")
+                cross_template = False
+
+            templates_result = {}
+            if cross_template:
+                print(f"# Evaluating on {task} - Templates {template_ids_to_evaluate} batched together")
+
+                templates_result = self.evaluate_task_all_templates(eval_dataset, metric_list=metric_list,
+                                                                    task=task,
+                                                                    template_ids=template_ids_to_evaluate,
+                                                                    predictions_paths=templates_predictions_path)
+                print()
+
             for template_id in template_ids_to_evaluate:
 
-                print(f"# Evaluating on {task} - Template {template_id}")
+                template_predictions_path = templates_predictions_path[template_id]
+
+                if cross_template:
+                    res_dict = templates_result[template_id]
+
+                    print(f"# Results on {task} - Template {template_id}")
+                    print(", ".join(f"{metric_name} -> {metric_val:.6f}"
+                                    for metric_name, metric_val in res_dict.items()))
+                else:
+                    print(f"# Evaluating on {task} - Template {template_id}")
 
-                res_dict = self.evaluate_task(eval_dataset, metric_list=metric_list,
-                                              task=task,
-                                              template_id=template_id)
+                    if from_predictions:
+                        res_dict = self.evaluate_predictions(template_predictions_path, metric_list=metric_list)
+                    else:
+                        res_dict = self.evaluate_task(eval_dataset, metric_list=metric_list,
+                                                      task=task,
+                                                      template_id=template_id,
+                                                      predictions_path=template_predictions_path)
 
                 dict_to_log = {f"{split_name}/{task}/template_id": template_id}
                 for metric_name, metric_val in res_dict.items():
@@ -73,13 +153,24 @@ class RecEvaluator:
 
                 log_wandb(dict_to_log, self.should_log)
 
+                # only the main process computes confidence intervals, since it saved the predictions
+                ci_metric_list = [metric for metric in metric_list if metric != Loss()]
+                if compute_ci and is_main_process() and len(ci_metric_list) != 0:
+                    task_ci[template_id] = self._bootstrap_template(template_predictions_path, ci_metric_list)
+
+                    log_wandb({f"{split_name}/{task}/{metric_name} - {bound}": ci_row[bound]
+                               for metric_name, ci_row in task_ci[template_id].iterrows()
+                               for bound in ("ci_low", "ci_high")}, self.should_log)
+
                 # simple newline for better separation between template evaluations
                 print()
 
             task_result_df = pd.DataFrame(task_result, index=template_ids_to_evaluate)
 
+            # the loss is only averaged across templates, it has no "best" value
             task_result_df_mean_best = task_result_df.agg({
-                str(metric): ["mean", "max"] if metric.operator_comparison == operator.gt else ["mean", "min"]
+                str(metric): ["mean"] if metric == Loss()
+                else ["mean", "max"] if metric.operator_comparison == operator.gt else ["mean", "min"]
                 for metric in metric_list})
 
             log_wandb({f"{split_name}/{task}/{metric} - mean": task_result_df_mean_best[metric]["mean"]
@@ -87,8 +178,9 @@ class RecEvaluator:
 
             # best results is always the last row (that's why -1)
             index_name_best = task_result_df_mean_best.index[-1]  # this could be "min" or "max"
-            log_wandb({f"{split_name}/{task}/{metric} - {index_name_best}": task_result_df_mean_best[metric].iloc[-1]
-                       for metric in task_result}, self.should_log)
+            if index_name_best != "mean":
+                log_wandb({f"{split_name}/{task}/{metric} - {index_name_best}": task_result_df_mean_best[metric].iloc[-1]
+                           for metric in task_result if metric != str(Loss())}, self.should_log)
 
             print(f"Mean and best result for task {task}:")
             print(task_result_df_mean_best)
@@ -100,6 +192,10 @@ class RecEvaluator:
 
             all_result[str(task)] = task_result_df
 
+            # in distributed mode, results are the same for all processes and only the main one saves them
+            if not is_main_process():
+                continue
+
             # e.g. reports/metrics/eval_exp/SequentialSideInfo.csv
             os.makedirs(output_dir, exist_ok=True)
             task_result_df.to_csv(os.path.join(output_dir, f"{task}.csv"))
@@ -107,37 +203,35 @@ class RecEvaluator:
             print(f"# CSV Results saved into {os.path.join(output_dir, f'{task}.csv')}!")
 
             if create_latex_table is True:
-                latex_table = self._create_latex_table(task_result_df, task_name=str(task))
+                latex_table = self._create_latex_table(task_result_df, task_name=str(task),
+                                                       n_summary_rows=len(task_result_df_mean_best))
 
                 with open(os.path.join(output_dir, f"{task}_latex.tex"), "w") as f:
                     f.write(latex_table)
 
                 print(f"# Latex Results saved into {os.path.join(output_dir, f'{task}_latex.tex')}!")
 
+            if len(task_ci) != 0:
+                task_ci_df = pd.concat(task_ci, names=["Template ID"])
+                task_ci_df.to_csv(os.path.join(output_dir, f"{task}_ci.csv"))
+
+                print(f"# Confidence intervals saved into {os.path.join(output_dir, f'{task}_ci.csv')}!")
+
             if i != len(tasks_to_evaluate):
                 # at the end of the whole eval process we don't print separator
                 print("-" * 80)
 
         return all_result
 
+    @instrumented("evaluate_task")
     def evaluate_task(self, eval_dataset: datasets.Dataset,
                       metric_list: list[AnonMetric],
                       task: AnonTask,
-                      template_id: int = None):
+                      template_id: int = None,
+                      max_minutes: float = None,
+                      predictions_path: str = None):
 
-        all_cls_metrics = {metric.__class__ for metric in metric_list}
-
-        for cls_metric in all_cls_metrics:
-
-            # if metric is compatible or is Loss, we pass directly to the next metric to check
-            if any(issubclass(cls_metric, cls_compatible) or cls_metric == Loss
-                   for cls_compatible in task.compatible_metrics()):
-                continue
-
-            raise ValueError(
-                f"Task {task} is incompatible with {cls_metric.__name__}! It can be only evaluated on the "
-                f"following metrics: {[compatible_metric.__name__ for compatible_metric in task.compatible_metrics()]}"
-            )
+        self._check_compatibility(task, metric_list)
 
         self.rec_model.eval()
 
@@ -147,14 +241,23 @@ class RecEvaluator:
         # we don't call set_eval_task because task are already instantiated
         self.rec_model.eval_task = task
 
-        # Loss() metric it's just a placeholder needed for exploiting polymorphism
-        return_loss = False
-        if Loss() in metric_list:
-            return_loss = True
-            metric_list.remove(Loss())
+        # Loss() metric it's just a placeholder needed for exploiting polymorphism.
+        # A new list is created so that the list passed by the caller is not modified
+        return_loss = Loss() in metric_list
+        metric_list = [metric for metric in metric_list if metric != Loss()]
+
+        # if only the loss should be computed, there's no need to generate predictions
+        loss_only = return_loss and len(metric_list) == 0
 
         split_name = eval_dataset.split if eval_dataset.split is not None else "eval"
 
+        # in distributed mode, each process generates predictions for a different range of batches.
+        # Tokenization is random (e.g. separators between items), so all processes tokenize the whole
+        # set starting from the same random state: in this way results are identical to the serial evaluation
+        world_size = get_world_size()
+        if world_size > 1:
+            set_rng_state(broadcast_object(get_rng_state()))
+
         preprocessed_eval = eval_dataset.map(
             self.rec_model.tokenize,
             remove_columns=eval_dataset.column_names,
@@ -165,43 +268,104 @@ class RecEvaluator:
         )
         preprocessed_eval.set_format("torch")
 
+        # predictions are checkpointed in shards of consecutive batches, if they should be saved
+        save_preds = predictions_path is not None and not loss_only
+        shard_n_batches = self.predictions_shard_batches if save_preds else 1
+
         # ceil because we don't drop the last batch
         total_n_batch = ceil(preprocessed_eval.num_rows / self.eval_batch_size)
+        total_n_shards = ceil(total_n_batch / shard_n_batches)
+
+        # index of the first batch evaluated by this process
+        first_batch = 0
+
+        if world_size > 1:
+            # each process evaluates whole shards, so that shards saved don't depend on the number of processes
+            shards_per_process = ceil(total_n_shards / world_size)
+            first_batch = min(get_rank() * shards_per_process * shard_n_batches, total_n_batch)
+            last_batch = min(first_batch + shards_per_process * shard_n_batches, total_n_batch)
+
+            preprocessed_eval = preprocessed_eval.select(
+                range(first_batch * self.eval_batch_size,
+                      min(last_batch * self.eval_batch_size, preprocessed_eval.num_rows))
+            )
+            total_n_batch = last_batch - first_batch
 
         pbar_eval = tqdm(preprocessed_eval.iter(batch_size=self.eval_batch_size),
-                         total=total_n_batch)
+                         total=total_n_batch,
+                         disable=not is_main_process())
+
+        # loss is accumulated on device, it is moved to the host only when we need to show it
+        eval_loss = RunningMean()
+
+        # metrics are updated at each batch, so that results so far can be shown at any moment
+        # without recomputing them on all the predictions generated
+        metric_accumulator = MetricAccumulator(metric_list)
 
-        eval_loss = 0
-        total_preds: list[np.ndarray[str]] = []
-        total_truths = []
+        # predictions and loss of the shard being generated
+        shard_preds: list[np.ndarray[str]] = []
+        shard_truths: list[np.ndarray[str]] = []
+        shard_loss = RunningMean()
 
         # during predictions generations, we disable logging coming from the metrics package (and its children)
         # logging will be enabled back when we generate ALL predictions
         # this is done to avoid redundant and duplicated messages
         logger.disable("src.evaluate.metrics")
 
+        start = time.time()
+
         # progress will go from 0 to 100. Init to -1 so at 0 we perform the first print
         progress = -1
         for i, batch in enumerate(pbar_eval, start=1):
 
-            prepared_input = self.rec_model.prepare_input(batch)
-            predictions, truths, loss = self.rec_model.generate_step(prepared_input, return_loss=return_loss)
+            batch_idx = first_batch + i - 1
+            shard_idx = batch_idx // shard_n_batches
+            shard_path = get_shard_path(predictions_path, shard_idx) if save_preds else None
+
+            # shards already saved by an interrupted evaluation are read rather than generated again,
+            # the whole shard is considered when its first batch is reached
+            if shard_path is not None and os.path.isfile(shard_path):
+                if batch_idx % shard_n_batches == 0:
+                    self._update_from_shard(shard_path, metric_accumulator, eval_loss)
+            else:
+                prepared_input = self.rec_model.prepare_input(batch)
+
+                if loss_only:
+                    loss = self.rec_model.eval_loss_step(prepared_input)
+                else:
+                    predictions, truths, loss = self.rec_model.generate_step(prepared_input,
+                                                                             return_loss=return_loss)
+
+                    with INSTRUMENTATION.stage("compute_metrics") as record:
+                        metric_accumulator.update(predictions, truths)
+                        record.count(n_samples=len(truths))
+
+                    shard_preds.extend(predictions)
+                    shard_truths.extend(truths)
 
-            eval_loss += loss.item()
+                shard_loss.update(loss)
 
-            total_preds.extend(predictions)
-            total_truths.extend(truths)
+                # the shard is complete when its last batch (or the last batch of the eval set) is generated
+                if (batch_idx + 1) % shard_n_batches == 0 or i == total_n_batch:
+                    eval_loss.update(shard_loss.total, count=shard_loss.count)
+
+                    if save_preds:
+                        self._save_shard(shard_path, eval_dataset, shard_idx, shard_n_batches,
+                                         shard_preds, shard_truths, shard_loss, template_id)
+
+                    shard_preds, shard_truths, shard_loss = [], [], RunningMean()
 
             # we update the loss every 1% progress considering the total n° of batches
             # tqdm update integer percentage (1%, 2%) when float percentage is over .5 threshold (1.501 -> 2%)
-            # so we print infos in the same way
-            if round(100 * (i / total_n_batch)) > progress:
-                result_so_far = self._compute_metrics(total_preds, total_truths, metric_list)
+            # so we print infos in the same way. Only the main process shows the progress. Non-streamable metrics
+            # (e.g. error metrics) are not shown, since computing them would consider again all the batches seen so far
+            if is_main_process() and round(100 * (i / total_n_batch)) > progress:
+                result_so_far = metric_accumulator.compute(streamable_only=True)
 
                 pbar_desc = []
 
                 if return_loss:
-                    pbar_desc.append(f"{split_name} Loss -> {(eval_loss / i):.6f}")
+                    pbar_desc.append(f"{split_name} Loss -> {eval_loss.flush():.6f}")
 
                 for metric_name, metric_val in result_so_far.items():
                     pbar_desc.append(f"{metric_name} -> {metric_val:.6f}")
@@ -210,78 +374,335 @@ class RecEvaluator:
 
                 progress += 1
 
+            # if there's a time budget, results are computed on the users evaluated so far
+            if max_minutes is not None and time.time() - start >= max_minutes * 60 and i != total_n_batch:
+                logger.warning(f"Time budget of {max_minutes} minutes exhausted, {split_name} results are computed "
+                               f"on the first {i}/{total_n_batch} batches")
+
+                # batches of the incomplete shard are considered in results, but they are not saved
+                if shard_loss.count > 0:
+                    eval_loss.update(shard_loss.total, count=shard_loss.count)
+
+                break
+
         pbar_eval.close()
 
-        eval_loss /= total_n_batch
+        # metrics of each process are merged following the order of the eval set
+        if world_size > 1:
+            metric_accumulator, *other_accumulators = gather_objects(metric_accumulator)
+
+            for other_accumulator in other_accumulators:
+                metric_accumulator.merge(other_accumulator)
+
+        eval_loss = eval_loss.flush(synchronize=True)
 
         # enable back logging for metrics package
         logger.enable("src.evaluate.metrics")
 
-        res_eval_dict = self._compute_metrics(total_preds, total_truths, metric_list)
+        res_eval_dict = metric_accumulator.compute()
 
         if return_loss is True:
             res_eval_dict[str(Loss())] = eval_loss
 
+        if save_preds:
+            # once every process saved its shards, they are merged in a single file
+            barrier()
+
+            shard_paths = [get_shard_path(predictions_path, shard_idx) for shard_idx in range(total_n_shards)]
+            if is_main_process() and all(os.path.isfile(shard_path) for shard_path in shard_paths):
+                merge_predictions_shards(predictions_path, shard_paths,
+                                         template_id=template_id,
+                                         batch_size=self.eval_batch_size,
+                                         loss=eval_loss if return_loss else None)
+
         return res_eval_dict
 
+    def evaluate_task_all_templates(self, eval_dataset: datasets.Dataset,
+                                    metric_list: list[AnonMetric],
+                                    task: AnonTask,
+                                    template_ids: list[int],
+                                    predictions_paths: dict[int, str | None] = None) -> dict[int, dict[str, float]]:
+        """
+        Evaluates all `template_ids` of `task` at once: prompts of every template are rendered for each user in a
+        single tokenization pass, and prompts of different templates are generated in the same batches, so that
+        only the last batch of the whole evaluation is not full. Predictions are then demultiplexed and metrics
+        of each template are computed on batches of `eval_batch_size` users, as `evaluate_task()` does.
+        The Loss can't be computed in this mode, since it is returned for whole batches
+
+        Returns:
+            dict where keys are template ids and values are the results of the template
+        """
+
+        self._check_compatibility(task, metric_list)
+
+        if Loss() in metric_list:
+            raise ValueError("Loss can't be computed when evaluating multiple templates at once!")
+
+        self.rec_model.eval()
+
+        split_name = eval_dataset.split if eval_dataset.split is not None else "eval"
+
+        # all processes tokenize the whole set starting from the same random state (see `evaluate_task()`)
+        world_size = get_world_size()
+        if world_size > 1:
+            set_rng_state(broadcast_object(get_rng_state()))
+
+        preprocessed_eval = eval_dataset.map(
+            self._tokenize_all_templates,
+            fn_kwargs={"task": task, "template_ids": template_ids},
+            with_indices=True,
+            remove_columns=eval_dataset.column_names,
+            keep_in_memory=True,
+            load_from_cache_file=False,
+            batched=True,
+            desc=f"Tokenizing {split_name} set for {len(template_ids)} templates"
+        )
+        preprocessed_eval.set_format("torch")
+
+        # ceil because we don't drop the last batch
+        total_n_batch = ceil(preprocessed_eval.num_rows / self.eval_batch_size)
+
+        if world_size > 1:
+            batches_per_process = ceil(total_n_batch / world_size)
+            first_batch = min(get_rank() * batches_per_process, total_n_batch)
+            last_batch = min(first_batch + batches_per_process, total_n_batch)
+
+            preprocessed_eval = preprocessed_eval.select(
+                range(first_batch * self.eval_batch_size,
+                      min(last_batch * self.eval_batch_size, preprocessed_eval.num_rows))
+            )
+            total_n_batch = last_batch - first_batch
+
+        pbar_eval = tqdm(preprocessed_eval.iter(batch_size=self.eval_batch_size),
+                         total=total_n_batch,
+                         disable=not is_main_process())
+
+        metric_accumulators = {template_id: MetricAccumulator(metric_list) for template_id in template_ids}
+
+        # demultiplexed predictions which still don't fill a batch of `eval_batch_size` users of the template
+        pending = {template_id: ([], []) for template_id in template_ids}
+
+        # predictions are kept only if they should be saved
+        save_preds = predictions_paths is not None and any(path is not None for path in predictions_paths.values())
+        total_preds = {template_id: ([], [], []) for template_id in template_ids}
+
+        logger.disable("src.evaluate.metrics")
+
+        # progress will go from 0 to 100. Init to -1 so at 0 we perform the first print
+        progress = -1
+        for i, batch in enumerate(pbar_eval, start=1):
+
+            batch_template_ids = batch.pop("template_id").numpy()
+            batch_user_rows = batch.pop("user_row").numpy()
+
+            prepared_input = self.rec_model.prepare_input(batch)
+            predictions, truths, _ = self.rec_model.generate_step(prepared_input, return_loss=False)
+
+            for template_id in np.unique(batch_template_ids):
+                template_idxs = np.flatnonzero(batch_template_ids == template_id)
+                template_pending_preds, template_pending_truths = pending[template_id]
+
+                template_pending_preds.extend(predictions[template_idxs])
+                template_pending_truths.extend(truths[template_idxs])
+
+                # metrics are updated with the same batches of users considered by `evaluate_task()`
+                while len(template_pending_preds) >= self.eval_batch_size:
+                    metric_accumulators[template_id].update(template_pending_preds[:self.eval_batch_size],
+                                                            template_pending_truths[:self.eval_batch_size])
+
+                    del template_pending_preds[:self.eval_batch_size]
+                    del template_pending_truths[:self.eval_batch_size]
+
+                if save_preds:
+                    template_user_rows, template_preds, template_truths = total_preds[template_id]
+
+                    template_user_rows.extend(batch_user_rows[template_idxs].tolist())
+                    template_preds.extend(predictions[template_idxs])
+                    template_truths.extend(truths[template_idxs])
+
+            # results shown are averaged across templates, non-streamable metrics are not shown
+            if is_main_process() and round(100 * (i / total_n_batch)) > progress:
+                results_so_far = pd.DataFrame([metric_accumulator.compute(streamable_only=True)
+                                               for metric_accumulator in metric_accumulators.values()]).mean()
+
+                pbar_eval.set_description(", ".join(f"{metric_name} -> {metric_val:.6f}"
+                                                    for metric_name, metric_val in results_so_far.items()))
+
+                progress += 1
+
+        pbar_eval.close()
+
+        # the last batch of each template may have less than `eval_batch_size` users
+        for template_id, (template_pending_preds, template_pending_truths) in pending.items():
+            if len(template_pending_preds) > 0:
+                metric_accumulators[template_id].update(template_pending_preds, template_pending_truths)
+
+        if world_size > 1:
+            gathered_accumulators = gather_objects(metric_accumulators)
+
+            for template_id in template_ids:
+                for other_accumulators in gathered_accumulators[1:]:
+                    metric_accumulators[template_id].merge(other_accumulators[template_id])
+
+        logger.enable("src.evaluate.metrics")
+
+        if save_preds:
+            gathered = gather_objects(total_preds)
+
+            if is_main_process():
+                all_user_ids = np.array(eval_dataset["user_id"])
+
+                for template_id in template_ids:
+                    if predictions_paths[template_id] is None:
+                        continue
+
+                    user_rows = [row for process_res in gathered for row in process_res[template_id][0]]
+                    save_predictions(predictions_paths[template_id],
+                                     user_ids=all_user_ids[user_rows].tolist(),
+                                     preds=[pred for process_res in gathered for pred in process_res[template_id][1]],
+                                     truths=[truth for process_res in gathered
+                                             for truth in process_res[template_id][2]],
+                                     template_id=template_id,
+                                     batch_size=self.eval_batch_size)
+
+        return {template_id: metric_accumulator.compute()
+                for template_id, metric_accumulator in metric_accumulators.items()}
+
+    def _tokenize_all_templates(self, batch: dict, indices: list[int], task: AnonTask, template_ids: list[int]):
+
+        tokenized_templates = []
+        for template_id in template_ids:
+            self.rec_model.eval_task = task.force_template(template_id)
+            tokenized_templates.append(self.rec_model.tokenize(batch))
+
+        # prompts of the same user are consecutive: they have similar length, so that padding is reduced
+        tokenized_batch = {
+            column: [tokenized[column][i] for i in range(len(indices)) for tokenized in tokenized_templates]
+            for column in tokenized_templates[0]
+        }
+
+        # needed to demultiplex predictions generated
+        tokenized_batch["template_id"] = [template_id for _ in indices for template_id in template_ids]
+        tokenized_batch["user_row"] = [user_row for user_row in indices for _ in template_ids]
+
+        return tokenized_batch
+
     @staticmethod
-    def _compute_metrics(preds: list[np.ndarray[str]], truths: list[np.ndarray[str]], metric_list: list[AnonMetric]):
+    def _check_compatibility(task: AnonTask, metric_list: list[AnonMetric]):
+
+        all_cls_metrics = {metric.__class__ for metric in metric_list}
+
+        for cls_metric in all_cls_metrics:
+
+            # if metric is compatible or is Loss, we pass directly to the next metric to check
+            if any(issubclass(cls_metric, cls_compatible) or cls_metric == Loss
+                   for cls_compatible in task.compatible_metrics()):
+                continue
+
+            raise ValueError(
+                f"Task {task} is incompatible with {cls_metric.__name__}! It can be only evaluated on the "
+                f"following metrics: {[compatible_metric.__name__ for compatible_metric in task.compatible_metrics()]}"
+            )
+
+    def _bootstrap_template(self, predictions_path: str, metric_list: list[AnonMetric]) -> pd.DataFrame:
 
-        # this works regardless of metric type, k is always None for error metrics. This works
-        # on the assumption that a metric type is the immediate parent of the specific metric,
-        # e.g. class Hit(RankingMetric) -> RankingMetric is the metric type
+        _, per_user_values = per_user_values_from_predictions(predictions_path, metric_list)
 
-        # Pad truth array if necessary
-        # (predictions can't be padded otherwise metric computation will be wrong, thus
-        # they should be in constant number for each user)
-        padded_truths = PaddedArr(truths)
+        template_ci = bootstrap_confidence_intervals(per_user_values, metric_list,
+                                                     n_resamples=self.bootstrap_resamples,
+                                                     confidence_level=self.confidence_level,
+                                                     random_seed=self.random_seed)
 
-        # convert preds to array and check that there is no <PAD> token
-        preds: np.ndarray = np.array(preds)
-        assert not (preds == "<PAD>").any(), "<PAD> is the pad token and can't be used as element of array!"
+        print(f"{self.confidence_level:.0%} bootstrap confidence intervals ({self.bootstrap_resamples} resamples):")
+        print(template_ci)
 
-        # we are separating metrics depending on their class
-        type2metric_dict: dict[type[AnonMetric], list[AnonMetric]] = defaultdict(list)
+        return template_ci
 
-        for metric in metric_list:
-            # metric_type is the immediate parent
-            [metric_type] = metric.__class__.__bases__
-            type2metric_dict[metric_type].append(metric)
+    def _save_shard(self, shard_path: str, eval_dataset: datasets.Dataset, shard_idx: int, shard_n_batches: int,
+                    shard_preds: list[np.ndarray[str]], shard_truths: list[np.ndarray[str]],
+                    shard_loss: RunningMean, template_id: int):
 
-        # each metric type could compute the precomputed metric differently
-        # If ranking metrics:
-        # Build rel binary matrix by cutting predictions to the max k desired
-        # Save resources by not computing relevance for predictions outside the k range,
-        # which are not used by any metric passed in input
+        # users are tokenized 1:1, so predictions follow the order of the users in the eval set
+        first_row = shard_idx * shard_n_batches * self.eval_batch_size
+        user_ids = eval_dataset[first_row:first_row + len(shard_preds)]["user_id"]
 
-        cls_precomputed_matrix = {}
-        for metric_type in type2metric_dict:
-            # find the metric with the max k: we will compute the precomputed matrix
-            # using that metric.
-            # Used to save some computational resources, since we will compute metrics
-            # by first cutting predictions to max k. If there is at least one None,
-            # sadly it means that we can't save any resource
-            max_k_metric = max(type2metric_dict[metric_type], key=lambda x: x.k if x.k is not None else np.inf)
+        # the loss is NaN if it was not requested
+        loss_sum = shard_loss.total.item()
 
-            cls_precomputed_matrix[metric_type] = max_k_metric.per_user_precomputed_matrix(preds, padded_truths)
+        save_predictions_shard(shard_path, user_ids, shard_preds, shard_truths,
+                               template_id=template_id,
+                               batch_size=self.eval_batch_size,
+                               loss_sum=None if np.isnan(loss_sum) else loss_sum,
+                               n_batches=shard_loss.count)
 
-        all_metric_results = {}
-        for metric in metric_list:
+    def _update_from_shard(self, shard_path: str, metric_accumulator: MetricAccumulator, eval_loss: RunningMean):
 
-            [metric_type] = metric.__class__.__bases__
-            precomputed_matrix = cls_precomputed_matrix[metric_type]
+        _, preds, truths, metadata = load_predictions(shard_path)
 
-            # when computing the specific metric result, we consider its k value which wil surely be <= max_k
-            # obviously if k is None, all predictions will be used (because no cut has happened)
-            if metric.k is not None:
-                precomputed_matrix = precomputed_matrix[:, :metric.k]
+        # predictions are considered in batches of the same size used when generating them
+        for start in range(0, len(preds), self.eval_batch_size):
+            metric_accumulator.update(preds[start:start + self.eval_batch_size],
+                                      truths[start:start + self.eval_batch_size])
+
+        loss_sum = metadata["loss_sum"] if metadata["loss_sum"] is not None else np.nan
+        eval_loss.update(torch.tensor(loss_sum), count=metadata["n_batches"])
+
+    def _sync_predictions_dir(self, predictions_dir: str, eval_dataset: datasets.Dataset):
+
+        manifest = build_manifest(self.rec_model, eval_dataset,
+                                  eval_batch_size=self.eval_batch_size,
+                                  shard_n_batches=self.predictions_shard_batches)
+
+        # only the main process checks (and eventually deletes) predictions previously saved
+        is_resumed = sync_manifest(predictions_dir, manifest) if is_main_process() else None
+        is_resumed = broadcast_object(is_resumed)
+
+        if is_resumed:
+            print(f"# Predictions saved in {predictions_dir} by a previous evaluation will be reused\n")
+
+        barrier()
+
+    def evaluate_predictions(self, predictions_path: str, metric_list: list[AnonMetric]):
+        """
+        Computes metrics on predictions previously saved by `evaluate_task()`, without generating them again.
+        Predictions are considered in batches of the same size used when generating them, so that results are
+        exactly the same
+        """
+
+        user_ids, preds, truths, metadata = load_predictions(predictions_path)
+
+        return_loss = Loss() in metric_list
+        metric_list = [metric for metric in metric_list if metric != Loss()]
+
+        batch_size = metadata["batch_size"]
+        metric_accumulator = MetricAccumulator(metric_list)
+        for start in range(0, len(preds), batch_size):
+            metric_accumulator.update(preds[start:start + batch_size], truths[start:start + batch_size])
+
+        res_eval_dict = metric_accumulator.compute()
+
+        if return_loss is True:
+            if metadata["loss"] is None:
+                logger.warning(f"Loss was not computed when generating predictions saved in {predictions_path}, "
+                               f"thus it will be NaN!")
+
+            res_eval_dict[str(Loss())] = metadata["loss"] if metadata["loss"] is not None else np.nan
+
+        print(f"# Metrics computed on {len(user_ids)} users from predictions saved in {predictions_path}")
+
+        return res_eval_dict
+
+    @staticmethod
+    def _compute_metrics(preds: list[np.ndarray[str]], truths: list[np.ndarray[str]], metric_list: list[AnonMetric]):
 
-            all_metric_results[str(metric)] = metric(precomputed_matrix)
+        # all predictions are considered as a single batch
+        metric_accumulator = MetricAccumulator(metric_list)
+        metric_accumulator.update(preds, truths)
 
-        return all_metric_results
+        return metric_accumulator.compute()
 
     @staticmethod
-    def _create_latex_table(res_df: pd.DataFrame, task_name: str):
+    def _create_latex_table(res_df: pd.DataFrame, task_name: str, n_summary_rows: int = 2):
 
         title = task_name
         n_metrics = len(res_df.columns)
@@ -318,8 +739,9 @@ class RecEvaluator:
         # --start numeric values
         latex_code += r"\midrule" + "\n"
 
-        template_res = res_df[:-2]
-        mean_best = res_df[-2:]
+        # the last rows are the summary ones (e.g. "mean" and "max", or only "mean" if the loss is the only metric)
+        template_res = res_df[:-n_summary_rows]
+        mean_best = res_df[-n_summary_rows:]
 
         # set bold for template id which gave best result for each metric
         for metric_name in template_res.columns:
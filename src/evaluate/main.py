@@ -1,21 +1,28 @@
 import os
+import time
 
+import pandas as pd
 from datasets import Dataset
 
-from src import GeneralParams, METRICS_DIR, PROCESSED_DATA_DIR, MODELS_DIR
+from src import GeneralParams, METRICS_DIR, PROCESSED_DATA_DIR, MODELS_DIR, PREDICTIONS_DIR
 from src.data import DataParams
 from src.data.abstract_dataset import AnonDataset
 from src.data.abstract_task import AnonTask
 from src.evaluate import EvalParams
 from src.evaluate.abstract_metric import AnonMetric
+from src.evaluate.abstract_metric import Loss
 from src.evaluate.evaluator import RecEvaluator
+from src.evaluate.predictions import get_predictions_path
+from src.evaluate.significance import per_user_values_from_predictions, align_users, paired_randomization_test
 from src.model import AnonModel, ModelParams
+from src.utils import seed_everything
 
 
 def eval_main(general_params: GeneralParams,
               data_params: DataParams,
               model_params: ModelParams,
-              eval_params: EvalParams):
+              eval_params: EvalParams,
+              from_predictions: bool = False):
 
     # general params
     exp_name = general_params.exp_name
@@ -26,6 +33,11 @@ def eval_main(general_params: GeneralParams,
     eval_batch_size = eval_params.eval_batch_size
     eval_task_dict = eval_params.eval_tasks
     create_latex_table = eval_params.create_latex_table
+    save_predictions = eval_params.save_predictions
+    predictions_shard_batches = eval_params.predictions_shard_batches
+    cross_template_batching = eval_params.cross_template_batching
+    bootstrap_resamples = eval_params.bootstrap_resamples
+    confidence_level = eval_params.confidence_level
 
     # load dataset created in data phase
     dataset_cls = AnonDataset.dataset_exists(data_params.dataset_cls_name, return_bool=False)
@@ -33,11 +45,17 @@ def eval_main(general_params: GeneralParams,
     dataset_path = os.path.join(PROCESSED_DATA_DIR, exp_name)
     dataset_obj = dataset_cls.load(dataset_path)
 
-    # load model created in model phase
-    model_cls = AnonModel.model_exists(model_params.model_cls_name, return_bool=False)
+    # load model created in model phase. If metrics are computed from predictions
+    # previously saved, there's no need to load the model
+    rec_model = None
+    if not from_predictions:
+        model_cls = AnonModel.model_exists(model_params.model_cls_name, return_bool=False)
+
+        model_path = os.path.join(MODELS_DIR, general_params.exp_name)
+        rec_model = model_cls.load(model_path, **model_params.model_kwargs)
 
-    model_path = os.path.join(MODELS_DIR, general_params.exp_name)
-    rec_model = model_cls.load(model_path, **model_params.model_kwargs)
+        # set model to correct device
+        rec_model.to(device)
 
     ds_dict = dataset_obj.get_hf_datasets()
     test_set = ds_dict["test"]
@@ -45,9 +63,6 @@ def eval_main(general_params: GeneralParams,
     # REDUCE FOR TEST
     # test_set = Dataset.from_dict(test_set[:100])
 
-    # set model to correct device
-    rec_model.to(device)
-
     # convert from str to objects
     eval_task_dict = {
         AnonTask.from_string(eval_task_str): [AnonMetric.from_string(metric_str) for metric_str in metric_list_str]
@@ -56,9 +71,159 @@ def eval_main(general_params: GeneralParams,
 
     output_dir = os.path.join(METRICS_DIR, exp_name)
 
-    evaluator = RecEvaluator(rec_model, eval_batch_size, should_log=should_log)
+    # e.g. reports/predictions/eval_exp
+    predictions_dir = os.path.join(PREDICTIONS_DIR, exp_name) if save_predictions or from_predictions else None
+
+    evaluator = RecEvaluator(rec_model, eval_batch_size, should_log=should_log,
+                             predictions_shard_batches=predictions_shard_batches,
+                             cross_template_batching=cross_template_batching,
+                             bootstrap_resamples=bootstrap_resamples,
+                             confidence_level=confidence_level,
+                             random_seed=general_params.random_seed)
 
     evaluator.evaluate_suite(test_set,
                              tasks_to_evaluate=eval_task_dict,
                              output_dir=output_dir,
-                             create_latex_table=create_latex_table)
+                             create_latex_table=create_latex_table,
+                             predictions_dir=predictions_dir,
+                             from_predictions=from_predictions)
+
+
+def compare_main(general_params: GeneralParams,
+                 eval_params: EvalParams,
+                 other_exp_name: str):
+    """
+    Compares results of the experiment with the ones of `other_exp_name` with a paired randomization test
+    for each task, template and metric. Predictions of both experiments must have been saved during evaluation
+    """
+
+    exp_name = general_params.exp_name
+
+    output_dir = os.path.join(METRICS_DIR, exp_name)
+    os.makedirs(output_dir, exist_ok=True)
+
+    for task_str, metric_list_str in eval_params.eval_tasks.items():
+        task = AnonTask.from_string(task_str)
+
+        # the loss is not computed for each user
+        metric_list = [AnonMetric.from_string(metric_str) for metric_str in metric_list_str]
+        metric_list = [metric for metric in metric_list if metric != Loss()]
+
+        if len(metric_list) == 0:
+            continue
+
+        task_test_results = {}
+        for template_id in task.inference_templates(return_id=True):
+            user_ids, per_user_values = per_user_values_from_predictions(
+                get_predictions_path(os.path.join(PREDICTIONS_DIR, exp_name), task, template_id), metric_list
+            )
+            other_user_ids, other_per_user_values = per_user_values_from_predictions(
+                get_predictions_path(os.path.join(PREDICTIONS_DIR, other_exp_name), task, template_id), metric_list
+            )
+
+            # users are paired by their id
+            per_user_values, other_per_user_values = align_users(user_ids, per_user_values,
+                                                                 other_user_ids, other_per_user_values)
+
+            task_test_results[template_id] = paired_randomization_test(
+                per_user_values, other_per_user_values, metric_list,
+                n_permutations=eval_params.randomization_permutations,
+                random_seed=general_params.random_seed
+            )
+
+        task_test_df = pd.concat(task_test_results, names=["Template ID"])
+        task_test_df = task_test_df.rename(columns={"A": exp_name, "B": other_exp_name})
+
+        print(f"Paired randomization test for task {task} ({eval_params.randomization_permutations} permutations):")
+        print(task_test_df)
+        print()
+
+        # e.g. reports/metrics/eval_exp/SequentialSideInfoTask_vs_other_exp.csv
+        task_test_df.to_csv(os.path.join(output_dir, f"{task}_vs_{other_exp_name}.csv"))
+
+        print(f"# CSV Results saved into {os.path.join(output_dir, f'{task}_vs_{other_exp_name}.csv')}!")
+
+
+def quantize_main(general_params: GeneralParams,
+                  data_params: DataParams,
+                  model_params: ModelParams,
+                  eval_params: EvalParams,
+                  quantize: str,
+                  output_dir: str = None):
+    """
+    Quantizes the model trained for inference on cpu, reports how metrics of the eval tasks on the validation
+    split change with respect to the original model, and saves the quantized model into `output_dir`
+    (by default models/{exp_name}/quantized_{quantize})
+    """
+
+    exp_name = general_params.exp_name
+
+    # load dataset created in data phase
+    dataset_cls = AnonDataset.dataset_exists(data_params.dataset_cls_name, return_bool=False)
+    dataset_obj = dataset_cls.load(os.path.join(PROCESSED_DATA_DIR, exp_name))
+
+    val_set = dataset_obj.get_hf_datasets()["validation"]
+
+    model_cls = AnonModel.model_exists(model_params.model_cls_name, return_bool=False)
+    model_path = os.path.join(MODELS_DIR, exp_name)
+
+    # the original model is loaded without any quantization, even if it is set in the model kwargs
+    model_kwargs = {key: val for key, val in model_params.model_kwargs.items() if key != "quantize"}
+
+    # e.g. reports/metrics/eval_exp/quantization
+    quantization_metrics_dir = os.path.join(METRICS_DIR, exp_name, "quantization")
+
+    results = {}
+    eval_minutes = {}
+    rec_model = None
+    for model_name, quantize_kwargs in (("fp32", {}), (quantize, {"quantize": quantize})):
+        print(f"# Evaluating {model_name} model on validation split")
+
+        rec_model = model_cls.load(model_path, **model_kwargs, **quantize_kwargs)
+
+        # quantized layers run on cpu only, so both models are evaluated on cpu for a fair comparison
+        rec_model.to("cpu")
+
+        # metric objects are created again, so that no state is shared between the two evaluations
+        eval_task_dict = {
+            AnonTask.from_string(eval_task_str): [AnonMetric.from_string(metric_str) for metric_str in metric_list_str]
+            for eval_task_str, metric_list_str in eval_params.eval_tasks.items()
+        }
+
+        evaluator = RecEvaluator(rec_model, eval_params.eval_batch_size, random_seed=general_params.random_seed)
+
+        # same state for both evaluations, so that the same prompts are rendered
+        seed_everything(general_params.random_seed)
+
+        start = time.perf_counter()
+        results[model_name] = evaluator.evaluate_suite(val_set,
+                                                       tasks_to_evaluate=eval_task_dict,
+                                                       output_dir=os.path.join(quantization_metrics_dir, model_name),
+                                                       create_latex_table=False)
+        eval_minutes[model_name] = (time.perf_counter() - start) / 60
+
+    print(" QUANTIZATION RESULTS ".center(80, "-"))
+
+    for task_str, quantized_result_df in results[quantize].items():
+        delta_df = quantized_result_df - results["fp32"][task_str]
+
+        print(f"Delta of {quantize} model with respect to fp32 model for task {task_str}:")
+        print(delta_df)
+        print()
+
+        # e.g. reports/metrics/eval_exp/quantization/SequentialSideInfoTask_int8_delta.csv
+        delta_df.to_csv(os.path.join(quantization_metrics_dir, f"{task_str}_{quantize}_delta.csv"))
+
+    print(f"Evaluation time on cpu: fp32 -> {eval_minutes['fp32']:.2f} minutes, "
+          f"{quantize} -> {eval_minutes[quantize]:.2f} minutes "
+          f"(speedup {eval_minutes['fp32'] / eval_minutes[quantize]:.2f}x)")
+
+    print(f"# CSV delta results saved into {quantization_metrics_dir}!")
+
+    output_dir = output_dir if output_dir is not None else os.path.join(model_path, f"quantized_{quantize}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    # the quantized model saved can be loaded back with `load()` as any other model
+    rec_model.save(output_dir)
+
+    print(f"# Quantized model saved into {output_dir}")
@@ -1,10 +1,11 @@
+import math
 import operator
 
 import numpy as np
 import pandas as pd
 from loguru import logger
 
-from src.evaluate.abstract_metric import AnonMetric, PaddedArr
+from src.evaluate.abstract_metric import AnonMetric, RaggedArr
 
 
 class ErrorMetric(AnonMetric):
@@ -16,50 +17,70 @@ class ErrorMetric(AnonMetric):
     def operator_comparison(self):
         return operator.lt
 
-    def per_user_precomputed_matrix(self, predictions: np.ndarray[str], truths: PaddedArr):
+    # predictions are bounded to the range of ALL the truths, so the result of a batch depends on the others
+    streamable = False
 
-        if (predictions.shape != truths.shape) or (truths == "<PAD>").any():
+    def per_user_precomputed_matrix(self, predictions: np.ndarray[str], truths: RaggedArr):
+        return self.merge_batch_states([self.batch_state(predictions, truths)])
+
+    def batch_state(self, predictions: np.ndarray[str], truths: RaggedArr) -> np.ndarray[float]:
+
+        truths = RaggedArr.wrap(truths)
+
+        # each user must have exactly one truth for each prediction
+        if (predictions.ndim != 2 or len(predictions) != len(truths) or
+                (truths.lengths != predictions.shape[1]).any()):
             raise ValueError("When computing Error metrics, predictions and truths should be in 1:1 relationship and "
                              "thus have same shape!")
 
+        # we consider only valid predictions (and their corresponding truth values),
+        # i.e. generated text by the LLM which can be converted into a number
+        valid_mask = self.defined_mask(predictions, truths)
+
         predictions = pd.to_numeric(predictions.flatten(), errors="coerce")
-        truths = pd.to_numeric(truths.flatten(), errors="coerce")
+        truths = pd.to_numeric(truths.values, errors="coerce")
 
         if np.isnan(truths).any():
             raise ValueError("Array representing the ground truth contains elements which are not numbers, "
                              "but numbers are required for error metrics!")
 
-        # we consider only valid predictions (and their corresponding truth values),
-        # i.e. generated text by the LLM which can be converted into a number
-        nan_predictions = np.isnan(predictions)
-
-        valid_preds = predictions[~nan_predictions]
-        valid_truths = truths[~nan_predictions]
+        valid_preds = predictions[valid_mask]
+        valid_truths = truths[valid_mask]
 
         if len(valid_preds) != len(predictions):
             ignored_predictions = len(predictions) - len(valid_preds)
             logger.info(f"For metric {str(self)}, {ignored_predictions} predictions (out of a total of "
                         f"{len(predictions)}) are ignored since the LLM did not generate valid numbers")
 
+        # first row contains valid predictions, second row their corresponding truths
+        return np.vstack((valid_preds, valid_truths)).astype(float)
+
+    def defined_mask(self, predictions: np.ndarray[str], truths: RaggedArr) -> np.ndarray[bool]:
+        # one value for each prediction, defined only if the prediction is a number
+        return ~np.isnan(pd.to_numeric(predictions.flatten(), errors="coerce"))
+
+    def merge_batch_states(self, batch_states: list[np.ndarray[float]]) -> np.ndarray[float]:
+
+        valid_preds, valid_truths = np.hstack(batch_states) if len(batch_states) != 0 else np.empty((2, 0))
+
         # we are bounding the predictions made which are over/below
         # the range of values we have in truth
-        max_truth = valid_truths.max()
-        min_truth = valid_truths.min()
-
-        valid_preds[valid_preds > max_truth] = max_truth
-        valid_preds[valid_preds < min_truth] = min_truth
+        if len(valid_truths) != 0:
+            valid_preds = np.clip(valid_preds, valid_truths.min(), valid_truths.max())
 
-        # perform subtraction ignoring <PAD> tokens
         return valid_preds - valid_truths
 
 
 class RMSE(ErrorMetric):
 
-    def __call__(self, per_user_precomputed_matrix: np.ndarray) -> float:
-        return np.sqrt(np.mean(per_user_precomputed_matrix ** 2)).item()
+    def per_user_values(self, per_user_precomputed_matrix: np.ndarray) -> np.ndarray:
+        return per_user_precomputed_matrix ** 2
+
+    def aggregate(self, total: float, count: int) -> float:
+        return math.sqrt(super().aggregate(total, count))
 
 
 class MAE(ErrorMetric):
 
-    def __call__(self, per_user_precomputed_matrix: np.ndarray) -> float:
-        return np.mean(np.abs(per_user_precomputed_matrix)).item()
+    def per_user_values(self, per_user_precomputed_matrix: np.ndarray) -> np.ndarray:
+        return np.abs(per_user_precomputed_matrix)
@@ -1,11 +1,98 @@
 from __future__ import annotations
 
 import operator
+from abc import abstractmethod
+from functools import lru_cache
 from typing import Callable
 
 import numpy as np
+import pandas as pd
 
-from src.evaluate.abstract_metric import AnonMetric, PaddedArr
+from src.evaluate.abstract_metric import AnonMetric, RaggedArr
+
+
+@lru_cache(maxsize=32)
+def discount_table(length: int, discount_log: Callable = np.log2) -> np.ndarray[float]:
+    """
+    Discounts of the first `length` ranking positions, i.e. discount_log(2), ..., discount_log(length + 1).
+    Tables are cached by length (and log function), thus they are computed only once and must not be modified
+    """
+
+    discounts = discount_log(np.arange(2, length + 2))
+    discounts.flags.writeable = False
+
+    return discounts
+
+
+@lru_cache(maxsize=32)
+def ideal_dcg_table(length: int, discount_log: Callable = np.log2) -> np.ndarray[float]:
+    """
+    Ideal DCG of a ranking list having n relevant items, for each n from 0 to `length`. Relevance is binary,
+    so the ideal ranking list simply has all the relevant items in the first positions: no sorting is needed
+    """
+
+    ideal_dcgs = np.concatenate(([0.], np.cumsum(1 / discount_table(length, discount_log))))
+    ideal_dcgs.flags.writeable = False
+
+    return ideal_dcgs
+
+
+class RankingPrefixStats:
+    """
+    Prefix sums over ranking positions of a binary relevance matrix. Each ranking metric at any cutoff k
+    (hit@5, hit@10, ndcg@10, ...) is read from them in a vectorized way, without slicing the relevance
+    matrix and recomputing everything for each metric
+    """
+
+    def __init__(self, rel_matrix: np.ndarray):
+
+        self.n_users, self.n_preds = rel_matrix.shape
+        self.rel_matrix = rel_matrix
+
+        # n° of relevant items in the first i+1 positions of each ranking list
+        self.cum_hits = np.cumsum(rel_matrix, axis=1, dtype=np.int64)
+
+        # position of the first relevant item (n_preds if there is none)
+        self.first_rel_position = np.where(rel_matrix.any(axis=1), rel_matrix.argmax(axis=1), self.n_preds)
+
+        # computed only if a metric needs them
+        self._precision_at_rel_sums = None
+        self._dcg_sums = {}
+
+    def _at_k(self, prefix_matrix: np.ndarray, k: int | None) -> np.ndarray:
+
+        # if k is None or greater than the n° of predictions, all predictions are considered
+        k = self.n_preds if k is None else min(k, self.n_preds)
+
+        if k == 0:
+            return np.zeros(self.n_users, dtype=prefix_matrix.dtype)
+
+        return prefix_matrix[:, k - 1]
+
+    def hits(self, k: int | None) -> np.ndarray[int]:
+        return self._at_k(self.cum_hits, k)
+
+    def precision_at_rel_sums(self, k: int | None) -> np.ndarray[float]:
+
+        # sum of the precision computed at each position of a relevant item
+        if self._precision_at_rel_sums is None:
+            positions = np.arange(1, self.n_preds + 1)
+            self._precision_at_rel_sums = np.cumsum(self.rel_matrix * self.cum_hits / positions, axis=1)
+
+        return self._at_k(self._precision_at_rel_sums, k)
+
+    def dcg(self, k: int | None, discount_log: Callable = np.log2) -> np.ndarray[float]:
+
+        if discount_log not in self._dcg_sums:
+            self._dcg_sums[discount_log] = np.cumsum(self.rel_matrix / discount_table(self.n_preds, discount_log),
+                                                     axis=1)
+
+        return self._at_k(self._dcg_sums[discount_log], k)
+
+    def ideal_dcg(self, k: int | None, discount_log: Callable = np.log2) -> np.ndarray[float]:
+
+        # ideal DCG only depends on the n° of relevant items in the ranking list cut at k
+        return ideal_dcg_table(self.n_preds, discount_log)[self.hits(k)]
 
 
 class RankingMetric(AnonMetric):
@@ -14,19 +101,46 @@ class RankingMetric(AnonMetric):
     def operator_comparison(self):
         return operator.gt
 
-    def per_user_precomputed_matrix(self, predictions: np.ndarray[str], truths: PaddedArr):
+    def per_user_precomputed_matrix(self, predictions: np.ndarray[str], truths: RaggedArr):
+
+        truths = RaggedArr.wrap(truths)
 
         # If K is none a new dimension is added! Important to be sure k is not None
         if self.k is not None:
             predictions = predictions[:, :self.k]
 
-        # no need to check if preds are != <PAD> to avoid that <PAD> tokens in pred and truth match,
-        # since predictions are surely not padded
-        result = predictions[:, np.newaxis, :] == truths[:, :, np.newaxis]
+        # strings are mapped to integer codes, so that relevance can be computed with integer comparisons.
+        # Truths are not padded, so only actual truths of each user are considered
+        n_users, n_preds = predictions.shape
+        codes, vocabulary = pd.factorize(np.concatenate((predictions.ravel(), truths.values)))
+
+        # each (user, item) pair is mapped to a unique key, so that the truths of all users can be
+        # sorted into a single array and membership of each prediction is tested with a binary search
+        user_offsets = np.arange(n_users, dtype=np.int64)[:, np.newaxis] * len(vocabulary)
+
+        pred_keys = codes[:predictions.size].reshape(n_users, n_preds) + user_offsets
+        truth_keys = np.sort(codes[predictions.size:] + user_offsets.ravel()[truths.row_ids])
+
+        # searchsorted returns len(truth_keys) for keys greater than all the truths, clip to avoid index errors
+        positions = np.searchsorted(truth_keys, pred_keys).clip(max=max(len(truth_keys) - 1, 0))
+        rel_matrix = (truth_keys[positions] == pred_keys) if len(truth_keys) != 0 else np.zeros_like(pred_keys)
+
+        return rel_matrix.astype(np.uint8)
+
+    def per_user_values(self, per_user_precomputed_matrix: np.ndarray) -> np.ndarray:
+        return self.per_user_values_from_prefix(RankingPrefixStats(per_user_precomputed_matrix))
 
-        rel_matrix = result.any(axis=1)
+    def per_user_values_multi(self, metrics: list[RankingMetric],
+                              per_user_precomputed_matrix: np.ndarray) -> dict[str, np.ndarray]:
 
-        return rel_matrix
+        # prefix sums are computed once, and each metric at its cutoff is read from them
+        prefix_stats = RankingPrefixStats(per_user_precomputed_matrix)
+
+        return {str(metric): metric.per_user_values_from_prefix(prefix_stats) for metric in metrics}
+
+    @abstractmethod
+    def per_user_values_from_prefix(self, prefix_stats: RankingPrefixStats) -> np.ndarray:
+        raise NotImplementedError
 
     def __eq__(self, other):
         if isinstance(other, self.__class__) and other.k == self.k:
@@ -43,53 +157,36 @@ class RankingMetric(AnonMetric):
 
 class Hit(RankingMetric):
 
-    def __call__(self, per_user_precomputed_matrix: np.ndarray) -> float:
+    def per_user_values_from_prefix(self, prefix_stats: RankingPrefixStats) -> np.ndarray:
 
-        # intuitively, we want to """remove""" the dimension of items (axis=1) and maintain
-        # the user dimension (axis=0). This variable will contain a bool value for each user: if at least one prediction
-        # is relevant (appears in the user ground truth) for the user, the bool value is True
-        per_user_hit = np.any(per_user_precomputed_matrix, axis=1)
-
-        return np.mean(per_user_hit).item()
+        # for each user, if at least one prediction in the first k positions is relevant
+        # (appears in the user ground truth), the hit is True
+        return prefix_stats.hits(self.k) > 0
 
 
 class MAP(RankingMetric):
 
-    def __call__(self, per_user_precomputed_matrix: np.ndarray) -> float:
-
-        cumulative_tp_matrix = np.cumsum(per_user_precomputed_matrix, axis=1)
-
-        pos_arr = np.arange(1, per_user_precomputed_matrix.shape[1] + 1)
-        position_rel_preds = pos_arr * per_user_precomputed_matrix  # it works thanks to numpy broadcasting
-
-        cumulative_precision = self.safe_div(cumulative_tp_matrix, position_rel_preds)
-        rel_count_per_user = np.count_nonzero(per_user_precomputed_matrix, axis=1)
-
-        aps = self.safe_div(cumulative_precision.sum(axis=1), rel_count_per_user)
+    def per_user_values_from_prefix(self, prefix_stats: RankingPrefixStats) -> np.ndarray:
 
-        map = np.mean(aps).item()
-
-        return map
+        # average precision is the sum of the precision at each relevant position, divided by
+        # the n° of relevant items in the first k positions
+        return self.safe_div(prefix_stats.precision_at_rel_sums(self.k), prefix_stats.hits(self.k))
 
 
 class MRR(RankingMetric):
 
-    def __call__(self, per_user_precomputed_matrix: np.ndarray) -> float:
-
-        # valid_preds are those predictions for which at least one relevant item has been recommended
-        valid_preds = per_user_precomputed_matrix.any(axis=1)
+    def per_user_values_from_prefix(self, prefix_stats: RankingPrefixStats) -> np.ndarray:
 
-        # take from valid preds the first occurrence of a relevant item (+1 since arrays start from 0)
-        first_occ_rel_pred = per_user_precomputed_matrix[valid_preds].argmax(axis=1) + 1
+        # if k is None or greater than the n° of predictions, all predictions are considered: users with no rel
+        # item have first_rel_position == n_preds, thus they would be counted if k was greater than it
+        k = prefix_stats.n_preds if self.k is None else min(self.k, prefix_stats.n_preds)
 
-        # compute rr for all users that have at least one rel item in their rec list
-        valid_rrs = 1 / first_occ_rel_pred
+        # rr is computed for all users that have at least one rel item in the first k positions of their rec list
+        # (+1 since arrays start from 0), users for which no rel item has been recommended have rr == 0
+        first_rel_position = prefix_stats.first_rel_position
+        has_rel_at_k = first_rel_position < k
 
-        # predictions.shape[0] so that we take into account also users for which
-        # no rel item has been recommended, effectively considering their rr == 0
-        mrr = valid_rrs.sum() / per_user_precomputed_matrix.shape[0]
-
-        return mrr
+        return np.divide(1, first_rel_position + 1, out=np.zeros(prefix_stats.n_users), where=has_rel_at_k)
 
 
 class NDCG(RankingMetric):
@@ -102,51 +199,11 @@ class NDCG(RankingMetric):
 
         self.discount_log = discount_log
 
-    def _dcg_score(self, r: np.ndarray[np.ndarray]) -> np.ndarray[float]:
-        """Discounted cumulative gain (DCG)
-        Parameters
-        ----------
-        r: Relevance scores (list or numpy) in rank order
-            (first element is the first item)
-        Returns
-        -------
-        DCG : float
-        """
-
-        discounts = self.discount_log(np.arange(2, r.shape[1] + 2))
-
-        # division possible thanks to numpy broadcasting
-        # safe division not necessary, arange starts from 2 and can't be 0
-        dcg = np.sum(r / discounts, axis=1)
-
-        return dcg
-
-    def _calc_ndcg(self, r: np.ndarray[np.ndarray]) -> np.ndarray[float]:
-        """Normalized discounted cumulative gain (NDCG)
-        Parameters
-        ----------
-        r: Relevance scores (list or numpy) in rank order
-            (first element is the first item)
-        Returns
-        -------
-        NDCG : float
-        """
-        actual_ndcgs = self._dcg_score(r)
-
-        # Get the indices that would sort each row in descending order
-        sorted_indices = np.argsort(-r, axis=1)
-
-        # Use the sorted_indices to sort the matrix row-wise in descending order
-        ideal_predictions = r[np.arange(r.shape[0])[:, np.newaxis], sorted_indices]
-
-        ideal_ndcgs = self._dcg_score(ideal_predictions)
-
-        return self.safe_div(actual_ndcgs, ideal_ndcgs)
-
-    def __call__(self, per_user_precomputed_matrix: np.ndarray[np.ndarray[bool]]):
-
-        per_user_precomputed_matrix = per_user_precomputed_matrix.astype(int)
+    def per_user_values_from_prefix(self, prefix_stats: RankingPrefixStats) -> np.ndarray:
 
-        ndcgs = self._calc_ndcg(per_user_precomputed_matrix)
+        # discounts are read from cached tables, and the ideal DCG is computed from the n° of relevant
+        # items in the first k positions (which in the ideal ranking list would be the first ones)
+        actual_dcgs = prefix_stats.dcg(self.k, self.discount_log)
+        ideal_dcgs = prefix_stats.ideal_dcg(self.k, self.discount_log)
 
-        return ndcgs.mean().item()
+        return self.safe_div(actual_dcgs, ideal_dcgs)
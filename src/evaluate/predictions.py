@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+
+import datasets
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import torch
+from datasets.fingerprint import Hasher
+from loguru import logger
+
+from src.data.abstract_task import AnonTask
+from src.model import AnonModel
+
+MANIFEST_NAME = "manifest.json"
+
+
+def get_predictions_path(predictions_dir: str, task: AnonTask, template_id: int) -> str:
+    # e.g. reports/predictions/eval_exp/SequentialSideInfoTask/template_0.parquet
+    return os.path.join(predictions_dir, str(task), f"template_{template_id}.parquet")
+
+
+def get_shard_path(predictions_path: str, shard_idx: int) -> str:
+    # e.g. reports/predictions/eval_exp/SequentialSideInfoTask/template_0_shards/shard_000003.parquet
+    shards_dir = f"{os.path.splitext(predictions_path)[0]}_shards"
+    return os.path.join(shards_dir, f"shard_{shard_idx:06d}.parquet")
+
+
+def save_predictions(path: str,
+                     user_ids: list[str],
+                     preds: list[np.ndarray[str]],
+                     truths: list[np.ndarray[str]],
+                     template_id: int,
+                     batch_size: int,
+                     loss: float = None):
+    """
+    Saves predictions generated for each user (and their ground truth) in a columnar parquet file.
+    The batch size used when generating predictions is saved as metadata, so that metrics can be computed
+    again batch by batch obtaining exactly the same results
+    """
+
+    _write_predictions_table(path, user_ids, preds, truths, template_id,
+                             metadata={"batch_size": batch_size, "loss": loss})
+
+
+def save_predictions_shard(path: str,
+                           user_ids: list[str],
+                           preds: list[np.ndarray[str]],
+                           truths: list[np.ndarray[str]],
+                           template_id: int,
+                           batch_size: int,
+                           loss_sum: float,
+                           n_batches: int):
+    """
+    Saves predictions generated for a range of consecutive batches. The sum of the loss of each batch is saved
+    (rather than their mean) so that the loss of the whole evaluation can be computed exactly once all shards
+    are available
+    """
+
+    _write_predictions_table(path, user_ids, preds, truths, template_id,
+                             metadata={"batch_size": batch_size, "loss_sum": loss_sum, "n_batches": n_batches})
+
+
+def merge_predictions_shards(path: str, shard_paths: list[str], template_id: int, batch_size: int,
+                             loss: float = None):
+    """
+    Merges shards saved with `save_predictions_shard()` into a single predictions file, as if it were
+    saved with `save_predictions()`
+    """
+
+    user_ids, preds, truths = [], [], []
+    for shard_path in shard_paths:
+        shard_user_ids, shard_preds, shard_truths, _ = load_predictions(shard_path)
+
+        user_ids.extend(shard_user_ids)
+        preds.extend(shard_preds)
+        truths.extend(shard_truths)
+
+    save_predictions(path, user_ids, preds, truths, template_id=template_id, batch_size=batch_size, loss=loss)
+
+
+def _write_predictions_table(path: str,
+                             user_ids: list[str],
+                             preds: list[np.ndarray[str]],
+                             truths: list[np.ndarray[str]],
+                             template_id: int,
+                             metadata: dict):
+
+    table = pa.table({
+        "user_id": pa.array(user_ids, type=pa.string()),
+        "template_id": pa.array(np.full(len(user_ids), template_id), type=pa.int32()),
+        "predictions": pa.array([list(pred) for pred in preds], type=pa.list_(pa.string())),
+        "truths": pa.array([list(truth) for truth in truths], type=pa.list_(pa.string()))
+    })
+
+    table = table.replace_schema_metadata({"anonllm": json.dumps(metadata)})
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # written to a temporary file first, so that a file at `path` is always complete
+    tmp_path = f"{path}.tmp"
+    pq.write_table(table, tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+
+
+def load_predictions(path: str) -> tuple[list[str], list[np.ndarray[str]], list[np.ndarray[str]], dict]:
+    """
+    Loads predictions saved with `save_predictions()`
+
+    Returns:
+        user ids, predictions and truths of each user, and the metadata of the file (e.g. batch size and loss)
+    """
+
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"No predictions found in {path}! Predictions must be generated first")
+
+    table = pq.read_table(path)
+    metadata = json.loads(table.schema.metadata[b"anonllm"])
+
+    user_ids = table.column("user_id").to_pylist()
+    preds = _list_column_to_arrays(table.column("predictions"))
+    truths = _list_column_to_arrays(table.column("truths"))
+
+    return user_ids, preds, truths, metadata
+
+
+def _list_column_to_arrays(column: pa.ChunkedArray) -> list[np.ndarray[str]]:
+
+    # elements of all lists are converted at once and then split, rather than converting each list
+    column = column.combine_chunks()
+    if len(column) == 0:
+        return []
+
+    values = pc.list_flatten(column).to_numpy(zero_copy_only=False).astype(str)
+    offsets = column.offsets.to_numpy()
+
+    return np.split(values, offsets[1:-1] - offsets[0])
+
+
+def build_manifest(rec_model: AnonModel, eval_dataset: datasets.Dataset, eval_batch_size: int,
+                   shard_n_batches: int) -> dict:
+    """
+    Describes everything which determines the predictions saved: the weights of the model, its generation config,
+    the eval set and how it is split in batches and shards
+    """
+
+    return {
+        "model_hash": model_fingerprint(rec_model),
+        "generation_config": rec_model.get_generation_config(),
+        "eval_set_hash": Hasher.hash(eval_dataset.data.table),
+        "eval_batch_size": eval_batch_size,
+        "shard_n_batches": shard_n_batches
+    }
+
+
+def model_fingerprint(rec_model: AnonModel) -> str:
+
+    weights_hash = hashlib.sha256()
+    for component_name, component_state_dict in sorted(rec_model.state_dict().items()):
+        for param_name, value in sorted(component_state_dict.items()):
+            weights_hash.update(f"{component_name}.{param_name}".encode("utf-8"))
+
+            _update_weights_hash(weights_hash, value)
+
+    return weights_hash.hexdigest()
+
+
+def _update_weights_hash(weights_hash, value):
+
+    # state dicts of quantized layers also contain tuples of tensors and dtypes
+    if isinstance(value, (tuple, list)):
+        for element in value:
+            _update_weights_hash(weights_hash, element)
+
+    elif isinstance(value, torch.Tensor):
+        tensor = value.detach().cpu()
+        if tensor.is_quantized:
+            tensor = tensor.dequantize()
+
+        # raw bytes are hashed, so that any dtype is supported (e.g. bfloat16 can't be converted to numpy)
+        weights_hash.update(tensor.contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+
+    else:
+        weights_hash.update(str(value).encode("utf-8"))
+
+
+def sync_manifest(predictions_dir: str, manifest: dict) -> bool:
+    """
+    Compares `manifest` with the one of predictions previously saved in `predictions_dir`. If they differ,
+    saved predictions are stale (e.g. they were generated by another checkpoint of the model) and are deleted,
+    so that they are never mixed with new ones
+
+    Returns:
+        True if predictions previously saved are still valid and can be reused, False otherwise
+    """
+
+    manifest_path = os.path.join(predictions_dir, MANIFEST_NAME)
+
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            saved_manifest = json.load(f)
+
+        # json round trip so that e.g. tuples and lists are compared equally
+        if saved_manifest == json.loads(json.dumps(manifest)):
+            return True
+
+        changed = [key for key in manifest if saved_manifest.get(key) != json.loads(json.dumps(manifest[key]))]
+        logger.warning(f"Predictions saved in {predictions_dir} are stale ({', '.join(changed)} changed), "
+                       f"they will be deleted and generated again")
+
+    shutil.rmtree(predictions_dir, ignore_errors=True)
+    os.makedirs(predictions_dir)
+
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=4)
+
+    return False
@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+from src.evaluate.abstract_metric import AnonMetric, MetricAccumulator
+from src.evaluate.predictions import load_predictions
+
+# max n° of elements of each matrix of resamples (or permutations) built at once, so that memory stays bounded
+# regardless of the n° of users and of resamples. Each matrix is processed with a single matrix product
+_MAX_CHUNK_ELEMENTS = 2 ** 22
+
+
+def per_user_values_from_predictions(predictions_path: str,
+                                     metric_list: list[AnonMetric]) -> tuple[list[str], dict[str, np.ndarray]]:
+    """
+    Computes the per user values of each metric from predictions saved by the evaluator. Predictions are
+    considered in batches of the same size used when generating them, so that values are exactly the same
+    computed during evaluation
+
+    Returns:
+        user ids and, for each metric, its per user values (NaN where the metric is not defined)
+    """
+
+    user_ids, preds, truths, metadata = load_predictions(predictions_path)
+
+    batch_size = metadata["batch_size"]
+    metric_accumulator = MetricAccumulator(metric_list, keep_per_user_values=True)
+    for start in range(0, len(preds), batch_size):
+        metric_accumulator.update(preds[start:start + batch_size], truths[start:start + batch_size])
+
+    return user_ids, metric_accumulator.per_user_values()
+
+
+def bootstrap_confidence_intervals(per_user_values: dict[str, np.ndarray],
+                                   metric_list: list[AnonMetric],
+                                   n_resamples: int = 1000,
+                                   confidence_level: float = 0.95,
+                                   random_seed: int = None) -> pd.DataFrame:
+    """
+    Computes percentile bootstrap confidence intervals of each metric. Users are resampled with replacement
+    `n_resamples` times, and each resample is represented by how many times each user is drawn: in this way
+    the result of each metric for all resamples is obtained with a single matrix product
+
+    Returns:
+        DataFrame where the index contains metric names, and columns are the result of the metric,
+        the lower and the upper bound of the confidence interval
+    """
+
+    rng = np.random.default_rng(random_seed)
+    alpha = 1 - confidence_level
+
+    metric_names = [str(metric) for metric in metric_list]
+
+    # NaN values are not considered: they are not summed and they are not counted
+    values = np.column_stack([per_user_values[metric_name] for metric_name in metric_names])
+    defined = ~np.isnan(values)
+    values = np.where(defined, values, 0.)
+
+    n_users = len(values)
+
+    resampled_totals, resampled_counts = [], []
+    for resample_counts in _resample_counts(rng, n_users, n_resamples):
+        resampled_totals.append(resample_counts @ values)
+        resampled_counts.append(resample_counts @ defined)
+
+    resampled_totals = np.vstack(resampled_totals) if n_users != 0 else np.zeros((n_resamples, len(metric_list)))
+    resampled_counts = np.vstack(resampled_counts) if n_users != 0 else np.zeros((n_resamples, len(metric_list)))
+
+    ci_dict = {"result": [], "ci_low": [], "ci_high": []}
+    for i, metric in enumerate(metric_list):
+        resampled_results = _aggregate(metric, resampled_totals[:, i], resampled_counts[:, i])
+
+        # resamples where no user has a defined value have a NaN result and are not considered
+        ci_low, ci_high = (np.nanquantile(resampled_results, [alpha / 2, 1 - alpha / 2])
+                           if not np.isnan(resampled_results).all() else (np.nan, np.nan))
+
+        ci_dict["result"].append(metric.aggregate(values[:, i].sum().item(), defined[:, i].sum().item()))
+        ci_dict["ci_low"].append(ci_low)
+        ci_dict["ci_high"].append(ci_high)
+
+    return pd.DataFrame(ci_dict, index=pd.Index(metric_names, name="Metric"))
+
+
+def paired_randomization_test(per_user_values_a: dict[str, np.ndarray],
+                              per_user_values_b: dict[str, np.ndarray],
+                              metric_list: list[AnonMetric],
+                              n_permutations: int = 10000,
+                              random_seed: int = None) -> pd.DataFrame:
+    """
+    Two-sided paired randomization test between the per user values of two systems (A and B) evaluated on the
+    same users, in the same order. Under the null hypothesis the two systems are exchangeable, so in each
+    permutation values of A and B are swapped for a random subset of users. Each permutation is represented by
+    a row of 0/1 flags, so that totals of all permutations are obtained with a single matrix product.
+    Only users for which the metric is defined for both systems are considered. Permutations are shared by
+    all metrics
+
+    Returns:
+        DataFrame where the index contains metric names, and columns are the result of A and B,
+        their difference and the p-value of the test
+    """
+
+    rng = np.random.default_rng(random_seed)
+
+    metric_names = [str(metric) for metric in metric_list]
+
+    values_a = np.column_stack([per_user_values_a[metric_name] for metric_name in metric_names])
+    values_b = np.column_stack([per_user_values_b[metric_name] for metric_name in metric_names])
+
+    if values_a.shape != values_b.shape:
+        raise ValueError(f"Per user values of the two systems are not paired, they are computed on a different "
+                         f"n° of users ({len(values_a)} and {len(values_b)})!")
+
+    # a user contributes to a metric only if it is defined for both systems: for the other users the
+    # difference is set to 0, so that swapping their values has no effect
+    both_defined = ~np.isnan(values_a) & ~np.isnan(values_b)
+    values_a = np.where(both_defined, values_a, 0.)
+    values_b = np.where(both_defined, values_b, 0.)
+
+    n_users = both_defined.sum(axis=0)
+    totals_a, totals_b = values_a.sum(axis=0), values_b.sum(axis=0)
+
+    results_a = np.array([metric.aggregate(totals_a[i].item(), n_users[i].item())
+                          for i, metric in enumerate(metric_list)])
+    results_b = np.array([metric.aggregate(totals_b[i].item(), n_users[i].item())
+                          for i, metric in enumerate(metric_list)])
+    observed_diffs = results_a - results_b
+
+    # swapping values of a user moves their difference from the total of A to the total of B
+    diffs = values_a - values_b
+
+    n_extreme = np.zeros(len(metric_list), dtype=int)
+    for swap_flags in _random_flags(rng, len(diffs), n_permutations):
+        swapped = swap_flags @ diffs
+
+        for i, metric in enumerate(metric_list):
+            permuted_diffs = (_aggregate(metric, totals_a[i] - swapped[:, i], n_users[i]) -
+                              _aggregate(metric, totals_b[i] + swapped[:, i], n_users[i]))
+
+            # tolerance so that permutations equal to the observed one are not missed due to rounding
+            n_extreme[i] += (np.abs(permuted_diffs) >= abs(observed_diffs[i]) - 1e-12).sum()
+
+    # the observed assignment is counted as one of the permutations, so the p-value is never 0
+    p_values = np.where(n_users != 0, (n_extreme + 1) / (n_permutations + 1), np.nan)
+
+    test_dict = {"A": results_a, "B": results_b, "difference": observed_diffs, "p_value": p_values}
+
+    return pd.DataFrame(test_dict, index=pd.Index(metric_names, name="Metric"))
+
+
+def align_users(user_ids_a: list[str], per_user_values_a: dict[str, np.ndarray],
+                user_ids_b: list[str], per_user_values_b: dict[str, np.ndarray]) -> tuple[dict[str, np.ndarray],
+                                                                                          dict[str, np.ndarray]]:
+    """
+    Reorders per user values of B so that they follow the order of users of A, considering only users
+    evaluated by both
+    """
+
+    user_ids_a = pd.Index(user_ids_a)
+    positions_b = pd.Index(user_ids_b).get_indexer(user_ids_a)
+
+    common_a = positions_b != -1
+    positions_b = positions_b[common_a]
+
+    aligned_a, aligned_b = {}, {}
+    for metric_name in per_user_values_a:
+        values_a, values_b = per_user_values_a[metric_name], per_user_values_b[metric_name]
+
+        if len(values_a) != len(user_ids_a) or len(values_b) != len(user_ids_b):
+            raise ValueError(f"{metric_name} does not have a value for each user, thus users can't be aligned!")
+
+        aligned_a[metric_name] = values_a[common_a]
+        aligned_b[metric_name] = values_b[positions_b]
+
+    return aligned_a, aligned_b
+
+
+def _aggregate(metric: AnonMetric, totals: np.ndarray, counts: np.ndarray | int) -> np.ndarray[float]:
+    # `aggregate()` of metrics works with scalars, here it is applied to the totals of all resamples
+    return np.vectorize(metric.aggregate, otypes=[float])(totals, counts)
+
+
+def _resample_counts(rng: np.random.Generator, n_users: int, n_resamples: int) -> Iterator[np.ndarray[float]]:
+
+    # each row contains how many times each user is drawn in a resample
+    chunk_size = max(1, _MAX_CHUNK_ELEMENTS // max(n_users, 1))
+    for start in range(0, n_resamples if n_users != 0 else 0, chunk_size):
+        size = min(chunk_size, n_resamples - start)
+
+        # indexes drawn for each resample are offset by row, so that all counts are computed with one bincount
+        drawn = rng.integers(0, n_users, size=(size, n_users)) + np.arange(size)[:, np.newaxis] * n_users
+
+        yield np.bincount(drawn.ravel(), minlength=size * n_users).reshape(size, n_users).astype(float)
+
+
+def _random_flags(rng: np.random.Generator, n_users: int, n_permutations: int) -> Iterator[np.ndarray[float]]:
+
+    chunk_size = max(1, _MAX_CHUNK_ELEMENTS // max(n_users, 1))
+    for start in range(0, n_permutations, chunk_size):
+        size = min(chunk_size, n_permutations - start)
+
+        yield rng.integers(0, 2, size=(size, n_users)).astype(float)
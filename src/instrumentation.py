@@ -0,0 +1,304 @@
+from __future__ import annotations
+
+import copy
+import functools
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from typing import Callable
+
+import pandas as pd
+import torch
+
+from src.utils import log_wandb
+
+
+@dataclass
+class StageStats:
+    """
+    Statistics accumulated over all the calls of a stage of the pipeline
+
+    Args:
+        n_calls: n° of times the stage has been performed
+        wall_time: total seconds spent in the stage
+        n_samples: total n° of samples processed by the stage (0 if not counted)
+        n_tokens: total n° of non padding tokens processed by the stage (0 if not counted)
+        n_positions: total n° of tokens processed by the stage, padding included
+        peak_rss_mb: peak resident memory of the process at the end of the stage. It's the peak since the start of
+            the process, so the first stage at which it increases is the one which allocated the memory
+    """
+    n_calls: int = 0
+    wall_time: float = 0.
+    n_samples: int = 0
+    n_tokens: int = 0
+    n_positions: int = 0
+    peak_rss_mb: float = 0.
+
+    @property
+    def samples_per_s(self) -> float | None:
+        return self.n_samples / self.wall_time if self.n_samples > 0 and self.wall_time > 0 else None
+
+    @property
+    def tokens_per_s(self) -> float | None:
+        return self.n_tokens / self.wall_time if self.n_tokens > 0 and self.wall_time > 0 else None
+
+    @property
+    def padding_ratio(self) -> float | None:
+        return 1 - self.n_tokens / self.n_positions if self.n_positions > 0 else None
+
+    def __sub__(self, other: StageStats) -> StageStats:
+        # stats of the calls performed after `other` was taken, peak memory is not cumulative
+        return StageStats(n_calls=self.n_calls - other.n_calls,
+                          wall_time=self.wall_time - other.wall_time,
+                          n_samples=self.n_samples - other.n_samples,
+                          n_tokens=self.n_tokens - other.n_tokens,
+                          n_positions=self.n_positions - other.n_positions,
+                          peak_rss_mb=self.peak_rss_mb)
+
+    def to_dict(self) -> dict:
+        return {
+            "n_calls": self.n_calls,
+            "wall_time_s": self.wall_time,
+            "mean_time_ms": 1000 * self.wall_time / self.n_calls if self.n_calls > 0 else None,
+            "n_samples": self.n_samples,
+            "samples_per_s": self.samples_per_s,
+            "n_tokens": self.n_tokens,
+            "tokens_per_s": self.tokens_per_s,
+            "padding_ratio": self.padding_ratio,
+            "peak_rss_mb": self.peak_rss_mb
+        }
+
+
+class StageRecord:
+    """
+    Object yielded by `Instrumentation.stage()`, used to count samples and tokens processed inside the stage
+    """
+
+    def __init__(self):
+        self.n_samples = 0
+        self.n_tokens = 0
+        self.n_positions = 0
+
+    def count(self, n_samples: int = 0, attention_mask: torch.Tensor | list[list[int]] = None):
+        """
+        Counts samples processed by the stage and, if `attention_mask` is passed, tokens: the attention mask may be
+        a padded tensor or a list of unpadded masks (i.e. with no padding)
+        """
+
+        self.n_samples += n_samples
+
+        if isinstance(attention_mask, torch.Tensor):
+            self.n_tokens += int(attention_mask.sum())
+            self.n_positions += attention_mask.numel()
+        elif attention_mask is not None:
+            n_tokens = sum(len(sample_mask) for sample_mask in attention_mask)
+            self.n_tokens += n_tokens
+            self.n_positions += n_tokens
+
+    def count_batch(self, batch: dict, attention_mask_key: str = None):
+        """
+        Counts samples (and tokens, if `attention_mask_key` is in the batch) of a batch in dict of lists/tensors
+        format
+        """
+
+        if attention_mask_key is not None and attention_mask_key in batch:
+            attention_mask = batch[attention_mask_key]
+            self.count(n_samples=len(attention_mask), attention_mask=attention_mask)
+        elif len(batch) != 0:
+            self.count(n_samples=len(next(iter(batch.values()))))
+
+
+class Instrumentation:
+    """
+    Lightweight instrumentation of the stages of the pipeline: each stage records wall time, samples/s, tokens/s,
+    padding ratio and peak RSS. It is disabled by default, so that stages run with no overhead unless
+    `enable()` is called.
+
+    Stages are recorded with the `stage()` context manager or with the `instrumented()` decorator, which also counts
+    samples and tokens of the dict passed to (or returned by) the decorated function. Stages can be nested: the
+    wall time of the outer stage includes the one of the inner stages
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stats: dict[str, StageStats] = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.stats = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Context manager recording a call of the stage `name`. Samples and tokens processed can be counted with the
+        `StageRecord` yielded
+        """
+
+        record = StageRecord()
+
+        if not self.enabled:
+            yield record
+            return
+
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            # cuda kernels are asynchronous, they must be completed to know the time spent
+            if torch.cuda.is_available() and torch.cuda.is_initialized():
+                torch.cuda.synchronize()
+
+            self.add(name, time.perf_counter() - start, record)
+
+    def add(self, name: str, wall_time: float, record: StageRecord = None):
+        """
+        Records a call of the stage `name` which lasted `wall_time` seconds, for stages which can't be wrapped by
+        `stage()`. Samples and tokens processed are the ones counted by `record`, if passed
+        """
+
+        if not self.enabled:
+            return
+
+        record = record if record is not None else StageRecord()
+
+        stage_stats = self.stats.setdefault(name, StageStats())
+        stage_stats.n_calls += 1
+        stage_stats.wall_time += wall_time
+        stage_stats.n_samples += record.n_samples
+        stage_stats.n_tokens += record.n_tokens
+        stage_stats.n_positions += record.n_positions
+        stage_stats.peak_rss_mb = peak_rss_mb()
+
+    def instrumented(self, name: str, count_from: str = None, attention_mask_key: str = None):
+        """
+        Decorator recording each call of the decorated function as a call of the stage `name`
+
+        Args:
+            name: name of the stage
+            count_from: "input" to count samples and tokens of the first dict passed to the function, "output" to
+                count the ones of the dict returned by the function, None to not count them
+            attention_mask_key: key of the attention mask in the dict counted, used to count tokens and padding
+        """
+
+        if count_from not in {"input", "output", None}:
+            raise ValueError(f"count_from should be 'input', 'output' or None, but {count_from} was passed!")
+
+        def decorator(fn: Callable):
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+
+                with self.stage(name) as record:
+
+                    # the input is counted before the call, since the function may modify it
+                    if count_from == "input":
+                        batch = next((arg for arg in args if isinstance(arg, dict)), None)
+                        if batch is not None:
+                            record.count_batch(batch, attention_mask_key)
+
+                    output = fn(*args, **kwargs)
+
+                    if count_from == "output" and isinstance(output, dict):
+                        record.count_batch(output, attention_mask_key)
+
+                return output
+
+            return wrapper
+
+        return decorator
+
+    def snapshot(self) -> dict[str, StageStats]:
+        """
+        Returns a copy of the stats recorded so far, to pass as `since` to other methods so that only the calls
+        performed after the snapshot are considered (e.g. those of a single epoch)
+        """
+        return copy.deepcopy(self.stats)
+
+    def summary(self, since: dict[str, StageStats] = None) -> dict[str, dict]:
+        """
+        Returns a dict with the stats of each stage, in the order in which stages were first performed
+        """
+
+        since = since if since is not None else {}
+
+        summary = {}
+        for stage_name, stage_stats in self.stats.items():
+            stage_stats = stage_stats - since.get(stage_name, StageStats())
+
+            if stage_stats.n_calls > 0:
+                summary[stage_name] = stage_stats.to_dict()
+
+        return summary
+
+    def print_summary(self, title: str = "Stages summary", since: dict[str, StageStats] = None):
+
+        summary = self.summary(since)
+        if len(summary) == 0:
+            return
+
+        summary_df = pd.DataFrame.from_dict(summary, orient="index")
+
+        # stderr to avoid overlap with tqdm
+        print(f"\n# {title}:", file=sys.stderr)
+        print(summary_df.to_string(float_format=lambda value: f"{value:.2f}", na_rep="-"), file=sys.stderr)
+
+    def to_wandb_dict(self, prefix: str = "instrumentation", since: dict[str, StageStats] = None) -> dict:
+        return {f"{prefix}/{stage_name}/{stat_name}": stat_value
+                for stage_name, stage_stats in self.summary(since).items()
+                for stat_name, stat_value in stage_stats.items()
+                if stat_value is not None}
+
+    def save(self, output_path: str):
+        """
+        Saves the stats of each stage as JSON into `output_path`
+        """
+
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+
+        with open(output_path, "w") as f:
+            json.dump({"stages": self.summary(),
+                       "raw_stats": {stage_name: asdict(stage_stats)
+                                     for stage_name, stage_stats in self.stats.items()}}, f, indent=4)
+
+    def report(self, output_path: str, should_log: bool = False):
+        """
+        Prints the summary of all the stages performed so far, saves it as JSON into `output_path` and logs it
+        to wandb if `should_log` is True
+        """
+
+        self.print_summary()
+        self.save(output_path)
+
+        print(f"# Instrumentation results saved into {output_path}!")
+
+        log_wandb(self.to_wandb_dict(), should_log)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux, in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 1024 ** 2 if sys.platform == "darwin" else peak_rss / 1024
+
+
+# instance shared by all the stages of the pipeline
+INSTRUMENTATION = Instrumentation()
+
+
+def instrumented(name: str, count_from: str = None, attention_mask_key: str = None):
+    """
+    Decorator recording each call of the decorated function as a stage of `INSTRUMENTATION`,
+    check `Instrumentation.instrumented()` for more
+    """
+    return INSTRUMENTATION.instrumented(name, count_from=count_from, attention_mask_key=attention_mask_key)
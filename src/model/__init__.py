@@ -25,6 +25,14 @@ class ModelParams:
     monitor_metric: str = "loss"
     train_batch_size: int = 4
     eval_batch_size: int = train_batch_size
+    checkpoint_every_n_steps: int = None
+    checkpoint_every_n_minutes: float = None
+    val_subsample_size: int = None
+    val_budget_minutes: float = None
+    patience: int = None
+    min_delta: float = 0.
+    val_every_n_steps: int = None
+    max_train_minutes: float = None
 
     @classmethod
     def from_parse(cls, model_section: dict):
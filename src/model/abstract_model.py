@@ -1,18 +1,23 @@
 from __future__ import annotations
 
 import inspect
+import json
 import os.path
 import pickle
 from abc import abstractmethod, ABC
-from typing import List, Optional, Literal, Dict
+from typing import List, Optional, Literal, Dict, Callable
 
 import numpy as np
 import torch
 from requests.structures import CaseInsensitiveDict
+from safetensors.torch import save_file
 from transformers import PreTrainedModel, PreTrainedTokenizer, AutoConfig, AutoTokenizer
+from transformers.utils import SAFE_WEIGHTS_NAME, WEIGHTS_NAME
 
 from src.data.abstract_dataset import AnonDataset
 from src.data.abstract_task import AnonTask
+from src.model.quantization import quantize_model, QUANTIZED_WEIGHTS_NAME, QUANTIZATION_CONFIG_NAME
+from src.utils import atomic_torch_save
 
 
 class AnonModel(ABC):
@@ -25,6 +30,10 @@ class AnonModel(ABC):
 
         super().__init_subclass__(**kwargs)
 
+    # fields of a tokenized eval sample which determine the predictions generated for it (e.g. prompt token ids,
+    # but not the ground truth). Used to recognize identical prompts, if None all fields are considered
+    prompt_fields: tuple[str, ...] = None
+
     def __init__(self, training_tasks_str: List[str],
                  all_unique_labels: List[str],
                  items_meta_dict: dict,
@@ -72,6 +81,13 @@ class AnonModel(ABC):
     def train_step(self, prepared_batch: dict) -> torch.FloatTensor:
         raise NotImplementedError
 
+    @abstractmethod
+    @torch.no_grad()
+    def eval_loss_step(self, prepared_batch: dict) -> torch.FloatTensor:
+        # same loss of `train_step()`, computed during evaluation (e.g. validation loss) without gradients.
+        # It is a different method so that its calls are not recorded as train steps by the instrumentation
+        raise NotImplementedError
+
     @abstractmethod
     @torch.no_grad()
     def generate_step(self, prepared_batch: dict, return_loss: bool = False) -> tuple[np.ndarray[np.ndarray[str]],
@@ -97,6 +113,15 @@ class AnonModel(ABC):
     def save(self, output_dir: str):
         raise NotImplementedError
 
+    @abstractmethod
+    def save_static(self, output_dir: str):
+        # everything that doesn't change during training (e.g. config, tokenizer, etc.)
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_weights(self, output_dir: str, state_dict: dict[str, dict[str, torch.Tensor]] = None):
+        raise NotImplementedError
+
     @classmethod
     @abstractmethod
     def load(cls, dir_path: str, **kwargs) -> AnonModel:
@@ -106,6 +131,18 @@ class AnonModel(ABC):
     def to(self, device: str):
         raise NotImplementedError
 
+    @abstractmethod
+    def state_dict(self) -> dict[str, dict[str, torch.Tensor]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_state_dict(self, state_dict: dict[str, dict[str, torch.Tensor]]):
+        raise NotImplementedError
+
+    def get_generation_config(self) -> dict:
+        # parameters which affect predictions returned by `generate_step()`, empty if the model has none
+        return {}
+
     @classmethod
     def from_cls(cls, model_cls: type[AnonModel], dataset_obj: AnonDataset, **kwargs) -> AnonModel:
         raise NotImplementedError
@@ -153,6 +190,9 @@ class AnonModelHF(AnonModel):
                  eval_task_str: str = None,
                  eval_template_id: int | str = None,
                  train_task_selection_strat: Literal['random', 'all'] = "all",
+                 candidate_scoring: bool = False,
+                 candidate_batch_size: int = 256,
+                 quantize: Literal['int8', 'int8_weight_only', 'int4_weight_only'] = None,
                  **model_config_kwargs):
 
         super().__init__(training_tasks_str=training_tasks_str,
@@ -165,26 +205,175 @@ class AnonModelHF(AnonModel):
         if self.model_class is None:
             raise AttributeError("Please set the class attribute 'model_class' when extending AnonModelHF!")
 
-        self.model = self.model_class.from_pretrained(name_or_path, **model_config_kwargs)
+        # checked before loading the model, to fail fast
+        if candidate_scoring is True and type(self)._tokenize_candidates is AnonModelHF._tokenize_candidates:
+            raise ValueError(f"{self.__class__.__name__} does not support candidate scoring, "
+                             f"candidate_scoring can't be set to True!")
+
+        # weights of a quantized model saved can only be loaded into a model quantized in the same way
+        saved_quantization = self._saved_quantization(name_or_path)
+        if saved_quantization is not None and quantize not in {None, saved_quantization}:
+            raise ValueError(f"Model in {name_or_path} was saved with {saved_quantization} quantization, "
+                             f"it can't be loaded with {quantize} quantization!")
+
+        if saved_quantization is None:
+            self.model = self.model_class.from_pretrained(name_or_path, **model_config_kwargs)
+        else:
+            self.model = self.model_class(AutoConfig.from_pretrained(name_or_path, **model_config_kwargs))
+
         self.tokenizer = self.tokenizer_class.from_pretrained(name_or_path)
 
+        # linear layers are quantized for inference on cpu, the model can't be trained anymore
+        self.quantization = saved_quantization if saved_quantization is not None else quantize
+        if self.quantization is not None:
+            self.model = quantize_model(self.model, self.quantization)
+
+        if saved_quantization is not None:
+            # weights of int8 layers are quantized tensors (with their qscheme), which the weights-only unpickler
+            # rejects in torch 2.0 (the version pinned in requirements.txt). It is disabled explicitly since newer
+            # versions enable it by default. The file is only written by `save_weights()`, so it is as trusted
+            # as the other files of the checkpoint
+            quantized_state_dict = torch.load(os.path.join(name_or_path, QUANTIZED_WEIGHTS_NAME),
+                                              map_location="cpu", weights_only=False)
+            self.model.load_state_dict(quantized_state_dict)
+
         # store in model config all parameters needed to re-instantiate the hf model,
         # so to exploit serialization and de-serialization of hf with from_pretrained()
         self.model.config.training_tasks_str = training_tasks_str
         self.model.config.all_unique_labels = all_unique_labels
 
+        # for ranking tasks, candidates are ranked by their likelihood rather than generated with beam search.
+        # This is an inference choice which is not stored in the model config
+        self.candidate_scoring = candidate_scoring
+        self.candidate_batch_size = candidate_batch_size
+
+    @staticmethod
+    def _saved_quantization(dir_path: str) -> str | None:
+
+        quantization_config_path = os.path.join(dir_path, QUANTIZATION_CONFIG_NAME)
+        if not os.path.isfile(quantization_config_path):
+            return None
+
+        with open(quantization_config_path) as f:
+            return json.load(f)["quantize"]
+
     def train(self, mode: bool = True):
 
+        if mode is True and self.quantization is not None:
+            raise ValueError("A quantized model can only be used for inference, it can't be trained!")
+
         if mode is True:
             AnonTask.train()
         else:
             AnonTask.eval()
 
-        self.model.train(mode=mode)
+        # also modules added to the hf model (e.g. dropout of injected embeddings) switch mode
+        for component in self.named_components().values():
+            component.train(mode=mode)
+
+    def named_components(self) -> dict[str, torch.nn.Module]:
+        # all torch modules holding weights of the model. This method should be extended
+        # by subclasses whenever they add any module which is not part of the hf model
+        return {"model": self.model}
+
+    def state_dict(self) -> dict[str, dict[str, torch.Tensor]]:
+        return {name: component.state_dict() for name, component in self.named_components().items()}
+
+    def load_state_dict(self, state_dict: dict[str, dict[str, torch.Tensor]]):
+        for name, component in self.named_components().items():
+            component.load_state_dict(state_dict[name])
+
+    def get_generation_config(self) -> dict:
+        generation_config = self.model.generation_config.to_diff_dict() if self.model.can_generate() else {}
+
+        if self.candidate_scoring is True:
+            generation_config["candidate_scoring"] = True
+
+        return generation_config
+
+    def _tokenize_candidates(self, candidates: list[str]) -> list:
+        """
+        Encodes each candidate as the target text is encoded by `tokenize()`. Subclasses supporting
+        `candidate_scoring` must implement it, together with a `score_pairs` function passed to
+        `_rank_candidates()`, which receives the encodings returned here as they are
+
+        Returns:
+            the encoding of each candidate, in the same order of `candidates`
+        """
+        raise NotImplementedError(f"{self.__class__.__name__} does not support candidate scoring!")
+
+    def _rank_candidates(self, candidates: list[list[str]] | None, n_samples: int, top_k: int,
+                         score_pairs: Callable[[torch.Tensor, list], torch.Tensor]) -> np.ndarray[str]:
+        """
+        Ranks the candidates of each sample by the log-likelihood of the model generating them as target text.
+        Scores are computed by `score_pairs` on chunks of `candidate_batch_size` (sample, candidate) pairs: it
+        receives the index of the sample of each pair and the encoded candidate of each pair
+
+        Args:
+            candidates: candidates of each sample. If None, all items of the catalog are ranked for each sample
+            n_samples: n° of samples in the batch
+            top_k: n° of candidates returned for each sample
+            score_pairs: function returning the log-likelihood of each pair
+
+        Returns:
+            matrix of shape (n° of samples, top_k) with the candidates sorted by decreasing likelihood
+        """
+
+        if candidates is None:
+            candidates = [self.all_unique_labels.tolist()] * n_samples
+
+        n_candidates = np.array([len(sample_candidates) for sample_candidates in candidates])
+        pair_sample_idxs = np.repeat(np.arange(n_samples), n_candidates)
+        pair_candidates = np.array([candidate for sample_candidates in candidates for candidate in sample_candidates])
+
+        # candidates shared by different samples (e.g. the catalog) are tokenized only once
+        unique_candidates, pair_unique_idxs = np.unique(pair_candidates, return_inverse=True)
+        encoded_candidates = self._tokenize_candidates(unique_candidates.tolist())
+
+        scores = []
+        for start in range(0, len(pair_candidates), self.candidate_batch_size):
+            end = start + self.candidate_batch_size
+
+            sample_idxs = torch.from_numpy(pair_sample_idxs[start:end]).to(self.model.device)
+            chunk_encoded_candidates = [encoded_candidates[i] for i in pair_unique_idxs[start:end]]
+
+            scores.append(score_pairs(sample_idxs, chunk_encoded_candidates).float().cpu())
+
+        scores = torch.cat(scores).numpy()
+
+        # all samples should return the same n° of predictions
+        top_k = min(top_k, n_candidates.min())
+
+        offsets = np.concatenate(([0], np.cumsum(n_candidates)))
+        ranked_candidates = []
+        for i in range(n_samples):
+            sample_scores = scores[offsets[i]:offsets[i + 1]]
+            best_idxs = np.argsort(-sample_scores, kind="stable")[:top_k]
+
+            ranked_candidates.append(pair_candidates[offsets[i]:offsets[i + 1]][best_idxs])
+
+        return np.array(ranked_candidates)
+
+    @staticmethod
+    def _sequence_log_likelihood(logits: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+
+        # log probability of each label token, labels set to -100 (padding) are ignored
+        labels_mask = labels != -100
+        token_log_probs = torch.log_softmax(logits.float(), dim=-1)
+        token_log_probs = token_log_probs.gather(-1, labels.clamp(min=0).unsqueeze(-1)).squeeze(-1)
+
+        return (token_log_probs * labels_mask).sum(dim=-1)
 
     def save(self, output_dir: str):
-        # save hf model and parameters that we added to the config
-        self.model.save_pretrained(save_directory=output_dir)
+        self.save_static(output_dir)
+        self.save_weights(output_dir)
+
+    def save_static(self, output_dir: str):
+        # save hf config (with parameters that we added to it) and generation config
+        self.model.config.save_pretrained(save_directory=output_dir)
+
+        if self.model.can_generate():
+            self.model.generation_config.save_pretrained(save_directory=output_dir)
 
         # also tokenizer is saved
         self.tokenizer.save_pretrained(save_directory=output_dir)
@@ -192,6 +381,86 @@ class AnonModelHF(AnonModel):
         with open(os.path.join(output_dir, "items_meta_dict.pkl"), 'wb') as handle:
             pickle.dump(self.items_meta_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
+    def save_weights(self, output_dir: str, state_dict: dict[str, dict[str, torch.Tensor]] = None):
+        # state_dict can be passed to save a snapshot of the weights taken previously (e.g. from
+        # a background thread while the training goes on), otherwise the current weights are saved
+        if state_dict is None:
+            state_dict = self.state_dict()
+
+        if self.quantization is not None:
+            # quantized weights can't be saved with safetensors, and they can't be loaded by `from_pretrained()`
+            atomic_torch_save(state_dict["model"], os.path.join(output_dir, QUANTIZED_WEIGHTS_NAME))
+
+            with open(os.path.join(output_dir, QUANTIZATION_CONFIG_NAME), "w") as f:
+                json.dump({"quantize": self.quantization}, f, indent=4)
+
+            return
+
+        # tied weights (e.g. input and output embeddings) are stored only once, as hf does,
+        # they will be tied again by `from_pretrained()`
+        tied_weights_names = self._tied_weights_names()
+        hf_state_dict = {name: tensor.contiguous() for name, tensor in state_dict["model"].items()
+                         if name not in tied_weights_names}
+
+        # write to a temporary file and then rename it, so that a valid file is always present
+        weights_path = os.path.join(output_dir, SAFE_WEIGHTS_NAME)
+        save_file(hf_state_dict, f"{weights_path}.tmp", metadata={"format": "pt"})
+        os.replace(f"{weights_path}.tmp", weights_path)
+
+        # weights saved with the pytorch format would be stale
+        if os.path.isfile(os.path.join(output_dir, WEIGHTS_NAME)):
+            os.remove(os.path.join(output_dir, WEIGHTS_NAME))
+
+    def _tied_weights_names(self) -> set[str]:
+
+        # a weight is tied to another one if they share the same memory
+        seen_data_ptrs = set()
+        tied_weights_names = set()
+        for name, tensor in self.model.state_dict().items():
+            if tensor.data_ptr() in seen_data_ptrs:
+                tied_weights_names.add(name)
+            seen_data_ptrs.add(tensor.data_ptr())
+
+        return tied_weights_names
+
+    def export_onnx(self, output_dir: str, opset_version: int = 14):
+        """
+        Exports the model into ONNX graphs which include any embedding injected by the model, together with all
+        files needed to generate predictions with onnxruntime only (see `src.serve.onnx_runtime`)
+        """
+        raise NotImplementedError(f"{self.__class__.__name__} can't be exported to ONNX!")
+
+    @staticmethod
+    def _export_onnx_graph(module: torch.nn.Module, args: tuple, output_path: str, input_names: list[str],
+                           output_names: list[str], dynamic_axes: dict[str, dict[int, str]], opset_version: int):
+
+        export_kwargs = {}
+
+        # the torchscript based exporter is the one which supports dynamic axes of hf models,
+        # recent torch versions use the dynamo based one by default
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            export_kwargs["dynamo"] = False
+
+        module.eval()
+        with torch.no_grad():
+            torch.onnx.export(module, args, output_path,
+                              input_names=input_names,
+                              output_names=output_names,
+                              dynamic_axes=dynamic_axes,
+                              opset_version=opset_version,
+                              **export_kwargs)
+
+    def _save_onnx_static(self, output_dir: str, onnx_config: dict):
+
+        # the runtime only needs the `tokenizers` library, not the whole hf tokenizer
+        self.tokenizer.backend_tokenizer.save(os.path.join(output_dir, "tokenizer.json"))
+
+        # hf tokenizers clean up spaces of decoded texts (e.g. " ," -> ","), the runtime should do the same
+        onnx_config = {**onnx_config, "clean_up_tokenization_spaces": self.tokenizer.clean_up_tokenization_spaces}
+
+        with open(os.path.join(output_dir, "onnx_config.json"), "w") as f:
+            json.dump(onnx_config, f, indent=4)
+
     @classmethod
     # this method should be subclassed whenever the model has any additional parameter
     # that is NOT stored inside the hugging face model config
@@ -223,6 +492,11 @@ class AnonModelHF(AnonModel):
         return obj
 
     def to(self, device: str):
+
+        # int8 kernels of dynamically quantized layers are available on cpu only
+        if self.quantization == "int8" and not str(device).startswith("cpu"):
+            raise ValueError(f"Models with int8 quantization can only run on cpu, but {device} was specified!")
+
         return self.model.to(device)
 
     @classmethod
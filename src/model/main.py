@@ -10,7 +10,8 @@ from src.model import ModelParams, AnonModel
 from src.model.trainer import RecTrainer
 
 
-def model_main(general_params: GeneralParams, data_params: DataParams, model_params: ModelParams):
+def model_main(general_params: GeneralParams, data_params: DataParams, model_params: ModelParams,
+               resume: bool = False):
 
     # general params
     exp_name = general_params.exp_name
@@ -22,6 +23,14 @@ def model_main(general_params: GeneralParams, data_params: DataParams, model_par
     train_batch_size = model_params.train_batch_size
     eval_batch_size = model_params.eval_batch_size
     monitor_metric = model_params.monitor_metric
+    checkpoint_every_n_steps = model_params.checkpoint_every_n_steps
+    checkpoint_every_n_minutes = model_params.checkpoint_every_n_minutes
+    val_subsample_size = model_params.val_subsample_size
+    val_budget_minutes = model_params.val_budget_minutes
+    patience = model_params.patience
+    min_delta = model_params.min_delta
+    val_every_n_steps = model_params.val_every_n_steps
+    max_train_minutes = model_params.max_train_minutes
 
     # model params
     model_cls_name = model_params.model_cls_name
@@ -72,7 +81,16 @@ def model_main(general_params: GeneralParams, data_params: DataParams, model_par
         train_sampling_fn=sampling_fn,
         monitor_metric=monitor_metric_obj,
         output_dir=output_dir,
+        checkpoint_every_n_steps=checkpoint_every_n_steps,
+        checkpoint_every_n_minutes=checkpoint_every_n_minutes,
+        val_subsample_size=val_subsample_size,
+        val_budget_minutes=val_budget_minutes,
+        random_seed=general_params.random_seed,
+        patience=patience,
+        min_delta=min_delta,
+        val_every_n_steps=val_every_n_steps,
+        max_train_minutes=max_train_minutes,
         should_log=log_wandb
     )
 
-    trainer.train(train, validation_dataset=val)
+    trainer.train(train, validation_dataset=val, resume=resume)
@@ -13,14 +13,49 @@ from torch.nn.utils.rnn import pad_sequence
 from torch.optim import AdamW
 from transformers import GPT2LMHeadModel, GPT2TokenizerFast, GenerationConfig, AutoConfig
 
+from src.instrumentation import instrumented
 from src.model.abstract_model import AnonModelHF
-from src.utils import dict_list2list_dict, list_dict2dict_list
+from src.utils import dict_list2list_dict, list_dict2dict_list, atomic_torch_save
+
+
+class GPT2ForExport(nn.Module):
+    """
+    GPT2Rec taking token ids rather than input embeddings, so that whole word embeddings are injected inside the
+    exported graph, and returning the log probabilities of the next token
+    """
+
+    def __init__(self, rec_model: GPT2Rec):
+        super().__init__()
+
+        self.model = rec_model.model
+        self.whole_word_embeddings = rec_model.whole_word_embeddings
+
+    def forward(self, input_ids: Tensor, attention_mask: Tensor, position_ids: Tensor, whole_word_ids: Tensor = None):
+
+        inputs_embeds = self.model.transformer.wte(input_ids)
+
+        if self.whole_word_embeddings is not None:
+            # as in generate(), whole word embeddings are injected into prompt tokens only:
+            # generated tokens have word id -1
+            injected_mask = (whole_word_ids >= 0).unsqueeze(dim=-1)
+            whole_word_embeds = self.whole_word_embeddings(whole_word_ids.clamp(min=0))
+            inputs_embeds = inputs_embeds + whole_word_embeds * injected_mask
+
+        output = self.model(inputs_embeds=inputs_embeds,
+                            attention_mask=attention_mask,
+                            position_ids=position_ids,
+                            use_cache=False)
+
+        return torch.log_softmax(output.logits[:, -1], dim=-1)
 
 
 class GPT2Rec(AnonModelHF):
     model_class = GPT2LMHeadModel
     tokenizer_class = GPT2TokenizerFast
 
+    # total_* fields also contain the target text, which does not affect generation
+    prompt_fields = ("input_prompt_ids", "input_whole_word_ids")
+
     def __init__(self,
                  name_or_path: str,
                  training_tasks_str: List[str],
@@ -32,6 +67,9 @@ class GPT2Rec(AnonModelHF):
                  input_prefix: str = "Input: ",
                  target_prefix: str = "Target: ",
                  inject_whole_word_embeds: bool = False,
+                 candidate_scoring: bool = False,
+                 candidate_batch_size: int = 256,
+                 quantize: Literal['int8', 'int8_weight_only', 'int4_weight_only'] = None,
                  **model_config_and_gen_kwargs):
 
         # before passing the model config kwargs to super (which will pass them to the model config),
@@ -57,6 +95,9 @@ class GPT2Rec(AnonModelHF):
             eval_task_str=eval_task_str,
             eval_template_id=eval_template_id,
             train_task_selection_strat=train_task_selection_strat,
+            candidate_scoring=candidate_scoring,
+            candidate_batch_size=candidate_batch_size,
+            quantize=quantize,
             **model_config_kwargs
         )
 
@@ -109,6 +150,7 @@ class GPT2Rec(AnonModelHF):
             weight_decay=0.01
         )
 
+    @instrumented("tokenize", count_from="output", attention_mask_key="total_attention_mask")
     def tokenize(self, batch):
 
         if "user_id" not in batch:
@@ -143,7 +185,9 @@ class GPT2Rec(AnonModelHF):
                 # each task gives as output a list: this list contains surely an inference prompt-target (i.e.,
                 # a prompt target which could be used at inference time) and a variable number of support tasks
                 # (i.e. tasks which do not have as target text the prediction of interest for the task)
-                for (input_text, target_text, gt) in templates_list:
+                for task_output in templates_list:
+
+                    input_text, target_text, gt = task_output
 
                     # <end of text token> so we enforce the fact that the model should make the prediction
                     # (represented by the target text) and that's it! No endless generation!
@@ -197,11 +241,17 @@ class GPT2Rec(AnonModelHF):
                         # it may be the item id or the item rating for example, depending on the task chosen
                         encoded_sequence["gt"] = gt
 
+                        # candidates listed in the prompt are ranked rather than generated. If the task lists
+                        # none, all items of the catalog will be ranked
+                        if self.candidate_scoring is True and task_output.candidates is not None:
+                            encoded_sequence["candidates"] = task_output.candidates
+
                     encoded_sequence_list.append(encoded_sequence)
 
         # from list of dicts to dict of lists
         return list_dict2dict_list(encoded_sequence_list)
 
+    @instrumented("prepare_input", count_from="output", attention_mask_key="total_attention_mask")
     def prepare_input(self, batch: dict):
         input_dict = {}
 
@@ -261,6 +311,9 @@ class GPT2Rec(AnonModelHF):
         if "gt" in batch:
             input_dict["gt"] = batch["gt"]
 
+        if "candidates" in batch:
+            input_dict["candidates"] = batch["candidates"]
+
         return input_dict
 
     def _tokenize_whole_word_ids(self, input_whole_word_ids: list, target_whole_word_ids: list):
@@ -302,7 +355,16 @@ class GPT2Rec(AnonModelHF):
 
         return inputs_embeds
 
+    @instrumented("train_step", count_from="input", attention_mask_key="total_attention_mask")
     def train_step(self, batch: dict):
+        return self._compute_loss(batch)
+
+    @instrumented("eval/loss_step", count_from="input", attention_mask_key="total_attention_mask")
+    @torch.no_grad()
+    def eval_loss_step(self, batch: dict):
+        return self._compute_loss(batch)
+
+    def _compute_loss(self, batch: dict):
 
         inputs_embeds = self.model.transformer.wte(batch["total_input_ids"])
 
@@ -315,6 +377,7 @@ class GPT2Rec(AnonModelHF):
 
         return output.loss
 
+    @instrumented("generate_step", count_from="input", attention_mask_key="input_prompt_attention_mask")
     @torch.no_grad()
     def generate_step(self, batch: dict, return_loss: bool = False):
 
@@ -322,7 +385,7 @@ class GPT2Rec(AnonModelHF):
             raise ValueError("Model can't perform generate_step since no eval_task is set! "
                              "Pass it when initializing the model or with `set_eval_task()`")
 
-        if return_loss and "labels" not in batch:
+        if return_loss and "total_labels" not in batch:
             raise ValueError("Loss can't be returned if no label is set!")
 
         # if it's not a ranking task (e.g., it is a rating prediction task),
@@ -334,11 +397,13 @@ class GPT2Rec(AnonModelHF):
             num_return_sequences = 1
 
         gt = np.array(batch.pop("gt"))
+        candidates = batch.pop("candidates", None)
 
         loss = torch.tensor(torch.nan)
         if return_loss is True:
-            # this does not update gradients since we use decorator torch.no_grad()
-            loss = self.train_step(batch)
+            # this does not update gradients since we use decorator torch.no_grad(). The time spent
+            # is part of the generate step, thus it's not recorded as a different stage
+            loss = self._compute_loss(batch)
 
         # for decoder only model, input should be padded to the left when performing batch inference with generate,
         # otherwise you are continuing generating over a pad token which was little meaning!
@@ -354,6 +419,15 @@ class GPT2Rec(AnonModelHF):
             left_padded_word_ids = self._left_pad(batch["input_whole_word_ids"], pad_token=0)
             inputs_embeds = self._inject_whole_word_embeds(inputs_embeds, left_padded_word_ids)
 
+        if self.candidate_scoring is True and self.eval_task.is_ranking_task():
+            # the last word id of the prompt is needed to compute word ids of the candidates
+            last_prompt_word_ids = left_padded_word_ids[:, -1] if self.whole_word_embeddings is not None else None
+
+            mapped_predictions = self._score_candidates(inputs_embeds, left_padded_attn_mask, last_prompt_word_ids,
+                                                        candidates, top_k=num_return_sequences)
+
+            return mapped_predictions, gt, loss
+
         # for some decoder only models (in particular gpt2) it is possible to perform generate using
         # custom inputs_embeds. They are used at the 1st step of the generation process only.
         # It is needed to pass also "input_ids" so that the input prompt is returned in output
@@ -374,6 +448,76 @@ class GPT2Rec(AnonModelHF):
 
         return mapped_predictions, gt, loss
 
+    def _tokenize_candidates(self, candidates: list[str]) -> list[tuple[list[int], list[int]]]:
+
+        # candidates are encoded as target texts are encoded in `tokenize()`, together with their word ids
+        encoded_candidates = self.tokenizer([f"{candidate}<|endoftext|>" for candidate in candidates],
+                                            truncation=True,
+                                            return_attention_mask=False)
+
+        return [(candidate_ids, encoded_candidates.word_ids(i))
+                for i, candidate_ids in enumerate(encoded_candidates.input_ids)]
+
+    def _score_candidates(self, inputs_embeds: Tensor, left_padded_attn_mask: Tensor,
+                          last_prompt_word_ids: Tensor | None, candidates: list[list[str]] | None,
+                          top_k: int) -> np.ndarray[str]:
+
+        # same position ids that generate() computes for left padded prompts
+        position_ids = (left_padded_attn_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        prompt_lengths = left_padded_attn_mask.sum(dim=-1)
+
+        # the prompt is processed only once for each sample, and its kv cache is shared by all candidates of the sample
+        prompt_output = self.model(inputs_embeds=inputs_embeds,
+                                   attention_mask=left_padded_attn_mask,
+                                   position_ids=position_ids,
+                                   use_cache=True)
+
+        prompt_past_key_values = prompt_output.past_key_values
+
+        # logits predicting the first token of the target
+        prompt_next_logits = prompt_output.logits[:, -1]
+
+        def score_pairs(sample_idxs: Tensor, encoded_candidates: list[tuple[list[int], list[int]]]):
+
+            candidate_ids = pad_sequence([torch.tensor(candidate_ids) for candidate_ids, _ in encoded_candidates],
+                                         batch_first=True,
+                                         padding_value=-100).to(self.model.device)
+            candidate_mask = (candidate_ids != -100).long()
+
+            candidates_embeds = self.model.transformer.wte(candidate_ids.clamp(min=0))
+
+            if self.whole_word_embeddings is not None:
+                # word ids of the target continue from the last word id of the prompt, as in `tokenize()`
+                candidate_word_ids = pad_sequence([torch.tensor(word_ids) for _, word_ids in encoded_candidates],
+                                                  batch_first=True,
+                                                  padding_value=-1).to(self.model.device)
+                candidate_word_ids = candidate_word_ids + last_prompt_word_ids[sample_idxs].unsqueeze(dim=1) + 1
+
+                # the last token is the eos token, its word id is 0 as for padding
+                candidate_lengths = candidate_mask.sum(dim=-1)
+                candidate_word_ids[torch.arange(len(candidate_ids)), candidate_lengths - 1] = 0
+                candidate_word_ids = candidate_word_ids * candidate_mask
+
+                candidates_embeds = self._inject_whole_word_embeds(candidates_embeds, candidate_word_ids)
+
+            past_key_values = tuple((key[sample_idxs], value[sample_idxs]) for key, value in prompt_past_key_values)
+
+            candidate_position_ids = (prompt_lengths[sample_idxs].unsqueeze(dim=1) +
+                                      torch.arange(candidate_ids.shape[1], device=self.model.device))
+
+            # teacher forcing: all tokens of all candidates are scored with a single forward over the cached prompt
+            output = self.model(inputs_embeds=candidates_embeds,
+                                past_key_values=past_key_values,
+                                attention_mask=torch.cat((left_padded_attn_mask[sample_idxs], candidate_mask), dim=1),
+                                position_ids=candidate_position_ids)
+
+            # the i-th token of the candidate is predicted by the logits of the previous token
+            logits = torch.cat((prompt_next_logits[sample_idxs].unsqueeze(dim=1), output.logits[:, :-1]), dim=1)
+
+            return self._sequence_log_likelihood(logits, candidate_ids)
+
+        return self._rank_candidates(candidates, len(inputs_embeds), top_k, score_pairs)
+
     def _left_pad(self, right_padded_tensor: torch.Tensor, pad_token: int):
 
         # calculate the number of padding tokens in each row, which is where
@@ -445,19 +589,77 @@ class GPT2Rec(AnonModelHF):
 
         return mapped_predictions.tolist()
 
+    def export_onnx(self, output_dir: str, opset_version: int = 14):
+
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.eval()
+
+        # dummy inputs, only their dtype and n° of dimensions matter since batch and sequence axes are dynamic
+        dummy_inputs = self.tokenizer(["dummy input text", "dummy"], padding=True, return_tensors="pt")
+        input_ids = dummy_inputs.input_ids.to(self.model.device)
+        attention_mask = dummy_inputs.attention_mask.to(self.model.device)
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+
+        kwargs = {}
+        if self.whole_word_embeddings is not None:
+            kwargs["whole_word_ids"] = torch.ones_like(input_ids)
+
+        input_names = ["input_ids", "attention_mask", "position_ids", *kwargs.keys()]
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["next_token_log_probs"] = {0: "batch"}
+
+        self._export_onnx_graph(GPT2ForExport(self),
+                                args=(input_ids, attention_mask, position_ids, kwargs),
+                                output_path=os.path.join(output_dir, "decoder.onnx"),
+                                input_names=input_names,
+                                output_names=["next_token_log_probs"],
+                                dynamic_axes=dynamic_axes,
+                                opset_version=opset_version)
+
+        generation_config = self.model.generation_config
+        self._save_onnx_static(output_dir, {
+            "model_type": "gpt2",
+            "inject_whole_word_embeds": self.model.config.inject_whole_word_embeds,
+            "input_prefix": self.model.config.input_prefix,
+            "target_prefix": self.model.config.target_prefix,
+            "model_max_length": self.tokenizer.model_max_length,
+            "pad_token_id": self.tokenizer.pad_token_id,
+            "eos_token_id": generation_config.eos_token_id,
+            "num_beams": generation_config.num_beams,
+            "num_return_sequences": generation_config.num_return_sequences,
+            "max_new_tokens": generation_config.max_new_tokens,
+            "max_length": generation_config.max_length,
+            "length_penalty": generation_config.length_penalty
+        })
+
+    def named_components(self):
+        components = super().named_components()
+
+        if self.whole_word_embeddings is not None:
+            components["whole_word_embeddings"] = self.whole_word_embeddings
+
+        return components
+
     def to(self, device: str):
+        # the hf model is moved first, so that nothing is moved if the device is not supported
+        model = super().to(device)
+
         if self.whole_word_embeddings is not None:
             self.whole_word_embeddings.to(device)
 
-        return super().to(device)
+        return model
+
+    def save_weights(self, output_dir: str, state_dict: dict[str, dict[str, Tensor]] = None):
 
-    def save(self, output_dir: str):
+        if state_dict is None:
+            state_dict = self.state_dict()
 
-        super().save(output_dir)
+        super().save_weights(output_dir, state_dict)
 
         if self.whole_word_embeddings is not None:
             whole_word_emb_out_pth = os.path.join(output_dir, "whole_word_emb.pth")
-            torch.save(self.whole_word_embeddings.state_dict(), whole_word_emb_out_pth)
+            atomic_torch_save(state_dict["whole_word_embeddings"], whole_word_emb_out_pth)
 
     @classmethod
     def load(cls, dir_path: str, **config_gen_anon_kwargs) -> GPT2Rec:
@@ -10,10 +10,12 @@ import torch
 from torch import nn, Tensor
 from torch.nn.utils.rnn import pad_sequence
 from transformers import T5ForConditionalGeneration, Adafactor, T5TokenizerFast, GenerationConfig, AutoConfig
+from transformers.modeling_outputs import BaseModelOutput
 
 from src.data.abstract_dataset import AnonDataset
+from src.instrumentation import instrumented
 from src.model.abstract_model import AnonModelHF
-from src.utils import dict_list2list_dict, list_dict2dict_list
+from src.utils import dict_list2list_dict, list_dict2dict_list, atomic_torch_save
 
 
 class UserEmbeds(nn.Module):
@@ -37,10 +39,60 @@ class UserEmbeds(nn.Module):
         return x
 
 
+class T5EncoderForExport(nn.Module):
+    """
+    Encoder of T5Rec which takes token ids rather than input embeddings, so that user and whole word
+    embeddings are injected inside the exported graph
+    """
+
+    def __init__(self, rec_model: T5Rec):
+        super().__init__()
+
+        self.shared = rec_model.model.shared
+        self.encoder = rec_model.model.get_encoder()
+        self.user_embeddings = rec_model.user_embeddings
+        self.whole_word_embeddings = rec_model.whole_word_embeddings
+
+    def forward(self, input_ids: Tensor, attention_mask: Tensor, whole_word_ids: Tensor = None,
+                user_idx: Tensor = None):
+
+        inputs_embeds = self.shared(input_ids)
+
+        if self.user_embeddings is not None:
+            inputs_embeds = inputs_embeds + self.user_embeddings(user_idx).unsqueeze(dim=1)
+
+        if self.whole_word_embeddings is not None:
+            inputs_embeds = inputs_embeds + self.whole_word_embeddings(whole_word_ids)
+
+        return self.encoder(inputs_embeds=inputs_embeds, attention_mask=attention_mask).last_hidden_state
+
+
+class T5DecoderForExport(nn.Module):
+    """
+    Decoder of T5Rec returning the log probabilities of the next token given the tokens decoded so far
+    """
+
+    def __init__(self, rec_model: T5Rec):
+        super().__init__()
+
+        self.model = rec_model.model
+
+    def forward(self, decoder_input_ids: Tensor, encoder_hidden_states: Tensor, encoder_attention_mask: Tensor):
+
+        output = self.model(encoder_outputs=BaseModelOutput(last_hidden_state=encoder_hidden_states),
+                            attention_mask=encoder_attention_mask,
+                            decoder_input_ids=decoder_input_ids,
+                            use_cache=False)
+
+        return torch.log_softmax(output.logits[:, -1], dim=-1)
+
+
 class T5Rec(AnonModelHF):
     model_class = T5ForConditionalGeneration
     tokenizer_class = T5TokenizerFast
 
+    prompt_fields = ("input_ids", "whole_word_ids", "user_idx")
+
     def __init__(self,
                  name_or_path: str,
                  training_tasks_str: List[str],
@@ -52,6 +104,9 @@ class T5Rec(AnonModelHF):
                  eval_task_str: str = None,
                  eval_template_id: int | str = None,
                  train_task_selection_strat: Literal['random', 'all'] = "all",
+                 candidate_scoring: bool = False,
+                 candidate_batch_size: int = 256,
+                 quantize: Literal['int8', 'int8_weight_only', 'int4_weight_only'] = None,
                  **model_config_and_gen_kwargs):
 
         # before passing the model config kwargs to super (which will pass them to the model config),
@@ -76,6 +131,9 @@ class T5Rec(AnonModelHF):
             eval_task_str=eval_task_str,
             eval_template_id=eval_template_id,
             train_task_selection_strat=train_task_selection_strat,
+            candidate_scoring=candidate_scoring,
+            candidate_batch_size=candidate_batch_size,
+            quantize=quantize,
             **model_config_kwargs
         )
 
@@ -132,6 +190,7 @@ class T5Rec(AnonModelHF):
             warmup_init=False
         )
 
+    @instrumented("tokenize", count_from="output", attention_mask_key="attention_mask")
     def tokenize(self, batch: dict):
 
         if "user_id" not in batch:
@@ -166,7 +225,9 @@ class T5Rec(AnonModelHF):
                 # each task gives as output a list: this list contains surely an inference prompt-target (i.e.,
                 # a prompt target which could be used at inference time) and a variable number of support tasks
                 # (i.e. tasks which do not have as target text the prediction of interest for the task)
-                for (input_text, target_text, gt) in templates_list:
+                for task_output in templates_list:
+
+                    input_text, target_text, gt = task_output
 
                     encoded_sequence = self.tokenizer(text=input_text, text_target=target_text, truncation=True)
 
@@ -197,11 +258,17 @@ class T5Rec(AnonModelHF):
                         # it may be the item id or the item rating for example, depending on the task chosen
                         encoded_sequence["gt"] = gt
 
+                        # candidates listed in the prompt are ranked rather than generated. If the task lists
+                        # none, all items of the catalog will be ranked
+                        if self.candidate_scoring is True and task_output.candidates is not None:
+                            encoded_sequence["candidates"] = task_output.candidates
+
                     encoded_sequence_list.append(encoded_sequence)
 
         # from list of dicts to dict of lists
         return list_dict2dict_list(encoded_sequence_list)
 
+    @instrumented("prepare_input", count_from="output", attention_mask_key="attention_mask")
     def prepare_input(self, batch: dict):
         input_dict = {}
 
@@ -222,7 +289,7 @@ class T5Rec(AnonModelHF):
         if "user_idx" in batch:
             # dim 1 is equal to 1, we don't need it since user_idxs will be passed
             # through the emb layer of UserEmbeds
-            input_dict["user_idx"] = batch["user_idx"].to(self.model.device).squeeze()
+            input_dict["user_idx"] = batch["user_idx"].to(self.model.device).squeeze(dim=1)
 
         if "labels" in batch:
             lm_labels = pad_sequence(batch["labels"], batch_first=True, padding_value=-100)
@@ -231,6 +298,9 @@ class T5Rec(AnonModelHF):
         if "gt" in batch:
             input_dict["gt"] = batch["gt"]
 
+        if "candidates" in batch:
+            input_dict["candidates"] = batch["candidates"]
+
         return input_dict
 
     def _inject_whole_word_embeds(self, token_inputs_embeds: Tensor, whole_word_ids: Tensor):
@@ -249,7 +319,16 @@ class T5Rec(AnonModelHF):
 
         return inputs_embeds
 
+    @instrumented("train_step", count_from="input", attention_mask_key="attention_mask")
     def train_step(self, batch: dict):
+        return self._compute_loss(batch)
+
+    @instrumented("eval/loss_step", count_from="input", attention_mask_key="attention_mask")
+    @torch.no_grad()
+    def eval_loss_step(self, batch: dict):
+        return self._compute_loss(batch)
+
+    def _compute_loss(self, batch: dict):
 
         inputs_embeds = self.model.shared(batch["input_ids"])
 
@@ -265,6 +344,7 @@ class T5Rec(AnonModelHF):
 
         return output.loss
 
+    @instrumented("generate_step", count_from="input", attention_mask_key="attention_mask")
     @torch.no_grad()
     def generate_step(self, batch: dict, return_loss: bool = False):
 
@@ -285,6 +365,7 @@ class T5Rec(AnonModelHF):
             num_return_sequences = 1
 
         gt = np.array(batch.pop("gt"))
+        candidates = batch.pop("candidates", None)
 
         inputs_embeds = self.model.shared(batch["input_ids"])
         if self.model.config.inject_user_embeds is True:
@@ -300,6 +381,12 @@ class T5Rec(AnonModelHF):
                                 labels=batch["labels"])
             loss = output.loss
 
+        if self.candidate_scoring is True and self.eval_task.is_ranking_task():
+            mapped_predictions = self._score_candidates(inputs_embeds, batch["attention_mask"], candidates,
+                                                        top_k=num_return_sequences)
+
+            return mapped_predictions, gt, loss
+
         beam_outputs = self.model.generate(
             inputs_embeds=inputs_embeds,
             attention_mask=batch["attention_mask"],
@@ -312,6 +399,32 @@ class T5Rec(AnonModelHF):
 
         return mapped_predictions, gt, loss
 
+    def _tokenize_candidates(self, candidates: list[str]) -> list[list[int]]:
+        # candidates are encoded as target texts are encoded in `tokenize()`
+        return self.tokenizer(text_target=candidates, truncation=True).input_ids
+
+    def _score_candidates(self, inputs_embeds: Tensor, attention_mask: Tensor, candidates: list[list[str]] | None,
+                          top_k: int) -> np.ndarray[str]:
+
+        # the encoder runs only once for each sample, and its output is shared by all candidates of the sample
+        encoder_hidden_states = self.model.get_encoder()(inputs_embeds=inputs_embeds,
+                                                         attention_mask=attention_mask).last_hidden_state
+
+        def score_pairs(sample_idxs: Tensor, encoded_candidates: list[list[int]]):
+
+            labels = pad_sequence([torch.tensor(candidate_ids) for candidate_ids in encoded_candidates],
+                                  batch_first=True,
+                                  padding_value=-100).to(self.model.device)
+
+            # teacher forcing: all tokens of all candidates are scored with a single decoder forward
+            output = self.model(encoder_outputs=BaseModelOutput(last_hidden_state=encoder_hidden_states[sample_idxs]),
+                                attention_mask=attention_mask[sample_idxs],
+                                labels=labels)
+
+            return self._sequence_log_likelihood(output.logits, labels)
+
+        return self._rank_candidates(candidates, len(inputs_embeds), top_k, score_pairs)
+
     @torch.no_grad()
     def inference(self, input_text: str | list[str], user_id: str | list[str] = None, **gen_config):
         # if inject_user_embeds is True, `input_text` and `user_id` should be in 1:1 relationship,
@@ -381,26 +494,109 @@ class T5Rec(AnonModelHF):
 
         return mapped_predictions.tolist()
 
+    def export_onnx(self, output_dir: str, opset_version: int = 14):
+
+        os.makedirs(output_dir, exist_ok=True)
+
+        # dropout of injected embeddings should not be part of the graph
+        self.eval()
+
+        # dummy inputs, only their dtype and n° of dimensions matter since batch and sequence axes are dynamic
+        dummy_inputs = self.tokenizer(["dummy input text", "dummy"], padding=True, return_tensors="pt")
+        input_ids = dummy_inputs.input_ids.to(self.model.device)
+        attention_mask = dummy_inputs.attention_mask.to(self.model.device)
+
+        encoder_kwargs = {}
+        if self.whole_word_embeddings is not None:
+            encoder_kwargs["whole_word_ids"] = torch.ones_like(input_ids)
+        if self.user_embeddings is not None:
+            encoder_kwargs["user_idx"] = torch.zeros(len(input_ids), dtype=torch.long, device=self.model.device)
+
+        encoder_input_names = ["input_ids", "attention_mask", *encoder_kwargs.keys()]
+        encoder_dynamic_axes = {name: {0: "batch", 1: "sequence"}
+                                for name in encoder_input_names + ["encoder_hidden_states"]}
+        if "user_idx" in encoder_dynamic_axes:
+            encoder_dynamic_axes["user_idx"] = {0: "batch"}
+
+        self._export_onnx_graph(T5EncoderForExport(self),
+                                args=(input_ids, attention_mask, encoder_kwargs),
+                                output_path=os.path.join(output_dir, "encoder.onnx"),
+                                input_names=encoder_input_names,
+                                output_names=["encoder_hidden_states"],
+                                dynamic_axes=encoder_dynamic_axes,
+                                opset_version=opset_version)
+
+        with torch.no_grad():
+            encoder_hidden_states = T5EncoderForExport(self)(input_ids, attention_mask, **encoder_kwargs)
+
+        decoder_input_ids = torch.full((len(input_ids), 2), self.model.config.decoder_start_token_id,
+                                       device=self.model.device)
+
+        self._export_onnx_graph(T5DecoderForExport(self),
+                                args=(decoder_input_ids, encoder_hidden_states, attention_mask),
+                                output_path=os.path.join(output_dir, "decoder.onnx"),
+                                input_names=["decoder_input_ids", "encoder_hidden_states", "encoder_attention_mask"],
+                                output_names=["next_token_log_probs"],
+                                dynamic_axes={"decoder_input_ids": {0: "batch", 1: "decoded_sequence"},
+                                              "encoder_hidden_states": {0: "batch", 1: "sequence"},
+                                              "encoder_attention_mask": {0: "batch", 1: "sequence"},
+                                              "next_token_log_probs": {0: "batch"}},
+                                opset_version=opset_version)
+
+        generation_config = self.model.generation_config
+        self._save_onnx_static(output_dir, {
+            "model_type": "t5",
+            "inject_user_embeds": self.model.config.inject_user_embeds,
+            "inject_whole_word_embeds": self.model.config.inject_whole_word_embeds,
+            "user_mapping": self.model.config.user_mapping,
+            "model_max_length": self.tokenizer.model_max_length,
+            "pad_token_id": self.tokenizer.pad_token_id,
+            "decoder_start_token_id": self.model.config.decoder_start_token_id,
+            "eos_token_id": generation_config.eos_token_id,
+            "num_beams": generation_config.num_beams,
+            "num_return_sequences": generation_config.num_return_sequences,
+            "max_new_tokens": generation_config.max_new_tokens,
+            "max_length": generation_config.max_length,
+            "length_penalty": generation_config.length_penalty
+        })
+
+    def named_components(self):
+        components = super().named_components()
+
+        if self.user_embeddings is not None:
+            components["user_embeddings"] = self.user_embeddings
+
+        if self.whole_word_embeddings is not None:
+            components["whole_word_embeddings"] = self.whole_word_embeddings
+
+        return components
+
     def to(self, device: str):
+        # the hf model is moved first, so that nothing is moved if the device is not supported
+        model = super().to(device)
+
         if self.user_embeddings is not None:
             self.user_embeddings.to(device)
 
         if self.whole_word_embeddings is not None:
             self.whole_word_embeddings.to(device)
 
-        return super().to(device)
+        return model
+
+    def save_weights(self, output_dir: str, state_dict: dict[str, dict[str, Tensor]] = None):
 
-    def save(self, output_dir: str):
+        if state_dict is None:
+            state_dict = self.state_dict()
 
-        super().save(output_dir)
+        super().save_weights(output_dir, state_dict)
 
         if self.user_embeddings is not None:
             user_emb_out_pth = os.path.join(output_dir, "user_emb.pth")
-            torch.save(self.user_embeddings.state_dict(), user_emb_out_pth)
+            atomic_torch_save(state_dict["user_embeddings"], user_emb_out_pth)
 
         if self.whole_word_embeddings is not None:
             whole_word_emb_out_pth = os.path.join(output_dir, "whole_word_emb.pth")
-            torch.save(self.whole_word_embeddings.state_dict(), whole_word_emb_out_pth)
+            atomic_torch_save(state_dict["whole_word_embeddings"], whole_word_emb_out_pth)
 
     @classmethod
     def load(cls, dir_path: str, **config_gen_anon_kwargs) -> T5Rec:
@@ -424,6 +620,7 @@ class T5Rec(AnonModelHF):
                   training_tasks_str=config.training_tasks_str,
                   all_unique_labels=config.all_unique_labels,
                   items_meta_dict=items_meta_dict,
+                  all_unique_users=config.all_unique_users,
                   inject_user_embeds=config.inject_user_embeds,
                   inject_whole_word_embeds=config.inject_whole_word_embeds,
 
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import torch
+from torch import nn, Tensor
+from transformers.pytorch_utils import Conv1D
+
+# - int8: weights and activations of linear layers are quantized to int8 (activations dynamically, at each forward)
+# - int8_weight_only / int4_weight_only: only weights of linear layers are quantized, they are dequantized to the
+#   dtype of activations at each forward
+QUANTIZATION_MODES = ("int8", "int8_weight_only", "int4_weight_only")
+
+# weights of quantized models are saved with these names instead of the ones of hf
+QUANTIZED_WEIGHTS_NAME = "quantized_model.pt"
+QUANTIZATION_CONFIG_NAME = "quantization_config.json"
+
+
+class WeightOnlyQuantizedLinear(nn.Module):
+    """
+    Linear layer whose weights are stored as int8 values (or int4 values packed two by two into a byte), with a
+    scale for each group of `group_size` input features of each output feature. Weights are dequantized at each
+    forward
+
+    Args:
+        in_features: size of each input sample
+        out_features: size of each output sample
+        n_bits: 8 or 4. If 4, `in_features` must be even
+        group_size: n° of consecutive input features sharing the same scale. If `in_features` is not divisible by
+            it, a single scale is used for each output feature
+        bias: if True, the layer has a bias (which is not quantized)
+    """
+
+    def __init__(self, in_features: int, out_features: int, n_bits: int = 8, group_size: int = 128,
+                 bias: bool = True):
+        super().__init__()
+
+        if n_bits not in {8, 4}:
+            raise ValueError(f"Weights can only be quantized to 8 or 4 bits, but {n_bits} were specified!")
+        if n_bits == 4 and in_features % 2 != 0:
+            raise ValueError("Weights can be quantized to 4 bits only if the n° of input features is even!")
+
+        self.in_features = in_features
+        self.out_features = out_features
+        self.n_bits = n_bits
+        self.group_size = group_size if in_features % group_size == 0 else in_features
+
+        # with 4 bits, each byte contains two consecutive weights
+        packed_in_features = in_features if n_bits == 8 else in_features // 2
+        self.register_buffer("qweight", torch.zeros(out_features, packed_in_features, dtype=torch.int8))
+        self.register_buffer("scales", torch.ones(out_features, in_features // self.group_size))
+        self.register_buffer("bias", torch.zeros(out_features) if bias else None)
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear, n_bits: int = 8, group_size: int = 128) -> WeightOnlyQuantizedLinear:
+
+        obj = cls(linear.in_features, linear.out_features, n_bits=n_bits, group_size=group_size,
+                  bias=linear.bias is not None).to(linear.weight.device)
+
+        # symmetric quantization, the max absolute value of each group is mapped to the max quantized value
+        max_quantized = 2 ** (n_bits - 1) - 1
+        grouped_weight = linear.weight.detach().float().reshape(obj.out_features, -1, obj.group_size)
+        scales = grouped_weight.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / max_quantized
+
+        qweight = (grouped_weight / scales).round().clamp(-max_quantized - 1, max_quantized).to(torch.int8)
+        qweight = qweight.reshape(obj.out_features, obj.in_features)
+
+        if n_bits == 4:
+            # the low 4 bits contain the weight in even position, the high 4 bits the one in odd position
+            qweight = (qweight[:, 0::2] & 0x0F) | (qweight[:, 1::2] << 4)
+
+        obj.qweight.copy_(qweight)
+        obj.scales.copy_(scales.squeeze(dim=-1))
+        if linear.bias is not None:
+            obj.bias.copy_(linear.bias.detach())
+
+        return obj
+
+    @property
+    def weight(self) -> Tensor:
+        # quantized weights, as for other quantized layers: hf models check their dtype to know if a linear
+        # layer is quantized
+        return self.qweight
+
+    def dequantize_weight(self) -> Tensor:
+
+        qweight = self.qweight
+        if self.n_bits == 4:
+            # arithmetic shifts extend the sign of the 4 bits values
+            low_weights = (qweight << 4) >> 4
+            high_weights = qweight >> 4
+            qweight = torch.stack((low_weights, high_weights), dim=-1).reshape(self.out_features, self.in_features)
+
+        grouped_weight = qweight.reshape(self.out_features, -1, self.group_size).float() * self.scales.unsqueeze(-1)
+
+        return grouped_weight.reshape(self.out_features, self.in_features)
+
+    def forward(self, x: Tensor):
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return nn.functional.linear(x, self.dequantize_weight().to(x.dtype), bias)
+
+    def extra_repr(self) -> str:
+        return (f"in_features={self.in_features}, out_features={self.out_features}, n_bits={self.n_bits}, "
+                f"group_size={self.group_size}, bias={self.bias is not None}")
+
+
+def _replace_modules(model: nn.Module, module_cls: type[nn.Module], replace_fn):
+
+    # list, since modules are replaced while iterating
+    for name, module in list(model.named_modules()):
+        if isinstance(module, module_cls):
+            parent_name, _, child_name = name.rpartition(".")
+            parent = model.get_submodule(parent_name) if parent_name != "" else model
+
+            setattr(parent, child_name, replace_fn(module))
+
+
+def _conv1d_to_linear(conv1d: Conv1D) -> nn.Linear:
+
+    # Conv1D of hf (used e.g. by gpt2) is a linear layer with transposed weights
+    in_features, out_features = conv1d.weight.shape
+
+    linear = nn.Linear(in_features, out_features, device=conv1d.weight.device, dtype=conv1d.weight.dtype)
+    linear.weight.data.copy_(conv1d.weight.data.T)
+    linear.bias.data.copy_(conv1d.bias.data)
+
+    return linear
+
+
+def quantize_model(model: nn.Module, mode: str, group_size: int = 128) -> nn.Module:
+    """
+    Quantizes linear layers of `model` (in place when possible) for inference on cpu
+
+    Args:
+        model: model to quantize
+        mode: one of `QUANTIZATION_MODES`
+        group_size: n° of input features sharing the same scale with weight only modes
+
+    Returns:
+        the quantized model
+    """
+
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Quantization mode {mode} is not supported! Supported modes are {QUANTIZATION_MODES}")
+
+    model.eval()
+
+    # Conv1D layers are linear layers too, but they are not recognized as such by torch quantization
+    _replace_modules(model, Conv1D, _conv1d_to_linear)
+
+    if mode == "int8":
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    n_bits = 8 if mode == "int8_weight_only" else 4
+    _replace_modules(model, nn.Linear,
+                     lambda linear: (WeightOnlyQuantizedLinear.from_linear(linear, n_bits=n_bits,
+                                                                           group_size=group_size)
+                                     if n_bits == 8 or linear.in_features % 2 == 0 else linear))
+
+    return model
@@ -1,3 +1,5 @@
+import hashlib
+import os
 import sys
 import time
 from math import ceil
@@ -6,16 +8,36 @@ from typing import Optional, Callable, Dict
 import datasets
 import numpy as np
 import pandas as pd
-import wandb
+import torch
+from loguru import logger
 from tqdm import tqdm
 
 from src.evaluate.evaluator import RecEvaluator
 from src.evaluate.abstract_metric import Loss
+from src.instrumentation import INSTRUMENTATION, StageRecord, instrumented
 from src.model import AnonModel
-from src.utils import log_wandb, format_time
+from src.utils import (AsyncWandbLogger, BackgroundWorker, RunningMean, format_time, get_rng_state, set_rng_state,
+                       atomic_torch_save, get_world_size, get_rank, is_main_process, barrier, broadcast_object,
+                       any_process, min_across_processes)
 from src.evaluate.abstract_metric import AnonMetric
 
 
+class _TrainStepModule(torch.nn.Module):
+    """
+    Wraps all the trainable components of a model into a single torch module whose forward is the train step of the
+    model, so that it can be wrapped by DistributedDataParallel and gradients are synchronized across processes
+    """
+
+    def __init__(self, rec_model: AnonModel):
+        super().__init__()
+
+        self.rec_model = rec_model
+        self.components = torch.nn.ModuleDict(rec_model.named_components())
+
+    def forward(self, batch: dict):
+        return self.rec_model.train_step(batch)
+
+
 class RecTrainer:
 
     def __init__(self,
@@ -26,6 +48,15 @@ class RecTrainer:
                  output_dir: str,
                  monitor_metric: AnonMetric = Loss(),
                  eval_batch_size: Optional[int] = None,
+                 checkpoint_every_n_steps: Optional[int] = None,
+                 checkpoint_every_n_minutes: Optional[float] = None,
+                 val_subsample_size: Optional[int] = None,
+                 val_budget_minutes: Optional[float] = None,
+                 random_seed: int = 42,
+                 patience: Optional[int] = None,
+                 min_delta: float = 0.,
+                 val_every_n_steps: Optional[int] = None,
+                 max_train_minutes: Optional[float] = None,
                  should_log: bool = False):
 
         self.rec_model = rec_model
@@ -37,6 +68,24 @@ class RecTrainer:
         self.output_dir = output_dir
         self.should_log = should_log
 
+        # checkpoints contain everything needed to resume an interrupted training
+        # (model, optimizer, random states, trainer state)
+        self.checkpoint_every_n_steps = checkpoint_every_n_steps
+        self.checkpoint_every_n_minutes = checkpoint_every_n_minutes
+        self.checkpoint_filename = "trainer_checkpoint.pth"
+
+        # validation can be performed on a fixed subsample of users and/or within a time budget
+        self.val_subsample_size = val_subsample_size
+        self.val_budget_minutes = val_budget_minutes
+        self.random_seed = random_seed
+
+        # training stops when the monitor metric doesn't improve (by at least min_delta) for
+        # `patience` consecutive validations, or when max_train_minutes are elapsed
+        self.patience = patience
+        self.min_delta = min_delta
+        self.val_every_n_steps = val_every_n_steps
+        self.max_train_minutes = max_train_minutes
+
         # evaluator for validating with validation set during training
         # we set should_log to False because we want to have full control,
         # and we will log differently during validation phase
@@ -57,87 +106,244 @@ class RecTrainer:
                 dataframe_dict["input_text_placeholder"].append(input_text_placeholder)
                 dataframe_dict["target_text_placeholder"].append(target_text_placeholder)
 
-        log_wandb({"train/task_templates": wandb.Table(dataframe=pd.DataFrame(dataframe_dict))}, should_log)
+        # logs are sent by a background thread, so that training steps never wait for wandb
+        self.logger = AsyncWandbLogger(should_log)
+        if should_log:
+            import wandb
+
+            self.logger.log({"train/task_templates": wandb.Table(dataframe=pd.DataFrame(dataframe_dict))})
 
-    def train(self, train_dataset: datasets.Dataset, validation_dataset: datasets.Dataset = None):
+    @instrumented("train")
+    def train(self, train_dataset: datasets.Dataset, validation_dataset: datasets.Dataset = None,
+              resume: bool = False):
 
         print(f"# Start training for {self.n_epochs} epochs\n")
 
         # init variables for saving best model thanks to validation set (if present)
-        best_epoch = None
-        best_res_op_comparison = None
-        best_val_monitor_result = None
+        self.best_epoch = None
+        self.best_step = None
+        self.best_val_monitor_result = None
+        self.best_state_dict = None
+        self.n_val_without_improvement = 0
 
         # depending on the monitor metric, in order to find the best model we should either
         # minimize the metric (e.g. loss) or maximize it (e.g. hit)
         if validation_dataset is not None:
-            best_res_op_comparison = self.monitor_metric.operator_comparison
 
             # small trick to get the initialization value
-            best_val_monitor_result = +np.inf if best_res_op_comparison(-np.inf, +np.inf) else -np.inf
+            best_res_op_comparison = self.monitor_metric.operator_comparison
+            self.best_val_monitor_result = +np.inf if best_res_op_comparison(-np.inf, +np.inf) else -np.inf
+
+            # the subsample is chosen once, so that validation results are comparable across epochs
+            if self.val_subsample_size is not None:
+                validation_dataset = self._subsample_validation(validation_dataset)
 
         optimizer = self.rec_model.get_suggested_optimizer
 
-        start = time.time()
-        for current_epoch in range(1, self.n_epochs + 1):
+        # in distributed mode (launched via torchrun) each process trains on a different shard of the train set
+        # and gradients are averaged across processes. Only the main process saves and logs
+        world_size = get_world_size()
+        rank = get_rank()
+
+        train_step_fn = self.rec_model.train_step
+        if world_size > 1:
+            train_step_fn = torch.nn.parallel.DistributedDataParallel(_TrainStepModule(self.rec_model))
+
+            print(f"# Distributed training with {world_size} processes\n")
+
+        # everything that doesn't change during training (config, tokenizer, etc.) is saved only once,
+        # model weights are saved by a background thread each time we find a better model
+        if is_main_process():
+            self.rec_model.save_static(self.output_dir)
+        weights_saver = BackgroundWorker()
+
+        # variables needed to continue an interrupted training from the last checkpoint
+        start_epoch = 1
+        start_step = 0
+        global_step = 0
+        elapsed_before_resume = 0
+        resumed_epoch_rng_state = None
+        resumed_rng_state = None
+        resumed_train_loss = None
+
+        if resume is True:
+            checkpoint = self._load_checkpoint(optimizer)
+
+            if checkpoint is not None:
+                trainer_state = checkpoint["trainer_state"]
+
+                start_epoch = trainer_state["epoch"]
+                start_step = trainer_state["step"]
+                global_step = trainer_state["global_step"]
+                elapsed_before_resume = trainer_state["elapsed_time"]
+                self.best_epoch = trainer_state["best_epoch"]
+                self.best_step = trainer_state["best_step"]
+                self.best_val_monitor_result = trainer_state["best_val_monitor_result"]
+                self.n_val_without_improvement = trainer_state["n_val_without_improvement"]
+                resumed_train_loss = trainer_state["train_loss"]
+
+                resumed_epoch_rng_state = checkpoint["epoch_rng_state"]
+                resumed_rng_state = checkpoint["rng_state"]
+
+                print(f"# Resuming training from Epoch {start_epoch}, step {start_step}\n")
+
+        last_checkpoint_time = time.time()
+
+        # set to True as soon as one of the stopping criteria is met (patience exhausted, time limit reached)
+        stop_training = False
+
+        start = time.time() - elapsed_before_resume
+        for current_epoch in range(start_epoch, self.n_epochs + 1):
 
             self.rec_model.train()
 
+            # stats of the stages performed in this epoch are shown at its end, if instrumentation is enabled
+            epoch_stats_snapshot = INSTRUMENTATION.snapshot()
+            epoch_start = time.perf_counter()
+
+            # when resuming, we restore the random state that there was at the start of the interrupted epoch,
+            # so that the train set is sampled, tokenized and shuffled exactly as it was before the interruption
+            if resumed_epoch_rng_state is not None:
+                set_rng_state(resumed_epoch_rng_state)
+                resumed_epoch_rng_state = None
+
+            # all processes must sample the train set in the same way, so that each one trains on a different shard
+            epoch_rng_state = broadcast_object(get_rng_state())
+            if world_size > 1:
+                set_rng_state(epoch_rng_state)
+
             # at the start of each iteration, we randomly sample the train sequence and tokenize it
             # batched set to True because data can be augmented, either when sampling or when
             # tokenizing (e.g. a task has multiple support templates)
 
-            sampled_train = train_dataset.map(self.train_sampling_fn,
-                                              remove_columns=train_dataset.column_names,
-                                              keep_in_memory=True,
-                                              load_from_cache_file=False,
-                                              batched=True,
-                                              desc="Sampling train set")
-
-            preprocessed_train = sampled_train.map(self.rec_model.tokenize,
-                                                   remove_columns=sampled_train.column_names,
-                                                   keep_in_memory=True,
-                                                   load_from_cache_file=False,
-                                                   batched=True,
-                                                   desc="Tokenizing train set")
+            with INSTRUMENTATION.stage("train/sample_train_set") as record:
+                sampled_train = train_dataset.map(self.train_sampling_fn,
+                                                  remove_columns=train_dataset.column_names,
+                                                  keep_in_memory=True,
+                                                  load_from_cache_file=False,
+                                                  batched=True,
+                                                  desc="Sampling train set")
+                record.count(n_samples=sampled_train.num_rows)
+
+            if world_size > 1:
+                sampled_train = sampled_train.shard(num_shards=world_size, index=rank, contiguous=True)
+
+            # it includes the time spent by `datasets` to write the tokenized set, besides the `tokenize` stage
+            with INSTRUMENTATION.stage("train/tokenize_train_set") as record:
+                preprocessed_train = sampled_train.map(self.rec_model.tokenize,
+                                                       remove_columns=sampled_train.column_names,
+                                                       keep_in_memory=True,
+                                                       load_from_cache_file=False,
+                                                       batched=True,
+                                                       desc="Tokenizing train set")
+                record.count(n_samples=preprocessed_train.num_rows)
 
             # shuffle here so that if we augment data (2 or more row for a single user) it is shuffled
             preprocessed_train = preprocessed_train.shuffle()
             preprocessed_train.set_format("torch")
 
+            # all processes must perform the same n° of steps (tokenization could augment data differently
+            # in each shard), so the few extra samples of the biggest shards are dropped
+            if world_size > 1:
+                n_rows = min_across_processes(preprocessed_train.num_rows)
+                preprocessed_train = preprocessed_train.select(range(n_rows))
+
             # ceil because we don't drop the last batch
             total_n_batch = ceil(preprocessed_train.num_rows / self.batch_size)
 
-            pbar = tqdm(preprocessed_train.iter(batch_size=self.batch_size),
-                        total=total_n_batch)
-
-            train_loss = 0
+            # loss is accumulated on device, it is moved to the host only when we need to show it
+            train_loss = RunningMean()
 
             # progress will go from 0 to 100. Init to -1 so at 0 we perform the first print
             progress = -1
-            for i, batch in enumerate(pbar, start=1):
+
+            # batches already performed before the interruption are skipped, and the random state
+            # that there was when the checkpoint was saved is restored
+            epoch_start_step = start_step if current_epoch == start_epoch else 0
+            if epoch_start_step > 0:
+                preprocessed_train = preprocessed_train.select(
+                    range(epoch_start_step * self.batch_size, preprocessed_train.num_rows)
+                )
+                progress = round(100 * (epoch_start_step / total_n_batch))
+
+            if resumed_rng_state is not None:
+                set_rng_state(resumed_rng_state)
+                resumed_rng_state = None
+
+                train_loss.total, train_loss.count = resumed_train_loss
+
+            pbar = tqdm(preprocessed_train.iter(batch_size=self.batch_size),
+                        total=total_n_batch,
+                        initial=epoch_start_step,
+                        disable=not is_main_process())
+
+            for i, batch in enumerate(pbar, start=epoch_start_step + 1):
 
                 optimizer.zero_grad()
 
                 prepared_input = self.rec_model.prepare_input(batch)
-                loss = self.rec_model.train_step(prepared_input)
+                loss = train_step_fn(prepared_input)
 
-                loss.backward()
-                optimizer.step()
+                with INSTRUMENTATION.stage("train/backward_optimizer_step"):
+                    loss.backward()
+                    optimizer.step()
 
-                train_loss += loss.item()
+                global_step += 1
+
+                train_loss.update(loss)
 
                 # we update the loss every 1% progress considering the total n° of batches.
                 # tqdm update integer percentage (1%, 2%) when float percentage is over .5 threshold (1.501 -> 2%)
-                # so we print infos in the same way
-                if round(100 * (i / total_n_batch)) > progress:
-                    pbar.set_description(f"Epoch {current_epoch}/{self.n_epochs}, Loss -> {(train_loss / i):.6f}")
+                # so we print infos in the same way. This is also the only moment in which
+                # the loss is synchronized with the host, so logging cost does not depend on the n° of steps
+                progress_milestone = round(100 * (i / total_n_batch)) > progress
+                if progress_milestone:
+                    train_loss_so_far = train_loss.flush(synchronize=True)
+
+                    pbar.set_description(f"Epoch {current_epoch}/{self.n_epochs}, Loss -> {train_loss_so_far:.6f}")
                     progress += 1
-                    log_wandb({
-                        "train/loss": train_loss / i
-                    }, self.should_log)
+                    self.logger.log({
+                        "train/loss": train_loss_so_far
+                    })
+
+                # step based validation, performed instead of the validation at the end of each epoch
+                if (validation_dataset is not None and self.val_every_n_steps is not None and
+                        global_step % self.val_every_n_steps == 0):
+
+                    val_to_log = self._validate(validation_dataset, current_epoch, global_step, weights_saver)
+                    self.logger.log(val_to_log)
+
+                    self.rec_model.train()
+
+                    stop_training = self._patience_exhausted()
 
-            train_loss /= total_n_batch
+                # all processes must agree on stopping, otherwise the others would wait forever. Agreeing
+                # requires synchronizing them, so as for the loss this is done only at progress milestones
+                if (self.max_train_minutes is not None and progress_milestone and
+                        any_process(time.time() - start >= self.max_train_minutes * 60)):
+                    print(f"\nMax training time of {self.max_train_minutes} minutes reached, training is stopped!",
+                          file=sys.stderr)
+                    stop_training = True
+
+                if stop_training:
+                    break
+
+                if is_main_process() and self._should_checkpoint(global_step, last_checkpoint_time):
+                    self._save_checkpoint(
+                        optimizer,
+                        weights_saver,
+                        epoch_rng_state=epoch_rng_state,
+                        trainer_state=self._trainer_state(
+                            epoch=current_epoch,
+                            step=i,
+                            global_step=global_step,
+                            elapsed_time=time.time() - start,
+                            train_loss=(train_loss.total, train_loss.count)
+                        )
+                    )
+                    last_checkpoint_time = time.time()
+
+            train_loss = train_loss.flush(synchronize=True)
 
             pbar.close()
 
@@ -146,51 +352,59 @@ class RecTrainer:
                 "train/epoch": current_epoch
             }
 
-            if validation_dataset is not None:
+            if validation_dataset is not None and self.val_every_n_steps is None and not stop_training:
 
-                print(f"- Start validation for Epoch {current_epoch}", file=sys.stderr)
+                val_to_log = self._validate(validation_dataset, current_epoch, global_step, weights_saver)
+                dict_to_log.update(val_to_log)
 
-                self.rec_model.eval()
+                stop_training = self._patience_exhausted()
 
-                # we surely want loss for the progbar
-                metric_list = [Loss()]
-                if self.monitor_metric != Loss():
-                    metric_list.append(self.monitor_metric)
+            epoch_record = StageRecord()
+            epoch_record.count(n_samples=preprocessed_train.num_rows)
+            INSTRUMENTATION.add("train/epoch", time.perf_counter() - epoch_start, epoch_record)
+            if INSTRUMENTATION.enabled and is_main_process():
+                INSTRUMENTATION.print_summary(f"Stages of epoch {current_epoch}", since=epoch_stats_snapshot)
+                dict_to_log.update(INSTRUMENTATION.to_wandb_dict(since=epoch_stats_snapshot))
 
-                val_result = self.rec_evaluator.evaluate_task(
-                    validation_dataset,
-                    task=self.rec_model.eval_task,
-                    metric_list=metric_list
+            # log to wandb at each epoch
+            self.logger.log(dict_to_log)
+
+            if stop_training:
+                break
+
+            # at the end of each epoch, we always save a checkpoint (if checkpointing is enabled),
+            # so that a resumed training will not repeat the validation phase
+            checkpoint_enabled = self.checkpoint_every_n_steps is not None or self.checkpoint_every_n_minutes is not None
+            if is_main_process() and checkpoint_enabled:
+                rng_state = get_rng_state()
+                self._save_checkpoint(
+                    optimizer,
+                    weights_saver,
+                    epoch_rng_state=rng_state,
+                    rng_state=rng_state,
+                    trainer_state=self._trainer_state(
+                        epoch=current_epoch + 1,
+                        step=0,
+                        global_step=global_step,
+                        elapsed_time=time.time() - start,
+                        train_loss=(None, 0)
+                    )
                 )
+                last_checkpoint_time = time.time()
 
-                monitor_val = val_result[str(self.monitor_metric)]
-                should_save = best_res_op_comparison(monitor_val,
-                                                     best_val_monitor_result)
-
-                # we save the best model based on the metric/loss result
-                if should_save:
-                    best_epoch = current_epoch
-                    best_val_monitor_result = monitor_val
-                    self.rec_model.save(self.output_dir)
-
-                    print(f"Validation {self.monitor_metric} improved, model saved into {self.output_dir}!",
-                          file=sys.stderr)
-
-                # prefix "val" for val result dict
-                val_to_log = {f"val/{metric_name}": metric_val for metric_name, metric_val in val_result.items()}
-                val_to_log["val/epoch"] = current_epoch
+            # simple newline to better separate different epochs
+            print(file=sys.stderr)  # stderr to avoid overlap with tqdm
 
-                dict_to_log.update(val_to_log)
+        # if no validation set (or training was stopped before any validation), we simply save the last model
+        if self.best_epoch is None and is_main_process():
+            self.best_state_dict = self._snapshot_state_dict()
+            weights_saver.submit(self.rec_model.save_weights, self.output_dir, self.best_state_dict)
 
-            # if no validation set, we simply save the model of the last epoch
-            elif current_epoch == self.n_epochs:
-                self.rec_model.save(self.output_dir)
+        # wait for the last weights to be written to disk
+        weights_saver.close()
 
-            # log to wandb at each epoch
-            log_wandb(dict_to_log, self.should_log)
-
-            # simple newline to better separate different epochs
-            print(file=sys.stderr)  # stderr to avoid overlap with tqdm
+        # other processes can load the best model only when the main process has finished writing it
+        barrier()
 
         elapsed_time = time.time() - start
 
@@ -203,12 +417,191 @@ class RecTrainer:
         # are optional depending on the elapsed time
         print(f"# Elapsed time: {format_time(elapsed_time)}")
 
-        if best_epoch is not None:
-            print(f"# Best epoch: {best_epoch}")
-            dict_to_log["train/best_epoch"] = best_epoch
+        if self.best_epoch is not None:
+            print(f"# Best epoch: {self.best_epoch} (step {self.best_step})")
+            dict_to_log["train/best_epoch"] = self.best_epoch
+            dict_to_log["train/best_step"] = self.best_step
+
+        self.logger.log(dict_to_log)
+
+        # wait for all pending logs to be sent
+        self.logger.close()
+
+        # return best model if validation was set, otherwise this return the model
+        # saved at the last epoch. Best weights are restored from memory, unless training was resumed
+        # and no better model was found after resuming: in that case, best weights are only on disk
+        if self.best_state_dict is None:
+            return self.rec_model.load(self.output_dir)
+
+        self.rec_model.load_state_dict(self.best_state_dict)
+
+        return self.rec_model
+
+    def _validate(self, validation_dataset: datasets.Dataset, current_epoch: int, global_step: int,
+                  weights_saver: BackgroundWorker) -> dict:
+
+        print(f"- Start validation for Epoch {current_epoch} (step {global_step})", file=sys.stderr)
+
+        self.rec_model.eval()
+
+        # we surely want loss for the progbar
+        metric_list = [Loss()]
+        if self.monitor_metric != Loss():
+            metric_list.append(self.monitor_metric)
+
+        # if the monitor metric is the loss, no prediction is generated during validation.
+        # In distributed mode, all processes validate on different users and get the same merged result
+        val_result = self.rec_evaluator.evaluate_task(
+            validation_dataset,
+            task=self.rec_model.eval_task,
+            metric_list=metric_list,
+            max_minutes=self.val_budget_minutes
+        )
+
+        monitor_val = val_result[str(self.monitor_metric)]
+
+        # we save the best model based on the metric/loss result, improvements
+        # lower than min_delta are not considered as such
+        improved = (self.monitor_metric.operator_comparison(monitor_val, self.best_val_monitor_result) and
+                    abs(monitor_val - self.best_val_monitor_result) > self.min_delta)
+
+        if improved:
+            self.best_epoch = current_epoch
+            self.best_step = global_step
+            self.best_val_monitor_result = monitor_val
+            self.n_val_without_improvement = 0
+
+            # in memory copy of the weights, written to disk in background while training goes on
+            if is_main_process():
+                self.best_state_dict = self._snapshot_state_dict()
+                weights_saver.submit(self.rec_model.save_weights, self.output_dir, self.best_state_dict)
+
+            print(f"Validation {self.monitor_metric} improved, model will be saved into {self.output_dir}!",
+                  file=sys.stderr)
+        else:
+            self.n_val_without_improvement += 1
+
+        # prefix "val" for val result dict
+        val_to_log = {f"val/{metric_name}": metric_val for metric_name, metric_val in val_result.items()}
+        val_to_log["val/epoch"] = current_epoch
+        val_to_log["val/step"] = global_step
+
+        return val_to_log
+
+    def _patience_exhausted(self) -> bool:
+
+        if self.patience is not None and self.n_val_without_improvement >= self.patience:
+            print(f"Validation {self.monitor_metric} did not improve for {self.n_val_without_improvement} "
+                  f"validations, training is stopped!", file=sys.stderr)
+            return True
+
+        return False
+
+    def _trainer_state(self, epoch: int, step: int, global_step: int, elapsed_time: float,
+                       train_loss: tuple) -> dict:
+
+        return {
+            "epoch": epoch,
+            "step": step,
+            "global_step": global_step,
+            "elapsed_time": elapsed_time,
+            "best_epoch": self.best_epoch,
+            "best_step": self.best_step,
+            "best_val_monitor_result": self.best_val_monitor_result,
+            "n_val_without_improvement": self.n_val_without_improvement,
+            "train_loss": train_loss
+        }
+
+    def _subsample_validation(self, validation_dataset: datasets.Dataset) -> datasets.Dataset:
+
+        n_users = validation_dataset.num_rows
+        if self.val_subsample_size >= n_users:
+            logger.warning(f"val_subsample_size={self.val_subsample_size} is not lower than the n° of validation "
+                           f"users ({n_users}), the whole validation set will be used!")
+            return validation_dataset
+
+        # private generator, so that the global random state (and thus training) is not affected
+        rng = np.random.default_rng(self.random_seed)
+
+        # users are sorted by length of their history (ties are broken randomly) and split into
+        # strata of equal size, i.e. quantiles of the history length distribution
+        history_lengths = np.array([len(seq) for seq in validation_dataset["input_item_seq"]])
+        random_order = rng.permutation(n_users)
+        sorted_users = random_order[np.argsort(history_lengths[random_order], kind="stable")]
+
+        n_strata = min(10, self.val_subsample_size)
+        strata = np.array_split(sorted_users, n_strata)
+
+        # n° of users to sample from each stratum is proportional to its size,
+        # the leftover is assigned to the strata with the largest remainders
+        quotas = np.array([len(stratum) for stratum in strata]) * self.val_subsample_size / n_users
+        n_to_sample = np.floor(quotas).astype(int)
+        leftover = self.val_subsample_size - n_to_sample.sum()
+        n_to_sample[np.argsort(-(quotas - n_to_sample), kind="stable")[:leftover]] += 1
+
+        sampled_idxs = np.concatenate([rng.choice(stratum, size=n, replace=False)
+                                       for stratum, n in zip(strata, n_to_sample)])
+        sampled_idxs.sort()
+
+        val_subsample = validation_dataset.select(sampled_idxs)
+
+        # fingerprint of the users chosen, so that it can be checked that results of different runs are comparable
+        fingerprint = hashlib.sha1(" ".join(val_subsample["user_id"]).encode("utf-8")).hexdigest()[:12]
+
+        print(f"# Validation will be performed on a subsample of {val_subsample.num_rows}/{n_users} users "
+              f"stratified by history length (fingerprint: {fingerprint})\n")
+        self.logger.log({"val/subsample_size": val_subsample.num_rows,
+                         "val/subsample_fingerprint": fingerprint})
+
+        return val_subsample
+
+    def _snapshot_state_dict(self) -> dict[str, dict[str, torch.Tensor]]:
+
+        # copy on cpu of all the weights, so that the copy is not modified by the next training steps
+        return {
+            component_name: {name: tensor.detach().to("cpu", copy=True) for name, tensor in component_state.items()}
+            for component_name, component_state in self.rec_model.state_dict().items()
+        }
+
+    def _should_checkpoint(self, global_step: int, last_checkpoint_time: float):
+
+        if self.checkpoint_every_n_steps is not None and global_step % self.checkpoint_every_n_steps == 0:
+            return True
+
+        if self.checkpoint_every_n_minutes is not None:
+            return time.time() - last_checkpoint_time >= self.checkpoint_every_n_minutes * 60
+
+        return False
+
+    def _save_checkpoint(self, optimizer: torch.optim.Optimizer, weights_saver: BackgroundWorker,
+                         epoch_rng_state: dict, trainer_state: dict, rng_state: dict = None):
+
+        # the checkpoint refers to the best model found so far, which a resumed training reloads from disk:
+        # thus the best weights must be completely written before the checkpoint is
+        weights_saver.join()
+
+        checkpoint = {
+            "model": self.rec_model.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "rng_state": rng_state if rng_state is not None else get_rng_state(),
+            "epoch_rng_state": epoch_rng_state,
+            "trainer_state": trainer_state
+        }
+
+        atomic_torch_save(checkpoint, os.path.join(self.output_dir, self.checkpoint_filename))
+
+    def _load_checkpoint(self, optimizer: torch.optim.Optimizer) -> Optional[dict]:
+
+        checkpoint_path = os.path.join(self.output_dir, self.checkpoint_filename)
+
+        if not os.path.isfile(checkpoint_path):
+            logger.warning(f"No checkpoint found in {self.output_dir}, training will start from scratch!")
+            return None
+
+        # weights_only=False since the checkpoint contains also the random states of the libraries
+        checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
 
-        log_wandb(dict_to_log, self.should_log)
+        self.rec_model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
 
-        # return best model pif validation was set, otherwise this return the model
-        # saved at the last epoch
-        return self.rec_model.load(self.output_dir)
+        return checkpoint
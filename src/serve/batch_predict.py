@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+from typing import Iterator
+
+import datasets
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
+import torch.multiprocessing
+from tqdm import tqdm
+
+from src.data.abstract_task import AnonTask
+from src.model import AnonModel
+from src.serve.inference import tokenize_samples, generate_from_tokenized, missing_fields
+from src.utils import dict_list2list_dict, seed_everything
+
+OUTPUT_FORMATS = (".parquet", ".jsonl")
+
+
+def get_parts_dir(output_path: str) -> str:
+    # e.g. reports/recommendations/exp/SequentialSideInfoTask_parts
+    return f"{os.path.splitext(output_path)[0]}_parts"
+
+
+def get_part_path(parts_dir: str, chunk_idx: int, output_format: str) -> str:
+    return os.path.join(parts_dir, f"part_{chunk_idx:06d}{output_format}")
+
+
+def iter_input_chunks(input_source: datasets.Dataset | str, chunk_size: int) -> Iterator[list[dict]]:
+    """
+    Streams samples from a dataset split or from a JSONL file (one JSON object with the fields required by the task
+    for each line), `chunk_size` samples at a time, so that the whole input is never loaded in memory
+    """
+
+    if isinstance(input_source, datasets.Dataset):
+        for batch in input_source.iter(batch_size=chunk_size):
+            yield dict_list2list_dict(batch)
+        return
+
+    with open(input_source) as f:
+        chunk = []
+        for line in f:
+            if line.strip():
+                chunk.append(json.loads(line))
+
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+
+        if len(chunk) != 0:
+            yield chunk
+
+
+def top_k_distinct(predictions: list[str], top_k: int = None) -> list[str]:
+    # predictions are sorted by score, but beam search may generate the same item more than once
+    return list(dict.fromkeys(predictions))[:top_k]
+
+
+def predict_chunk(rec_model: AnonModel, task: AnonTask, samples: list[dict], batch_size: int,
+                  top_k: int = None) -> tuple[list[str], list[list[str]]]:
+
+    for i, sample in enumerate(samples):
+        missing = missing_fields(task, sample)
+        if len(missing) != 0:
+            raise ValueError(f"Fields {missing} are required by {task} but they are missing from sample {i} "
+                             f"(user {sample.get('user_id')})!")
+
+    recommendations = []
+    for start in range(0, len(samples), batch_size):
+        batch_samples = samples[start:start + batch_size]
+
+        # each sample is always rendered with the same prompt, so that results don't depend on how
+        # samples are split among workers or on interrupted runs
+        tokenized_batch = tokenize_samples(rec_model, task, batch_samples, deterministic=True)
+        predictions = generate_from_tokenized(rec_model, task, tokenized_batch)
+
+        recommendations.extend(top_k_distinct(list(user_predictions), top_k) for user_predictions in predictions)
+
+    return [sample["user_id"] for sample in samples], recommendations
+
+
+def save_part(path: str, user_ids: list[str], recommendations: list[list[str]]):
+
+    # written to a temporary file first, so that a part at `path` is always complete
+    tmp_path = f"{path}.tmp"
+
+    if path.endswith(".parquet"):
+        table = pa.table({
+            "user_id": pa.array(user_ids, type=pa.string()),
+            "recommendations": pa.array(recommendations, type=pa.list_(pa.string()))
+        })
+        pq.write_table(table, tmp_path, compression="zstd")
+    else:
+        with open(tmp_path, "w") as f:
+            for user_id, user_recommendations in zip(user_ids, recommendations):
+                f.write(json.dumps({"user_id": user_id, "recommendations": user_recommendations}) + "\n")
+
+    os.replace(tmp_path, path)
+
+
+def merge_parts(output_path: str, part_paths: list[str]):
+    """
+    Concatenates parts into the output file one part at a time, so that memory stays bounded
+    """
+
+    tmp_path = f"{output_path}.tmp"
+
+    if output_path.endswith(".parquet"):
+        writer = None
+        for part_path in part_paths:
+            table = pq.read_table(part_path)
+
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema, compression="zstd")
+            writer.write_table(table)
+
+        if writer is not None:
+            writer.close()
+        else:
+            pq.write_table(pa.table({"user_id": pa.array([], type=pa.string()),
+                                     "recommendations": pa.array([], type=pa.list_(pa.string()))}), tmp_path)
+    else:
+        with open(tmp_path, "wb") as out_f:
+            for part_path in part_paths:
+                with open(part_path, "rb") as part_f:
+                    shutil.copyfileobj(part_f, out_f)
+
+    os.replace(tmp_path, output_path)
+
+
+def predict_parts(rec_model: AnonModel,
+                  task: AnonTask,
+                  input_source: datasets.Dataset | str,
+                  parts_dir: str,
+                  output_format: str,
+                  batch_size: int,
+                  chunk_size: int,
+                  top_k: int = None,
+                  worker_idx: int = 0,
+                  n_workers: int = 1):
+    """
+    Generates recommendations for the chunks of the input assigned to this worker (one every `n_workers`),
+    saving each chunk as a separate part. Parts already saved (e.g. by an interrupted run) are skipped
+    """
+
+    rec_model.eval()
+
+    pbar = tqdm(iter_input_chunks(input_source, chunk_size), desc=f"Worker {worker_idx}", unit="chunk",
+                position=worker_idx)
+
+    for chunk_idx, samples in enumerate(pbar):
+
+        part_path = get_part_path(parts_dir, chunk_idx, output_format)
+        if chunk_idx % n_workers != worker_idx or os.path.isfile(part_path):
+            continue
+
+        user_ids, recommendations = predict_chunk(rec_model, task, samples, batch_size, top_k)
+        save_part(part_path, user_ids, recommendations)
+
+
+def _worker_main(worker_idx: int, n_workers: int, model_cls_name: str, model_path: str, model_kwargs: dict,
+                 device: str, random_seed: int, task: AnonTask, predict_kwargs: dict):
+
+    seed_everything(random_seed)
+
+    # cpu cores are shared among workers, otherwise each worker would use all of them and they would contend
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // n_workers))
+
+    # each worker loads its own copy of the model. With more than one gpu, workers are spread among them
+    if device.startswith("cuda") and torch.cuda.device_count() > 1:
+        device = f"cuda:{worker_idx % torch.cuda.device_count()}"
+
+    model_cls = AnonModel.model_exists(model_cls_name, return_bool=False)
+    rec_model = model_cls.load(model_path, **model_kwargs)
+    rec_model.to(device)
+
+    predict_parts(rec_model, task, worker_idx=worker_idx, n_workers=n_workers, **predict_kwargs)
+
+
+def run_workers(n_workers: int, model_cls_name: str, model_path: str, model_kwargs: dict, device: str,
+                random_seed: int, task: AnonTask, predict_kwargs: dict):
+    """
+    Runs `predict_parts()` in `n_workers` processes, each one loading the model saved in `model_path`
+    """
+
+    # spawn, so that workers don't inherit the state of torch (e.g. cuda) from this process
+    mp_context = torch.multiprocessing.get_context("spawn")
+
+    processes = [mp_context.Process(target=_worker_main,
+                                    args=(worker_idx, n_workers, model_cls_name, model_path, model_kwargs,
+                                          device, random_seed, task, predict_kwargs))
+                 for worker_idx in range(n_workers)]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join()
+
+    failed_workers = [worker_idx for worker_idx, process in enumerate(processes) if process.exitcode != 0]
+    if len(failed_workers) != 0:
+        raise RuntimeError(f"Workers {failed_workers} failed! Launch the same command again to resume "
+                           f"from the chunks already saved")
+
+
+def build_predict_manifest(model_hash: str, generation_config: dict, task: AnonTask, template_id: int | str,
+                           input_id: str, chunk_size: int, top_k: int) -> dict:
+    """
+    Describes everything which determines the parts saved, so that parts of a different run are never mixed
+    """
+
+    return {
+        "model_hash": model_hash,
+        "generation_config": generation_config,
+        "task": str(task),
+        "template_id": template_id,
+        "input": input_id,
+        "chunk_size": chunk_size,
+        "top_k": top_k
+    }
+
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    LRU cache of the predictions generated for each prompt, with a time to live. Entries are evicted (least
+    recently used first) whenever the cache holds more than `max_entries` entries or its estimated size exceeds
+    `max_bytes`. Predictions depend on the weights of the model, so the cache is tied to a model hash:
+    all entries are dropped when a different one is set with `sync_model()`
+
+    Args:
+        max_entries: max n° of entries kept
+        max_bytes: max estimated memory occupied by keys and predictions of all the entries
+        ttl_seconds: entries older than this are considered expired. If None, they never expire
+        model_hash: hash of the model whose predictions are cached
+    """
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 100 * 2 ** 20, ttl_seconds: float = None,
+                 model_hash: str = None):
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.model_hash = model_hash
+
+        # key -> (predictions, expiration time, estimated size)
+        self._entries: OrderedDict[str, tuple[list[str], float, int]] = OrderedDict()
+        self.n_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # the cache may be used by the event loop and by the thread generating predictions at the same time
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(prompt: dict[str, list], generation_config: dict, is_ranking_task: bool) -> str:
+        """
+        Key of a tokenized prompt: the same prompt token ids generate the same predictions only if the
+        generation config (and the n° of predictions returned, which depends on the task) is the same
+        """
+
+        # sorted keys, so that the key does not depend on the order of the fields
+        canonical_prompt = json.dumps([prompt, generation_config, is_ranking_task], sort_keys=True, default=str)
+
+        return hashlib.sha256(canonical_prompt.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _estimate_size(key: str, predictions: list[str]) -> int:
+        return (sys.getsizeof(key) + sys.getsizeof(predictions) +
+                sum(sys.getsizeof(prediction) for prediction in predictions))
+
+    def sync_model(self, model_hash: str):
+
+        # predictions of another checkpoint are stale
+        with self._lock:
+            if model_hash != self.model_hash:
+                self._entries.clear()
+                self.n_bytes = 0
+                self.model_hash = model_hash
+
+    def get(self, key: str) -> list[str] | None:
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[1] < time.monotonic():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+
+            return entry[0]
+
+    def put(self, key: str, predictions: list[str]):
+
+        size = self._estimate_size(key, predictions)
+
+        # an entry which can't fit even in an empty cache is not stored
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+
+        expiration = time.monotonic() + self.ttl_seconds if self.ttl_seconds is not None else float("inf")
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (predictions, expiration, size)
+            self.n_bytes += size
+
+            while len(self._entries) > self.max_entries or self.n_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: str):
+        _, _, size = self._entries.pop(key)
+        self.n_bytes -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+
+        n_lookups = self.hits + self.misses
+
+        return {
+            "entries": len(self),
+            "bytes": self.n_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / n_lookups if n_lookups != 0 else None,
+            "evictions": self.evictions
+        }
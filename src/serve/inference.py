@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import hashlib
+import inspect
+import json
+import random
+
+import numpy as np
+from datasets import Dataset
+
+from src.data.abstract_task import AnonTask
+from src.model import AnonModel
+
+# ground truth fields not known at inference time (e.g. `gt_item` of sequential tasks) are filled with a placeholder,
+# which only ends up in the target text discarded by the model. Ground truth fields which appear in the inference
+# prompt (`AnonTask.prompt_gt_fields`, e.g. the target item listed among the candidates of Direct tasks) are never
+# filled: they must be given by the caller
+GT_PLACEHOLDER = [""]
+
+# arguments of a task which are given by the model rather than by the sample
+_MODEL_PROVIDED_ARGS = {"self", "catalog_items", "items_meta_dict"}
+
+
+def required_fields(task: AnonTask) -> list[str]:
+    """
+    Fields that each sample must contain so that `task` can render its inference prompt
+    (e.g. `user_id` and `input_item_seq`). Ground truth fields are required only if they appear in the prompt
+    """
+
+    return [name for name, param in inspect.signature(task.__call__).parameters.items()
+            if param.default is inspect.Parameter.empty
+            and param.kind not in {inspect.Parameter.VAR_KEYWORD, inspect.Parameter.VAR_POSITIONAL}
+            and name not in _MODEL_PROVIDED_ARGS
+            and (not name.startswith("gt_") or name in task.prompt_gt_fields)]
+
+
+def missing_fields(task: AnonTask, sample: dict) -> list[str]:
+    return [field for field in required_fields(task) if field not in sample]
+
+
+def tokenize_samples(rec_model: AnonModel, task: AnonTask, samples: list[dict],
+                     deterministic: bool = False) -> dict[str, list]:
+    """
+    Renders the prompt of each sample with the inference templates of `task` (or the single template forced on it)
+    and tokenizes it exactly as done during evaluation. The model should already be in eval mode
+
+    Args:
+        deterministic: rendering is random (e.g. separators between items and the template chosen). If True, the
+            random state used to render each sample is derived from the sample itself, so that the same sample
+            is always rendered with the same prompt (e.g. so that its predictions can be cached)
+
+    Returns:
+        tokenized samples as a dict of lists, with one element for each sample
+    """
+
+    missing = {field for sample in samples for field in missing_fields(task, sample)}
+    if len(missing) != 0:
+        raise ValueError(f"Fields {sorted(missing)} are required by {task} to render its inference prompt!")
+
+    gt_fields = [name for name in inspect.signature(task.__call__).parameters if name.startswith("gt_")]
+
+    # from list of dicts to dict of lists, with placeholders for ground truth fields which are not given (and
+    # which thus don't appear in the prompt)
+    fields = list(dict.fromkeys([field for sample in samples for field in sample] + gt_fields))
+    batch = {field: [sample.get(field, GT_PLACEHOLDER) for sample in samples] for field in fields}
+
+    rec_model.eval_task = task
+
+    if not deterministic:
+        return rec_model.tokenize(batch)
+
+    # global random state is restored afterwards, so that it is not affected by the seeds set
+    python_state, numpy_state = random.getstate(), np.random.get_state()
+
+    tokenized_samples = []
+    for i, sample in enumerate(samples):
+        seed = _sample_seed(task, sample)
+        random.seed(seed)
+        np.random.seed(seed)
+
+        tokenized_samples.append(rec_model.tokenize({field: values[i:i + 1] for field, values in batch.items()}))
+
+    random.setstate(python_state)
+    np.random.set_state(numpy_state)
+
+    return {field: [value for tokenized_sample in tokenized_samples for value in tokenized_sample[field]]
+            for field in tokenized_samples[0]} if len(tokenized_samples) != 0 else {}
+
+
+def _sample_seed(task: AnonTask, sample: dict) -> int:
+    # ground truth fields which don't affect the prompt don't affect the seed either
+    canonical_sample = json.dumps({field: value for field, value in sample.items()
+                                   if not field.startswith("gt_") or field in task.prompt_gt_fields},
+                                  sort_keys=True, default=str)
+    return int.from_bytes(hashlib.sha256(canonical_sample.encode("utf-8")).digest()[:4], "little")
+
+
+def generate_from_tokenized(rec_model: AnonModel, task: AnonTask,
+                            tokenized_batch: dict[str, list]) -> np.ndarray[str]:
+    """
+    Generates predictions for samples tokenized with `tokenize_samples()`, so that injected embeddings and the n° of
+    predictions returned for the task are handled by the model itself
+
+    Returns:
+        matrix of shape (n° of samples, n° of predictions for each sample)
+    """
+
+    rec_model.eval_task = task
+
+    # same conversion to tensors that the evaluator performs on the tokenized eval set
+    tokenized_batch = Dataset.from_dict(tokenized_batch).with_format("torch")[:]
+
+    prepared_input = rec_model.prepare_input(tokenized_batch)
+    predictions, _, _ = rec_model.generate_step(prepared_input, return_loss=False)
+
+    return predictions
+
+
+def generate_recommendations(rec_model: AnonModel, task: AnonTask, samples: list[dict]) -> np.ndarray[str]:
+    return generate_from_tokenized(rec_model, task, tokenize_samples(rec_model, task, samples))
+
+
+def prompt_of(rec_model: AnonModel, tokenized_batch: dict[str, list], idx: int) -> dict[str, list]:
+    # fields of the idx-th tokenized sample which determine its predictions
+    prompt_fields = rec_model.prompt_fields
+    if prompt_fields is None:
+        prompt_fields = [field for field in tokenized_batch if field != "gt"]
+
+    return {field: tokenized_batch[field][idx] for field in prompt_fields if field in tokenized_batch}
@@ -0,0 +1,166 @@
+import asyncio
+import os
+import shutil
+
+from src import GeneralParams, MODELS_DIR, PROCESSED_DATA_DIR, RECOMMENDATIONS_DIR
+from src.data import DataParams
+from src.data.abstract_dataset import AnonDataset
+from src.data.abstract_task import AnonTask
+from src.evaluate import EvalParams
+from src.evaluate.predictions import model_fingerprint, sync_manifest
+from src.model import AnonModel, ModelParams
+from src.serve.batch_predict import (OUTPUT_FORMATS, get_parts_dir, get_part_path, predict_parts, run_workers,
+                                     merge_parts, build_predict_manifest)
+from src.serve.cache import ResultCache
+from src.serve.server import RecServer
+
+
+def serve_main(general_params: GeneralParams,
+               model_params: ModelParams,
+               host: str = "127.0.0.1",
+               port: int = 8000,
+               max_batch_size: int = 32,
+               max_wait_ms: float = 10.,
+               cache_size: int = 10000,
+               cache_max_mb: float = 100.,
+               cache_ttl_seconds: float = 600.,
+               max_body_mb: float = 1.):
+
+    # general params
+    exp_name = general_params.exp_name
+    device = general_params.device
+
+    # load model created in model phase
+    model_cls = AnonModel.model_exists(model_params.model_cls_name, return_bool=False)
+
+    model_path = os.path.join(MODELS_DIR, exp_name)
+    rec_model = model_cls.load(model_path, **model_params.model_kwargs)
+
+    # set model to correct device
+    rec_model.to(device)
+
+    # predictions of repeated prompts are cached, unless the cache is disabled
+    cache = None
+    if cache_size > 0:
+        cache = ResultCache(max_entries=cache_size, max_bytes=int(cache_max_mb * 2 ** 20),
+                            ttl_seconds=cache_ttl_seconds)
+
+    server = RecServer(rec_model, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, cache=cache,
+                       max_body_bytes=int(max_body_mb * 2 ** 20))
+
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        print("# Server stopped")
+
+
+def predict_main(general_params: GeneralParams,
+                 data_params: DataParams,
+                 model_params: ModelParams,
+                 eval_params: EvalParams,
+                 task_str: str = None,
+                 template_id: int | str = None,
+                 input_path: str = None,
+                 split: str = "test",
+                 output_path: str = None,
+                 top_k: int = None,
+                 n_workers: int = 1,
+                 chunk_batches: int = 100):
+    """
+    Generates recommendations for all the users of a split of the processed dataset (or of a JSONL file) and
+    saves them into a Parquet or JSONL file. Users are processed in chunks of `chunk_batches` batches which are
+    saved as soon as they are generated, thus launching the same command after an interruption resumes from
+    the chunks already saved
+    """
+
+    # general params
+    exp_name = general_params.exp_name
+    device = general_params.device
+
+    batch_size = eval_params.eval_batch_size
+    chunk_size = batch_size * chunk_batches
+
+    # if not specified, the first task evaluated is used
+    task_str = task_str if task_str is not None else next(iter(eval_params.eval_tasks))
+    task = AnonTask.task_exists(task_str, template_id=template_id, return_bool=False)()
+    if template_id is not None:
+        task.force_template(template_id)
+
+    if input_path is not None:
+        input_source = input_path
+        input_id = f"{os.path.abspath(input_path)}:{os.path.getsize(input_path)}:{os.path.getmtime(input_path)}"
+    else:
+        dataset_cls = AnonDataset.dataset_exists(data_params.dataset_cls_name, return_bool=False)
+        dataset_obj = dataset_cls.load(os.path.join(PROCESSED_DATA_DIR, exp_name))
+
+        input_source = dataset_obj.get_hf_datasets()[split]
+        input_id = f"{exp_name}:{split}:{input_source._fingerprint}"
+
+    # e.g. reports/recommendations/exp/SequentialSideInfoTask.parquet
+    if output_path is None:
+        template_suffix = f"_template_{template_id}" if template_id is not None else ""
+        output_path = os.path.join(RECOMMENDATIONS_DIR, exp_name, f"{task}{template_suffix}.parquet")
+
+    output_format = os.path.splitext(output_path)[1]
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Recommendations can only be saved in {OUTPUT_FORMATS} format, "
+                         f"but {output_path} was specified!")
+
+    # load model created in model phase
+    model_cls = AnonModel.model_exists(model_params.model_cls_name, return_bool=False)
+
+    model_path = os.path.join(MODELS_DIR, exp_name)
+    rec_model = model_cls.load(model_path, **model_params.model_kwargs)
+
+    # parts saved by a previous run are reused only if they were generated in the same way
+    parts_dir = get_parts_dir(output_path)
+    manifest = build_predict_manifest(model_fingerprint(rec_model), rec_model.get_generation_config(), task,
+                                      template_id, input_id, chunk_size, top_k)
+    if sync_manifest(parts_dir, manifest):
+        print(f"# Resuming from the recommendations already saved into {parts_dir}")
+
+    predict_kwargs = dict(input_source=input_source, parts_dir=parts_dir, output_format=output_format,
+                          batch_size=batch_size, chunk_size=chunk_size, top_k=top_k)
+
+    if n_workers > 1:
+        # each worker loads its own copy of the model
+        del rec_model
+        run_workers(n_workers, model_params.model_cls_name, model_path, model_params.model_kwargs, device,
+                    general_params.random_seed, task, predict_kwargs)
+    else:
+        rec_model.to(device)
+        predict_parts(rec_model, task, **predict_kwargs)
+
+    part_paths = sorted(os.path.join(parts_dir, file_name) for file_name in os.listdir(parts_dir)
+                        if file_name.endswith(output_format))
+    merge_parts(output_path, part_paths)
+
+    shutil.rmtree(parts_dir)
+
+    print(f"# Recommendations saved into {output_path}")
+
+
+def export_main(general_params: GeneralParams,
+                model_params: ModelParams,
+                output_dir: str = None,
+                opset_version: int = 14):
+    """
+    Exports the model trained into ONNX graphs which include embeddings injected by the model, so that
+    predictions can be generated with `src.serve.onnx_runtime.OnnxRecModel` without torch
+    """
+
+    exp_name = general_params.exp_name
+
+    # load model created in model phase
+    model_cls = AnonModel.model_exists(model_params.model_cls_name, return_bool=False)
+
+    model_path = os.path.join(MODELS_DIR, exp_name)
+    rec_model = model_cls.load(model_path, **model_params.model_kwargs)
+
+    # the graph is exported from cpu, it is run on cpu by the runtime
+    rec_model.to("cpu")
+
+    output_dir = output_dir if output_dir is not None else os.path.join(model_path, "onnx")
+    rec_model.export_onnx(output_dir, opset_version=opset_version)
+
+    print(f"# Model exported into {output_dir}")
@@ -0,0 +1,394 @@
+from __future__ import annotations
+
+import json
+import os
+
+import numpy as np
+import onnxruntime
+from tokenizers import Tokenizer
+
+
+class OnnxRecModel:
+    """
+    Generates predictions with a model exported by `export_onnx()` using onnxruntime on CPU, so that neither torch
+    nor transformers are needed. As the `inference()` method of the original model, it takes input texts already
+    rendered and returns the texts generated with greedy (num_beams=1) or beam search decoding
+
+    Args:
+        dir_path: directory in which the model was exported
+        onnx_config: dict saved into `onnx_config.json` by `export_onnx()`
+        n_threads: n° of threads used by onnxruntime for each graph. If None, onnxruntime default is used
+    """
+    str_alias_cls: dict[str, type[OnnxRecModel]] = {}
+
+    # the `model_type` saved into `onnx_config.json` by the exported model
+    model_type: str = None
+
+    # automatically called on subclass definition, will populate the str_alias_cls dict
+    def __init_subclass__(cls, **kwargs):
+        if cls.model_type is not None:
+            cls.str_alias_cls[cls.model_type] = cls
+
+        super().__init_subclass__(**kwargs)
+
+    def __init__(self, dir_path: str, onnx_config: dict, n_threads: int = None):
+
+        self.onnx_config = onnx_config
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(dir_path, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=onnx_config["model_max_length"])
+
+        # the padding last used by the hf tokenizer may have been saved, but prompts are padded by the model
+        self.tokenizer.no_padding()
+
+        self.session_options = onnxruntime.SessionOptions()
+        if n_threads is not None:
+            self.session_options.intra_op_num_threads = n_threads
+
+    def _session(self, onnx_path: str) -> onnxruntime.InferenceSession:
+        return onnxruntime.InferenceSession(onnx_path, sess_options=self.session_options,
+                                            providers=["CPUExecutionProvider"])
+
+    @classmethod
+    def load(cls, dir_path: str, n_threads: int = None) -> OnnxRecModel:
+
+        with open(os.path.join(dir_path, "onnx_config.json")) as f:
+            onnx_config = json.load(f)
+
+        try:
+            model_cls = cls.str_alias_cls[onnx_config["model_type"]]
+        except KeyError:
+            raise KeyError(f"Exported model type {onnx_config['model_type']} is not supported!") from None
+
+        return model_cls(dir_path, onnx_config, n_threads=n_threads)
+
+    def _encode_prompts(self, input_text: list[str], **kwargs) -> int:
+        """
+        Runs whatever is needed once for each prompt before decoding, and stores it so that it can be used by
+        `_next_token_log_probs()`
+
+        Returns:
+            length offset used by the length penalty of beam search (n° of tokens preceding generated tokens)
+        """
+        raise NotImplementedError
+
+    def _next_token_log_probs(self, sample_idxs: np.ndarray, generated_ids: np.ndarray) -> np.ndarray:
+        """
+        Log probabilities of the next token of each sequence being decoded
+
+        Args:
+            sample_idxs: index of the prompt of each sequence
+            generated_ids: matrix of shape (n° of sequences, n° of tokens generated so far)
+
+        Returns:
+            matrix of shape (n° of sequences, vocabulary size)
+        """
+        raise NotImplementedError
+
+    def _max_new_tokens(self, prompt_length: int) -> int:
+        raise NotImplementedError
+
+    def inference(self, input_text: str | list[str], num_beams: int = None, num_return_sequences: int = None,
+                  max_new_tokens: int = None, length_penalty: float = None, **encode_kwargs) -> list[list[str]]:
+
+        if not isinstance(input_text, list):
+            input_text = [input_text]
+
+        generated_ids = self._generate(input_text, num_beams, num_return_sequences, max_new_tokens, length_penalty,
+                                       **encode_kwargs)
+
+        return self._decode(generated_ids)
+
+    def _generate(self, input_text: list[str], num_beams: int = None, num_return_sequences: int = None,
+                  max_new_tokens: int = None, length_penalty: float = None,
+                  **encode_kwargs) -> list[list[list[int]]]:
+
+        # generation parameters not passed are the ones of the generation config of the exported model
+        num_beams = num_beams if num_beams is not None else self.onnx_config["num_beams"]
+        num_return_sequences = (num_return_sequences if num_return_sequences is not None
+                                else self.onnx_config["num_return_sequences"])
+        length_penalty = length_penalty if length_penalty is not None else self.onnx_config["length_penalty"]
+
+        if num_return_sequences > num_beams:
+            raise ValueError(f"num_return_sequences ({num_return_sequences}) can't be greater than "
+                             f"num_beams ({num_beams})!")
+
+        length_offset = self._encode_prompts(input_text, **encode_kwargs)
+        max_new_tokens = max_new_tokens if max_new_tokens is not None else self._max_new_tokens(length_offset)
+
+        return self._beam_search(len(input_text), num_beams, num_return_sequences, max_new_tokens,
+                                 length_penalty, length_offset)
+
+    def _decode(self, generated_ids: list[list[list[int]]]) -> list[list[str]]:
+
+        decoded_texts = [self.tokenizer.decode_batch(sample_generated_ids, skip_special_tokens=True)
+                         for sample_generated_ids in generated_ids]
+
+        # models exported before the option was saved are assumed to use the hf default
+        if self.onnx_config.get("clean_up_tokenization_spaces", True) is True:
+            decoded_texts = [[clean_up_tokenization(text) for text in sample_texts] for sample_texts in decoded_texts]
+
+        return decoded_texts
+
+    def _beam_search(self, n_samples: int, num_beams: int, num_return_sequences: int, max_new_tokens: int,
+                     length_penalty: float, length_offset: int) -> list[list[list[int]]]:
+        """
+        Beam search as performed by hf generate() with `early_stopping=True`: decoding of a sample stops as soon as
+        `num_beams` sequences ended with the eos token. With `num_beams=1` it is equivalent to greedy decoding
+
+        Returns:
+            for each sample, token ids of the `num_return_sequences` sequences with the highest score
+        """
+
+        eos_token_id = self.onnx_config["eos_token_id"]
+
+        # beams of the i-th sample are rows from i * num_beams to (i + 1) * num_beams
+        generated_ids = np.zeros((n_samples * num_beams, 0), dtype=np.int64)
+
+        # at first step all beams are identical, so only the first one is expanded
+        beam_scores = np.full((n_samples, num_beams), -np.inf, dtype=np.float32)
+        beam_scores[:, 0] = 0
+
+        # (score, token ids) of the sequences which ended with the eos token for each sample
+        finished = [[] for _ in range(n_samples)]
+        done = np.zeros(n_samples, dtype=bool)
+
+        for step in range(max_new_tokens):
+
+            active_samples = np.flatnonzero(~done)
+            if len(active_samples) == 0:
+                break
+
+            rows = (active_samples[:, np.newaxis] * num_beams + np.arange(num_beams)).ravel()
+            log_probs = self._next_token_log_probs(rows // num_beams, generated_ids[rows])
+            vocab_size = log_probs.shape[-1]
+
+            scores = (beam_scores[active_samples].reshape(-1, 1) + log_probs).reshape(len(active_samples), -1)
+
+            # 2 * num_beams best continuations, so that at least num_beams of them do not end with the eos token
+            n_top = min(2 * num_beams, scores.shape[1])
+            top_idxs = np.argpartition(-scores, n_top - 1, axis=1)[:, :n_top]
+            top_idxs = np.take_along_axis(top_idxs, np.argsort(-np.take_along_axis(scores, top_idxs, axis=1),
+                                                               axis=1, kind="stable"), axis=1)
+
+            # sequences of samples already done are simply extended with eos, they won't be used anymore
+            next_generated_ids = np.concatenate((generated_ids,
+                                                 np.full((len(generated_ids), 1), eos_token_id)), axis=1)
+
+            for j, sample_idx in enumerate(active_samples):
+
+                next_beams = []
+                for rank, idx in enumerate(top_idxs[j]):
+                    beam, token_id = divmod(int(idx), vocab_size)
+                    beam_row = sample_idx * num_beams + beam
+
+                    if token_id == eos_token_id:
+                        # as in hf, a sequence ending with eos is kept only if it is among the best num_beams
+                        if rank < num_beams:
+                            finished[sample_idx].append((scores[j, idx] / (length_offset + step) ** length_penalty,
+                                                         generated_ids[beam_row].tolist()))
+                    else:
+                        next_beams.append((beam_row, token_id, scores[j, idx]))
+
+                    if len(next_beams) == num_beams:
+                        break
+
+                sample_rows = slice(sample_idx * num_beams, (sample_idx + 1) * num_beams)
+                beam_rows, token_ids, next_scores = zip(*next_beams)
+
+                next_generated_ids[sample_rows, :-1] = generated_ids[list(beam_rows)]
+                next_generated_ids[sample_rows, -1] = token_ids
+                beam_scores[sample_idx] = next_scores
+
+                done[sample_idx] = len(finished[sample_idx]) >= num_beams
+
+            generated_ids = next_generated_ids
+
+        # sequences which did not end before max_new_tokens compete with the finished ones
+        for sample_idx in np.flatnonzero(~done):
+            for beam in range(num_beams):
+                finished[sample_idx].append((beam_scores[sample_idx, beam] /
+                                             (length_offset + generated_ids.shape[1]) ** length_penalty,
+                                             generated_ids[sample_idx * num_beams + beam].tolist()))
+
+        return [[sequence for _, sequence in sorted(sample_finished, key=lambda x: -x[0])[:num_return_sequences]]
+                for sample_finished in finished]
+
+
+class T5OnnxRecModel(OnnxRecModel):
+    model_type = "t5"
+
+    def __init__(self, dir_path: str, onnx_config: dict, n_threads: int = None):
+
+        super().__init__(dir_path, onnx_config, n_threads=n_threads)
+
+        self.encoder_session = self._session(os.path.join(dir_path, "encoder.onnx"))
+        self.decoder_session = self._session(os.path.join(dir_path, "decoder.onnx"))
+
+        self.encoder_hidden_states = None
+        self.encoder_attention_mask = None
+
+    def _max_new_tokens(self, prompt_length: int) -> int:
+
+        if self.onnx_config["max_new_tokens"] is not None:
+            return self.onnx_config["max_new_tokens"]
+
+        # max length of hf includes the decoder start token
+        return self.onnx_config["max_length"] - 1
+
+    def _encode_prompts(self, input_text: list[str], user_id: str | list[str] = None) -> int:
+
+        encodings = self.tokenizer.encode_batch(input_text)
+        max_length = max(len(encoding.ids) for encoding in encodings)
+
+        input_ids = np.full((len(encodings), max_length), self.onnx_config["pad_token_id"], dtype=np.int64)
+        attention_mask = np.zeros((len(encodings), max_length), dtype=np.int64)
+        whole_word_ids = np.zeros((len(encodings), max_length), dtype=np.int64)
+
+        for i, encoding in enumerate(encodings):
+            input_ids[i, :len(encoding.ids)] = encoding.ids
+            attention_mask[i, :len(encoding.ids)] = 1
+
+            # as in T5Rec, word ids start from 1 and special tokens have word id 0
+            whole_word_ids[i, :len(encoding.ids)] = [word_id + 1 if word_id is not None else 0
+                                                     for word_id in encoding.word_ids]
+
+        encoder_inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+
+        if self.onnx_config["inject_whole_word_embeds"] is True:
+            encoder_inputs["whole_word_ids"] = whole_word_ids
+
+        if self.onnx_config["inject_user_embeds"] is True:
+
+            if not isinstance(user_id, list) and user_id is not None:
+                user_id = [user_id]
+
+            if user_id is None or len(user_id) != len(input_text):
+                raise ValueError("Model was fine-tuned with `inject_user_embeds`, please for each input text "
+                                 "specify to which user it refers to with the `user_id` parameter")
+
+            try:
+                encoder_inputs["user_idx"] = np.array([self.onnx_config["user_mapping"][user] for user in user_id],
+                                                      dtype=np.int64)
+            except KeyError as e:
+                missing_key = e.args[0]
+                raise KeyError(f"User {missing_key} was not known at train time!") from None
+
+        [self.encoder_hidden_states] = self.encoder_session.run(None, encoder_inputs)
+        self.encoder_attention_mask = attention_mask
+
+        # the decoder start token precedes generated tokens
+        return 1
+
+    def _next_token_log_probs(self, sample_idxs: np.ndarray, generated_ids: np.ndarray) -> np.ndarray:
+
+        decoder_start_ids = np.full((len(generated_ids), 1), self.onnx_config["decoder_start_token_id"])
+        decoder_input_ids = np.concatenate((decoder_start_ids, generated_ids), axis=1).astype(np.int64)
+
+        [log_probs] = self.decoder_session.run(None, {
+            "decoder_input_ids": decoder_input_ids,
+            "encoder_hidden_states": self.encoder_hidden_states[sample_idxs],
+            "encoder_attention_mask": self.encoder_attention_mask[sample_idxs]
+        })
+
+        return log_probs
+
+
+class GPT2OnnxRecModel(OnnxRecModel):
+    model_type = "gpt2"
+
+    def __init__(self, dir_path: str, onnx_config: dict, n_threads: int = None):
+
+        super().__init__(dir_path, onnx_config, n_threads=n_threads)
+
+        self.decoder_session = self._session(os.path.join(dir_path, "decoder.onnx"))
+
+        self.prompt_ids = None
+        self.prompt_attention_mask = None
+        self.prompt_whole_word_ids = None
+
+    def inference(self, input_text: str | list[str], num_beams: int = None, num_return_sequences: int = None,
+                  max_new_tokens: int = None, length_penalty: float = None, format_input: bool = True,
+                  return_only_target: bool = False) -> list[list[str]]:
+
+        if not isinstance(input_text, list):
+            input_text = [input_text]
+
+        generated_ids = self._generate(input_text, num_beams, num_return_sequences, max_new_tokens, length_penalty,
+                                       format_input=format_input)
+
+        # as `GPT2Rec.inference()`, generated texts are preceded by their prompt unless only the target is requested
+        # (padding of the prompt is made of special tokens, which are not decoded)
+        if return_only_target is False:
+            generated_ids = [[self.prompt_ids[i].tolist() + sequence_ids for sequence_ids in sample_generated_ids]
+                             for i, sample_generated_ids in enumerate(generated_ids)]
+
+        return self._decode(generated_ids)
+
+    def _max_new_tokens(self, prompt_length: int) -> int:
+
+        if self.onnx_config["max_new_tokens"] is not None:
+            return self.onnx_config["max_new_tokens"]
+
+        # max length of hf includes the prompt
+        return max(self.onnx_config["max_length"] - prompt_length, 0)
+
+    def _encode_prompts(self, input_text: list[str], format_input: bool = True) -> int:
+
+        if format_input is True:
+            input_text = [f"{self.onnx_config['input_prefix']}{inp} \n{self.onnx_config['target_prefix']}"
+                          for inp in input_text]
+
+        encodings = self.tokenizer.encode_batch(input_text)
+        max_length = max(len(encoding.ids) for encoding in encodings)
+
+        # prompts are padded to the left, as done by GPT2Rec before generating
+        self.prompt_ids = np.full((len(encodings), max_length), self.onnx_config["pad_token_id"], dtype=np.int64)
+        self.prompt_attention_mask = np.zeros((len(encodings), max_length), dtype=np.int64)
+        self.prompt_whole_word_ids = np.zeros((len(encodings), max_length), dtype=np.int64)
+
+        for i, encoding in enumerate(encodings):
+            start = max_length - len(encoding.ids)
+
+            self.prompt_ids[i, start:] = encoding.ids
+            self.prompt_attention_mask[i, start:] = 1
+            self.prompt_whole_word_ids[i, start:] = [word_id + 1 if word_id is not None else 0
+                                                     for word_id in encoding.word_ids]
+
+        # the whole padded prompt precedes generated tokens
+        return max_length
+
+    def _next_token_log_probs(self, sample_idxs: np.ndarray, generated_ids: np.ndarray) -> np.ndarray:
+
+        input_ids = np.concatenate((self.prompt_ids[sample_idxs], generated_ids), axis=1).astype(np.int64)
+        attention_mask = np.concatenate((self.prompt_attention_mask[sample_idxs],
+                                         np.ones_like(generated_ids)), axis=1).astype(np.int64)
+
+        # same position ids that generate() computes for left padded prompts
+        position_ids = np.clip(attention_mask.cumsum(axis=1) - 1, 0, None)
+
+        decoder_inputs = {"input_ids": input_ids, "attention_mask": attention_mask, "position_ids": position_ids}
+
+        if self.onnx_config["inject_whole_word_embeds"] is True:
+            # generated tokens have no whole word embedding
+            decoder_inputs["whole_word_ids"] = np.concatenate((self.prompt_whole_word_ids[sample_idxs],
+                                                               np.full_like(generated_ids, -1)),
+                                                              axis=1).astype(np.int64)
+
+        [log_probs] = self.decoder_session.run(None, decoder_inputs)
+
+        return log_probs
+
+
+def clean_up_tokenization(text: str) -> str:
+    # same clean up of spaces before punctuation and abbreviated forms performed by hf tokenizers when decoding
+    return (text.replace(" .", ".")
+            .replace(" ?", "?")
+            .replace(" !", "!")
+            .replace(" ,", ",")
+            .replace(" ' ", "'")
+            .replace(" n't", "n't")
+            .replace(" 'm", "'m")
+            .replace(" 's", "'s")
+            .replace(" 've", "'ve")
+            .replace(" 're", "'re"))
@@ -0,0 +1,450 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Callable, Hashable, Sequence
+
+import numpy as np
+from loguru import logger
+
+from src.data.abstract_task import AnonTask
+from src.model import AnonModel
+from src.evaluate.predictions import model_fingerprint
+from src.serve.cache import ResultCache
+from src.serve.inference import missing_fields, tokenize_samples, generate_from_tokenized, prompt_of
+
+# upper bounds (in seconds) of the buckets of the latency histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets, like the ones exposed by Prometheus: each bucket counts the observations
+    less than or equal to its upper bound (and greater than the previous one), the last bucket counts all the others
+    """
+
+    def __init__(self, bounds: Sequence[float]):
+
+        self.bounds = np.asarray(bounds, dtype=float)
+        self.bucket_counts = np.zeros(len(self.bounds) + 1, dtype=np.int64)
+
+        self.count = 0
+        self.total = 0.
+
+    def observe(self, value: float):
+
+        self.bucket_counts[np.searchsorted(self.bounds, value, side="left")] += 1
+
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q: float) -> float | None:
+        """
+        Estimates the `q` quantile of the observations (assumed non-negative) from the buckets, as Prometheus does:
+        observations are assumed to be uniformly distributed inside their bucket, and quantiles falling in the
+        last bucket are estimated with the largest upper bound
+
+        Returns:
+            the quantile estimated, or None if nothing has been observed
+        """
+
+        if not 0 < q <= 1:
+            raise ValueError(f"q should be in (0, 1], but {q} was passed!")
+
+        if self.count == 0:
+            return None
+
+        cumulative_counts = np.cumsum(self.bucket_counts)
+        rank = q * self.count
+
+        bucket_idx = int(np.searchsorted(cumulative_counts, rank, side="left"))
+        if bucket_idx == len(self.bounds):
+            return float(self.bounds[-1])
+
+        lower_bound = self.bounds[bucket_idx - 1] if bucket_idx != 0 else 0.
+        previous_count = cumulative_counts[bucket_idx - 1] if bucket_idx != 0 else 0
+
+        return float(lower_bound + (self.bounds[bucket_idx] - lower_bound) *
+                     (rank - previous_count) / self.bucket_counts[bucket_idx])
+
+    def to_dict(self) -> dict:
+
+        # cumulative counts, as Prometheus does
+        cumulative_counts = np.cumsum(self.bucket_counts).tolist()
+        bucket_names = [f"{bound:g}" for bound in self.bounds] + ["+Inf"]
+
+        return {
+            "buckets": dict(zip(bucket_names, cumulative_counts)),
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.total / self.count if self.count != 0 else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99)
+        }
+
+
+class MicroBatcher:
+    """
+    Coalesces items submitted concurrently into micro-batches. Only items having the same key can be processed
+    together (e.g. requests for the same task and template). A batch is processed as soon as it has
+    `max_batch_size` items or its oldest item waited `max_wait_ms` milliseconds. Batches are processed one at a
+    time by a worker thread, so while the model is busy new items keep accumulating and batches grow with the load
+
+    Args:
+        process_fn: function which, given a key and a list of items, returns the result of each item
+        max_batch_size: max n° of items processed together
+        max_wait_ms: max time that an item can wait for other items to be batched with
+    """
+
+    def __init__(self, process_fn: Callable[[Hashable, list], Sequence], max_batch_size: int = 32,
+                 max_wait_ms: float = 10.):
+
+        self.process_fn = process_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        # buckets are powers of 2, plus the max batch size
+        self.batch_size_histogram = Histogram(
+            sorted({2 ** i for i in range(int(np.log2(max_batch_size)) + 1)} | {max_batch_size})
+        )
+
+        # for each key, items waiting to be processed along with the future of their result and their arrival time
+        self._pending: dict[Hashable, list[tuple[object, asyncio.Future, float]]] = {}
+        self._new_item = asyncio.Event()
+
+        # the model is used by a single thread, so that the event loop is never blocked by generation
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._worker_task = None
+
+    def start(self):
+        self._worker_task = asyncio.get_running_loop().create_task(self._worker())
+
+    async def stop(self):
+
+        if self._worker_task is not None:
+            self._worker_task.cancel()
+
+        self._executor.shutdown(wait=False)
+
+    async def submit(self, key: Hashable, item: object):
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(key, []).append((item, future, time.monotonic()))
+        self._new_item.set()
+
+        return await future
+
+    @property
+    def n_pending(self) -> int:
+        return sum(len(items) for items in self._pending.values())
+
+    async def _next_batch(self) -> tuple[Hashable, list[tuple[object, asyncio.Future, float]]]:
+
+        while True:
+            self._new_item.clear()
+
+            # items whose caller is gone (e.g. the client disconnected) are not processed
+            self._pending = {key: [pending for pending in items if not pending[1].done()]
+                             for key, items in self._pending.items()}
+            self._pending = {key: items for key, items in self._pending.items() if len(items) != 0}
+
+            now = time.monotonic()
+            ready_keys = [key for key, items in self._pending.items()
+                          if len(items) >= self.max_batch_size or now >= items[0][2] + self.max_wait]
+
+            if len(ready_keys) != 0:
+                # the batch whose oldest item has been waiting the most is processed first
+                key = min(ready_keys, key=lambda ready_key: self._pending[ready_key][0][2])
+
+                batch = self._pending[key][:self.max_batch_size]
+                self._pending[key] = self._pending[key][self.max_batch_size:]
+
+                return key, batch
+
+            # wait for new items, or for the deadline of the oldest one
+            timeout = None
+            if len(self._pending) != 0:
+                timeout = min(items[0][2] for items in self._pending.values()) + self.max_wait - now
+
+            try:
+                await asyncio.wait_for(self._new_item.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+
+        loop = asyncio.get_running_loop()
+
+        while True:
+            key, batch = await self._next_batch()
+            self.batch_size_histogram.observe(len(batch))
+
+            try:
+                results = await loop.run_in_executor(self._executor, self.process_fn,
+                                                     key, [item for item, _, _ in batch])
+            except Exception as e:
+                logger.exception(f"Error while processing a batch of {len(batch)} items")
+
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+class RecServer:
+    """
+    Minimal asyncio HTTP server which generates recommendations online with `rec_model`. Requests are rendered
+    with the templates of the requested task, and concurrent requests for the same task and template are
+    generated together in micro-batches.
+
+    Endpoints:
+        POST /recommend: JSON object with the `task` to use, optionally the `template_id` (otherwise a random
+            inference template is used), and the fields required by the task (e.g. `user_id` and `input_item_seq`).
+            Returns the predictions generated for the user
+        GET /metrics: latency and batch size histograms, and statistics of the result cache
+        GET /health: always returns status "ok" once the server is up
+
+    Args:
+        rec_model: model which generates recommendations, it is set in eval mode
+        max_batch_size: max n° of requests generated together
+        max_wait_ms: max time that a request can wait for other requests to be batched with
+        cache: if set, predictions of each prompt are cached, so that requests whose prompt was already seen are
+            answered without generating
+        max_body_bytes: max size of the body of a request, bigger requests are rejected without reading them
+    """
+
+    def __init__(self, rec_model: AnonModel, max_batch_size: int = 32, max_wait_ms: float = 10.,
+                 cache: ResultCache = None, max_body_bytes: int = 2 ** 20):
+
+        self.rec_model = rec_model
+        self.rec_model.eval()
+
+        self.max_body_bytes = max_body_bytes
+
+        self.cache = cache
+        self.generation_config = rec_model.get_generation_config()
+        if self.cache is not None:
+            self.cache.sync_model(model_fingerprint(rec_model))
+
+        self.batcher = MicroBatcher(self._process_batch, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        self.latency_histogram = Histogram(LATENCY_BUCKETS)
+
+        # tasks are instantiated once for each (task, template) pair requested
+        self._tasks: dict[tuple[str, int | str | None], AnonTask] = {}
+
+    def _get_task(self, task_name: str, template_id: int | str = None) -> AnonTask:
+
+        key = (task_name.lower(), template_id)
+        if key not in self._tasks:
+            task_cls = AnonTask.task_exists(task_name, template_id=template_id, return_bool=False)
+
+            task = task_cls()
+            if template_id is not None:
+                task.force_template(template_id)
+
+            self._tasks[key] = task
+
+        return self._tasks[key]
+
+    def _process_batch(self, key: tuple[str, int | str | None], samples: list[dict]) -> list[list[str]]:
+
+        task = self._tasks[key]
+        # with the cache, the same request is always rendered with the same prompt, so that it can be a hit
+        tokenized_batch = tokenize_samples(self.rec_model, task, samples, deterministic=self.cache is not None)
+
+        if self.cache is None:
+            return generate_from_tokenized(self.rec_model, task, tokenized_batch).tolist()
+
+        cache_keys = [ResultCache.make_key(prompt_of(self.rec_model, tokenized_batch, i), self.generation_config,
+                                           task.is_ranking_task())
+                      for i in range(len(samples))]
+        results = [self.cache.get(cache_key) for cache_key in cache_keys]
+
+        # prompts not cached are generated only once, even if they are repeated in the batch
+        to_generate = {cache_key: i for i, (cache_key, result) in enumerate(zip(cache_keys, results))
+                       if result is None}
+
+        if len(to_generate) != 0:
+            tokenized_to_generate = {field: [values[i] for i in to_generate.values()]
+                                     for field, values in tokenized_batch.items()}
+            predictions = generate_from_tokenized(self.rec_model, task, tokenized_to_generate).tolist()
+
+            generated = dict(zip(to_generate.keys(), predictions))
+            for cache_key, prediction in generated.items():
+                self.cache.put(cache_key, prediction)
+
+            results = [result if result is not None else generated[cache_key]
+                       for cache_key, result in zip(cache_keys, results)]
+
+        return results
+
+    def parse_request(self, request: dict) -> tuple[str, int | str | None, dict]:
+        """
+        Validates a recommendation request
+
+        Returns:
+            the task name, the template id and the sample (i.e. all the other fields of the request)
+
+        Raises:
+            ValueError: if the request is not valid (e.g. the task does not exist or a field is missing)
+        """
+
+        if not isinstance(request, dict):
+            raise ValueError("The request should be a JSON object!")
+
+        sample = dict(request)
+        task_name = sample.pop("task", None)
+        template_id = sample.pop("template_id", None)
+
+        if task_name is None:
+            raise ValueError("The task to use for generating recommendations must be specified with 'task'!")
+
+        try:
+            task = self._get_task(task_name, template_id)
+        except KeyError as e:
+            raise ValueError(e.args[0]) from None
+
+        missing = missing_fields(task, sample)
+        if len(missing) != 0:
+            raise ValueError(f"Fields {missing} are required by {task} but they are missing from the request!")
+
+        return task_name, template_id, sample
+
+    async def recommend(self, task_name: str, template_id: int | str | None, sample: dict) -> dict:
+        """
+        Generates recommendations for a single request already validated by `parse_request()`, waiting for other
+        requests to be batched with it
+        """
+
+        start = time.monotonic()
+
+        predictions = await self.batcher.submit((task_name.lower(), template_id), sample)
+
+        self.latency_histogram.observe(time.monotonic() - start)
+
+        return {
+            "user_id": sample.get("user_id"),
+            "task": str(self._get_task(task_name, template_id)),
+            "template_id": template_id,
+            "recommendations": predictions
+        }
+
+    def stats(self) -> dict:
+        return {
+            "latency_seconds": self.latency_histogram.to_dict(),
+            "batch_size": self.batcher.batch_size_histogram.to_dict(),
+            "pending_requests": self.batcher.n_pending,
+            "cache": self.cache.stats() if self.cache is not None else None
+        }
+
+    async def _route(self, method: str, path: str, body: bytes) -> tuple[HTTPStatus, dict]:
+
+        match method, path:
+
+            case "GET", "/health":
+                return HTTPStatus.OK, {"status": "ok"}
+
+            case "GET", "/metrics":
+                return HTTPStatus.OK, self.stats()
+
+            case "POST", "/recommend":
+                try:
+                    # JSONDecodeError is a subclass of ValueError
+                    task_name, template_id, sample = self.parse_request(json.loads(body))
+                except ValueError as e:
+                    return HTTPStatus.BAD_REQUEST, {"error": str(e)}
+
+                try:
+                    return HTTPStatus.OK, await self.recommend(task_name, template_id, sample)
+                except Exception as e:
+                    return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"{type(e).__name__}: {e}"}
+
+            case _:
+                return HTTPStatus.NOT_FOUND, {"error": f"{method} {path} not found"}
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+
+        try:
+            # connections are kept alive, so that a client can send several requests
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                try:
+                    method, path, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    self._write_response(writer, HTTPStatus.BAD_REQUEST, {"error": "Malformed request line"},
+                                         keep_alive=False)
+                    break
+
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                # the body is not read if its length is invalid or too big, so the connection can't be reused
+                try:
+                    content_length = int(headers.get("content-length", 0))
+                    if content_length < 0:
+                        raise ValueError
+                except ValueError:
+                    self._write_response(writer, HTTPStatus.BAD_REQUEST, {"error": "Invalid Content-Length header"},
+                                         keep_alive=False)
+                    await writer.drain()
+                    break
+
+                if content_length > self.max_body_bytes:
+                    self._write_response(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                         {"error": f"Request body is bigger than {self.max_body_bytes} bytes"},
+                                         keep_alive=False)
+                    await writer.drain()
+                    break
+
+                body = await reader.readexactly(content_length)
+
+                status, payload = await self._route(method, path.split("?")[0], body)
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                self._write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _write_response(writer: asyncio.StreamWriter, status: HTTPStatus, payload: dict, keep_alive: bool):
+
+        body = json.dumps(payload).encode("utf-8")
+        headers = (f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                   f"Content-Type: application/json\r\n"
+                   f"Content-Length: {len(body)}\r\n"
+                   f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+
+        writer.write(headers.encode("latin-1") + body)
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000):
+
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        self.batcher.start()
+
+        print(f"# Serving recommendations on http://{host}:{port} (POST /recommend, GET /metrics)")
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.stop()
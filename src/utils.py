@@ -1,16 +1,20 @@
+import datetime
 import os
+import queue
 import random
+import threading
 from contextlib import contextmanager
-from typing import List, Dict
+from typing import List, Dict, Callable
 
 import numpy as np
 import torch
 import torch.backends.cudnn
-import wandb
+import torch.distributed
 import yaml
 from cytoolz import merge_with
-from yaspin import yaspin
-from yaspin.spinners import Spinners
+
+# wandb and yaspin are imported only when used, since importing them takes a long time and they are not needed
+# e.g. when only validating a config
 
 
 def seed_everything(seed: int):
@@ -35,17 +39,285 @@ def seed_everything(seed: int):
     return seed
 
 
+def get_rng_state() -> dict:
+    """
+    Function which returns the current state of the random generators of each library used by this repository,
+    so that it can be restored later with `set_rng_state()`
+    """
+
+    rng_state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state()
+    }
+
+    if torch.cuda.is_available():
+        rng_state["cuda"] = torch.cuda.get_rng_state_all()
+
+    return rng_state
+
+
+def set_rng_state(rng_state: dict):
+
+    random.setstate(rng_state["python"])
+    np.random.set_state(rng_state["numpy"])
+    torch.set_rng_state(rng_state["torch"])
+
+    if "cuda" in rng_state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state["cuda"])
+
+
+def atomic_torch_save(obj, path: str):
+    # we first write into a temporary file and then rename it: renaming is atomic, so
+    # if the process is killed while saving, the previous file at `path` is still valid
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
 def log_wandb(parameters_to_log: dict, should_log: bool):
     if should_log is True:
+        import wandb
+
         wandb.log(parameters_to_log)
 
 
+class BackgroundWorker:
+    """
+    Runs the submitted callables one after the other (thus in submission order) on a single daemon thread,
+    so that the caller never waits for them. Exceptions raised by a job are re-raised when calling `join()`
+    """
+
+    def __init__(self):
+        self._jobs = queue.Queue()
+        self._error = None
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+
+            # None is the sentinel which stops the worker
+            if job is None:
+                self._jobs.task_done()
+                break
+
+            fn, args, kwargs = job
+            try:
+                # after the first error, remaining jobs are discarded
+                if self._error is None:
+                    fn(*args, **kwargs)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._jobs.task_done()
+
+    def submit(self, fn: Callable, *args, **kwargs):
+        self._jobs.put((fn, args, kwargs))
+
+    def join(self):
+        # wait for all jobs submitted so far
+        self._jobs.join()
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        self._jobs.put(None)
+        self._thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+
+class AsyncWandbLogger:
+    """
+    Same as `log_wandb()`, but logs are sent to wandb by a background thread.
+    Logs are sent in the same order in which they are submitted
+    """
+
+    def __init__(self, should_log: bool):
+        self.should_log = should_log
+        self._worker = None
+
+    def log(self, parameters_to_log: dict):
+        if self.should_log is True:
+
+            # worker is started lazily, so that the logger can be used again after being closed
+            if self._worker is None:
+                self._worker = BackgroundWorker()
+
+            import wandb
+
+            self._worker.submit(wandb.log, parameters_to_log)
+
+    def close(self):
+        if self._worker is not None:
+            self._worker.close()
+            self._worker = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RunningMean:
+    """
+    Accumulates scalar tensors (e.g. the loss of each step) directly on their device, so that no
+    host-device synchronization happens at each update. The host value is obtained only when `flush()`
+    is called, that's when synchronization happens
+    """
+
+    def __init__(self):
+        self.total = None
+        self.count = 0
+
+    def update(self, value: torch.Tensor, count: int = 1):
+        # `value` can also be the sum of `count` values accumulated elsewhere
+
+        # detach so that the computational graph of each step is not kept alive
+        value = value.detach()
+
+        self.total = value.clone() if self.total is None else self.total + value
+        self.count += count
+
+    def flush(self, synchronize: bool = False) -> float:
+        """
+        Returns the mean of the values accumulated so far. If `synchronize` is True, the mean is computed
+        considering the values accumulated by all the distributed processes, thus it must be called by all of them
+        """
+
+        total = self.total if self.total is not None else torch.tensor(0.)
+        count = self.count
+
+        if synchronize and get_world_size() > 1:
+            total_count = torch.tensor([total.item(), count], dtype=torch.float64, device=_collective_device())
+            torch.distributed.all_reduce(total_count)
+            total, count = total_count[0], total_count[1].item()
+
+        if count == 0:
+            return 0.
+
+        return (total / count).item()
+
+
+def init_distributed(device: str) -> str:
+    """
+    Initializes the default process group if the script has been launched with `torchrun` using more than
+    one process. The `gloo` backend is used for cpu, `nccl` for cuda
+
+    Returns:
+        The device that the current process should use (with cuda, each process uses the gpu of its local rank)
+    """
+
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+
+    if world_size > 1 and not torch.distributed.is_initialized():
+        backend = "nccl" if device.startswith("cuda") else "gloo"
+
+        # validation and evaluation could take a long time, while other processes wait
+        torch.distributed.init_process_group(backend=backend, timeout=datetime.timedelta(hours=6))
+
+        if device.startswith("cuda"):
+            device = f"cuda:{os.environ.get('LOCAL_RANK', 0)}"
+            torch.cuda.set_device(device)
+
+    return device
+
+
+def get_world_size() -> int:
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_world_size()
+
+    return 1
+
+
+def get_rank() -> int:
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank()
+
+    return 0
+
+
+def _collective_device() -> str:
+    # gloo collectives work on cpu tensors, nccl ones on cuda tensors
+    return f"cuda:{torch.cuda.current_device()}" if torch.distributed.get_backend() == "nccl" else "cpu"
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def barrier():
+    if get_world_size() > 1:
+        torch.distributed.barrier()
+
+
+def broadcast_object(obj, src: int = 0):
+    """
+    Returns the `obj` of the process with rank `src` to every process. It must be called by all processes
+    """
+
+    if get_world_size() > 1:
+        obj_list = [obj]
+        torch.distributed.broadcast_object_list(obj_list, src=src)
+        obj = obj_list[0]
+
+    return obj
+
+
+def gather_objects(obj) -> list:
+    """
+    Returns the list of `obj` of every process, ordered by rank. It must be called by all processes
+    """
+
+    if get_world_size() == 1:
+        return [obj]
+
+    gathered = [None] * get_world_size()
+    torch.distributed.all_gather_object(gathered, obj)
+
+    return gathered
+
+
+def any_process(flag: bool) -> bool:
+    """
+    Returns True if `flag` is True for at least one of the distributed processes. It must be called by all processes
+    """
+
+    return bool(_all_reduce_scalar(int(flag), op=torch.distributed.ReduceOp.MAX))
+
+
+def min_across_processes(value: int) -> int:
+    """
+    Returns the minimum `value` among all the distributed processes. It must be called by all processes
+    """
+
+    return int(_all_reduce_scalar(value, op=torch.distributed.ReduceOp.MIN))
+
+
+def _all_reduce_scalar(value, op):
+    if get_world_size() > 1:
+        value_tensor = torch.tensor(value, device=_collective_device())
+        torch.distributed.all_reduce(value_tensor, op=op)
+        value = value_tensor.item()
+
+    return value
+
+
 @contextmanager
 def init_wandb(should_log: bool, **kwargs):
     if should_log is True:
         project = kwargs.pop("project", "P5-Thesis")
         exp_name = kwargs.pop("name", None)
 
+        import wandb
+
         with wandb.init(project=project, name=exp_name, **kwargs):
             yield
     else:
@@ -74,6 +346,8 @@ class PrintWithSpin:
         self.yaspin_obj = None
 
     def __enter__(self):
+        from yaspin import yaspin
+        from yaspin.spinners import Spinners
 
         self.yaspin_obj = yaspin(Spinners.sand, text=self.text, side="right").__enter__()
 
@@ -0,0 +1,108 @@
+import os
+import random
+import tempfile
+import unittest
+
+from src.data import AnonDataset
+from src.data.datasets.synthetic_dataset import SyntheticDataset, MIN_HISTORY_LENGTH
+
+
+class TestSyntheticDataset(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dataset = SyntheticDataset(n_users=50, n_items=80, n_interactions=600, seed=0)
+
+    def test_registered(self):
+        self.assertIs(AnonDataset.dataset_exists("SyntheticDataset", return_bool=False), SyntheticDataset)
+
+    def test_invalid_n_interactions(self):
+        with self.assertRaises(ValueError):
+            SyntheticDataset(n_users=50, n_interactions=MIN_HISTORY_LENGTH * 50 - 1)
+
+    def test_generated_data(self):
+
+        self.assertEqual(len(self.dataset.original_df), 50)
+        self.assertEqual(sum(len(item_sequence) for item_sequence in self.dataset.original_df["item_sequence"]), 600)
+        self.assertTrue(all(len(item_sequence) >= MIN_HISTORY_LENGTH
+                            for item_sequence in self.dataset.original_df["item_sequence"]))
+
+        self.assertEqual(len(self.dataset.all_users), 50)
+        self.assertTrue(set(self.dataset.all_items).issubset(self.dataset.items_meta_dict.keys()))
+
+        # title and categories of each interaction are the ones of the interacted item
+        first_user = self.dataset.original_df.iloc[0]
+        for item, title, categories in zip(first_user["item_sequence"], first_user["title_sequence"],
+                                           first_user["categories_sequence"]):
+            self.assertEqual(title, self.dataset.items_meta_dict[item]["title"])
+            self.assertEqual(list(categories), self.dataset.items_meta_dict[item]["categories"])
+
+    def test_same_seed_same_data(self):
+
+        other_dataset = SyntheticDataset(n_users=50, n_items=80, n_interactions=600, seed=0)
+
+        self.assertTrue(self.dataset.original_df.equals(other_dataset.original_df))
+        self.assertEqual(self.dataset.items_meta_dict, other_dataset.items_meta_dict)
+
+    def test_split_data(self):
+
+        for (_, user_row), (_, train_row), (_, val_row), (_, test_row) in zip(self.dataset.original_df.iterrows(),
+                                                                              self.dataset.train_df.iterrows(),
+                                                                              self.dataset.val_df.iterrows(),
+                                                                              self.dataset.test_df.iterrows()):
+            item_sequence = list(user_row["item_sequence"])
+
+            self.assertEqual(list(train_row["item_sequence"]), item_sequence[:-2])
+
+            self.assertEqual(list(val_row["input_item_seq"]), item_sequence[:-2])
+            self.assertEqual(list(val_row["gt_item"]), [item_sequence[-2]])
+
+            self.assertEqual(list(test_row["input_item_seq"]), item_sequence[:-1])
+            self.assertEqual(list(test_row["gt_item"]), [item_sequence[-1]])
+            self.assertEqual(list(test_row["gt_rating"]), [user_row["rating_sequence"][-1]])
+
+    def test_get_hf_datasets(self):
+
+        hf_datasets = self.dataset.get_hf_datasets()
+        self.assertEqual(set(hf_datasets.keys()), {"train", "validation", "test"})
+        self.assertEqual(hf_datasets["test"][0]["gt_title"], [self.dataset.test_df.iloc[0]["gt_title"][0]])
+
+        hf_datasets = self.dataset.get_hf_datasets(merge_train_val=True)
+        self.assertEqual(set(hf_datasets.keys()), {"train", "test"})
+        self.assertEqual(hf_datasets["train"][0]["item_sequence"],
+                         list(self.dataset.test_df.iloc[0]["input_item_seq"]))
+
+    def test_sample_train_sequence(self):
+
+        random.seed(42)
+        train_split = self.dataset.get_hf_datasets()["train"]
+
+        sampled_split = train_split.map(self.dataset.sample_train_sequence, batched=True,
+                                        remove_columns=train_split.column_names)
+
+        for train_sample, sampled in zip(train_split, sampled_split):
+            item_sequence = train_sample["item_sequence"]
+            input_item_seq = sampled["input_item_seq"]
+
+            self.assertGreaterEqual(len(input_item_seq), 1)
+            self.assertEqual(len(sampled["input_categories_seq"]), len(input_item_seq))
+
+            # input and target are consecutive items of the train sequence
+            sampled_subsequence = input_item_seq + sampled["gt_item"]
+            self.assertTrue(any(item_sequence[i:i + len(sampled_subsequence)] == sampled_subsequence
+                                for i in range(len(item_sequence))))
+
+    def test_save_load(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.dataset.save(tmp_dir)
+            self.assertTrue(os.path.isfile(os.path.join(tmp_dir, "synthetic_dat.pkl")))
+
+            loaded_dataset = SyntheticDataset.load(tmp_dir)
+
+        self.assertTrue(loaded_dataset.test_df.equals(self.dataset.test_df))
+        self.assertEqual(loaded_dataset.items_meta_dict, self.dataset.items_meta_dict)
+
+
+if __name__ == '__main__':
+    unittest.main()
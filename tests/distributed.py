@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+import os
+import socket
+from typing import Callable
+
+import torch
+import torch.distributed
+import torch.multiprocessing
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _init_and_run(rank: int, world_size: int, port: int, fn: Callable, args: tuple):
+
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+
+    # processes share the cpu, so each one uses only a few threads
+    torch.set_num_threads(max(1, torch.get_num_threads() // world_size))
+
+    torch.distributed.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        fn(rank, *args)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+def run_distributed(fn: Callable, world_size: int, *args):
+    """
+    Runs `fn(rank, *args)` in `world_size` processes which form a `gloo` process group, as if they were
+    launched with `torchrun`. `fn` must be defined at module level, so that it can be pickled, and it should
+    write anything to check into files, since return values are discarded
+    """
+
+    torch.multiprocessing.spawn(_init_and_run, args=(world_size, _free_port(), fn, args), nprocs=world_size)
@@ -106,6 +106,30 @@ class TestRankingMetric(unittest.TestCase):
 
         self.assertTrue(np.array_equal(expected, result))
 
+    def test_per_user_values_multi(self):
+
+        rel_matrix = np.array([
+            [0, 1, 0, 1, 1],
+            [0, 0, 0, 0, 0],
+            [1, 0, 0, 0, 1],
+            [0, 0, 0, 1, 0]
+        ], dtype=np.uint8)
+
+        metrics = [Hit(k=1), Hit(k=4), MAP(k=2), MAP(), MRR(k=3), MRR(), NDCG(k=2), NDCG(k=10)]
+
+        # values of all metrics read from prefix sums are the same of those computed by cutting
+        # the relevance matrix for each metric
+        result = Hit().per_user_values_multi(metrics, rel_matrix)
+
+        for metric in metrics:
+            expected = metric.per_user_values(rel_matrix[:, :metric.k] if metric.k is not None else rel_matrix)
+
+            self.assertTrue(np.allclose(expected, result[str(metric)]))
+
+        # ideal dcg is computed from the n° of relevant items in the cut ranking list
+        expected_user_1 = (1 / np.log2(3) + 1 / np.log2(5) + 1 / np.log2(6)) / (1 + 1 / np.log2(3) + 1 / np.log2(4))
+        self.assertAlmostEqual(expected_user_1, result["NDCG@10"][0])
+
 
 class TestHit(unittest.TestCase):
 
@@ -455,6 +479,32 @@ class TestMRR(unittest.TestCase):
         expected = (rr_user_1 + rr_user_2 + rr_user_3) / 3
 
         self.assertEqual(expected, result)
+
+    def test__call__k_greater_than_n_preds(self):
+
+        # users with no relevant item must have rr == 0 even if k is greater than the n° of predictions
+        metric = MRR(k=5)
+
+        predictions = np.array([
+            ["item_1", "item_2", "item_3"],
+            ["item_4", "item_5", "item_6"]
+        ])
+
+        truths = PaddedArr([
+            ["item_1"],
+            ["item_8"]
+        ])
+
+        rel_binary_matrix = metric.per_user_precomputed_matrix(predictions, truths)
+        result = metric(rel_binary_matrix)
+
+        rr_user_1 = 1
+        rr_user_2 = 0
+
+        expected = (rr_user_1 + rr_user_2) / 2
+
+        self.assertEqual(expected, result)
+        self.assertEqual(MRR()(rel_binary_matrix), result)
     
     def test_from_string(self):
 
@@ -1,9 +1,12 @@
 import inspect
 import unittest
+from unittest import mock
 
 import numpy as np
 
-from src.evaluate.abstract_metric import PaddedArr, AnonMetric, Loss
+from src.evaluate.abstract_metric import PaddedArr, RaggedArr, AnonMetric, Loss, MetricAccumulator
+from src.evaluate.metrics.error_metrics import ErrorMetric, RMSE, MAE
+from src.evaluate.metrics.ranking_metrics import Hit, MAP, MRR, NDCG
 
 
 class TestPaddedArr(unittest.TestCase):
@@ -85,6 +88,55 @@ class TestPaddedArr(unittest.TestCase):
             PaddedArr(list_rows)
 
 
+class TestRaggedArr(unittest.TestCase):
+
+    def test__init__(self):
+
+        list_rows = [
+            ["1", "2", "3", "4", "5"],
+            [],
+            ["1", "2", "3"],
+            ["1"]
+        ]
+
+        result = RaggedArr(list_rows)
+
+        # values of all rows are flattened, no padding happens
+        self.assertTrue(np.array_equal(np.array(["1", "2", "3", "4", "5", "1", "2", "3", "1"]), result.values))
+        self.assertTrue(np.array_equal(np.array([0, 5, 5, 8, 9]), result.offsets))
+        self.assertTrue(np.array_equal(np.array([5, 0, 3, 1]), result.lengths))
+        self.assertTrue(np.array_equal(np.array([0, 0, 0, 0, 0, 2, 2, 2, 3]), result.row_ids))
+
+        self.assertEqual(len(list_rows), len(result))
+        for i, row in enumerate(list_rows):
+            self.assertEqual(row, result[i].tolist())
+
+        # dense representation is the same of PaddedArr
+        self.assertTrue(np.array_equal(PaddedArr(list_rows), result.to_padded()))
+
+        # <PAD> is the pad token and can't be used as element
+        with self.assertRaises(AssertionError):
+            RaggedArr([["1", "<PAD>"], ["1"]])
+
+    def test__init__from_padded(self):
+
+        list_rows = [
+            ["1", "2", "3"],
+            ["1"],
+            []
+        ]
+
+        # pad tokens of a padded array are not considered
+        result = RaggedArr(PaddedArr(list_rows))
+        expected = RaggedArr(list_rows)
+
+        self.assertTrue(np.array_equal(expected.values, result.values))
+        self.assertTrue(np.array_equal(expected.offsets, result.offsets))
+
+        # wrap does not convert truths which are already ragged
+        self.assertIs(expected, RaggedArr.wrap(expected))
+
+
 class TestAnonMetric(unittest.TestCase):
 
     def test_all_metrics_available(self):
@@ -220,5 +272,135 @@ class TestLoss(unittest.TestCase):
         self.assertEqual(expected, result)
 
 
+class TestMetricAccumulator(unittest.TestCase):
+
+    def test_update_compute_ranking(self):
+
+        predictions = [
+            np.array(["item_1", "item_2", "item_3"]),
+            np.array(["item_1", "item_50", "item_6"]),
+            np.array(["item_9", "item_8", "item_2"]),
+            np.array(["item_4", "item_3", "item_7"])
+        ]
+
+        truths = [
+            np.array(["item_3", "item_1", "item_80", "item_90"]),
+            np.array(["item_8", "item_3", "item_4"]),
+            np.array(["item_8", "item_2"]),
+            np.array(["item_7"])
+        ]
+
+        metric_list = [Hit(k=1), MRR(k=2), MAP(), NDCG(k=3)]
+
+        # results computed on all predictions at once
+        expected = {}
+        for metric in metric_list:
+            precomputed_matrix = metric.per_user_precomputed_matrix(np.array(predictions), PaddedArr(truths))
+            expected[str(metric)] = metric(precomputed_matrix)
+
+        # results computed batch by batch (truths of each batch are padded differently)
+        accumulator = MetricAccumulator(metric_list)
+        accumulator.update(predictions[:1], truths[:1])
+        accumulator.update(predictions[1:], truths[1:])
+
+        result = accumulator.compute()
+
+        self.assertEqual(expected.keys(), result.keys())
+        for metric_name in expected:
+            self.assertAlmostEqual(expected[metric_name], result[metric_name])
+
+    def test_update_compute_error(self):
+
+        predictions = [np.array(["1.2"]), np.array(["100"]), np.array(["not a number"]), np.array(["-20"])]
+        truths = [np.array(["3"]), np.array(["4"]), np.array(["1"]), np.array(["5"])]
+
+        metric_list = [RMSE(), MAE()]
+
+        expected = {}
+        for metric in metric_list:
+            precomputed_matrix = metric.per_user_precomputed_matrix(np.array(predictions), PaddedArr(truths))
+            expected[str(metric)] = metric(precomputed_matrix)
+
+        # predictions are bounded to the range of ALL truths, not only the ones of their batch
+        accumulator = MetricAccumulator(metric_list)
+        for pred, truth in zip(predictions, truths):
+            accumulator.update([pred], [truth])
+
+        result = accumulator.compute()
+
+        self.assertEqual(expected, result)
+
+    def test_compute_streamable_only(self):
+
+        predictions = [np.array(["1.2"]), np.array(["100"])]
+        truths = [np.array(["3"]), np.array(["4"])]
+
+        accumulator = MetricAccumulator([Hit(), RMSE(), MAE()])
+        accumulator.update(predictions, truths)
+
+        # the state of the batches of non-streamable metrics is not merged
+        with mock.patch.object(ErrorMetric, "merge_batch_states") as merge_batch_states:
+            result = accumulator.compute(streamable_only=True)
+
+        merge_batch_states.assert_not_called()
+        self.assertEqual(result, {"Hit": 0.})
+
+        self.assertEqual(accumulator.compute().keys(), {"Hit", "RMSE", "MAE"})
+
+    def test_merge(self):
+
+        predictions = [np.array(["item_1", "item_2"]), np.array(["item_3", "item_4"]), np.array(["item_5", "item_6"])]
+        truths = [np.array(["item_2"]), np.array(["item_5"]), np.array(["item_5"])]
+
+        metric_list = [Hit(), MRR()]
+
+        accumulator = MetricAccumulator(metric_list)
+        for pred, truth in zip(predictions, truths):
+            accumulator.update([pred], [truth])
+
+        # accumulators of different processes merged together give the same results
+        first_accumulator = MetricAccumulator(metric_list)
+        first_accumulator.update(predictions[:1], truths[:1])
+
+        second_accumulator = MetricAccumulator(metric_list)
+        second_accumulator.update(predictions[1:2], truths[1:2])
+        second_accumulator.update(predictions[2:], truths[2:])
+
+        first_accumulator.merge(second_accumulator)
+
+        self.assertEqual(accumulator.compute(), first_accumulator.compute())
+
+    def test_per_user_values(self):
+
+        predictions = [np.array(["1.2"]), np.array(["100"]), np.array(["not a number"]), np.array(["-20"])]
+        truths = [np.array(["3"]), np.array(["4"]), np.array(["1"]), np.array(["5"])]
+
+        # per user values are not kept by default
+        with self.assertRaises(ValueError):
+            MetricAccumulator([MAE()]).per_user_values()
+
+        accumulator = MetricAccumulator([MAE(), RMSE()], keep_per_user_values=True)
+        accumulator.update(predictions[:2], truths[:2])
+        accumulator.update(predictions[2:], truths[2:])
+
+        per_user_values = accumulator.per_user_values()
+
+        # predictions are bounded to the range of the truths of all valid predictions [3, 5],
+        # the invalid prediction has a NaN value
+        np.testing.assert_allclose(per_user_values["MAE"], [0, 1, np.nan, 2])
+        np.testing.assert_allclose(per_user_values["RMSE"], [0, 1, np.nan, 4])
+
+        # per user values of ranking metrics follow the order of users
+        accumulator = MetricAccumulator([Hit(k=1), MRR()], keep_per_user_values=True)
+        accumulator.update([np.array(["item_1", "item_2"])], [np.array(["item_2"])])
+        accumulator.update([np.array(["item_3", "item_4"]), np.array(["item_5", "item_6"])],
+                           [np.array(["item_3"]), np.array(["item_7"])])
+
+        per_user_values = accumulator.per_user_values()
+
+        np.testing.assert_array_equal(per_user_values["Hit@1"], [0, 1, 0])
+        np.testing.assert_array_equal(per_user_values["MRR"], [.5, 1, 0])
+
+
 if __name__ == '__main__':
     unittest.main()
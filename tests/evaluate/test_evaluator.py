@@ -1,6 +1,8 @@
 import os.path
 import shutil
+import tempfile
 import unittest
+from math import ceil
 from unittest.mock import Mock
 
 import datasets
@@ -11,9 +13,44 @@ import torch
 from src.data.tasks.tasks import SequentialSideInfoTask, RatingPredictionTask
 from src.evaluate.abstract_metric import Loss
 from src.evaluate.evaluator import RecEvaluator
+from src.evaluate.predictions import save_predictions, load_predictions, get_predictions_path
 from src.evaluate.metrics.error_metrics import MAE, RMSE
 from src.evaluate.metrics.ranking_metrics import Hit, MRR, MAP
 from src.model import AnonModel
+from src.utils import seed_everything
+from tests.distributed import run_distributed
+from tests.tiny_models import tiny_dataset, build_tiny_checkpoint, tiny_rec_model
+
+
+# tasks evaluated by the distributed evaluation test, with their metrics
+_DISTRIBUTED_EVAL_TASKS = {
+    SequentialSideInfoTask(): [Hit(k=2), MRR(k=2), MAP(k=2), Loss()],
+    RatingPredictionTask(): [RMSE(), MAE()]
+}
+
+
+def _evaluate_tasks(checkpoint_dir: str, predictions_dir: str) -> dict:
+
+    dataset = tiny_dataset()
+    test_set = dataset.get_hf_datasets()["test"]
+
+    seed_everything(42)
+    rec_model = tiny_rec_model("T5Rec", dataset, checkpoint_dir,
+                               training_tasks_str=["SequentialSideInfoTask", "RatingPredictionTask"])
+
+    # 20 users, 7 batches of size 3, 4 shards of 2 batches each
+    eva = RecEvaluator(rec_model, eval_batch_size=3, predictions_shard_batches=2)
+    eva._sync_predictions_dir(predictions_dir, test_set)
+
+    return {str(task): eva.evaluate_task(test_set, metric_list=metric_list, task=task, template_id=0,
+                                         predictions_path=get_predictions_path(predictions_dir, task, 0))
+            for task, metric_list in _DISTRIBUTED_EVAL_TASKS.items()}
+
+
+def _distributed_evaluate_tasks(rank: int, checkpoint_dir: str, predictions_dir: str, results_dir: str):
+
+    results = _evaluate_tasks(checkpoint_dir, predictions_dir)
+    torch.save(results, os.path.join(results_dir, f"rank_{rank}.pth"))
 
 
 class TestEvaluator(unittest.TestCase):
@@ -28,6 +65,9 @@ class TestEvaluator(unittest.TestCase):
             torch.tensor(.5)
         )
 
+        # when only the loss is requested, predictions are not generated and 'eval_loss_step()' is used
+        mocked_model.eval_loss_step.return_value = torch.tensor(.5)
+
         mocked_dataset = Mock(spec=datasets.Dataset, num_rows=5)
         mocked_dataset.map.return_value = mocked_dataset
         mocked_dataset.set_format.return_value = mocked_dataset
@@ -62,11 +102,12 @@ class TestEvaluator(unittest.TestCase):
         self.assertIsInstance(sequential_sideinfo_res, pd.DataFrame)
         self.assertIsInstance(rating_prediction_res, pd.DataFrame)
 
-        # assert that mean and max are present in each result df at the last 2 positions
+        # assert that mean and best are present in each result df at the last 2 positions
+        # (best is "max" for ranking metrics, "min" for error metrics)
         self.assertEqual(sequential_sideinfo_res.index[-2], "mean")
         self.assertEqual(sequential_sideinfo_res.index[-1], "max")
         self.assertEqual(rating_prediction_res.index[-2], "mean")
-        self.assertEqual(rating_prediction_res.index[-1], "max")
+        self.assertEqual(rating_prediction_res.index[-1], "min")
 
         # assert that other index values are all the inference templates of the task
         self.assertEqual(sequential_sideinfo_res.index[:-2].tolist(),
@@ -159,11 +200,169 @@ class TestEvaluator(unittest.TestCase):
         self.assertTrue(len(res) == 1)
         self.assertIn("Loss", res)
 
-        # the mocked 'generate_step()' returns always the same loss,
+        # the mocked 'eval_loss_step()' returns always the same loss,
         # so after we divide the summed loss over the total number of batches
         # we should get same loss
         self.assertEqual(res["Loss"], .5)
 
+    def test_evaluate_task_time_budget(self):
+        eva = RecEvaluator(self.mocked_model, eval_batch_size=1)
+
+        # with an exhausted time budget, evaluation stops after the first batch
+        # and results are computed on the users evaluated so far
+        res = eva.evaluate_task(eval_dataset=self.mocked_dataset,
+                                metric_list=[Hit(), Loss()],
+                                task=SequentialSideInfoTask(),
+                                template_id=0,
+                                max_minutes=0)
+
+        self.assertEqual(res["Hit"], 1)
+        self.assertEqual(res["Loss"], .5)
+
+    def test_evaluate_predictions(self):
+
+        predictions = [
+            np.array(["item_1", "item_2", "item_3"]),
+            np.array(["item_1", "item_50", "item_6"]),
+            np.array(["item_9", "item_8", "item_2"])
+        ]
+
+        truths = [
+            np.array(["item_3", "item_1", "item_80", "item_90"]),
+            np.array(["item_8", "item_3", "item_4"]),
+            np.array(["item_8", "item_2"])
+        ]
+
+        save_predictions("to_del/template_0.parquet", user_ids=["1", "2", "3"], preds=predictions, truths=truths,
+                         template_id=0, batch_size=2, loss=.5)
+
+        # the model is not needed to compute metrics from saved predictions
+        eva = RecEvaluator(None, eval_batch_size=1)
+
+        res = eva.evaluate_predictions("to_del/template_0.parquet", metric_list=[Hit(), MRR(k=2), Loss()])
+
+        expected = eva._compute_metrics(predictions, truths, metric_list=[Hit(), MRR(k=2)])
+        expected["Loss"] = .5
+
+        self.assertEqual(expected, res)
+
+        # predictions not generated yet
+        with self.assertRaises(FileNotFoundError):
+            eva.evaluate_predictions("to_del/template_1.parquet", metric_list=[Hit()])
+
+        shutil.rmtree("to_del", ignore_errors=True)
+
+    def test_evaluate_task_resume(self):
+
+        eval_dataset = datasets.Dataset.from_dict({"user_id": [str(i) for i in range(7)]})
+
+        model = Mock(spec=AnonModel)
+        model.tokenize.side_effect = lambda batch: {"user_id": batch["user_id"]}
+        model.prepare_input.side_effect = lambda batch: batch
+
+        # each user has as prediction its own id, and it is relevant only for even users
+        def generate_step(batch, return_loss):
+            user_ids = np.array(batch["user_id"])
+            truths = np.where(user_ids.astype(int) % 2 == 0, user_ids, "no_item")
+
+            return user_ids[:, None], truths[:, None], torch.tensor(float(user_ids[0]))
+
+        model.generate_step.side_effect = generate_step
+
+        # 7 users, 4 batches of size 2, 2 shards of 2 batches each
+        eva = RecEvaluator(model, eval_batch_size=2, predictions_shard_batches=2)
+        expected = eva.evaluate_task(eval_dataset, metric_list=[Hit(), Loss()], task=SequentialSideInfoTask(),
+                                     predictions_path="to_del/template_0.parquet")
+
+        self.assertAlmostEqual(expected["Hit"], 4 / 7)
+        self.assertAlmostEqual(expected["Loss"], (0 + 2 + 4 + 6) / 4)
+        self.assertTrue(os.path.isfile("to_del/template_0_shards/shard_000000.parquet"))
+        self.assertTrue(os.path.isfile("to_del/template_0_shards/shard_000001.parquet"))
+
+        # simulate a crash happened after the first shard was saved:
+        # only the batches of the second shard are generated again
+        os.remove("to_del/template_0_shards/shard_000001.parquet")
+        os.remove("to_del/template_0.parquet")
+        model.generate_step.reset_mock()
+
+        res = eva.evaluate_task(eval_dataset, metric_list=[Hit(), Loss()], task=SequentialSideInfoTask(),
+                                predictions_path="to_del/template_0.parquet")
+
+        self.assertEqual(model.generate_step.call_count, 2)
+        self.assertEqual(expected, res)
+
+        # the merged file contains predictions of all users
+        self.assertEqual(eva.evaluate_predictions("to_del/template_0.parquet", metric_list=[Hit(), Loss()]),
+                         expected)
+
+        shutil.rmtree("to_del", ignore_errors=True)
+
+    def test_evaluate_suite_cross_template(self):
+
+        eval_dataset = datasets.Dataset.from_dict({"user_id": [str(i) for i in range(7)]})
+
+        model = Mock(spec=AnonModel)
+        model.prepare_input.side_effect = lambda batch: batch
+
+        # the template used to tokenize each user is kept, so that predictions depend on it
+        def tokenize(batch):
+            [template_id] = model.eval_task.all_templates(return_id=True)
+            return {"user_id": batch["user_id"], "template_id_used": [template_id] * len(batch["user_id"])}
+
+        # the prediction is right only if the sum of the user id and the template id is even
+        def generate_step(batch, return_loss):
+            user_ids = np.array(batch["user_id"])
+            template_ids = batch["template_id_used"].numpy()
+            predictions = np.where((user_ids.astype(int) + template_ids) % 2 == 0, user_ids, "no_item")
+
+            return predictions[:, None], user_ids[:, None], torch.tensor(torch.nan)
+
+        model.tokenize.side_effect = tokenize
+        model.generate_step.side_effect = generate_step
+
+        n_templates = len(SequentialSideInfoTask().inference_templates())
+
+        expected = RecEvaluator(model, eval_batch_size=2).evaluate_suite(
+            eval_dataset, tasks_to_evaluate={SequentialSideInfoTask(): [Hit(), MRR(k=2)]}, output_dir="to_del",
+            create_latex_table=False
+        )
+
+        # 7 users -> 4 batches for each template
+        self.assertEqual(model.generate_step.call_count, 4 * n_templates)
+        model.generate_step.reset_mock()
+
+        res = RecEvaluator(model, eval_batch_size=2, cross_template_batching=True).evaluate_suite(
+            eval_dataset, tasks_to_evaluate={SequentialSideInfoTask(): [Hit(), MRR(k=2)]}, output_dir="to_del",
+            create_latex_table=False
+        )
+
+        # prompts of all templates are generated together, only the last batch is not full
+        self.assertEqual(model.generate_step.call_count, ceil(7 * n_templates / 2))
+        pd.testing.assert_frame_equal(expected["SequentialSideInfoTask"], res["SequentialSideInfoTask"])
+
+        # the loss can't be demultiplexed, templates are evaluated one at a time
+        model.generate_step.reset_mock()
+        RecEvaluator(model, eval_batch_size=2, cross_template_batching=True).evaluate_suite(
+            eval_dataset, tasks_to_evaluate={SequentialSideInfoTask(): [Hit(), Loss()]}, output_dir="to_del",
+            create_latex_table=False
+        )
+        self.assertEqual(model.generate_step.call_count, 4 * n_templates)
+
+        shutil.rmtree("to_del", ignore_errors=True)
+
+    def test__create_latex_table_loss_only(self):
+
+        # when the loss is the only metric, the only summary row is the mean
+        res_df = pd.DataFrame({str(Loss()): [0.5, 0.4, 0.3, 0.4]}, index=[0, 1, 2, "mean"])
+
+        latex_table = RecEvaluator._create_latex_table(res_df, task_name="SequentialSideInfoTask", n_summary_rows=1)
+
+        template_rows, summary_rows = latex_table.split(r"\midrule")[1:]
+
+        self.assertIn("2 & \\textbf{0.3000}", template_rows)
+        self.assertNotIn("2 & ", summary_rows)
+        self.assertIn("mean & 0.4000", summary_rows)
+
     # usually private methods are automatically tested when tested other methods,
     # but due to the great importance and relevance of this method, it is tested
     # individually
@@ -279,5 +478,47 @@ class TestEvaluator(unittest.TestCase):
             eva._compute_metrics(predictions, truths, metric_list=[Hit()])
 
 
+
+class TestDistributedEvaluator(unittest.TestCase):
+
+    def test_two_processes(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            checkpoint_dir = build_tiny_checkpoint("T5Rec", tiny_dataset(), os.path.join(tmp_dir, "tiny_t5"))
+
+            expected = _evaluate_tasks(checkpoint_dir, os.path.join(tmp_dir, "serial_predictions"))
+
+            distributed_predictions_dir = os.path.join(tmp_dir, "distributed_predictions")
+            run_distributed(_distributed_evaluate_tasks, 2, checkpoint_dir, distributed_predictions_dir, tmp_dir)
+
+            results = [torch.load(os.path.join(tmp_dir, f"rank_{rank}.pth"), weights_only=False)
+                       for rank in range(2)]
+
+            # merged metrics are the same of the serial evaluation, for all processes
+            # (error metrics are NaN if the tiny model doesn't generate any number)
+            for rank_results in results:
+                self.assertEqual(rank_results.keys(), expected.keys())
+                for task_name, task_results in rank_results.items():
+                    self.assertEqual(task_results.keys(), expected[task_name].keys())
+                    np.testing.assert_allclose(list(task_results.values()), list(expected[task_name].values()),
+                                               rtol=1e-5)
+
+            # and the shards saved by each process are merged in the same predictions of the serial evaluation
+            for task in _DISTRIBUTED_EVAL_TASKS:
+                user_ids, preds, truths, metadata = load_predictions(
+                    get_predictions_path(os.path.join(tmp_dir, "distributed_predictions"), task, 0)
+                )
+                expected_user_ids, expected_preds, expected_truths, expected_metadata = load_predictions(
+                    get_predictions_path(os.path.join(tmp_dir, "serial_predictions"), task, 0)
+                )
+
+                self.assertEqual(user_ids, expected_user_ids)
+                self.assertEqual(len(user_ids), 20)
+                for pred, expected_pred in zip(preds + truths, expected_preds + expected_truths, strict=True):
+                    np.testing.assert_array_equal(pred, expected_pred)
+
+                self.assertEqual(metadata.keys(), expected_metadata.keys())
+
+
 if __name__ == '__main__':
     unittest.main()
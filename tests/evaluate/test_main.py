@@ -2,7 +2,7 @@ import os
 import unittest
 from unittest.mock import Mock, patch, MagicMock
 
-from src import GeneralParams, METRICS_DIR
+from src import GeneralParams, METRICS_DIR, PREDICTIONS_DIR
 from src.data import AnonDataset, DataParams
 from src.data.tasks.tasks import SequentialSideInfoTask, DirectSideInfoTask
 from src.evaluate import EvalParams
@@ -45,13 +45,52 @@ class TestEvalMain(unittest.TestCase):
 
         mock_dataset_exists.assert_called_with("dataset_name", return_bool=False)
         mock_model_exists.assert_called_with("model_name", return_bool=False)
-        mock_rec_eval_init.assert_called_with(mocked_model_obj, 1, should_log=False)
+        mock_rec_eval_init.assert_called_with(mocked_model_obj, 1, should_log=False,
+                                              predictions_shard_batches=eval_params.predictions_shard_batches,
+                                              cross_template_batching=eval_params.cross_template_batching,
+                                              bootstrap_resamples=eval_params.bootstrap_resamples,
+                                              confidence_level=eval_params.confidence_level,
+                                              random_seed=general_params.random_seed)
 
         mock_evaluate_suite.assert_called_with(mocked_dataset_hf,
                                                tasks_to_evaluate={SequentialSideInfoTask(): [Loss(), Hit(k=10)],
                                                                   DirectSideInfoTask(): [Hit(k=5), MRR(k=1)]},
                                                output_dir=os.path.join(METRICS_DIR, "exp_name"),
-                                               create_latex_table=eval_params.create_latex_table)
+                                               create_latex_table=eval_params.create_latex_table,
+                                               predictions_dir=os.path.join(PREDICTIONS_DIR, "exp_name"),
+                                               from_predictions=False)
+
+    @patch.object(AnonDataset, "dataset_exists", return_value=mocked_dataset_cls)
+    @patch.object(AnonModel, "model_exists", return_value=mocked_model_cls)
+    @patch.object(RecEvaluator, "__init__", return_value=None)
+    @patch.object(RecEvaluator, "evaluate_suite")
+    def test_eval_main_from_predictions(self, mock_evaluate_suite, mock_rec_eval_init, mock_model_exists,
+                                        mock_dataset_exists):
+
+        general_params = GeneralParams(exp_name="exp_name")
+        data_params = DataParams(dataset_cls_name="dataset_name", dataset_params={})
+        model_params = ModelParams(model_cls_name="model_name", model_kwargs={}, train_tasks=("SequentialSideInfoTask",))
+        eval_params = EvalParams(eval_tasks={"SequentialSideInfoTask": ["hit@10"]},
+                                 eval_batch_size=1,
+                                 save_predictions=False)
+
+        eval_main(general_params, data_params, model_params, eval_params, from_predictions=True)
+
+        # metrics are computed from saved predictions, so the model is not loaded
+        mock_model_exists.assert_not_called()
+        mock_rec_eval_init.assert_called_with(None, 1, should_log=False,
+                                              predictions_shard_batches=eval_params.predictions_shard_batches,
+                                              cross_template_batching=eval_params.cross_template_batching,
+                                              bootstrap_resamples=eval_params.bootstrap_resamples,
+                                              confidence_level=eval_params.confidence_level,
+                                              random_seed=general_params.random_seed)
+
+        mock_evaluate_suite.assert_called_with(mocked_dataset_hf,
+                                               tasks_to_evaluate={SequentialSideInfoTask(): [Hit(k=10)]},
+                                               output_dir=os.path.join(METRICS_DIR, "exp_name"),
+                                               create_latex_table=eval_params.create_latex_table,
+                                               predictions_dir=os.path.join(PREDICTIONS_DIR, "exp_name"),
+                                               from_predictions=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,111 @@
+import shutil
+import unittest
+
+import numpy as np
+
+from src.evaluate.metrics.error_metrics import RMSE
+from src.evaluate.metrics.ranking_metrics import Hit, MRR
+from src.evaluate.predictions import save_predictions
+from src.evaluate.significance import (per_user_values_from_predictions, bootstrap_confidence_intervals,
+                                       paired_randomization_test, align_users)
+
+
+class TestSignificance(unittest.TestCase):
+
+    def test_per_user_values_from_predictions(self):
+
+        predictions = [np.array(["item_1", "item_2"]), np.array(["item_3", "item_4"]), np.array(["item_5", "item_6"])]
+        truths = [np.array(["item_2"]), np.array(["item_3"]), np.array(["item_7"])]
+
+        save_predictions("to_del/template_0.parquet", user_ids=["1", "2", "3"], preds=predictions, truths=truths,
+                         template_id=0, batch_size=2)
+
+        user_ids, per_user_values = per_user_values_from_predictions("to_del/template_0.parquet", [Hit(k=1), MRR()])
+
+        self.assertEqual(["1", "2", "3"], user_ids)
+        np.testing.assert_array_equal(per_user_values["Hit@1"], [0, 1, 0])
+        np.testing.assert_array_equal(per_user_values["MRR"], [.5, 1, 0])
+
+        shutil.rmtree("to_del", ignore_errors=True)
+
+    def test_bootstrap_confidence_intervals(self):
+
+        rng = np.random.default_rng(42)
+        per_user_values = {"Hit": (rng.random(5000) < .3).astype(float),
+                           "RMSE": rng.random(5000)}
+
+        # the metric is not defined for some users
+        per_user_values["RMSE"][:100] = np.nan
+
+        ci_df = bootstrap_confidence_intervals(per_user_values, [Hit(), RMSE()], n_resamples=2000, random_seed=42)
+
+        self.assertEqual(["Hit", "RMSE"], ci_df.index.tolist())
+        self.assertEqual(["result", "ci_low", "ci_high"], ci_df.columns.tolist())
+
+        # results are computed as the metrics do
+        self.assertAlmostEqual(ci_df.loc["Hit", "result"], per_user_values["Hit"].mean())
+        self.assertAlmostEqual(ci_df.loc["RMSE", "result"], np.sqrt(np.nanmean(per_user_values["RMSE"])))
+
+        for metric_name, ci_row in ci_df.iterrows():
+            self.assertLess(ci_row["ci_low"], ci_row["result"])
+            self.assertGreater(ci_row["ci_high"], ci_row["result"])
+
+        # the standard error of the mean of a bernoulli is known, the 95% interval is ~ +- 1.96 of it
+        expected_half_width = 1.96 * np.sqrt(.3 * .7 / 5000)
+        self.assertAlmostEqual(ci_df.loc["Hit", "ci_high"] - ci_df.loc["Hit", "ci_low"], 2 * expected_half_width,
+                               delta=.005)
+
+        # same seed, same intervals
+        ci_df_same_seed = bootstrap_confidence_intervals(per_user_values, [Hit(), RMSE()], n_resamples=2000,
+                                                         random_seed=42)
+        self.assertTrue(ci_df.equals(ci_df_same_seed))
+
+        # if all users have the same value, the interval collapses on it
+        ci_df = bootstrap_confidence_intervals({"Hit": np.ones(100)}, [Hit()], n_resamples=100, random_seed=42)
+        self.assertEqual([1, 1, 1], ci_df.loc["Hit"].tolist())
+
+    def test_paired_randomization_test(self):
+
+        rng = np.random.default_rng(42)
+        values_a = {"Hit": (rng.random(2000) < .3).astype(float)}
+        values_b = {"Hit": (rng.random(2000) < .5).astype(float)}
+
+        test_df = paired_randomization_test(values_a, values_b, [Hit()], n_permutations=1000, random_seed=42)
+
+        self.assertEqual(["A", "B", "difference", "p_value"], test_df.columns.tolist())
+        self.assertAlmostEqual(test_df.loc["Hit", "difference"], values_a["Hit"].mean() - values_b["Hit"].mean())
+
+        # a difference of 20 points on 2000 users is never obtained by chance
+        self.assertAlmostEqual(test_df.loc["Hit", "p_value"], 1 / 1001)
+
+        # comparing a system with itself, all permutations are as extreme as the observed one
+        test_df = paired_randomization_test(values_a, values_a, [Hit()], n_permutations=1000, random_seed=42)
+        self.assertEqual(test_df.loc["Hit", "p_value"], 1)
+
+        # users for which the metric is not defined for one of the systems are not considered
+        values_a = {"RMSE": np.array([1., 4., np.nan])}
+        values_b = {"RMSE": np.array([1., 4., 9.])}
+        test_df = paired_randomization_test(values_a, values_b, [RMSE()], n_permutations=10, random_seed=42)
+        self.assertEqual(test_df.loc["RMSE", "A"], test_df.loc["RMSE", "B"])
+
+        # values must be paired
+        with self.assertRaises(ValueError):
+            paired_randomization_test({"Hit": np.ones(3)}, {"Hit": np.ones(4)}, [Hit()])
+
+    def test_align_users(self):
+
+        values_a = {"Hit": np.array([1., 0., 1.])}
+        values_b = {"Hit": np.array([0., 0., 1., 1.])}
+
+        aligned_a, aligned_b = align_users(["u1", "u2", "u3"], values_a, ["u4", "u3", "u1", "u2"], values_b)
+
+        # u4 is not evaluated by A, values of B follow the order of users of A
+        np.testing.assert_array_equal(aligned_a["Hit"], [1, 0, 1])
+        np.testing.assert_array_equal(aligned_b["Hit"], [1, 1, 0])
+
+        with self.assertRaises(ValueError):
+            align_users(["u1", "u2"], values_a, ["u1", "u2", "u3", "u4"], values_b)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import os
+import tempfile
+import unittest
+
+import torch
+from safetensors.torch import load_file
+from transformers.utils import SAFE_WEIGHTS_NAME
+
+from src.data.abstract_task import AnonTask
+from tests.tiny_models import tiny_dataset, build_tiny_checkpoint, tiny_rec_model
+
+
+class TestTrainEvalMode(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.dataset = tiny_dataset()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def assert_mode(self, rec_model, training: bool):
+
+        # modules added to the hf model (e.g. dropout of user embeddings) must switch mode too
+        for name, component in rec_model.named_components().items():
+            for module_name, module in component.named_modules():
+                self.assertEqual(module.training, training, f"{name}.{module_name} is not in the expected mode")
+
+        self.assertEqual(AnonTask.training, training)
+
+    def test_t5_eval_disables_dropout(self):
+
+        checkpoint_dir = build_tiny_checkpoint("T5Rec", self.dataset, f"{self.tmp_dir.name}/t5")
+        rec_model = tiny_rec_model("T5Rec", self.dataset, checkpoint_dir,
+                                   inject_user_embeds=True, inject_whole_word_embeds=True)
+        self.assertEqual(set(rec_model.named_components()), {"model", "user_embeddings", "whole_word_embeddings"})
+
+        rec_model.train()
+        self.assert_mode(rec_model, training=True)
+
+        # user embeddings are dropped out only in training mode
+        user_idx = torch.arange(len(self.dataset.all_users))
+        torch.manual_seed(0)
+        self.assertFalse(torch.equal(rec_model.user_embeddings(user_idx), rec_model.user_embeddings(user_idx)))
+
+        rec_model.eval()
+        self.assert_mode(rec_model, training=False)
+
+        self.assertTrue(torch.equal(rec_model.user_embeddings(user_idx), rec_model.user_embeddings(user_idx)))
+
+    def test_gpt2_eval_disables_dropout(self):
+
+        checkpoint_dir = build_tiny_checkpoint("GPT2Rec", self.dataset, f"{self.tmp_dir.name}/gpt2")
+        rec_model = tiny_rec_model("GPT2Rec", self.dataset, checkpoint_dir, inject_whole_word_embeds=True)
+        self.assertEqual(set(rec_model.named_components()), {"model", "whole_word_embeddings"})
+
+        rec_model.train()
+        self.assert_mode(rec_model, training=True)
+
+        rec_model.eval()
+        self.assert_mode(rec_model, training=False)
+
+
+
+class TestSaveLoad(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.dataset = tiny_dataset()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    @staticmethod
+    def perturb(rec_model):
+        # so that weights differ from the ones of the checkpoint the model is initialized from
+        with torch.no_grad():
+            for component in rec_model.named_components().values():
+                for parameter in component.parameters():
+                    parameter.add_(torch.randn_like(parameter))
+
+    def assert_state_dict_equal(self, state_dict, expected_state_dict):
+
+        self.assertEqual(state_dict.keys(), expected_state_dict.keys())
+        for component_name, component_state in state_dict.items():
+            self.assertEqual(component_state.keys(), expected_state_dict[component_name].keys())
+            for name, tensor in component_state.items():
+                torch.testing.assert_close(tensor, expected_state_dict[component_name][name])
+
+    def test_state_dict_round_trip(self):
+
+        checkpoint_dir = build_tiny_checkpoint("T5Rec", self.dataset, f"{self.tmp_dir.name}/t5_state_dict")
+        rec_model = tiny_rec_model("T5Rec", self.dataset, checkpoint_dir,
+                                   inject_user_embeds=True, inject_whole_word_embeds=True)
+        other_model = tiny_rec_model("T5Rec", self.dataset, checkpoint_dir,
+                                     inject_user_embeds=True, inject_whole_word_embeds=True)
+        self.perturb(rec_model)
+
+        # one state dict for each component
+        self.assertEqual(set(rec_model.state_dict()), {"model", "user_embeddings", "whole_word_embeddings"})
+
+        other_model.load_state_dict(rec_model.state_dict())
+        self.assert_state_dict_equal(other_model.state_dict(), rec_model.state_dict())
+
+    def test_t5_saved_snapshot(self):
+
+        checkpoint_dir = build_tiny_checkpoint("T5Rec", self.dataset, f"{self.tmp_dir.name}/t5_snapshot")
+        rec_model = tiny_rec_model("T5Rec", self.dataset, checkpoint_dir,
+                                   inject_user_embeds=True, inject_whole_word_embeds=True)
+        self.perturb(rec_model)
+
+        snapshot = {component_name: {name: tensor.clone() for name, tensor in component_state.items()}
+                    for component_name, component_state in rec_model.state_dict().items()}
+
+        # weights change after the snapshot is taken (i.e. training goes on), the snapshot is saved anyway
+        self.perturb(rec_model)
+
+        output_dir = f"{self.tmp_dir.name}/t5_saved"
+        os.makedirs(output_dir)
+        rec_model.save_static(output_dir)
+        rec_model.save_weights(output_dir, snapshot)
+
+        loaded_model = type(rec_model).load(output_dir)
+        self.assert_state_dict_equal(loaded_model.state_dict(), snapshot)
+
+    def test_gpt2_tied_weights(self):
+
+        checkpoint_dir = build_tiny_checkpoint("GPT2Rec", self.dataset, f"{self.tmp_dir.name}/gpt2_tied")
+        rec_model = tiny_rec_model("GPT2Rec", self.dataset, checkpoint_dir, inject_whole_word_embeds=True)
+        self.perturb(rec_model)
+
+        output_dir = f"{self.tmp_dir.name}/gpt2_saved"
+        os.makedirs(output_dir)
+        rec_model.save(output_dir)
+
+        # the output embeddings are tied to the input ones, thus they are stored only once
+        saved_weights = load_file(os.path.join(output_dir, SAFE_WEIGHTS_NAME))
+        self.assertIn("transformer.wte.weight", saved_weights)
+        self.assertNotIn("lm_head.weight", saved_weights)
+
+        loaded_model = type(rec_model).load(output_dir)
+        self.assert_state_dict_equal(loaded_model.state_dict(), rec_model.state_dict())
+
+        # and they are tied again when loading
+        self.assertIs(loaded_model.model.get_output_embeddings().weight,
+                      loaded_model.model.get_input_embeddings().weight)
+
+
+if __name__ == '__main__':
+    unittest.main()
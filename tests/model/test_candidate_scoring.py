@@ -0,0 +1,187 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+from datasets import Dataset
+
+from src.data.abstract_task import AnonTask
+from src.model.abstract_model import AnonModelHF
+from src.model.models.t5 import T5Rec
+from tests.tiny_models import tiny_dataset, build_tiny_checkpoint, tiny_rec_model
+
+
+class CandidateScoringMixin:
+
+    model_cls_name: str = None
+    model_kwargs: dict = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.checkpoint_dir = tempfile.TemporaryDirectory()
+
+        cls.dataset = tiny_dataset()
+        build_tiny_checkpoint(cls.model_cls_name, cls.dataset, cls.checkpoint_dir.name)
+
+        cls.rec_model = tiny_rec_model(cls.model_cls_name, cls.dataset, cls.checkpoint_dir.name,
+                                       num_beams=5, num_return_sequences=5, candidate_scoring=True,
+                                       **cls.model_kwargs)
+
+        # users with histories of different lengths, so that prompts of a batch are padded
+        test_set = cls.dataset.get_hf_datasets()["test"]
+        cls.samples = sorted(test_set.to_list(), key=lambda sample: len(set(sample["input_item_seq"])))[:4]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.checkpoint_dir.cleanup()
+
+    def tokenize(self, task_str: str, template_id, samples: list[dict]) -> dict:
+
+        self.rec_model.eval_task = AnonTask.from_string(task_str).force_template(template_id)
+
+        # prompts are rendered with a fixed random state, so that all batches list the same candidates
+        np.random.seed(0)
+
+        return self.rec_model.tokenize(Dataset.from_list(samples)[:])
+
+    def predict(self, tokenized_batch: dict) -> np.ndarray:
+
+        prepared_batch = self.rec_model.prepare_input(Dataset.from_dict(tokenized_batch).with_format("torch")[:])
+        predictions, _, _ = self.rec_model.generate_step(prepared_batch)
+
+        return predictions
+
+    def score_targets(self, tokenized_batch: dict, targets: list[str]) -> torch.Tensor:
+
+        # scores computed by `score_pairs` of the model, the function itself is captured from `_rank_candidates()`
+        captured = {}
+        rank_candidates = self.rec_model._rank_candidates
+
+        def capture_score_pairs(candidates, n_samples, top_k, score_pairs):
+            captured["score_pairs"] = score_pairs
+            return rank_candidates(candidates, n_samples, top_k, score_pairs)
+
+        with mock.patch.object(self.rec_model, "_rank_candidates", side_effect=capture_score_pairs):
+            self.predict(tokenized_batch)
+
+        with torch.no_grad():
+            return captured["score_pairs"](torch.arange(len(targets)), self.rec_model._tokenize_candidates(targets))
+
+    def full_sequence_score(self, tokenized_sample: dict) -> torch.Tensor:
+        # log-likelihood of the target text of a single sample, computed on the whole sequence as in training
+        raise NotImplementedError
+
+    def test_candidate_batch_size_invariance(self):
+
+        tokenized_batch = self.tokenize("SequentialSideInfoTask", 0, self.samples)
+
+        with mock.patch.object(self.rec_model, "candidate_batch_size", 256):
+            expected_predictions = self.predict(tokenized_batch)
+
+        for candidate_batch_size in [1, 7, 100]:
+            with self.subTest(candidate_batch_size=candidate_batch_size):
+                with mock.patch.object(self.rec_model, "candidate_batch_size", candidate_batch_size):
+                    np.testing.assert_array_equal(self.predict(tokenized_batch), expected_predictions)
+
+    def test_batch_equals_single_sample(self):
+
+        # prompts of different lengths are padded (on the left for decoder only models) in the batch
+        tokenized_batch = self.tokenize("SequentialSideInfoTask", 0, self.samples)
+        self.assertGreater(len({len(input_ids) for input_ids in next(iter(tokenized_batch.values()))}), 1)
+
+        batch_predictions = self.predict(tokenized_batch)
+
+        for i in range(len(self.samples)):
+            with self.subTest(sample=i):
+                single_tokenized = {field: values[i:i + 1] for field, values in tokenized_batch.items()}
+                np.testing.assert_array_equal(self.predict(single_tokenized), batch_predictions[i:i + 1])
+
+    def test_score_equals_full_sequence_score(self):
+
+        tokenized_batch = self.tokenize("SequentialSideInfoTask", 0, self.samples)
+        targets = [sample["gt_item"][0] for sample in self.samples]
+
+        scores = self.score_targets(tokenized_batch, targets)
+
+        for i in range(len(self.samples)):
+            with self.subTest(sample=i):
+                tokenized_sample = {field: values[i:i + 1] for field, values in tokenized_batch.items()}
+                torch.testing.assert_close(scores[i], self.full_sequence_score(tokenized_sample),
+                                           atol=1e-4, rtol=1e-4)
+
+    def test_predictions_from_candidates(self):
+
+        tokenized_batch = self.tokenize("P5EvalDirectTask", "5-8", self.samples)
+        predictions = self.predict(tokenized_batch)
+
+        self.assertEqual(predictions.shape, (len(self.samples), 5))
+        for sample_predictions, sample_candidates in zip(predictions, tokenized_batch["candidates"]):
+            self.assertTrue(set(sample_predictions).issubset(sample_candidates))
+            self.assertEqual(len(set(sample_predictions)), len(sample_predictions))
+
+        # if the task lists no candidate, items of the catalog are ranked
+        predictions = self.predict(self.tokenize("SequentialSideInfoTask", 0, self.samples))
+        self.assertTrue(set(predictions.flatten()).issubset(self.rec_model.all_unique_labels))
+
+
+class TestT5CandidateScoring(CandidateScoringMixin, unittest.TestCase):
+
+    model_cls_name = "T5Rec"
+    model_kwargs = {"inject_whole_word_embeds": True, "inject_user_embeds": True}
+
+    def full_sequence_score(self, tokenized_sample: dict) -> torch.Tensor:
+
+        batch = self.rec_model.prepare_input(Dataset.from_dict(tokenized_sample).with_format("torch")[:])
+
+        inputs_embeds = self.rec_model.model.shared(batch["input_ids"])
+        inputs_embeds = self.rec_model._inject_user_embeds(inputs_embeds, batch["user_idx"])
+        inputs_embeds = self.rec_model._inject_whole_word_embeds(inputs_embeds, batch["whole_word_ids"])
+
+        with torch.no_grad():
+            output = self.rec_model.model(inputs_embeds=inputs_embeds, attention_mask=batch["attention_mask"],
+                                          labels=batch["labels"])
+
+        return self.rec_model._sequence_log_likelihood(output.logits, batch["labels"])[0]
+
+    def test_unsupported_model(self):
+
+        class NoCandidateScoringT5Rec(T5Rec):
+            _tokenize_candidates = AnonModelHF._tokenize_candidates
+
+        try:
+            with self.assertRaisesRegex(ValueError, "does not support candidate scoring"):
+                NoCandidateScoringT5Rec(self.checkpoint_dir.name, training_tasks_str=["SequentialSideInfoTask"],
+                                        all_unique_labels=self.dataset.all_items.tolist(),
+                                        items_meta_dict=self.dataset.items_meta_dict, candidate_scoring=True)
+        finally:
+            # the class defined is automatically registered among the models available
+            T5Rec.str_alias_cls.pop("NoCandidateScoringT5Rec")
+
+
+class TestGPT2CandidateScoring(CandidateScoringMixin, unittest.TestCase):
+
+    model_cls_name = "GPT2Rec"
+    model_kwargs = {"inject_whole_word_embeds": True}
+
+    def full_sequence_score(self, tokenized_sample: dict) -> torch.Tensor:
+
+        # prompt and target in a single sequence with no padding and no kv cache, as in training
+        batch = self.rec_model.prepare_input(Dataset.from_dict(tokenized_sample).with_format("torch")[:])
+
+        inputs_embeds = self.rec_model.model.transformer.wte(batch["total_input_ids"])
+        inputs_embeds = self.rec_model._inject_whole_word_embeds(inputs_embeds, batch["total_whole_word_ids"])
+
+        with torch.no_grad():
+            logits = self.rec_model.model(inputs_embeds=inputs_embeds,
+                                          attention_mask=batch["total_attention_mask"]).logits
+
+        # only tokens of the target are scored, the i-th token is predicted by the logits of the previous one
+        labels = batch["total_labels"].clone()
+        labels[:, :batch["input_prompt_ids"].shape[1]] = -100
+
+        return self.rec_model._sequence_log_likelihood(logits[:, :-1], labels[:, 1:])[0]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+import os
+import tempfile
+import unittest
+
+import torch
+from torch import nn
+
+from src.data.abstract_task import AnonTask
+from src.model import AnonModel
+from src.model.quantization import (WeightOnlyQuantizedLinear, quantize_model, QUANTIZATION_MODES,
+                                    QUANTIZED_WEIGHTS_NAME, QUANTIZATION_CONFIG_NAME)
+from tests.tiny_models import tiny_dataset, build_tiny_checkpoint, tiny_rec_model
+
+
+class TestWeightOnlyQuantizedLinear(unittest.TestCase):
+
+    def test_invalid_parameters(self):
+
+        with self.assertRaises(ValueError):
+            WeightOnlyQuantizedLinear(8, 4, n_bits=2)
+
+        with self.assertRaises(ValueError):
+            WeightOnlyQuantizedLinear(7, 4, n_bits=4)
+
+    def test_int4_pack_unpack(self):
+
+        # each group contains its max absolute value 7, so that all integer weights are represented exactly
+        int_weight = torch.randint(-7, 8, (3, 8))
+        int_weight[:, 0] = 7
+        int_weight[:, 4] = -7
+
+        linear = nn.Linear(8, 3)
+        with torch.no_grad():
+            linear.weight.copy_(int_weight * 0.5)
+
+        quantized = WeightOnlyQuantizedLinear.from_linear(linear, n_bits=4, group_size=4)
+
+        # two weights are packed into each byte
+        self.assertEqual(quantized.qweight.shape, (3, 4))
+        self.assertEqual(quantized.qweight.dtype, torch.int8)
+
+        low_weights, high_weights = (quantized.qweight << 4) >> 4, quantized.qweight >> 4
+        torch.testing.assert_close(low_weights.long(), int_weight[:, 0::2])
+        torch.testing.assert_close(high_weights.long(), int_weight[:, 1::2])
+
+        torch.testing.assert_close(quantized.dequantize_weight(), linear.weight.detach())
+        torch.testing.assert_close(quantized.bias, linear.bias.detach())
+
+    def test_int4_negative_extremes(self):
+
+        # -8 is the smallest 4 bits value, its sign must be preserved when unpacking
+        int_weight = torch.tensor([[-8, 7, -1, 0], [0, -8, 1, -1]])
+
+        quantized = WeightOnlyQuantizedLinear(4, 2, n_bits=4, group_size=4)
+        quantized.qweight.copy_((int_weight[:, 0::2] & 0x0F) | (int_weight[:, 1::2] << 4))
+
+        torch.testing.assert_close(quantized.dequantize_weight(), int_weight.float())
+
+    def test_dequantize_error_bound(self):
+
+        torch.manual_seed(0)
+
+        for n_bits in [8, 4]:
+            for in_features, group_size in [(64, 16), (64, 64), (48, 32)]:
+                with self.subTest(n_bits=n_bits, in_features=in_features, group_size=group_size):
+
+                    linear = nn.Linear(in_features, 16)
+                    quantized = WeightOnlyQuantizedLinear.from_linear(linear, n_bits=n_bits, group_size=group_size)
+
+                    # a single scale for each output feature if in_features is not divisible by group_size
+                    expected_group_size = group_size if in_features % group_size == 0 else in_features
+                    self.assertEqual(quantized.scales.shape, (16, in_features // expected_group_size))
+
+                    # rounding error is at most half of the scale of the group
+                    scales = quantized.scales.repeat_interleave(expected_group_size, dim=1)
+                    error = (quantized.dequantize_weight() - linear.weight.detach()).abs()
+                    self.assertTrue(torch.all(error <= scales / 2 + 1e-6))
+
+                    x = torch.randn(5, in_features)
+                    output_error = (quantized(x) - linear(x).detach()).abs()
+                    self.assertTrue(torch.all(output_error <= (x.abs() @ (scales / 2).T) + 1e-5))
+
+    def test_quantize_model(self):
+
+        model = nn.Sequential(nn.Linear(8, 8), nn.ReLU(), nn.Linear(8, 3), nn.Linear(3, 2))
+
+        with self.assertRaises(ValueError):
+            quantize_model(model, "int2")
+
+        quantize_model(model, "int4_weight_only", group_size=4)
+
+        self.assertIsInstance(model[0], WeightOnlyQuantizedLinear)
+        self.assertIsInstance(model[2], WeightOnlyQuantizedLinear)
+        self.assertEqual(model[0].n_bits, 4)
+
+        # layers with an odd n° of input features can't be packed, they are kept in full precision
+        self.assertIsInstance(model[3], nn.Linear)
+        self.assertFalse(model.training)
+
+
+class QuantizedModelMixin:
+
+    model_cls_name: str = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+
+        cls.dataset = tiny_dataset()
+        cls.checkpoint_dir = build_tiny_checkpoint(cls.model_cls_name, cls.dataset,
+                                                   os.path.join(cls.tmp_dir.name, "checkpoint"))
+
+        task = AnonTask.from_string("SequentialSideInfoTask").force_template(0)
+        samples = cls.dataset.get_hf_datasets()["test"].select(range(2)).to_list()
+        cls.input_text = [task(**sample, items_meta_dict=cls.dataset.items_meta_dict,
+                               catalog_items=cls.dataset.all_items)[0].input_text
+                          for sample in samples]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def test_save_load_round_trip(self):
+
+        for mode in QUANTIZATION_MODES:
+            with self.subTest(quantize=mode):
+
+                rec_model = tiny_rec_model(self.model_cls_name, self.dataset, self.checkpoint_dir, quantize=mode)
+                predictions = rec_model.inference(self.input_text, num_beams=2, num_return_sequences=2,
+                                                  max_new_tokens=5)
+
+                output_dir = os.path.join(self.tmp_dir.name, f"quantized_{mode}")
+                os.makedirs(output_dir)
+                rec_model.save(output_dir)
+
+                # quantized weights are saved in their own format, together with the quantization used
+                self.assertTrue(os.path.isfile(os.path.join(output_dir, QUANTIZED_WEIGHTS_NAME)))
+                self.assertTrue(os.path.isfile(os.path.join(output_dir, QUANTIZATION_CONFIG_NAME)))
+
+                model_cls = AnonModel.model_exists(self.model_cls_name, return_bool=False)
+                loaded_model = model_cls.load(output_dir)
+                loaded_model.eval()
+
+                self.assertEqual(loaded_model.quantization, mode)
+                self.assertEqual(loaded_model.inference(self.input_text, num_beams=2, num_return_sequences=2,
+                                                        max_new_tokens=5), predictions)
+
+                # weights quantized in a way can't be loaded into a model quantized differently
+                other_mode = next(other_mode for other_mode in QUANTIZATION_MODES if other_mode != mode)
+                with self.assertRaises(ValueError):
+                    model_cls.load(output_dir, quantize=other_mode)
+
+    def test_quantized_model_cant_be_trained(self):
+
+        rec_model = tiny_rec_model(self.model_cls_name, self.dataset, self.checkpoint_dir,
+                                   quantize="int8_weight_only")
+
+        with self.assertRaisesRegex(ValueError, "can't be trained"):
+            rec_model.train()
+
+        # eval mode is still allowed
+        rec_model.eval()
+
+    def test_int8_only_on_cpu(self):
+
+        rec_model = tiny_rec_model(self.model_cls_name, self.dataset, self.checkpoint_dir,
+                                   inject_whole_word_embeds=True, quantize="int8")
+
+        with self.assertRaisesRegex(ValueError, "can only run on cpu"):
+            rec_model.to("cuda")
+
+        # nothing is moved if the device is not supported
+        self.assertTrue(all(param.device.type == "cpu"
+                            for component in rec_model.named_components().values()
+                            for param in component.parameters()))
+
+        rec_model.to("cpu")
+
+
+class TestT5Quantization(QuantizedModelMixin, unittest.TestCase):
+    model_cls_name = "T5Rec"
+
+
+class TestGPT2Quantization(QuantizedModelMixin, unittest.TestCase):
+    model_cls_name = "GPT2Rec"
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,377 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import torch
+
+from src.instrumentation import INSTRUMENTATION
+from src.model.trainer import RecTrainer, _TrainStepModule
+from src.utils import AsyncWandbLogger, seed_everything
+from tests.distributed import run_distributed
+from tests.tiny_models import tiny_dataset, build_tiny_checkpoint, tiny_rec_model
+
+
+class _Preempted(Exception):
+    pass
+
+
+def _distributed_train(rank: int, checkpoint_dir: str, output_dir: str, results_dir: str):
+
+    dataset = tiny_dataset()
+    hf_datasets = dataset.get_hf_datasets()
+
+    seed_everything(42)
+    rec_model = tiny_rec_model("T5Rec", dataset, checkpoint_dir)
+    trainer = RecTrainer(rec_model, n_epochs=2, batch_size=4, train_sampling_fn=dataset.sample_train_sequence,
+                         output_dir=output_dir, checkpoint_every_n_steps=3)
+
+    # weights are recorded at each validation, to check that they are the same in all processes
+    validated_state_dicts = []
+    val_results = []
+    evaluate_task = trainer.rec_evaluator.evaluate_task
+
+    def recording_evaluate_task(*args, **kwargs):
+        validated_state_dicts.append(trainer._snapshot_state_dict())
+        val_results.append(evaluate_task(*args, **kwargs))
+        return val_results[-1]
+
+    trainer.rec_evaluator.evaluate_task = recording_evaluate_task
+
+    # batches of the train steps only (model in train mode), not the validation ones
+    n_train_batches = 0
+    prepare_input = rec_model.prepare_input
+
+    def counting_prepare_input(batch):
+        nonlocal n_train_batches
+        n_train_batches += rec_model.model.training
+        return prepare_input(batch)
+
+    rec_model.prepare_input = counting_prepare_input
+
+    ddp_cls = torch.nn.parallel.DistributedDataParallel
+    with mock.patch("torch.nn.parallel.DistributedDataParallel", wraps=ddp_cls) as ddp, \
+            mock.patch.object(rec_model, "save_static", wraps=rec_model.save_static) as save_static, \
+            mock.patch.object(rec_model, "save_weights", wraps=rec_model.save_weights) as save_weights, \
+            mock.patch.object(trainer, "_save_checkpoint", wraps=trainer._save_checkpoint) as save_checkpoint:
+        trained_model = trainer.train(hf_datasets["train"], validation_dataset=hf_datasets["validation"])
+
+    torch.save({
+        "ddp_module_cls": [type(call.args[0]) for call in ddp.call_args_list],
+        "n_train_batches": n_train_batches,
+        "n_save_static": save_static.call_count,
+        "n_save_weights": save_weights.call_count,
+        "n_save_checkpoint": save_checkpoint.call_count,
+        "validated_state_dicts": validated_state_dicts,
+        "val_results": val_results,
+        "final_state_dict": trained_model.state_dict()
+    }, os.path.join(results_dir, f"rank_{rank}.pth"))
+
+
+class TestRecTrainer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+
+        cls.dataset = tiny_dataset()
+        cls.checkpoint_dir = build_tiny_checkpoint("T5Rec", cls.dataset, os.path.join(cls.tmp_dir.name, "tiny_t5"))
+
+        hf_datasets = cls.dataset.get_hf_datasets()
+        cls.train_set = hf_datasets["train"]
+        cls.val_set = hf_datasets["validation"]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def _trainer(self, output_dir: str, **trainer_kwargs) -> RecTrainer:
+
+        # each trainer starts from the same initial weights and random state
+        seed_everything(42)
+        rec_model = tiny_rec_model("T5Rec", self.dataset, self.checkpoint_dir)
+
+        trainer_kwargs = {"n_epochs": 2, "batch_size": 8, **trainer_kwargs}
+        trainer = RecTrainer(rec_model,
+                             train_sampling_fn=self.dataset.sample_train_sequence,
+                             output_dir=os.path.join(self.tmp_dir.name, output_dir),
+                             **trainer_kwargs)
+
+        # logs are inspected to check the loss of each epoch
+        trainer.logger = mock.Mock(spec=AsyncWandbLogger)
+
+        return trainer
+
+    @staticmethod
+    def _epoch_losses(trainer: RecTrainer) -> list:
+        return [call.args[0]["train/loss"] for call in trainer.logger.log.call_args_list
+                if "train/epoch" in call.args[0]]
+
+    @staticmethod
+    def _interrupt_after(trainer: RecTrainer, n_train_steps: int):
+
+        # train steps only are counted, batches prepared by the validation (model in eval mode) are not
+        rec_model = trainer.rec_model
+        original_prepare_input = rec_model.prepare_input
+        n_steps_performed = 0
+
+        def prepare_input(batch):
+            nonlocal n_steps_performed
+
+            if rec_model.model.training:
+                if n_steps_performed == n_train_steps:
+                    raise _Preempted
+
+                n_steps_performed += 1
+
+            return original_prepare_input(batch)
+
+        rec_model.prepare_input = prepare_input
+
+    @staticmethod
+    def _mock_validation(trainer: RecTrainer, val_losses: list) -> list:
+
+        # each validation returns the next loss of `val_losses`, the weights validated each time are recorded
+        val_losses = iter(val_losses)
+        validated_state_dicts = []
+
+        def evaluate_task(*args, **kwargs):
+            validated_state_dicts.append(trainer._snapshot_state_dict())
+            return {"Loss": next(val_losses)}
+
+        trainer.rec_evaluator.evaluate_task = evaluate_task
+
+        return validated_state_dicts
+
+    def assert_model_weights(self, rec_model, expected_state_dict: dict):
+        for name, tensor in rec_model.state_dict()["model"].items():
+            torch.testing.assert_close(tensor, expected_state_dict["model"][name])
+
+    def test_resume_matches_uninterrupted_training(self):
+
+        trainer = self._trainer("uninterrupted")
+        trained_model = trainer.train(self.train_set, validation_dataset=self.val_set)
+
+        # interrupted in the middle of the 2nd epoch, a few steps after the last checkpoint
+        interrupted_trainer = self._trainer("interrupted", checkpoint_every_n_steps=4)
+        self._interrupt_after(interrupted_trainer, n_train_steps=trainer.best_step - 3)
+
+        with self.assertRaises(_Preempted):
+            interrupted_trainer.train(self.train_set, validation_dataset=self.val_set)
+
+        resumed_trainer = self._trainer("interrupted", checkpoint_every_n_steps=4)
+        resumed_model = resumed_trainer.train(self.train_set, validation_dataset=self.val_set, resume=True)
+
+        self.assertEqual(resumed_trainer.best_epoch, trainer.best_epoch)
+        self.assertEqual(resumed_trainer.best_step, trainer.best_step)
+        self.assertAlmostEqual(resumed_trainer.best_val_monitor_result, trainer.best_val_monitor_result)
+
+        # the epoch completed before the interruption is not repeated
+        expected_losses = self._epoch_losses(trainer)
+        self.assertEqual(len(self._epoch_losses(resumed_trainer)), 1)
+        resumed_losses = self._epoch_losses(interrupted_trainer) + self._epoch_losses(resumed_trainer)
+        for resumed_loss, expected_loss in zip(resumed_losses, expected_losses, strict=True):
+            self.assertAlmostEqual(resumed_loss, expected_loss, places=5)
+
+        expected_state_dict = trained_model.state_dict()
+        for component_name, component_state in resumed_model.state_dict().items():
+            for name, tensor in component_state.items():
+                torch.testing.assert_close(tensor, expected_state_dict[component_name][name])
+
+    def test_checkpoint_waits_for_best_weights(self):
+
+        trainer = self._trainer("slow_saver", n_epochs=1, checkpoint_every_n_steps=1000)
+
+        events = []
+        original_save_weights = trainer.rec_model.save_weights
+
+        def slow_save_weights(*args, **kwargs):
+            time.sleep(0.5)
+            original_save_weights(*args, **kwargs)
+            events.append("weights")
+
+        trainer.rec_model.save_weights = slow_save_weights
+
+        # the checkpoint saved at the end of the epoch refers to the best weights found by its validation
+        with mock.patch("src.model.trainer.atomic_torch_save",
+                        side_effect=lambda *args: events.append("checkpoint")):
+            trainer.train(self.train_set, validation_dataset=self.val_set)
+
+        self.assertEqual(events, ["weights", "checkpoint"])
+
+    def test_validation_loss_instrumentation(self):
+
+        trainer = self._trainer("instrumentation", n_epochs=1)
+
+        INSTRUMENTATION.enable()
+        try:
+            stats_snapshot = INSTRUMENTATION.snapshot()
+            trainer.train(self.train_set, validation_dataset=self.val_set)
+            summary = INSTRUMENTATION.summary(since=stats_snapshot)
+        finally:
+            INSTRUMENTATION.disable()
+
+        # the validation loss is not recorded as a train step: 60 train samples, 20 validation users
+        self.assertEqual(summary["train_step"]["n_samples"], 60)
+        self.assertEqual(summary["eval/loss_step"]["n_samples"], 20)
+        self.assertNotIn("generate_step", summary)
+
+    def test_snapshot_state_dict(self):
+
+        trainer = self._trainer("snapshot")
+        snapshot = trainer._snapshot_state_dict()
+
+        # the snapshot is a copy on cpu, not modified by the next training steps
+        with torch.no_grad():
+            for parameter in trainer.rec_model.model.parameters():
+                parameter.add_(1.)
+
+        state_dict = trainer.rec_model.state_dict()
+        self.assertEqual(snapshot.keys(), state_dict.keys())
+        for name, tensor in snapshot["model"].items():
+            self.assertEqual(tensor.device, torch.device("cpu"))
+            torch.testing.assert_close(tensor + 1., state_dict["model"][name])
+
+    def test_best_weights_restored(self):
+
+        trainer = self._trainer("best_weights", n_epochs=3)
+
+        # the 2nd epoch is the best one
+        validated_state_dicts = self._mock_validation(trainer, val_losses=[2., 1., 3.])
+
+        rec_model_cls = type(trainer.rec_model)
+        with mock.patch.object(trainer.rec_model, "save_static", wraps=trainer.rec_model.save_static) as save_static, \
+                mock.patch.object(trainer.rec_model, "save_weights",
+                                  wraps=trainer.rec_model.save_weights) as save_weights, \
+                mock.patch.object(rec_model_cls, "load", wraps=rec_model_cls.load) as load:
+            trained_model = trainer.train(self.train_set, validation_dataset=self.val_set)
+
+        self.assertEqual(trainer.best_epoch, 2)
+
+        # static artifacts are written once, weights each time a better model is found
+        save_static.assert_called_once()
+        self.assertEqual(save_weights.call_count, 2)
+
+        # best weights are restored from memory, not from disk
+        load.assert_not_called()
+        best_state_dict, last_state_dict = validated_state_dicts[1], validated_state_dicts[2]
+        self.assert_model_weights(trained_model, best_state_dict)
+
+        self.assertFalse(all(torch.equal(tensor, last_state_dict["model"][name])
+                             for name, tensor in trained_model.state_dict()["model"].items()))
+
+        # and they are the ones saved on disk
+        self.assert_model_weights(rec_model_cls.load(trainer.output_dir), best_state_dict)
+
+    def test_patience(self):
+
+        trainer = self._trainer("patience", n_epochs=5, patience=2)
+
+        # no improvement at the 3rd and 4th epoch
+        validated_state_dicts = self._mock_validation(trainer, val_losses=[3., 2., 2.5, 2.1, 1.])
+        trained_model = trainer.train(self.train_set, validation_dataset=self.val_set)
+
+        self.assertEqual(len(validated_state_dicts), 4)
+        self.assertEqual(len(self._epoch_losses(trainer)), 4)
+
+        self.assertEqual(trainer.best_epoch, 2)
+        self.assertEqual(trainer.best_val_monitor_result, 2.)
+        self.assert_model_weights(trained_model, validated_state_dicts[1])
+
+    def test_min_delta(self):
+
+        trainer = self._trainer("min_delta", n_epochs=3, patience=1, min_delta=0.5)
+
+        # the 2nd epoch is better than the 1st one, but by less than min_delta
+        validated_state_dicts = self._mock_validation(trainer, val_losses=[3., 2.8, 1.])
+        trained_model = trainer.train(self.train_set, validation_dataset=self.val_set)
+
+        self.assertEqual(len(validated_state_dicts), 2)
+
+        self.assertEqual(trainer.best_epoch, 1)
+        self.assertEqual(trainer.best_val_monitor_result, 3.)
+        self.assert_model_weights(trained_model, validated_state_dicts[0])
+
+    def test_val_every_n_steps(self):
+
+        trainer = self._trainer("val_every_n_steps", n_epochs=2, val_every_n_steps=3)
+
+        validated_state_dicts = self._mock_validation(trainer, val_losses=[5., 4., 1., 2., 3.])
+        trained_model = trainer.train(self.train_set, validation_dataset=self.val_set)
+
+        # 2 epochs of 8 steps: validation is performed at steps 3, 6, 9, 12, 15 and not at the end of the epochs
+        val_steps = [call.args[0]["val/step"] for call in trainer.logger.log.call_args_list
+                     if "val/step" in call.args[0]]
+        self.assertEqual(val_steps, [3, 6, 9, 12, 15])
+        self.assertEqual(len(validated_state_dicts), 5)
+
+        self.assertEqual(trainer.best_epoch, 2)
+        self.assertEqual(trainer.best_step, 9)
+        self.assert_model_weights(trained_model, validated_state_dicts[2])
+
+    def test_max_train_minutes(self):
+
+        trainer = self._trainer("max_train_minutes", n_epochs=2, max_train_minutes=1)
+        validated_state_dicts = self._mock_validation(trainer, val_losses=[1., 1.])
+
+        # 30 seconds pass each time the trainer reads the clock, so the time limit is reached after a few steps
+        clock = iter(range(0, 10 ** 6, 30))
+        mocked_time = mock.Mock(wraps=time, time=lambda: next(clock))
+
+        rec_model = trainer.rec_model
+        with mock.patch("src.model.trainer.time", mocked_time), \
+                mock.patch.object(rec_model, "train_step", wraps=rec_model.train_step) as train_step:
+            trained_model = trainer.train(self.train_set, validation_dataset=self.val_set)
+
+        # training is stopped in the middle of the first epoch, before any validation
+        self.assertLess(train_step.call_count, 8)
+        self.assertEqual(validated_state_dicts, [])
+        self.assertIsNone(trainer.best_epoch)
+
+        # thus the last model is saved and returned
+        self.assert_model_weights(rec_model.load(trainer.output_dir), trained_model.state_dict())
+
+
+
+class TestDistributedRecTrainer(unittest.TestCase):
+
+    def test_two_processes(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            checkpoint_dir = build_tiny_checkpoint("T5Rec", tiny_dataset(), os.path.join(tmp_dir, "tiny_t5"))
+            output_dir = os.path.join(tmp_dir, "output")
+            os.makedirs(output_dir)
+
+            run_distributed(_distributed_train, 2, checkpoint_dir, output_dir, tmp_dir)
+
+            results = [torch.load(os.path.join(tmp_dir, f"rank_{rank}.pth"), weights_only=False)
+                       for rank in range(2)]
+
+            self.assertIn("trainer_checkpoint.pth", os.listdir(output_dir))
+
+        for rank_results in results:
+            self.assertEqual(rank_results["ddp_module_cls"], [_TrainStepModule])
+
+        # each process trains on a different shard of the train set, performing the same n° of steps
+        self.assertEqual(results[0]["n_train_batches"], results[1]["n_train_batches"])
+        self.assertGreater(results[0]["n_train_batches"], 0)
+
+        # only the main process writes files
+        self.assertEqual([rank_results["n_save_static"] for rank_results in results], [1, 0])
+        self.assertEqual(results[1]["n_save_weights"], 0)
+        self.assertEqual(results[1]["n_save_checkpoint"], 0)
+        self.assertGreater(results[0]["n_save_weights"], 0)
+        self.assertGreater(results[0]["n_save_checkpoint"], 0)
+
+        # processes are in sync: same weights when validating, same validation results, same final model
+        self.assertEqual(results[0]["val_results"], results[1]["val_results"])
+        self.assertEqual(len(results[0]["validated_state_dicts"]), 2)
+        for state_dict, other_state_dict in zip(results[0]["validated_state_dicts"] + [results[0]["final_state_dict"]],
+                                                results[1]["validated_state_dicts"] + [results[1]["final_state_dict"]]):
+            for name, tensor in state_dict["model"].items():
+                torch.testing.assert_close(tensor, other_state_dict["model"][name])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,243 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import datasets
+import pyarrow.parquet as pq
+
+from src.data.abstract_task import AnonTask
+from src.evaluate.predictions import sync_manifest
+from src.serve.batch_predict import (iter_input_chunks, top_k_distinct, save_part, merge_parts, predict_parts,
+                                     predict_chunk, get_part_path, build_predict_manifest, _worker_main)
+from tests.tiny_models import tiny_dataset, build_tiny_checkpoint, tiny_rec_model
+
+
+def read_output(path: str) -> tuple[list[str], list[list[str]]]:
+
+    if path.endswith(".parquet"):
+        table = pq.read_table(path).to_pydict()
+        return table["user_id"], table["recommendations"]
+
+    with open(path) as f:
+        rows = [json.loads(line) for line in f]
+
+    return [row["user_id"] for row in rows], [row["recommendations"] for row in rows]
+
+
+class TestBatchPredictIO(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_iter_input_chunks_dataset(self):
+
+        input_source = datasets.Dataset.from_dict({"user_id": [f"user_{i}" for i in range(7)],
+                                                   "input_item_seq": [[f"item_{i}"] for i in range(7)]})
+
+        chunks = list(iter_input_chunks(input_source, chunk_size=3))
+
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+        self.assertEqual(chunks[0][0], {"user_id": "user_0", "input_item_seq": ["item_0"]})
+        self.assertEqual([sample["user_id"] for chunk in chunks for sample in chunk],
+                         [f"user_{i}" for i in range(7)])
+
+    def test_iter_input_chunks_jsonl(self):
+
+        input_path = os.path.join(self.tmp_dir.name, "input.jsonl")
+        with open(input_path, "w") as f:
+            for i in range(6):
+                f.write(json.dumps({"user_id": f"user_{i}"}) + "\n")
+                # blank lines are skipped
+                if i == 2:
+                    f.write("\n")
+
+        chunks = list(iter_input_chunks(input_path, chunk_size=3))
+
+        self.assertEqual([[sample["user_id"] for sample in chunk] for chunk in chunks],
+                         [["user_0", "user_1", "user_2"], ["user_3", "user_4", "user_5"]])
+
+    def test_top_k_distinct(self):
+
+        predictions = ["item_1", "item_2", "item_1", "item_3", "item_2", "item_4"]
+
+        # order of the first occurrence is kept
+        self.assertEqual(top_k_distinct(predictions), ["item_1", "item_2", "item_3", "item_4"])
+        self.assertEqual(top_k_distinct(predictions, top_k=3), ["item_1", "item_2", "item_3"])
+        self.assertEqual(top_k_distinct(predictions, top_k=10), ["item_1", "item_2", "item_3", "item_4"])
+        self.assertEqual(top_k_distinct([], top_k=3), [])
+
+    def test_save_merge_parts(self):
+
+        for output_format in [".parquet", ".jsonl"]:
+            with self.subTest(output_format=output_format):
+
+                parts = [(["user_0", "user_1"], [["item_1", "item_2"], ["item_3"]]),
+                         (["user_2"], [["item_4", "item_5"]])]
+
+                part_paths = []
+                for chunk_idx, (user_ids, recommendations) in enumerate(parts):
+                    part_path = get_part_path(self.tmp_dir.name, chunk_idx, output_format)
+                    save_part(part_path, user_ids, recommendations)
+
+                    self.assertEqual(read_output(part_path), (user_ids, recommendations))
+                    part_paths.append(part_path)
+
+                output_path = os.path.join(self.tmp_dir.name, f"output{output_format}")
+                merge_parts(output_path, part_paths)
+
+                self.assertEqual(read_output(output_path), (["user_0", "user_1", "user_2"],
+                                                            [["item_1", "item_2"], ["item_3"], ["item_4", "item_5"]]))
+
+                # no temporary file is left behind
+                self.assertFalse(any(file_name.endswith(".tmp") for file_name in os.listdir(self.tmp_dir.name)))
+
+    def test_merge_no_parts(self):
+
+        for output_format in [".parquet", ".jsonl"]:
+            with self.subTest(output_format=output_format):
+
+                output_path = os.path.join(self.tmp_dir.name, f"output{output_format}")
+                merge_parts(output_path, [])
+
+                self.assertEqual(read_output(output_path), ([], []))
+
+    def test_save_part_atomic(self):
+
+        part_path = get_part_path(self.tmp_dir.name, 0, ".jsonl")
+        save_part(part_path, ["user_0"], [["item_1"]])
+
+        # a failure while writing leaves the part previously saved untouched
+        with mock.patch("src.serve.batch_predict.json.dumps", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                save_part(part_path, ["user_1"], [["item_2"]])
+
+        self.assertEqual(read_output(part_path), (["user_0"], [["item_1"]]))
+
+    def test_resume(self):
+
+        input_source = datasets.Dataset.from_dict({"user_id": [f"user_{i}" for i in range(5)]})
+        rec_model = mock.MagicMock()
+        task = AnonTask.from_string("SequentialSideInfoTask")
+
+        # part of an interrupted run
+        save_part(get_part_path(self.tmp_dir.name, 0, ".jsonl"), ["user_0", "user_1"], [["saved"], ["saved"]])
+
+        def predict_chunk_mock(rec_model, task, samples, batch_size, top_k):
+            return [sample["user_id"] for sample in samples], [["generated"]] * len(samples)
+
+        with mock.patch("src.serve.batch_predict.predict_chunk", side_effect=predict_chunk_mock) as predicted:
+            predict_parts(rec_model, task, input_source, self.tmp_dir.name, ".jsonl", batch_size=1, chunk_size=2)
+
+        # the part already saved is skipped, the others are generated
+        self.assertEqual(predicted.call_count, 2)
+        self.assertEqual(read_output(get_part_path(self.tmp_dir.name, 0, ".jsonl"))[1], [["saved"], ["saved"]])
+        self.assertEqual(read_output(get_part_path(self.tmp_dir.name, 1, ".jsonl")),
+                         (["user_2", "user_3"], [["generated"], ["generated"]]))
+        self.assertEqual(read_output(get_part_path(self.tmp_dir.name, 2, ".jsonl")),
+                         (["user_4"], [["generated"]]))
+
+    def test_workers_split_chunks(self):
+
+        input_source = datasets.Dataset.from_dict({"user_id": [f"user_{i}" for i in range(5)]})
+        task = AnonTask.from_string("SequentialSideInfoTask")
+
+        def predict_chunk_mock(rec_model, task, samples, batch_size, top_k):
+            return [sample["user_id"] for sample in samples], [[]] * len(samples)
+
+        # each worker generates one chunk every n_workers
+        with mock.patch("src.serve.batch_predict.predict_chunk", side_effect=predict_chunk_mock):
+            predict_parts(mock.MagicMock(), task, input_source, self.tmp_dir.name, ".jsonl", batch_size=1,
+                          chunk_size=1, worker_idx=1, n_workers=2)
+
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)),
+                         [os.path.basename(get_part_path(self.tmp_dir.name, chunk_idx, ".jsonl"))
+                          for chunk_idx in [1, 3]])
+
+    def test_manifest_change(self):
+
+        parts_dir = os.path.join(self.tmp_dir.name, "output_parts")
+        task = AnonTask.from_string("SequentialSideInfoTask")
+        manifest = build_predict_manifest("hash", {"num_beams": 2}, task, None, "input", chunk_size=10, top_k=5)
+
+        self.assertFalse(sync_manifest(parts_dir, manifest))
+        save_part(get_part_path(parts_dir, 0, ".jsonl"), ["user_0"], [["item_1"]])
+
+        # same run, parts are reused
+        self.assertTrue(sync_manifest(parts_dir, manifest))
+        self.assertTrue(os.path.isfile(get_part_path(parts_dir, 0, ".jsonl")))
+
+        # parts generated differently are deleted
+        changed_manifest = build_predict_manifest("hash", {"num_beams": 2}, task, None, "input",
+                                                  chunk_size=10, top_k=10)
+        self.assertFalse(sync_manifest(parts_dir, changed_manifest))
+        self.assertFalse(os.path.isfile(get_part_path(parts_dir, 0, ".jsonl")))
+
+    def test_worker_threads(self):
+
+        model_cls = mock.MagicMock()
+
+        with mock.patch("src.serve.batch_predict.AnonModel.model_exists", return_value=model_cls), \
+                mock.patch("src.serve.batch_predict.predict_parts") as predict_parts_mock, \
+                mock.patch("src.serve.batch_predict.os.cpu_count", return_value=8), \
+                mock.patch("src.serve.batch_predict.torch.set_num_threads") as set_num_threads:
+
+            # cpu cores are split among workers
+            _worker_main(0, 3, "T5Rec", "model_path", {}, "cpu", 42, mock.MagicMock(), {})
+            set_num_threads.assert_called_with(2)
+
+            # each worker uses at least one thread
+            _worker_main(0, 16, "T5Rec", "model_path", {}, "cpu", 42, mock.MagicMock(), {})
+            set_num_threads.assert_called_with(1)
+
+        self.assertEqual(predict_parts_mock.call_count, 2)
+
+
+class TestPredictChunk(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.checkpoint_dir = tempfile.TemporaryDirectory()
+
+        cls.dataset = tiny_dataset()
+        build_tiny_checkpoint("T5Rec", cls.dataset, cls.checkpoint_dir.name)
+
+        cls.rec_model = tiny_rec_model("T5Rec", cls.dataset, cls.checkpoint_dir.name,
+                                       num_beams=4, num_return_sequences=4)
+        cls.samples = cls.dataset.get_hf_datasets()["test"].select(range(5)).to_list()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.checkpoint_dir.cleanup()
+
+    def test_predict_chunk(self):
+
+        task = AnonTask.from_string("SequentialSideInfoTask").force_template(0)
+
+        user_ids, recommendations = predict_chunk(self.rec_model, task, self.samples, batch_size=2, top_k=3)
+
+        self.assertEqual(user_ids, [sample["user_id"] for sample in self.samples])
+        self.assertEqual(len(recommendations), len(self.samples))
+        for user_recommendations in recommendations:
+            self.assertLessEqual(len(user_recommendations), 3)
+            self.assertEqual(len(set(user_recommendations)), len(user_recommendations))
+
+        # predictions don't depend on how samples are split into batches
+        self.assertEqual(predict_chunk(self.rec_model, task, self.samples, batch_size=5, top_k=3)[1], recommendations)
+
+    def test_predict_chunk_missing_fields(self):
+
+        task = AnonTask.from_string("P5EvalDirectTask")
+        samples = [{field: value for field, value in sample.items() if not field.startswith("gt_")}
+                   for sample in self.samples]
+
+        with self.assertRaises(ValueError):
+            predict_chunk(self.rec_model, task, samples, batch_size=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import unittest
+from unittest import mock
+
+from src.serve.cache import ResultCache
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_make_key(self):
+
+        prompt = {"input_ids": [1, 2, 3], "attention_mask": [1, 1, 1]}
+        key = ResultCache.make_key(prompt, {"num_beams": 2}, False)
+
+        # the order of the fields does not matter
+        self.assertEqual(key, ResultCache.make_key(dict(reversed(prompt.items())), {"num_beams": 2}, False))
+
+        self.assertNotEqual(key, ResultCache.make_key({**prompt, "input_ids": [1, 2, 4]}, {"num_beams": 2}, False))
+        self.assertNotEqual(key, ResultCache.make_key(prompt, {"num_beams": 4}, False))
+        self.assertNotEqual(key, ResultCache.make_key(prompt, {"num_beams": 2}, True))
+
+    def test_get_put(self):
+
+        cache = ResultCache()
+
+        self.assertIsNone(cache.get("a"))
+
+        cache.put("a", ["item_1", "item_2"])
+        self.assertEqual(cache.get("a"), ["item_1", "item_2"])
+
+        # putting an existing key replaces its predictions
+        cache.put("a", ["item_3"])
+        self.assertEqual(cache.get("a"), ["item_3"])
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.n_bytes, ResultCache._estimate_size("a", ["item_3"]))
+
+    def test_lru_eviction(self):
+
+        cache = ResultCache(max_entries=2)
+
+        cache.put("a", ["item_1"])
+        cache.put("b", ["item_2"])
+
+        # "a" becomes the most recently used, so "b" is evicted
+        cache.get("a")
+        cache.put("c", ["item_3"])
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), ["item_1"])
+        self.assertEqual(cache.get("c"), ["item_3"])
+        self.assertEqual(cache.evictions, 1)
+
+    def test_max_bytes(self):
+
+        entry_size = ResultCache._estimate_size("a", ["item_1"])
+        cache = ResultCache(max_bytes=2 * entry_size)
+
+        cache.put("a", ["item_1"])
+        cache.put("b", ["item_2"])
+        cache.put("c", ["item_3"])
+
+        # the size of the cache never exceeds max_bytes, least recently used entries are evicted first
+        self.assertLessEqual(cache.n_bytes, 2 * entry_size)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.evictions, 1)
+
+        # an entry which can't fit even in an empty cache is not stored, and nothing is evicted for it
+        cache.put("d", [f"item_{i}" for i in range(100)])
+
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_max_entries_zero(self):
+
+        cache = ResultCache(max_entries=0)
+        cache.put("a", ["item_1"])
+
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get("a"))
+
+    def test_ttl(self):
+
+        with mock.patch("src.serve.cache.time") as time_mock:
+            time_mock.monotonic.return_value = 100.
+
+            cache = ResultCache(ttl_seconds=10)
+            cache.put("a", ["item_1"])
+
+            time_mock.monotonic.return_value = 110.
+            self.assertEqual(cache.get("a"), ["item_1"])
+
+            # expired entries are removed when they are looked up
+            time_mock.monotonic.return_value = 110.5
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(cache.n_bytes, 0)
+
+    def test_no_ttl(self):
+
+        with mock.patch("src.serve.cache.time") as time_mock:
+            time_mock.monotonic.return_value = 0.
+
+            cache = ResultCache()
+            cache.put("a", ["item_1"])
+
+            time_mock.monotonic.return_value = 1e9
+            self.assertEqual(cache.get("a"), ["item_1"])
+
+    def test_sync_model(self):
+
+        cache = ResultCache(model_hash="hash_1")
+        cache.put("a", ["item_1"])
+
+        # same model, entries are kept
+        cache.sync_model("hash_1")
+        self.assertEqual(cache.get("a"), ["item_1"])
+
+        # predictions of a different model are stale
+        cache.sync_model("hash_2")
+        self.assertEqual(cache.model_hash, "hash_2")
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.n_bytes, 0)
+        self.assertIsNone(cache.get("a"))
+
+    def test_stats(self):
+
+        cache = ResultCache(max_entries=1)
+        self.assertIsNone(cache.stats()["hit_rate"])
+
+        cache.put("a", ["item_1"])
+        cache.get("a")
+        cache.get("b")
+        cache.put("b", ["item_2"])
+        cache.get("b")
+        cache.get("a")
+
+        self.assertEqual(cache.stats(), {
+            "entries": 1,
+            "bytes": ResultCache._estimate_size("b", ["item_2"]),
+            "hits": 2,
+            "misses": 2,
+            "hit_rate": 0.5,
+            "evictions": 1
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import tempfile
+import unittest
+
+from src.data.abstract_task import AnonTask
+from src.data.tasks.p5_tasks import P5EvalDirectTask
+from src.serve.inference import required_fields, tokenize_samples, generate_from_tokenized
+from tests.tiny_models import tiny_dataset, build_tiny_checkpoint, tiny_rec_model
+
+
+class TestInference(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.checkpoint_dir = tempfile.TemporaryDirectory()
+
+        cls.dataset = tiny_dataset()
+        build_tiny_checkpoint("T5Rec", cls.dataset, cls.checkpoint_dir.name)
+
+        cls.rec_model = tiny_rec_model("T5Rec", cls.dataset, cls.checkpoint_dir.name, candidate_scoring=True)
+
+        # user with the shortest history, so that there are enough items to sample the candidates from
+        test_set = cls.dataset.get_hf_datasets()["test"]
+        cls.sample = min(test_set, key=lambda sample: len(set(sample["input_item_seq"])))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.checkpoint_dir.cleanup()
+
+    def test_required_fields(self):
+
+        sequential_task = AnonTask.from_string("SequentialSideInfoTask")
+        self.assertFalse(any(field.startswith("gt_") for field in required_fields(sequential_task)))
+
+        # the target item is listed among the candidates of the prompt
+        self.assertIn("gt_item", required_fields(P5EvalDirectTask()))
+
+    def test_direct_task_missing_gt_item(self):
+
+        sample = {field: value for field, value in self.sample.items() if not field.startswith("gt_")}
+
+        with self.assertRaises(ValueError):
+            tokenize_samples(self.rec_model, P5EvalDirectTask().force_template("5-8"), [sample])
+
+    def test_direct_task(self):
+
+        sample = {field: value for field, value in self.sample.items()
+                  if not field.startswith("gt_") or field == "gt_item"}
+        task = P5EvalDirectTask().force_template("5-8")
+
+        tokenized_sample = tokenize_samples(self.rec_model, task, [sample], deterministic=True)
+        prompt = self.rec_model.tokenizer.decode(tokenized_sample["input_ids"][0], skip_special_tokens=True)
+
+        # no candidate is empty, and the target item is one of them
+        self.assertNotRegex(prompt, r",\s*,")
+        [candidates] = tokenized_sample["candidates"]
+        self.assertIn(sample["gt_item"][0], candidates)
+        self.assertNotIn("", candidates)
+
+        # candidates listed in the prompt are ranked
+        [recommendations] = generate_from_tokenized(self.rec_model, task, tokenized_sample)
+
+        self.assertTrue(len(recommendations) > 0)
+        self.assertTrue(set(recommendations).issubset(candidates))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import tempfile
+import unittest
+
+from src.data.abstract_task import AnonTask
+from src.serve.onnx_runtime import OnnxRecModel, T5OnnxRecModel, GPT2OnnxRecModel
+from tests.tiny_models import tiny_dataset, build_tiny_checkpoint, tiny_rec_model
+
+
+class OnnxParityMixin:
+
+    model_cls_name: str = None
+    onnx_model_cls: type[OnnxRecModel] = None
+    model_kwargs: dict = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+
+        cls.dataset = tiny_dataset()
+        checkpoint_dir = build_tiny_checkpoint(cls.model_cls_name, cls.dataset,
+                                               os.path.join(cls.tmp_dir.name, "checkpoint"))
+
+        cls.rec_model = tiny_rec_model(cls.model_cls_name, cls.dataset, checkpoint_dir, **cls.model_kwargs)
+
+        cls.onnx_dir = os.path.join(cls.tmp_dir.name, "onnx")
+        cls.rec_model.export_onnx(cls.onnx_dir)
+        cls.onnx_model = OnnxRecModel.load(cls.onnx_dir)
+
+        # prompts of different lengths, so that they are padded in the batch
+        task = AnonTask.from_string("SequentialSideInfoTask").force_template(0)
+        samples = cls.dataset.get_hf_datasets()["test"].select(range(3)).to_list()
+        cls.input_text = [task(**sample, items_meta_dict=cls.dataset.items_meta_dict,
+                               catalog_items=cls.rec_model.all_unique_labels)[0].input_text
+                          for sample in samples]
+        cls.user_id = [sample["user_id"] for sample in samples]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def inference_kwargs(self) -> dict:
+        return {}
+
+    def test_exported_files(self):
+
+        self.assertIsInstance(self.onnx_model, self.onnx_model_cls)
+        self.assertTrue(os.path.isfile(os.path.join(self.onnx_dir, "onnx_config.json")))
+        self.assertTrue(os.path.isfile(os.path.join(self.onnx_dir, "tokenizer.json")))
+
+    def test_greedy_parity(self):
+
+        torch_predictions = self.rec_model.inference(self.input_text, num_beams=1, num_return_sequences=1,
+                                                     max_new_tokens=8, **self.inference_kwargs())
+        onnx_predictions = self.onnx_model.inference(self.input_text, num_beams=1, num_return_sequences=1,
+                                                     max_new_tokens=8, **self.inference_kwargs())
+
+        self.assertEqual(onnx_predictions, torch_predictions)
+
+    def test_beam_search_parity(self):
+
+        torch_predictions = self.rec_model.inference(self.input_text, num_beams=4, num_return_sequences=4,
+                                                     max_new_tokens=8, **self.inference_kwargs())
+        onnx_predictions = self.onnx_model.inference(self.input_text, num_beams=4, num_return_sequences=4,
+                                                     max_new_tokens=8, **self.inference_kwargs())
+
+        self.assertEqual(onnx_predictions, torch_predictions)
+
+    def test_num_return_sequences_greater_than_num_beams(self):
+
+        with self.assertRaises(ValueError):
+            self.onnx_model.inference(self.input_text, num_beams=2, num_return_sequences=4,
+                                      **self.inference_kwargs())
+
+
+class TestT5OnnxRecModel(OnnxParityMixin, unittest.TestCase):
+
+    model_cls_name = "T5Rec"
+    onnx_model_cls = T5OnnxRecModel
+    model_kwargs = {"inject_whole_word_embeds": True, "inject_user_embeds": True}
+
+    def inference_kwargs(self) -> dict:
+        return {"user_id": self.user_id}
+
+    def test_unknown_user(self):
+
+        with self.assertRaises(KeyError):
+            self.onnx_model.inference(self.input_text[0], user_id="unknown_user")
+
+        # users must be given when user embeddings are injected
+        with self.assertRaises(ValueError):
+            self.onnx_model.inference(self.input_text[0])
+
+
+class TestGPT2OnnxRecModel(OnnxParityMixin, unittest.TestCase):
+
+    model_cls_name = "GPT2Rec"
+    onnx_model_cls = GPT2OnnxRecModel
+    model_kwargs = {"inject_whole_word_embeds": True}
+
+    def test_return_only_target_parity(self):
+
+        torch_predictions = self.rec_model.inference(self.input_text, num_beams=4, num_return_sequences=2,
+                                                     max_new_tokens=8, return_only_target=True)
+        onnx_predictions = self.onnx_model.inference(self.input_text, num_beams=4, num_return_sequences=2,
+                                                     max_new_tokens=8, return_only_target=True)
+
+        self.assertEqual(onnx_predictions, torch_predictions)
+
+        # as in torch, by default generated texts are preceded by their prompt
+        torch_full_predictions = self.rec_model.inference(self.input_text, num_beams=4, num_return_sequences=2,
+                                                          max_new_tokens=8)
+        onnx_full_predictions = self.onnx_model.inference(self.input_text, num_beams=4, num_return_sequences=2,
+                                                          max_new_tokens=8)
+
+        self.assertEqual(onnx_full_predictions, torch_full_predictions)
+        self.assertTrue(all(full_prediction.endswith(prediction)
+                            for sample_full, sample_targets in zip(onnx_full_predictions, onnx_predictions)
+                            for full_prediction, prediction in zip(sample_full, sample_targets)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,352 @@
+import asyncio
+import json
+import tempfile
+import threading
+import time
+import unittest
+from http import HTTPStatus
+from unittest import mock
+
+from src.serve.server import Histogram, MicroBatcher, RecServer
+from tests.tiny_models import tiny_dataset, build_tiny_checkpoint, tiny_rec_model
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_to_dict(self):
+
+        histogram = Histogram([1, 2, 5])
+        for value in [0.5, 1, 3, 10]:
+            histogram.observe(value)
+
+        histogram_dict = histogram.to_dict()
+
+        # buckets are cumulative, and upper bounds are inclusive
+        self.assertEqual(histogram_dict["buckets"], {"1": 2, "2": 2, "5": 3, "+Inf": 4})
+        self.assertEqual(histogram_dict["count"], 4)
+        self.assertEqual(histogram_dict["sum"], 14.5)
+        self.assertEqual(histogram_dict["mean"], 3.625)
+        self.assertEqual(histogram_dict["p50"], 1)
+        self.assertEqual(histogram_dict["p95"], 5)
+        self.assertEqual(histogram_dict["p99"], 5)
+
+    def test_quantile(self):
+
+        histogram = Histogram([1, 2, 5])
+        for value in [0.5, 1, 3, 10]:
+            histogram.observe(value)
+
+        # linear interpolation inside the bucket of the quantile
+        self.assertEqual(histogram.quantile(0.25), 0.5)
+        self.assertEqual(histogram.quantile(0.5), 1)
+        self.assertEqual(histogram.quantile(0.625), 3.5)
+        self.assertEqual(histogram.quantile(0.75), 5)
+
+        # quantiles in the last bucket are estimated with the largest upper bound
+        self.assertEqual(histogram.quantile(1), 5)
+
+        with self.assertRaises(ValueError):
+            histogram.quantile(0)
+        with self.assertRaises(ValueError):
+            histogram.quantile(1.5)
+
+    def test_empty(self):
+
+        histogram_dict = Histogram([1, 2, 5]).to_dict()
+
+        self.assertEqual(histogram_dict["buckets"], {"1": 0, "2": 0, "5": 0, "+Inf": 0})
+        self.assertEqual(histogram_dict["count"], 0)
+        self.assertIsNone(histogram_dict["mean"])
+        self.assertIsNone(histogram_dict["p50"])
+
+
+class TestMicroBatcher(unittest.TestCase):
+
+    @staticmethod
+    def submit_all(batcher: MicroBatcher, *keys_items: tuple) -> list:
+
+        async def submit_all():
+            batcher.start()
+            try:
+                return await asyncio.gather(*(batcher.submit(key, item) for key, item in keys_items),
+                                            return_exceptions=True)
+            finally:
+                await batcher.stop()
+
+        return asyncio.run(submit_all())
+
+    def test_coalescing(self):
+
+        batches = []
+
+        def process_fn(key, items):
+            batches.append((key, items))
+            return [f"{key}-{item}" for item in items]
+
+        # a full batch is processed without waiting for the max wait
+        batcher = MicroBatcher(process_fn, max_batch_size=4, max_wait_ms=10_000)
+
+        start = time.monotonic()
+        results = self.submit_all(batcher, *[("a", i) for i in range(4)])
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(results, ["a-0", "a-1", "a-2", "a-3"])
+        self.assertEqual(batches, [("a", [0, 1, 2, 3])])
+        self.assertEqual(batcher.batch_size_histogram.to_dict()["buckets"]["4"], 1)
+
+    def test_max_batch_size(self):
+
+        batches = []
+
+        def process_fn(key, items):
+            batches.append((key, items))
+            return items
+
+        batcher = MicroBatcher(process_fn, max_batch_size=2, max_wait_ms=10)
+        results = self.submit_all(batcher, *[("a", i) for i in range(5)])
+
+        self.assertEqual(results, [0, 1, 2, 3, 4])
+        self.assertEqual(batches, [("a", [0, 1]), ("a", [2, 3]), ("a", [4])])
+
+    def test_different_keys(self):
+
+        batches = []
+
+        def process_fn(key, items):
+            batches.append((key, items))
+            return items
+
+        # items with different keys are never processed together
+        batcher = MicroBatcher(process_fn, max_batch_size=4, max_wait_ms=10)
+        results = self.submit_all(batcher, ("a", 0), ("b", 1), ("a", 2))
+
+        self.assertEqual(results, [0, 1, 2])
+        self.assertCountEqual(batches, [("a", [0, 2]), ("b", [1])])
+
+    def test_max_wait(self):
+
+        processed_at = []
+
+        def process_fn(key, items):
+            processed_at.append(time.monotonic())
+            return items
+
+        # a batch which is not full is processed once its oldest item waited max_wait_ms
+        batcher = MicroBatcher(process_fn, max_batch_size=8, max_wait_ms=100)
+
+        start = time.monotonic()
+        results = self.submit_all(batcher, ("a", 0), ("a", 1))
+
+        self.assertEqual(results, [0, 1])
+        self.assertEqual(len(processed_at), 1)
+        self.assertGreaterEqual(processed_at[0] - start, 0.1)
+
+    def test_error_propagation(self):
+
+        n_calls = []
+        lock = threading.Lock()
+
+        def process_fn(key, items):
+            with lock:
+                n_calls.append(key)
+
+            if key == "wrong":
+                raise RuntimeError("batch failed")
+            return items
+
+        batcher = MicroBatcher(process_fn, max_batch_size=4, max_wait_ms=10)
+        results = self.submit_all(batcher, ("wrong", 0), ("wrong", 1), ("ok", 2))
+
+        # every item of the failed batch gets the error, while other batches are still processed
+        self.assertIsInstance(results[0], RuntimeError)
+        self.assertIs(results[0], results[1])
+        self.assertEqual(str(results[0]), "batch failed")
+        self.assertEqual(results[2], 2)
+        self.assertCountEqual(n_calls, ["wrong", "ok"])
+
+
+class TestRecServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.checkpoint_dir = tempfile.TemporaryDirectory()
+
+        cls.dataset = tiny_dataset()
+        build_tiny_checkpoint("T5Rec", cls.dataset, cls.checkpoint_dir.name)
+
+        cls.rec_model = tiny_rec_model("T5Rec", cls.dataset, cls.checkpoint_dir.name, candidate_scoring=True)
+
+        # user with the shortest history, so that there are enough items to sample the candidates from
+        test_set = cls.dataset.get_hf_datasets()["test"]
+        cls.sample = min(test_set, key=lambda sample: len(set(sample["input_item_seq"])))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.checkpoint_dir.cleanup()
+
+    @staticmethod
+    def route(server: RecServer, *requests: tuple[str, str, object]) -> list[tuple[HTTPStatus, dict]]:
+
+        async def route_all():
+            server.batcher.start()
+            try:
+                return [await server._route(method, path, payload if isinstance(payload, bytes)
+                                            else json.dumps(payload).encode("utf-8"))
+                        for method, path, payload in requests]
+            finally:
+                await server.batcher.stop()
+
+        return asyncio.run(route_all())
+
+    @staticmethod
+    def exchange(server: RecServer, raw_request: bytes) -> tuple[int, dict, bool]:
+
+        # raw request sent to the server through a real connection, returns status, payload and whether
+        # the server closed the connection after responding. The batcher is not started, so requests
+        # sent this way should never reach the model
+        async def send():
+            tcp_server = await asyncio.start_server(server._handle_connection, "127.0.0.1", 0)
+            try:
+                reader, writer = await asyncio.open_connection(*tcp_server.sockets[0].getsockname()[:2])
+                writer.write(raw_request)
+                await writer.drain()
+
+                status = int((await reader.readline()).split()[1])
+                headers = {}
+                while (line := await reader.readline()) != b"\r\n":
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                payload = json.loads(await reader.readexactly(int(headers["content-length"])))
+                closed = await reader.read() == b"" if headers["connection"] == "close" else False
+
+                writer.close()
+                return status, payload, closed
+            finally:
+                tcp_server.close()
+
+        return asyncio.run(send())
+
+    def test_direct_task(self):
+
+        server = RecServer(self.rec_model, max_wait_ms=1)
+        request = {"task": "P5EvalDirectTask", "template_id": "5-8",
+                   "user_id": self.sample["user_id"], "user_name": self.sample["user_name"],
+                   "input_item_seq": self.sample["input_item_seq"]}
+
+        [(missing_status, missing_response), (status, response)] = self.route(
+            server,
+            ("POST", "/recommend", request),
+            ("POST", "/recommend", {**request, "gt_item": self.sample["gt_item"]})
+        )
+
+        # the target item is listed among the candidates of the prompt, so it is required
+        self.assertEqual(missing_status, HTTPStatus.BAD_REQUEST)
+        self.assertIn("gt_item", missing_response["error"])
+
+        self.assertEqual(status, HTTPStatus.OK, response)
+        self.assertTrue(len(response["recommendations"]) > 0)
+        self.assertTrue(set(response["recommendations"]).issubset(self.dataset.all_items))
+        self.assertNotIn("", response["recommendations"])
+
+    def test_route(self):
+
+        server = RecServer(self.rec_model, max_wait_ms=1)
+        request = {"task": "SequentialSideInfoTask", "template_id": 0,
+                   "user_id": self.sample["user_id"], "input_item_seq": self.sample["input_item_seq"],
+                   "input_categories_seq": self.sample["input_categories_seq"]}
+
+        with mock.patch.object(server, "parse_request", wraps=server.parse_request) as parse_request:
+            responses = self.route(
+                server,
+                ("GET", "/health", b""),
+                ("POST", "/recommend", request),
+                ("GET", "/metrics", b""),
+                ("GET", "/unknown", b"")
+            )
+
+        # the request is validated only once
+        parse_request.assert_called_once_with(request)
+
+        [(health_status, health), (status, response), (metrics_status, metrics), (not_found_status, _)] = responses
+
+        self.assertEqual((health_status, health), (HTTPStatus.OK, {"status": "ok"}))
+
+        self.assertEqual(status, HTTPStatus.OK, response)
+        self.assertEqual(response["user_id"], self.sample["user_id"])
+        self.assertEqual(response["task"], "SequentialSideInfoTask")
+        self.assertEqual(len(response["recommendations"]), self.rec_model.model.generation_config.num_return_sequences)
+
+        self.assertEqual(metrics_status, HTTPStatus.OK)
+        self.assertEqual(metrics["latency_seconds"]["count"], 1)
+        self.assertEqual(metrics["batch_size"]["count"], 1)
+        self.assertIsNone(metrics["cache"])
+
+        self.assertEqual(not_found_status, HTTPStatus.NOT_FOUND)
+
+    def test_route_bad_request(self):
+
+        server = RecServer(self.rec_model, max_wait_ms=1)
+        bad_requests = [
+            b"{not json",
+            [1, 2],
+            {"user_id": self.sample["user_id"]},
+            {"task": "UnknownTask", "user_id": self.sample["user_id"]},
+            {"task": "SequentialSideInfoTask", "template_id": "unknown", "user_id": self.sample["user_id"]},
+            {"task": "SequentialSideInfoTask", "user_id": self.sample["user_id"]},
+        ]
+
+        responses = self.route(server, *[("POST", "/recommend", bad_request) for bad_request in bad_requests])
+
+        for status, response in responses:
+            self.assertEqual(status, HTTPStatus.BAD_REQUEST)
+            self.assertIn("error", response)
+
+        # invalid requests never reach the model
+        self.assertEqual(server.batcher.batch_size_histogram.count, 0)
+        self.assertEqual(server.latency_histogram.count, 0)
+
+    def test_invalid_content_length(self):
+
+        for content_length in ["not a number", "-5", "1.5"]:
+            with self.subTest(content_length=content_length):
+                server = RecServer(self.rec_model, max_wait_ms=1)
+
+                status, response, closed = self.exchange(
+                    server, f"POST /recommend HTTP/1.1\r\nContent-Length: {content_length}\r\n\r\n{{}}".encode()
+                )
+
+                self.assertEqual(status, HTTPStatus.BAD_REQUEST)
+                self.assertIn("Content-Length", response["error"])
+                self.assertTrue(closed)
+
+    def test_body_too_large(self):
+
+        server = RecServer(self.rec_model, max_wait_ms=1, max_body_bytes=16)
+
+        # the body is rejected without reading it
+        status, response, closed = self.exchange(
+            server, b"POST /recommend HTTP/1.1\r\nContent-Length: 1000000\r\n\r\n{"
+        )
+
+        self.assertEqual(status, HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        self.assertIn("16 bytes", response["error"])
+        self.assertTrue(closed)
+
+        # a body within the limit is read and routed as usual
+        body = b"[1, 2]"
+        status, response, closed = self.exchange(
+            server, b"POST /recommend HTTP/1.1\r\nContent-Length: 6\r\nConnection: close\r\n\r\n" + body
+        )
+
+        self.assertEqual(status, HTTPStatus.BAD_REQUEST)
+        self.assertNotIn("Content-Length", response["error"])
+
+        status, response, closed = self.exchange(server, b"GET /health HTTP/1.1\r\n\r\n")
+
+        self.assertEqual((status, response), (HTTPStatus.OK, {"status": "ok"}))
+        self.assertFalse(closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from src import ROOT_PATH
+
+# max seconds spent importing modules when only validating a config
+IMPORT_TIME_BUDGET_S = 5.
+
+# modules which are not needed to validate a config, thus they must never be imported to do so
+LAZY_MODULES = {"wandb", "yaspin", "gdown", "datasets", "src.data.main", "src.model.main", "src.model.trainer",
+                "src.evaluate.main", "src.evaluate.evaluator", "src.serve.main", "onnxruntime"}
+
+CONFIG = """
+exp_name: exp_name
+device: cpu
+data:
+  AmazonDataset:
+    dataset_name: toys
+model:
+  T5Rec:
+    name_or_path: google/flan-t5-small
+  train_tasks:
+    - SequentialSideInfoTask
+eval:
+  eval_tasks:
+    SequentialSideInfoTask:
+      - hit@10
+"""
+
+
+def run_with_importtime(*cli_args: str) -> tuple[subprocess.CompletedProcess, dict[str, float]]:
+    """
+    Runs anonLLM.py with `python -X importtime` and returns the completed process together with a dict
+    containing, for each module imported at top level, the cumulative seconds spent importing it
+    """
+
+    completed_process = subprocess.run([sys.executable, "-X", "importtime", "anonLLM.py", *cli_args],
+                                       cwd=ROOT_PATH, capture_output=True, text=True)
+
+    # each line is "import time: self [us] | cumulative | imported package", nested imports are indented
+    top_level_imports = {}
+    for line in completed_process.stderr.splitlines():
+        if not line.startswith("import time:") or line.endswith("imported package"):
+            continue
+
+        _, cumulative_us, module_name = line.split("|")
+        if not module_name.startswith("  "):
+            top_level_imports[module_name.strip()] = int(cumulative_us) / 1e6
+
+    return completed_process, top_level_imports
+
+
+def imported_modules(completed_process: subprocess.CompletedProcess) -> set[str]:
+    return {line.split("|")[-1].strip() for line in completed_process.stderr.splitlines()
+            if line.startswith("import time:")}
+
+
+class TestCliStartup(unittest.TestCase):
+
+    def test_help(self):
+
+        completed_process, _ = run_with_importtime("--help")
+
+        self.assertEqual(completed_process.returncode, 0)
+
+        # no heavy module is imported just to print the help
+        self.assertNotIn("torch", imported_modules(completed_process))
+        self.assertNotIn("transformers", imported_modules(completed_process))
+
+    def test_conflicting_modes(self):
+
+        conflicting_modes = [("--serve", "--predict"), ("--export", "--quantize", "int8"),
+                             ("--compare-with", "other", "--serve")]
+
+        for modes in conflicting_modes:
+            with self.subTest(modes=modes):
+                completed_process, _ = run_with_importtime("-c", "params.yml", *modes)
+
+                # rejected by argparse, before importing any heavy module
+                self.assertEqual(completed_process.returncode, 2)
+                self.assertIn("not allowed with argument", completed_process.stderr)
+                self.assertNotIn("torch", imported_modules(completed_process))
+
+    def test_validate_config(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config_path = os.path.join(tmp_dir, "params.yml")
+            with open(config_path, "w") as f:
+                f.write(CONFIG)
+
+            completed_process, top_level_imports = run_with_importtime("-c", config_path, "--validate-config")
+
+        self.assertEqual(completed_process.returncode, 0, msg=completed_process.stderr[-2000:])
+        self.assertIn("is valid", completed_process.stdout)
+
+        self.assertEqual(LAZY_MODULES & imported_modules(completed_process), set())
+
+        import_time = sum(top_level_imports.values())
+        slowest_imports = sorted(top_level_imports.items(), key=lambda module_time: module_time[1], reverse=True)
+        self.assertLess(import_time, IMPORT_TIME_BUDGET_S,
+                        msg=f"Validating a config spent {import_time:.2f}s importing modules, slowest imports: "
+                            f"{slowest_imports[:5]}")
+
+    def test_validate_invalid_config(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config_path = os.path.join(tmp_dir, "params.yml")
+            with open(config_path, "w") as f:
+                f.write(CONFIG.replace("T5Rec", "NotExistingModel"))
+
+            completed_process, _ = run_with_importtime("-c", config_path, "--validate-config")
+
+        self.assertNotEqual(completed_process.returncode, 0)
+        self.assertNotIn("is valid", completed_process.stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import json
+import os
+import tempfile
+import unittest
+
+import torch
+
+from src.instrumentation import Instrumentation
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.instrumentation = Instrumentation()
+        self.instrumentation.enable()
+
+    def test_disabled(self):
+
+        self.instrumentation.disable()
+
+        @self.instrumentation.instrumented("decorated_stage")
+        def decorated_fn(x):
+            return x + 1
+
+        with self.instrumentation.stage("stage") as record:
+            record.count(n_samples=10)
+
+        self.assertEqual(decorated_fn(1), 2)
+        self.assertEqual(self.instrumentation.summary(), {})
+
+    def test_stage(self):
+
+        for _ in range(3):
+            with self.instrumentation.stage("stage") as record:
+                record.count(n_samples=2, attention_mask=[[1, 1, 1], [1]])
+
+        stage_summary = self.instrumentation.summary()["stage"]
+
+        self.assertEqual(stage_summary["n_calls"], 3)
+        self.assertEqual(stage_summary["n_samples"], 6)
+        self.assertEqual(stage_summary["n_tokens"], 12)
+        # masks in list format are unpadded
+        self.assertEqual(stage_summary["padding_ratio"], 0)
+        self.assertGreater(stage_summary["wall_time_s"], 0)
+        self.assertGreater(stage_summary["peak_rss_mb"], 0)
+
+    def test_stage_exception(self):
+
+        # the call is recorded even if the stage fails
+        with self.assertRaises(ValueError):
+            with self.instrumentation.stage("stage"):
+                raise ValueError
+
+        self.assertEqual(self.instrumentation.summary()["stage"]["n_calls"], 1)
+
+    def test_instrumented(self):
+
+        @self.instrumentation.instrumented("prepare", count_from="output", attention_mask_key="attention_mask")
+        def prepare(batch: dict) -> dict:
+            return {"attention_mask": torch.tensor([[1, 1, 1, 1], [1, 1, 0, 0]])}
+
+        @self.instrumentation.instrumented("step", count_from="input", attention_mask_key="attention_mask")
+        def step(batch: dict):
+            # the input is counted before the call, even if it's modified
+            batch.pop("attention_mask")
+
+        prepared_batch = prepare({})
+        step(prepared_batch)
+
+        summary = self.instrumentation.summary()
+        for stage_name in ("prepare", "step"):
+            self.assertEqual(summary[stage_name]["n_samples"], 2)
+            self.assertEqual(summary[stage_name]["n_tokens"], 6)
+            self.assertEqual(summary[stage_name]["padding_ratio"], 0.25)
+
+        with self.assertRaises(ValueError):
+            self.instrumentation.instrumented("stage", count_from="not_valid")
+
+    def test_since_snapshot(self):
+
+        with self.instrumentation.stage("first_stage") as record:
+            record.count(n_samples=5)
+
+        snapshot = self.instrumentation.snapshot()
+
+        with self.instrumentation.stage("first_stage") as record:
+            record.count(n_samples=3)
+        with self.instrumentation.stage("second_stage"):
+            pass
+
+        summary_since = self.instrumentation.summary(since=snapshot)
+        self.assertEqual(summary_since["first_stage"]["n_calls"], 1)
+        self.assertEqual(summary_since["first_stage"]["n_samples"], 3)
+        self.assertEqual(summary_since["second_stage"]["n_calls"], 1)
+
+        self.assertEqual(self.instrumentation.summary()["first_stage"]["n_samples"], 8)
+
+        wandb_dict = self.instrumentation.to_wandb_dict(since=snapshot)
+        self.assertEqual(wandb_dict["instrumentation/first_stage/n_samples"], 3)
+        # stats which can't be computed are not logged
+        self.assertNotIn("instrumentation/second_stage/samples_per_s", wandb_dict)
+
+    def test_save(self):
+
+        with self.instrumentation.stage("stage") as record:
+            record.count(n_samples=1)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, "instrumentation", "exp_name.json")
+            self.instrumentation.save(output_path)
+
+            with open(output_path) as f:
+                saved = json.load(f)
+
+        self.assertEqual(saved["stages"], self.instrumentation.summary())
+        self.assertEqual(saved["raw_stats"]["stage"]["n_samples"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,291 @@
+import os
+import random
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+
+from src.utils import (AsyncWandbLogger, BackgroundWorker, RunningMean, atomic_torch_save, get_rng_state,
+                       set_rng_state, get_world_size, get_rank, is_main_process, barrier, broadcast_object,
+                       gather_objects, any_process, min_across_processes)
+from tests.distributed import run_distributed
+
+
+def _collectives(rank: int, results_dir: str):
+
+    running_mean = RunningMean()
+    for value in range(rank + 1):
+        running_mean.update(torch.tensor(float(value)))
+
+    results = {
+        "world_size": get_world_size(),
+        "rank": get_rank(),
+        "is_main_process": is_main_process(),
+        "broadcast": broadcast_object({"from_rank": rank}),
+        "gathered": gather_objects(f"rank {rank}"),
+        "any_true": any_process(rank == 1),
+        "any_false": any_process(False),
+        "min": min_across_processes(10 - rank),
+        "local_mean": running_mean.flush(),
+        "synchronized_mean": running_mean.flush(synchronize=True)
+    }
+
+    barrier()
+
+    torch.save(results, os.path.join(results_dir, f"rank_{rank}.pth"))
+
+
+class TestAtomicTorchSave(unittest.TestCase):
+
+    def test_save(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "checkpoint.pth")
+
+            atomic_torch_save({"weights": torch.arange(5)}, path)
+
+            torch.testing.assert_close(torch.load(path)["weights"], torch.arange(5))
+
+            # the temporary file is renamed, not left alongside the saved one
+            self.assertEqual(os.listdir(tmp_dir), ["checkpoint.pth"])
+
+    def test_interrupted_save(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "checkpoint.pth")
+
+            atomic_torch_save({"weights": torch.arange(5)}, path)
+
+            # the process is killed while writing the new checkpoint: the previous one is still valid
+            with mock.patch("torch.save", side_effect=KeyboardInterrupt):
+                with self.assertRaises(KeyboardInterrupt):
+                    atomic_torch_save({"weights": torch.arange(10)}, path)
+
+            torch.testing.assert_close(torch.load(path)["weights"], torch.arange(5))
+
+
+class TestRngState(unittest.TestCase):
+
+    @staticmethod
+    def _draw() -> tuple:
+        return random.random(), np.random.rand(), torch.rand(1).item()
+
+    def test_round_trip(self):
+
+        rng_state = get_rng_state()
+        expected_draws = [self._draw() for _ in range(3)]
+
+        set_rng_state(rng_state)
+        self.assertEqual([self._draw() for _ in range(3)], expected_draws)
+
+    def test_state_is_a_copy(self):
+
+        rng_state = get_rng_state()
+        expected_draw = self._draw()
+
+        # drawing after saving the state doesn't change it, so it can be restored more than once
+        self._draw()
+        set_rng_state(rng_state)
+        self.assertEqual(self._draw(), expected_draw)
+
+        set_rng_state(rng_state)
+        self.assertEqual(self._draw(), expected_draw)
+
+
+class TestBackgroundWorker(unittest.TestCase):
+
+    def test_jobs_in_submission_order(self):
+
+        worker = BackgroundWorker()
+        results = []
+
+        # the first job is the slowest one, but the others wait for it
+        release = threading.Event()
+        worker.submit(lambda: (release.wait(), results.append(0)))
+        for i in range(1, 5):
+            worker.submit(results.append, i)
+
+        self.assertEqual(results, [])
+        release.set()
+
+        worker.join()
+        self.assertEqual(results, [0, 1, 2, 3, 4])
+
+        # the worker can still be used after join
+        worker.submit(results.append, 5)
+        worker.close()
+        self.assertEqual(results, [0, 1, 2, 3, 4, 5])
+
+    def test_error_raised_on_join(self):
+
+        worker = BackgroundWorker()
+        results = []
+
+        def failing_job():
+            raise ValueError("job failed")
+
+        worker.submit(failing_job)
+        worker.submit(results.append, 1)
+
+        with self.assertRaisesRegex(ValueError, "job failed"):
+            worker.join()
+
+        # jobs submitted after the failing one are discarded
+        self.assertEqual(results, [])
+
+        worker.close()
+
+    def test_error_raised_on_close(self):
+
+        worker = BackgroundWorker()
+
+        worker.submit(int, "not a number")
+
+        with self.assertRaises(ValueError):
+            worker.close()
+
+
+
+class TestAsyncWandbLogger(unittest.TestCase):
+
+    def test_close_drains_logs(self):
+
+        fake_wandb = mock.Mock()
+
+        # the first log is slow to be sent, close waits for all of them anyway
+        release = threading.Event()
+        fake_wandb.log.side_effect = lambda parameters: release.wait() if parameters["step"] == 0 else None
+
+        with mock.patch.dict(sys.modules, {"wandb": fake_wandb}):
+            logger = AsyncWandbLogger(should_log=True)
+            for step in range(5):
+                logger.log({"step": step})
+
+            threading.Timer(0.1, release.set).start()
+            logger.close()
+
+        self.assertEqual(fake_wandb.log.call_args_list, [mock.call({"step": step}) for step in range(5)])
+
+    def test_worker_error_raised_on_close(self):
+
+        fake_wandb = mock.Mock()
+        fake_wandb.log.side_effect = ConnectionError("wandb unreachable")
+
+        with mock.patch.dict(sys.modules, {"wandb": fake_wandb}):
+            with self.assertRaisesRegex(ConnectionError, "wandb unreachable"):
+                with AsyncWandbLogger(should_log=True) as logger:
+                    logger.log({"train/loss": 1.})
+
+    def test_should_log_false(self):
+
+        fake_wandb = mock.Mock()
+
+        with mock.patch.dict(sys.modules, {"wandb": fake_wandb}):
+            with AsyncWandbLogger(should_log=False) as logger:
+                logger.log({"train/loss": 1.})
+
+        fake_wandb.log.assert_not_called()
+
+
+class TestRunningMean(unittest.TestCase):
+
+    def test_update(self):
+
+        running_mean = RunningMean()
+        running_mean.update(torch.tensor(1.))
+        running_mean.update(torch.tensor(2.))
+
+        self.assertAlmostEqual(running_mean.flush(), 1.5)
+
+    def test_update_with_count(self):
+
+        running_mean = RunningMean()
+
+        # the sum of 3 values accumulated elsewhere, plus a single value
+        running_mean.update(torch.tensor(6.), count=3)
+        running_mean.update(torch.tensor(4.))
+
+        self.assertEqual(running_mean.count, 4)
+        self.assertAlmostEqual(running_mean.flush(), 2.5)
+
+    def test_empty(self):
+        self.assertEqual(RunningMean().flush(), 0.)
+        self.assertEqual(RunningMean().flush(synchronize=True), 0.)
+
+    def test_graph_not_kept(self):
+
+        value = torch.tensor(2., requires_grad=True)
+
+        running_mean = RunningMean()
+        running_mean.update(value * 2)
+
+        self.assertFalse(running_mean.total.requires_grad)
+
+    def test_resumed_state(self):
+
+        running_mean = RunningMean()
+        running_mean.update(torch.tensor(1.))
+        running_mean.update(torch.tensor(3.))
+
+        # the (total, count) state is saved in checkpoints, and restored when training is resumed
+        resumed_mean = RunningMean()
+        resumed_mean.total, resumed_mean.count = running_mean.total, running_mean.count
+        resumed_mean.update(torch.tensor(5.))
+
+        self.assertAlmostEqual(resumed_mean.flush(), 3.)
+
+        # the state saved at the end of an epoch is empty
+        resumed_mean = RunningMean()
+        resumed_mean.total, resumed_mean.count = None, 0
+        resumed_mean.update(torch.tensor(5.))
+
+        self.assertAlmostEqual(resumed_mean.flush(), 5.)
+
+
+
+class TestCollectives(unittest.TestCase):
+
+    def test_single_process(self):
+
+        self.assertEqual(get_world_size(), 1)
+        self.assertEqual(get_rank(), 0)
+        self.assertTrue(is_main_process())
+
+        barrier()
+        self.assertEqual(broadcast_object("obj"), "obj")
+        self.assertEqual(gather_objects("obj"), ["obj"])
+        self.assertTrue(any_process(True))
+        self.assertFalse(any_process(False))
+        self.assertEqual(min_across_processes(3), 3)
+
+    def test_two_processes(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            run_distributed(_collectives, 2, tmp_dir)
+
+            results = [torch.load(os.path.join(tmp_dir, f"rank_{rank}.pth"), weights_only=False)
+                       for rank in range(2)]
+
+        for rank, rank_results in enumerate(results):
+            self.assertEqual(rank_results["world_size"], 2)
+            self.assertEqual(rank_results["rank"], rank)
+            self.assertEqual(rank_results["is_main_process"], rank == 0)
+
+            self.assertEqual(rank_results["broadcast"], {"from_rank": 0})
+            self.assertEqual(rank_results["gathered"], ["rank 0", "rank 1"])
+            self.assertTrue(rank_results["any_true"])
+            self.assertFalse(rank_results["any_false"])
+            self.assertEqual(rank_results["min"], 9)
+
+            # rank 0 accumulated [0], rank 1 accumulated [0, 1]
+            self.assertAlmostEqual(rank_results["synchronized_mean"], 1 / 3)
+
+        self.assertEqual([rank_results["local_mean"] for rank_results in results], [0., 0.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
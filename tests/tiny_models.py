@@ -0,0 +1,38 @@
+from __future__ import annotations
+
+from benchmarks.synthetic_amazon import build_tiny_model
+from src.data.abstract_task import AnonTask
+from src.data.datasets.synthetic_dataset import SyntheticDataset
+from src.model import AnonModel
+
+
+def tiny_dataset(n_users: int = 20, n_items: int = 150, n_interactions: int = 1500) -> SyntheticDataset:
+    # enough items so that tasks listing 100 candidates (e.g. P5EvalDirectTask) can be rendered
+    return SyntheticDataset(n_users=n_users, n_items=n_items, n_interactions=n_interactions, seed=0)
+
+
+def build_tiny_checkpoint(model_cls_name: str, dataset: SyntheticDataset, output_dir: str) -> str:
+    """
+    Saves into `output_dir` a randomly initialized tiny model (with its tokenizer trained on ids and metadata of
+    `dataset` and on the templates of all tasks), to pass as `name_or_path` to `model_cls_name`
+    """
+
+    corpus = [" ".join(dataset.all_items.tolist()), " ".join(dataset.all_users.tolist())]
+    corpus.extend(f"{item_meta['title']} {' '.join(item_meta['categories'])}"
+                  for item_meta in dataset.items_meta_dict.values())
+    corpus.extend(f"{input_text} {target_text}"
+                  for task_cls in AnonTask.all_tasks_available()
+                  for input_text, target_text in task_cls.templates_dict.values())
+
+    return build_tiny_model(output_dir, model_cls_name, corpus, d_model=32, n_layers=1, vocab_size=1000)
+
+
+def tiny_rec_model(model_cls_name: str, dataset: SyntheticDataset, checkpoint_dir: str, **model_kwargs) -> AnonModel:
+
+    model_kwargs = {"training_tasks_str": ["SequentialSideInfoTask"], "eval_task_str": "SequentialSideInfoTask",
+                    "num_beams": 2, "num_return_sequences": 2, "max_new_tokens": 5, **model_kwargs}
+
+    rec_model = AnonModel.from_string(model_cls_name, dataset, name_or_path=checkpoint_dir, **model_kwargs)
+    rec_model.eval()
+
+    return rec_model